@@ -0,0 +1,105 @@
+"""
+Benchmarks for share placement and servers-of-happiness on synthetic grids.
+
+These need no running grid, so they ignore --number-of-nodes:
+
+$ systemd-run --user --scope pytest benchmarks/test_happiness.py
+"""
+
+from random import Random
+
+import pytest
+
+from allmydata.immutable.happiness_upload import ShareMatching, share_placement
+from allmydata.util.happinessutil import servers_of_happiness
+
+GRID_SIZES = [10, 30, 100, 300, 1000]
+
+
+def synthetic_grid(num_servers, total_shares, readonly_fraction=0.1,
+                   holding_fraction=0.2, seed=0):
+    """
+    Make up a grid in which some servers are read-only and some already
+    hold a few shares of the file, as they would after a partial upload or
+    a repair.
+
+    :return: (peers, readonly_peers, shares, peers_to_shares)
+    """
+    rng = Random(seed)
+    peers = {"server{}".format(i) for i in range(num_servers)}
+    shares = set(range(total_shares))
+    readonly_peers = {
+        peer for peer in peers if rng.random() < readonly_fraction
+    }
+    peers_to_shares = {}
+    for peer in sorted(peers):
+        if rng.random() < holding_fraction:
+            peers_to_shares[peer] = set(
+                rng.sample(sorted(shares), rng.randint(1, 3))
+            )
+    return (peers, readonly_peers, shares, peers_to_shares)
+
+
+def _total_shares(num_servers):
+    # Enough shares that every server could hold one, up to the largest
+    # number zfec allows.
+    return min(num_servers, 255)
+
+
+@pytest.mark.parametrize("num_servers", GRID_SIZES)
+def test_share_placement(num_servers, tahoe_benchmarker, capsys):
+    """
+    Compute the share placement for an upload to a grid where some servers
+    already hold shares.
+    """
+    grid = synthetic_grid(num_servers, _total_shares(num_servers))
+    with tahoe_benchmarker.record(
+        capsys, "share-placement-10-times", num_servers=num_servers
+    ):
+        for i in range(10):
+            placements = share_placement(*grid)
+    assert set(placements) == grid[2]
+
+
+@pytest.mark.parametrize("num_servers", GRID_SIZES)
+def test_servers_of_happiness(num_servers, tahoe_benchmarker, capsys):
+    """
+    Compute servers-of-happiness of a layout in which every share is held by
+    several servers, as the checker does for a well-spread file.
+    """
+    rng = Random(0)
+    total_shares = _total_shares(num_servers)
+    servers = ["server{}".format(i) for i in range(num_servers)]
+    sharemap = {
+        shnum: set(rng.sample(servers, min(3, num_servers)))
+        for shnum in range(total_shares)
+    }
+    with tahoe_benchmarker.record(
+        capsys, "servers-of-happiness-10-times", num_servers=num_servers
+    ):
+        for i in range(10):
+            happiness = servers_of_happiness(sharemap)
+    assert happiness <= total_shares
+
+
+@pytest.mark.parametrize("num_servers", GRID_SIZES)
+def test_incremental_happiness(num_servers, tahoe_benchmarker, capsys):
+    """
+    Keep servers-of-happiness up to date as each server's answer arrives, as
+    the uploader does during server selection.
+    """
+    (peers, readonly_peers, shares, peers_to_shares) = synthetic_grid(
+        num_servers, _total_shares(num_servers)
+    )
+    answers = [
+        (peer, peers_to_shares.get(peer, set())) for peer in sorted(peers)
+    ]
+    with tahoe_benchmarker.record(
+        capsys, "incremental-happiness", num_servers=num_servers
+    ):
+        matching = ShareMatching()
+        for (peer, held) in answers:
+            matching.add_server(peer, held)
+    assert matching.size() == ShareMatching.from_servermap(
+        peers_to_shares
+    ).size()
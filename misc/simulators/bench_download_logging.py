@@ -0,0 +1,56 @@
+"""
+Measure immutable download throughput from an in-process grid, with the
+downloader's NOISY log events generated, and with them suppressed by a
+``tahoe.immutable.download`` threshold of OPERATIONAL (as set by
+``[logging]threshold.tahoe.immutable.download = OPERATIONAL`` in tahoe.cfg).
+
+python bench_download_logging.py [MiB]
+"""
+
+import sys, tempfile, shutil, time
+
+from twisted.internet import defer, task
+
+from allmydata.immutable import upload
+from allmydata.util import log
+from allmydata.util.consumer import download_to_data
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+from allmydata.test.no_network import NoNetworkGrid
+
+RUNS = 3
+
+@defer.inlineCallbacks
+def main(reactor, size):
+    basedir = tempfile.mkdtemp()
+    port_assigner = SameProcessStreamEndpointAssigner()
+    port_assigner.setUp()
+    grid = NoNetworkGrid(basedir, num_clients=1, num_servers=10,
+                         client_config_hooks={}, port_assigner=port_assigner)
+    grid.startService()
+    try:
+        grid._check_clients()
+        c = grid.clients[0]
+        data = b"a" * size
+        ur = yield c.upload(upload.Data(data, convergence=None))
+        node = c.create_node_from_uri(ur.get_uri())
+        for (name, threshold) in [("logging on (NOISY)", log.NOISY),
+                                  ("logging off (OPERATIONAL)", log.OPERATIONAL)]:
+            log.set_threshold(threshold, "tahoe.immutable.download")
+            times = []
+            for i in range(RUNS):
+                start = time.perf_counter()
+                got = yield download_to_data(node)
+                times.append(time.perf_counter() - start)
+                assert got == data
+            best = min(times)
+            print("%-26s best of %d: %6.3fs, %7.2f MiB/s"
+                  % (name, RUNS, best, size / best / 2**20))
+    finally:
+        log.reset_thresholds()
+        yield grid.stopService()
+        port_assigner.tearDown()
+        shutil.rmtree(basedir)
+
+if __name__ == "__main__":
+    mib = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    task.react(main, (mib * 2**20,))
@@ -0,0 +1,39 @@
+"""
+Measure how long it takes to build a complete Merkle hash tree, and to
+validate all of its nodes in an IncompleteHashTree, for trees with up to a
+million leaves (a file of 128GiB with the default 128KiB segment size).
+
+python bench_hashtree.py
+"""
+
+from pyutil import benchutil
+
+from allmydata import hashtree
+from allmydata.util.hashutil import tagged_hash
+
+class B:
+    def init(self, N):
+        self.leaves = [tagged_hash(b"tag", b"%d" % i) for i in range(N)]
+
+    def build(self, N):
+        self.ht = hashtree.HashTree(self.leaves)
+
+    def init_check(self, N):
+        self.init(N)
+        self.build(N)
+        self.iht = hashtree.IncompleteHashTree(N)
+
+    def check(self, N):
+        self.iht.set_hashes(hashes=dict(enumerate(self.ht)))
+
+benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
+print("(microseconds per leaf)")
+
+b = B()
+for (name, func, initfunc) in [("HashTree", b.build, b.init),
+                               ("IncompleteHashTree.set_hashes", b.check, b.init_check)]:
+    print(name)
+    for N in [1000, 10000, 100000, 1000000]:
+        print("%7d" % N, end=' ')
+        benchutil.rep_bench(func, N, initfunc=initfunc, runreps=1, runiters=3,
+                            UNITS_PER_SECOND=1000000)
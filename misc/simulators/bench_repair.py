@@ -0,0 +1,79 @@
+"""
+Compare the traffic of a full immutable repair (a new upload of the whole
+file) with that of a targeted repair (which uploads only the missing
+shares), after one share of a 3-of-10 file has been lost, on an in-process
+grid of ten servers.
+
+python bench_repair.py [MiB]
+"""
+
+import os, sys, tempfile, shutil, time
+
+from twisted.internet import defer, task
+
+from allmydata.immutable import upload
+from allmydata.immutable.repairer import Repairer
+from allmydata.monitor import Monitor
+from allmydata.storage.common import storage_index_to_dir
+from allmydata.storage.immutable import BucketReader
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+from allmydata.test.no_network import NoNetworkGrid
+
+read_bytes = [0]
+_original_read = BucketReader.read
+def _counting_read(self, offset, length):
+    data = _original_read(self, offset, length)
+    read_bytes[0] += len(data)
+    return data
+BucketReader.read = _counting_read
+
+def share_files(grid, si):
+    files = set()
+    for ss in grid.servers_by_number.values():
+        d = os.path.join(ss.sharedir, storage_index_to_dir(si))
+        if os.path.exists(d):
+            files.update(os.path.join(d, f) for f in os.listdir(d))
+    return files
+
+@defer.inlineCallbacks
+def repair(grid, c, size, targeted):
+    ur = yield c.upload(upload.Data(os.urandom(size), convergence=None))
+    node = c.create_node_from_uri(ur.get_uri())
+    si = node.get_storage_index()
+    before = share_files(grid, si)
+    os.unlink(sorted(before)[0])
+    before = share_files(grid, si)
+    cr = yield node.check(Monitor())
+    read_bytes[0] = 0
+    start = time.perf_counter()
+    r = Repairer(node._cnode, c.get_storage_broker(), c._secret_holder,
+                 Monitor(), check_results=cr if targeted else None)
+    yield r.start()
+    elapsed = time.perf_counter() - start
+    uploaded = sum(os.stat(f).st_size for f in share_files(grid, si) - before)
+    return (read_bytes[0], uploaded, elapsed)
+
+@defer.inlineCallbacks
+def main(reactor, size):
+    basedir = tempfile.mkdtemp()
+    port_assigner = SameProcessStreamEndpointAssigner()
+    port_assigner.setUp()
+    grid = NoNetworkGrid(basedir, num_clients=1, num_servers=10,
+                         client_config_hooks={}, port_assigner=port_assigner)
+    grid.startService()
+    try:
+        grid._check_clients()
+        c = grid.clients[0]
+        print("file size %d bytes, 3-of-10, one share lost" % (size,))
+        for (name, targeted) in [("full", False), ("targeted", True)]:
+            (down, up, elapsed) = yield repair(grid, c, size, targeted)
+            print("%-9s repair: downloaded %9d bytes, uploaded %9d bytes,"
+                  " %6.3fs" % (name, down, up, elapsed))
+    finally:
+        yield grid.stopService()
+        port_assigner.tearDown()
+        shutil.rmtree(basedir)
+
+if __name__ == "__main__":
+    mib = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    task.react(main, (mib * 2**20,))
@@ -7,13 +7,18 @@ wget http://tahoe-lafs.org/trac/tahoe-lafs/raw-attachment/ticket/1170/run-112-ab
 And run this command passing that trace file's name:
 
 python bench_spans.py run-112-above28-flog-dump-sh8-on-nsziz.txt
+
+Without a trace file, a synthetic workload is run instead: N fragments are
+added in a shuffled order, leaving gaps between them, and then read back and
+popped. This shows how the cost per operation grows with the number of
+fragments held at once.
 """
 
 from pyutil import benchutil
 
 from allmydata.util.spans import DataSpans
 
-import re, sys
+import random, re, sys
 
 DUMP_S='_received spans trace .dump()'
 GET_R=re.compile('_received spans trace .get\(([0-9]*), ([0-9]*)\)')
@@ -46,7 +51,7 @@ class B:
                 mo = ADD_R.search(inline)
                 start = int(mo.group(1))
                 length = int(mo.group(2))
-                self.s.add(start, 'x'*length)
+                self.s.add(start, b'x'*length)
                 # self.stats['add'] = self.stats.get('add', 0) + 1
             elif GET_R.search(inline):
                 mo = GET_R.search(inline)
@@ -75,11 +80,38 @@ class B:
 
         # print(self.stats)
 
+class Fragments:
+    """Hold N fragments at once, as a downloader does when many small
+    responses arrive out of order."""
+    FRAGMENT = 32
+    GAP = 8
+
+    def init(self, N):
+        step = self.FRAGMENT + self.GAP
+        self.starts = [i*step for i in range(N)]
+        random.Random(N).shuffle(self.starts)
+        self.s = DataSpans()
+
+    def run(self, N):
+        data = b'x'*self.FRAGMENT
+        for start in self.starts:
+            self.s.add(start, data)
+            self.s.len()
+        for start in self.starts:
+            self.s.get(start, self.FRAGMENT)
+        for start in self.starts:
+            self.s.pop(start, self.FRAGMENT)
+
 benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
 print("(microseconds)")
 
-for N in [600, 6000, 60000]:
-    b = B(open(sys.argv[1], 'rU'))
-    print("%7d" % N, end=' ')
-    benchutil.rep_bench(b.run, N, b.init, UNITS_PER_SECOND=1000000)
-
+if len(sys.argv) > 1:
+    for N in [600, 6000, 60000]:
+        b = B(open(sys.argv[1], 'r'))
+        print("%7d" % N, end=' ')
+        benchutil.rep_bench(b.run, N, initfunc=b.init, runreps=1, UNITS_PER_SECOND=1000000)
+else:
+    for N in [100, 1000, 10000]:
+        f = Fragments()
+        print("%7d" % N, end=' ')
+        benchutil.rep_bench(f.run, N, initfunc=f.init, runreps=1, UNITS_PER_SECOND=1000000)
@@ -0,0 +1 @@
+Large convergent uploads through the web API now compute their encryption key while the request body is being spooled, instead of reading the spooled file again afterwards.
@@ -0,0 +1 @@
+The storage server's crawlers now save their progress after every prefix directory by appending only what changed to a journal, rather than rewriting their whole state file.
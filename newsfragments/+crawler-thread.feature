@@ -0,0 +1 @@
+The storage server's crawlers now do their disk work in a worker thread, and back off while the server is busy or its disk is slow.
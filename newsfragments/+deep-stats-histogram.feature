@@ -0,0 +1 @@
+Deep-stats finds file size histogram buckets with a bisect over precomputed bounds, and its results can be merged.
@@ -0,0 +1 @@
+Directories can be changed in batches with POST t=batch in the web API, which tahoe cp uses to add many files to a directory with few publishes.
@@ -0,0 +1 @@
+Immutable downloads now combine nearby reads from a share into one request, fetch whole hash trees at once, and read ahead during sequential downloads.
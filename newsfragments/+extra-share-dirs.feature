@@ -0,0 +1 @@
+Storage servers can keep shares in several share directories, normally one per disk, with the new ``[storage]extra_share_dirs`` and ``[storage]share_placement`` options.
@@ -0,0 +1 @@
+Share placement and servers-of-happiness now use Hopcroft-Karp matching, which is much faster on large grids.
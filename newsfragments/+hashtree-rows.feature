@@ -0,0 +1 @@
+Merkle hash trees are now hashed a row at a time, and the block hash trees of uploads are built in a worker thread instead of the reactor.
@@ -0,0 +1 @@
+HTTP storage connection pools now keep as many idle connections as recent demand needs, and the storage client reports connection reuse and wait times in its stats.
@@ -0,0 +1 @@
+``tahoe deep-check --incremental`` (and ``incremental=true`` in the web API) skips the files and directories which were checked recently and have not changed, using an index of when each object was last checked.
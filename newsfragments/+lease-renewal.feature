@@ -0,0 +1 @@
+The new `tahoe renew-leases` command renews the leases on a whole tree, sending storage servers batches of up to 5000 storage indexes at a time.
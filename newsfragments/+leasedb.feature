@@ -0,0 +1 @@
+Storage servers now keep the expiration time of every share's leases in a sqlite index, and delete the shares it says have expired without waiting for the lease crawler to reach them. An expired lease is now only cancelled along with its share.
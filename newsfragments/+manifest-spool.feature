@@ -0,0 +1 @@
+The results of t=start-manifest operations are spooled to disk instead of being held in memory, and can be fetched a page at a time with offset= and limit=.
@@ -0,0 +1 @@
+The web API's PUT /uri accepts random-key=true, and large uploads made that way are encoded while the request body is still arriving.
@@ -0,0 +1 @@
+A new background repair service, enabled in the ``[repair]`` section of ``tahoe.cfg``, regularly checks the files and directories below a list of root caps and repairs the ones most at risk first, within configurable concurrency and bandwidth limits.
@@ -0,0 +1 @@
+SFTP serves read-only opens of large immutable files with ranged reads, instead of first downloading the whole file into a temporary file.
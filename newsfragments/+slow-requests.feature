@@ -0,0 +1 @@
+The web API now traces how long each request spends traversing paths and rendering, and lists the slowest recent requests at /status/slow-requests.
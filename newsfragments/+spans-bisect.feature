@@ -0,0 +1 @@
+Downloads track received and requested byte ranges with structures that find ranges by bisection, so large files no longer slow down as their range lists grow.
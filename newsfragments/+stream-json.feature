@@ -0,0 +1 @@
+Directories can be listed one child per line with GET t=stream-json, so that large directories are not serialized or buffered all at once.
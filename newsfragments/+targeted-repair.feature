@@ -0,0 +1 @@
+Repairing an immutable file whose surviving shares are each on a different server now regenerates and uploads only the missing shares, instead of uploading the whole file again.
@@ -0,0 +1 @@
+Uploads with a random key skip asking servers which shares they already hold, and leave out servers that recently refused shares or are likely to be full.
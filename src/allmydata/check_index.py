@@ -0,0 +1,256 @@
+"""
+A local record of when each object was last checked, so that repeated
+deep-checks of a large tree only re-check what is due.
+
+The client keeps one ``CheckIndex`` in ``private/check-index.sqlite``.  It
+maps storage index to the time and outcome of the last check, and the time
+the object should next be checked.  Healthy objects become due again one
+``interval`` after they were checked; the first due time of each object is
+spread over the interval according to its storage index, so that a tree
+checked all at once comes due a little at a time rather than all at once
+again.  Unhealthy objects are always due.
+
+Directories also remember the version they had when they were last listed,
+and the earliest time anything below them comes due.  An incremental
+deep-check that finds a directory at the same version, with nothing below
+it due yet, does not list it at all.
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+
+from allmydata.interfaces import ICheckAndRepairResults, IDirectoryNode
+from allmydata.util import base32
+from allmydata.util.dbutil import get_db
+
+
+SCHEMA_v1 = """
+CREATE TABLE version -- added in v1
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE objects -- added in v1
+(
+ storage_index VARCHAR(26) PRIMARY KEY, -- base32(storage_index)
+ last_checked INTEGER NOT NULL,
+ healthy INTEGER NOT NULL,              -- 0 or 1
+ shares_good INTEGER NOT NULL,
+ next_check INTEGER NOT NULL,
+ dir_version TEXT,                      -- directories: version last listed
+ subtree_next_check INTEGER             -- directories: earliest next_check
+                                        -- of anything below, or NULL
+);
+"""
+
+# Commit after this many updates, so that a sweep of millions of objects
+# neither holds everything in one transaction nor syncs the disk for every
+# object.
+COMMIT_EVERY = 1000
+
+
+def _spread(storage_index: bytes) -> float:
+    """
+    :return: a number in (0, 1] derived from the storage index, used to
+        spread the first re-check of each object over one interval.
+    """
+    return (int.from_bytes(storage_index[:4], "big") + 1) / 2.0**32
+
+
+class CheckIndex:
+    """
+    :param dbfile: the sqlite file to keep the index in.
+    :param interval: how many seconds a healthy object may go without being
+        checked again.
+    """
+
+    def __init__(self, dbfile: str, interval: int):
+        (self._sqlite, self._db) = get_db(
+            dbfile, create_version=(SCHEMA_v1, 1), dbname="checkdb",
+        )
+        self._cursor = self._db.cursor()
+        self.interval = interval
+        self._uncommitted = 0
+
+    def get(self, storage_index: bytes) -> Optional[dict]:
+        si_s = str(base32.b2a(storage_index), "ascii")
+        self._cursor.execute(
+            "SELECT last_checked, healthy, shares_good, next_check,"
+            " dir_version, subtree_next_check FROM objects"
+            " WHERE storage_index=?", (si_s,))
+        row = self._cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(("last_checked", "healthy", "shares_good",
+                         "next_check", "dir_version", "subtree_next_check"),
+                        row))
+
+    def record_check(self, storage_index: bytes, results, now: int) -> int:
+        """
+        Remember the outcome of a check.
+
+        :param results: the ``ICheckResults`` (or ``ICheckAndRepairResults``,
+            in which case the post-repair results are used).
+
+        :return: when the object should next be checked.
+        """
+        if ICheckAndRepairResults.providedBy(results):
+            results = results.get_post_repair_results()
+        healthy = results.is_healthy()
+        previous = self.get(storage_index)
+        if not healthy:
+            next_check = now
+        elif previous is None or not previous["healthy"]:
+            next_check = now + int(self.interval * _spread(storage_index))
+        else:
+            next_check = now + self.interval
+        si_s = str(base32.b2a(storage_index), "ascii")
+        if previous is None:
+            self._cursor.execute(
+                "INSERT INTO objects VALUES (?,?,?,?,?,NULL,NULL)",
+                (si_s, now, int(healthy), results.get_share_counter_good(),
+                 next_check))
+        else:
+            self._cursor.execute(
+                "UPDATE objects SET last_checked=?, healthy=?, shares_good=?,"
+                " next_check=? WHERE storage_index=?",
+                (now, int(healthy), results.get_share_counter_good(),
+                 next_check, si_s))
+        self._updated()
+        return next_check
+
+    def record_directory(self, storage_index: bytes, dir_version: str,
+                         subtree_next_check: Optional[int]) -> None:
+        """
+        Remember the version of a directory that was just listed, and the
+        earliest time anything below it comes due.  The directory itself
+        must already have been recorded with ``record_check``.
+        """
+        si_s = str(base32.b2a(storage_index), "ascii")
+        self._cursor.execute(
+            "UPDATE objects SET dir_version=?, subtree_next_check=?"
+            " WHERE storage_index=?",
+            (dir_version, subtree_next_check, si_s))
+        self._updated()
+
+    def _updated(self):
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self) -> None:
+        self._db.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        self.commit()
+        self._db.close()
+
+
+def directory_version(node, results) -> Optional[str]:
+    """
+    :return: a string which changes whenever the contents of the directory
+        ``node`` change, taken from the results of checking it, or ``None``
+        if the check could not tell.
+    """
+    if not node.is_mutable():
+        return "immutable"
+    if ICheckAndRepairResults.providedBy(results):
+        results = results.get_post_repair_results()
+    servermap = results.get_servermap()
+    if servermap is None:
+        return None
+    best = servermap.best_recoverable_version()
+    if best is None:
+        return None
+    (seqnum, root_hash) = best[:2]
+    return "%d-%s" % (seqnum, str(base32.b2a(root_hash), "ascii"))
+
+
+class IncrementalCheck:
+    """
+    The state of one incremental deep-check: which objects to check, which
+    directories to list, and what to remember about them afterwards.  A
+    deep-check walker asks ``wants_check`` before checking each node and
+    reports the outcome to ``checked`` or ``skipped``, and passes its
+    ``should_enter`` and ``leave_directory`` hooks on to this object.
+    """
+
+    def __init__(self, index: CheckIndex, now: int):
+        self._index = index
+        self._now = now
+        # storage index -> directory version
+        self._versions: dict[bytes, Optional[str]] = {}
+        # storage index -> directory's own next check
+        self._own_due: dict[bytes, Optional[int]] = {}
+        # one [storage index, version, earliest due] frame per directory
+        # being walked, innermost last
+        self._stack: list[list] = []
+        self.objects_skipped = 0
+        self.directories_pruned = 0
+
+    def wants_check(self, node) -> bool:
+        si = node.get_storage_index()
+        if si is None:
+            # LIT files and unknown nodes: checking them costs nothing
+            return True
+        if IDirectoryNode.providedBy(node) and node.is_mutable():
+            # the check is how we find out whether it has changed
+            return True
+        entry = self._index.get(si)
+        return entry is None or entry["next_check"] <= self._now
+
+    def checked(self, node, results):
+        si = node.get_storage_index()
+        if si is None or results is None:
+            return
+        due = self._index.record_check(si, results, self._now)
+        if IDirectoryNode.providedBy(node):
+            self._versions[si] = directory_version(node, results)
+            self._own_due[si] = due
+        else:
+            self._fold(due)
+
+    def skipped(self, node):
+        si = node.get_storage_index()
+        self.objects_skipped += 1
+        entry = self._index.get(si)
+        if IDirectoryNode.providedBy(node):
+            self._versions[si] = "immutable"
+            self._own_due[si] = entry["next_check"]
+        else:
+            self._fold(entry["next_check"])
+
+    def should_enter(self, node) -> bool:
+        si = node.get_storage_index()
+        version = self._versions.pop(si, None)
+        own_due = self._own_due.pop(si, None)
+        entry = self._index.get(si)
+        if (entry is not None and version is not None
+            and entry["dir_version"] == version
+            and entry["subtree_next_check"] is not None
+            and entry["subtree_next_check"] > self._now):
+            self.directories_pruned += 1
+            self._fold(entry["subtree_next_check"])
+            if own_due is not None:
+                self._fold(own_due)
+            return False
+        self._stack.append([si, version, own_due])
+        return True
+
+    def leave_directory(self, node):
+        (si, version, due) = self._stack.pop()
+        if version is not None:
+            self._index.record_directory(si, version, due)
+        self._fold(due)
+
+    def _fold(self, due):
+        if due is None or not self._stack:
+            return
+        frame = self._stack[-1]
+        if frame[2] is None or due < frame[2]:
+            frame[2] = due
+
+    def finish(self):
+        self._index.commit()
@@ -63,6 +63,10 @@ from allmydata.interfaces import (
 )
 from allmydata.nodemaker import NodeMaker
 from allmydata.blacklist import Blacklist
+from allmydata.repair_scheduler import RepairScheduler, load_root_caps
+from allmydata.check_index import CheckIndex
+from allmydata.path_cache import PathCache
+from allmydata.directory_batcher import DirectoryBatchers
 from allmydata.node import _Config
 
 KiB=1024
@@ -87,10 +91,14 @@ def _is_valid_section(section_name):
 _client_config = configutil.ValidConfiguration(
     static_valid_sections={
         "client": (
+            "deep_check.recheck_interval",
+            "directory_batch.delay",
             "helper.furl",
             "introducer.furl",
             "key_generator.furl",
             "mutable.format",
+            "path_cache.max_entries",
+            "path_cache.ttl",
             "peers.preferred",
             "shares.happy",
             "shares.needed",
@@ -110,8 +118,10 @@ _client_config = configutil.ValidConfiguration(
             "expire.mode",
             "expire.mutable",
             "expire.override_lease_duration",
+            "extra_share_dirs",
             "readonly",
             "reserved_space",
+            "share_placement",
             "storage_dir",
             "plugins",
             "grid_management",
@@ -123,10 +133,18 @@ _client_config = configutil.ValidConfiguration(
             "host_privkey_file",
             "host_pubkey_file",
             "port",
+            "random_key_uploads",
         ),
         "helper": (
             "enabled",
         ),
+        "repair": (
+            "bandwidth",
+            "check_delay",
+            "concurrency",
+            "cycle_interval",
+            "enabled",
+        ),
     },
     is_valid_section=_is_valid_section,
     # Anything in a valid section is a valid item, for now.
@@ -310,6 +328,7 @@ def create_client_from_config(config, _client_factory=None, _introducer_factory=
     for ic in introducer_clients:
         ic.setServiceParent(client)
     storage_broker.setServiceParent(client)
+    client.stats_provider.register_producer(storage_broker)
     defer.returnValue(client)
 
 
@@ -660,6 +679,10 @@ class _Client(node.Node, pollmixin.PollMixin):
                 raise ValueError("config error: helper is enabled, but tub "
                                  "is not listening ('tub.port=' is empty)")
             self.init_helper()
+        self._check_index = None
+        self.repair_scheduler = None
+        if config.get_config("repair", "enabled", False, boolean=True):
+            self.init_repair_scheduler()
         self.init_sftp_server()
 
         # If the node sees an exit_trigger file, it will poll every second to see
@@ -817,6 +840,17 @@ class _Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        extra_sharedirs = [
+            self.config.get_config_path(d.strip())
+            for d in self.config.get_config(
+                "storage", "extra_share_dirs", "",
+            ).split(",")
+            if d.strip()
+        ]
+        share_placement = self.config.get_config(
+            "storage", "share_placement", "hash",
+        )
+
         ss = StorageServer(
             storedir, self.nodeid,
             reserved_space=reserved,
@@ -828,6 +862,8 @@ class _Client(node.Node, pollmixin.PollMixin):
             expiration_override_lease_duration=o_l_d,
             expiration_cutoff_date=cutoff_date,
             expiration_sharetypes=expiration_sharetypes,
+            extra_sharedirs=extra_sharedirs,
+            share_placement=share_placement,
         )
         ss.setServiceParent(self)
         return ss
@@ -954,6 +990,7 @@ class _Client(node.Node, pollmixin.PollMixin):
         uploader.setServiceParent(self)
         self.init_blacklist()
         self.init_nodemaker()
+        self.init_directory_batchers()
 
     def get_auth_token(self):
         """
@@ -1016,7 +1053,22 @@ class _Client(node.Node, pollmixin.PollMixin):
                                    self.get_encoding_parameters(),
                                    self.mutable_file_default,
                                    self._key_generator,
-                                   self.blacklist)
+                                   self.blacklist,
+                                   self._create_path_cache())
+
+    def _create_path_cache(self):
+        max_entries = int(self.config.get_config(
+            "client", "path_cache.max_entries", "0"))
+        if max_entries <= 0:
+            return None
+        ttl = parse_duration(self.config.get_config(
+            "client", "path_cache.ttl", "30 seconds"))
+        return PathCache(max_entries, ttl)
+
+    def init_directory_batchers(self):
+        delay = float(self.config.get_config(
+            "client", "directory_batch.delay", "0"))
+        self.directory_batchers = DirectoryBatchers(delay)
 
     def get_history(self):
         return self.history
@@ -1033,6 +1085,36 @@ class _Client(node.Node, pollmixin.PollMixin):
         helper_furlfile = self.config.get_private_path("helper.furl").encode(get_filesystem_encoding())
         self.tub.registerReference(self.helper, furlFile=helper_furlfile)
 
+    def get_check_index(self):
+        """
+        :return: the ``CheckIndex`` used by incremental deep-checks, opening
+            it the first time it is needed.
+        """
+        if self._check_index is None:
+            interval = parse_duration(self.config.get_config(
+                "client", "deep_check.recheck_interval", "30 days"))
+            self._check_index = CheckIndex(
+                self.config.get_private_path("check-index.sqlite"), interval)
+        return self._check_index
+
+    def init_repair_scheduler(self):
+        bandwidth = self.config.get_config("repair", "bandwidth", None)
+        if bandwidth is not None:
+            bandwidth = parse_abbreviated_size(bandwidth)
+        cycle_interval = parse_duration(
+            self.config.get_config("repair", "cycle_interval", "1 day"))
+        self.repair_scheduler = RepairScheduler(
+            self.nodemaker,
+            load_root_caps(self.config.get_private_path("repair-roots")),
+            self.config.get_private_path("repair.sqlite"),
+            concurrency=int(self.config.get_config("repair", "concurrency", "1")),
+            bandwidth=bandwidth,
+            check_delay=float(self.config.get_config("repair", "check_delay", "0")),
+            cycle_interval=cycle_interval,
+        )
+        self.repair_scheduler.setServiceParent(self)
+        self.stats_provider.register_producer(self.repair_scheduler)
+
     def _get_tempdir(self):
         """
         Determine the path to the directory where temporary files for this node
@@ -1061,6 +1143,7 @@ class _Client(node.Node, pollmixin.PollMixin):
             anonymous_tempfile_factory(self._get_tempdir()),
             nodeurl_path,
             staticdir,
+            operations_dir=self.config.get_private_path("operations"),
         )
         ws.setServiceParent(self)
 
@@ -1072,10 +1155,13 @@ class _Client(node.Node, pollmixin.PollMixin):
             sftp_portstr = self.config.get_config("sftpd", "port", "tcp:8022")
             pubkey_file = self.config.get_config("sftpd", "host_pubkey_file")
             privkey_file = self.config.get_config("sftpd", "host_privkey_file")
+            random_key_uploads = self.config.get_config(
+                "sftpd", "random_key_uploads", False, boolean=True)
 
             from allmydata.frontends import sftpd
             s = sftpd.SFTPServer(self, accountfile,
-                                 sftp_portstr, pubkey_file, privkey_file)
+                                 sftp_portstr, pubkey_file, privkey_file,
+                                 random_key_uploads)
             s.setServiceParent(self)
 
     def _check_exit_trigger(self, exit_trigger_file):
@@ -4,6 +4,7 @@ Ported to Python 3.
 """
 
 import math
+from bisect import bisect_left
 
 from allmydata.interfaces import IImmutableFileNode
 from allmydata.interfaces import IMutableFileNode
@@ -13,6 +14,31 @@ from allmydata.uri import LiteralFileURI
 from allmydata.uri import from_string
 from allmydata.util import mathutil
 
+# The histogram buckets are (0,0), (1,3), (4,10), (11,31), (32,100),
+# (101,316), (317, 1000), etc: two per decade. Their upper bounds are
+# computed once, up to the largest size anyone is likely to see, so that
+# finding the bucket of a size is just a binary search of a short list.
+SIZE_BUCKETS = [(0, 0), (1, 3)]
+_BUCKET_UPPER_BOUNDS = [0, 3]
+_BUCKET_RATIO = math.sqrt(10)
+
+def _add_bucket():
+    lower = SIZE_BUCKETS[-1][1] + 1
+    upper = int(mathutil.next_power_of_k(lower, _BUCKET_RATIO))
+    SIZE_BUCKETS.append((lower, upper))
+    _BUCKET_UPPER_BOUNDS.append(upper)
+
+while _BUCKET_UPPER_BOUNDS[-1] < 2**64:
+    _add_bucket()
+
+def bucket_index(size):
+    """Returns the index in SIZE_BUCKETS of the bucket holding size."""
+    assert size >= 0
+    while size > _BUCKET_UPPER_BOUNDS[-1]:
+        _add_bucket()
+    return bisect_left(_BUCKET_UPPER_BOUNDS, size)
+
+
 class DeepStats:
     """Deep stats object.
 
@@ -50,9 +76,8 @@ class DeepStats:
             self.stats[k] = 0
         self.histograms = {}
         for k in ["size-files-histogram"]:
-            self.histograms[k] = {} # maps (min,max) to count
-        self.buckets = [(0, 0), (1, 3)]
-        self.root = math.sqrt(10)
+            # the count for each of SIZE_BUCKETS, by index
+            self.histograms[k] = [0] * len(SIZE_BUCKETS)
 
     def set_monitor(self, monitor):
         """Sets a new monitor."""
@@ -92,6 +117,9 @@ class DeepStats:
             self.max("largest-directory", dirsize_bytes)
         dirsize_children = len(children)
         self.max("largest-directory-children", dirsize_children)
+        if self.monitor is not None:
+            # let the partial results be seen while the walk goes on
+            self.monitor.set_status(self.get_results())
 
     def add(self, key, value=1):
         self.stats[key] += value
@@ -101,38 +129,36 @@ class DeepStats:
 
     def which_bucket(self, size):
         # return (min,max) such that min <= size <= max
-        # values are from the set (0,0), (1,3), (4,10), (11,31), (32,100),
-        # (101,316), (317, 1000), etc: two per decade
-        assert size >= 0
-        i = 0
-        while True:
-            if i >= len(self.buckets):
-                # extend the list
-                new_lower = self.buckets[i-1][1]+1
-                new_upper = int(mathutil.next_power_of_k(new_lower, self.root))
-                self.buckets.append((new_lower, new_upper))
-            maybe = self.buckets[i]
-            if maybe[0] <= size <= maybe[1]:
-                return maybe
-            i += 1
-
-    def histogram(self, key, size):
-        bucket = self.which_bucket(size)
+        return SIZE_BUCKETS[bucket_index(size)]
+
+    def histogram(self, key, size, count=1):
+        i = bucket_index(size)
         h = self.histograms[key]
-        if bucket not in h:
-            h[bucket] = 0
-        h[bucket] += 1
+        if i >= len(h):
+            h.extend([0] * (i + 1 - len(h)))
+        h[i] += count
 
     def get_results(self):
         """Returns deep-stats results."""
         stats = self.stats.copy()
         for key in self.histograms:
-            h = self.histograms[key]
-            out = [ (bucket[0], bucket[1], h[bucket]) for bucket in h ]
-            out.sort()
-            stats[key] = out
+            stats[key] = [ SIZE_BUCKETS[i] + (count,)
+                           for (i, count) in enumerate(self.histograms[key])
+                           if count ]
         return stats
 
+    def merge(self, results):
+        """Adds in the results of another DeepStats, such as one which
+        walked a different subtree, as if I had seen its nodes myself."""
+        for key, value in results.items():
+            if key in self.histograms:
+                for (low, high, count) in value:
+                    self.histogram(key, low, count)
+            elif key.startswith("largest-"):
+                self.max(key, value)
+            elif key != "api-version":
+                self.add(key, value)
+
     def finish(self):
         """Finishes gathering stats."""
         return self.get_results()
@@ -0,0 +1,212 @@
+"""
+Coalescing of changes to directories.
+
+Every change to a mutable directory is a whole modification of the mutable
+file behind it: a servermap update, a download, and a publish. A
+``DirectoryBatcher`` queues the additions and removals of children of one
+directory and makes all those which arrive close together with a single
+modification. Changes which arrive while a modification is in progress
+wait for it and then go out together in the next one, so even without a
+delay a busy directory needs one publish per round trip rather than one
+per change.
+"""
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from allmydata.util import log
+
+
+class DirectoryBatcher:
+    """
+    I queue changes to one writeable directory and make them in batches.
+
+    :param node: the directory node.
+    :param float delay: how many seconds to wait for more changes after the
+        first one of a batch is queued.
+    :param int max_changes: make a batch as soon as it has this many changes.
+    :param clock: provides ``callLater``.
+    :param on_idle: called with me when I have nothing left to do.
+    """
+
+    def __init__(self, node, delay, max_changes, clock, on_idle=None):
+        self.node = node
+        self.delay = delay
+        self.max_changes = max_changes
+        self._clock = clock
+        self._on_idle = on_idle
+        self._batch = None
+        self._waiting = [] # one Deferred per change in self._batch
+        self._flushing = [] # Deferreds which fire after self._batch is made
+        self._timer = None
+        self._due = False
+        self._running = False
+        self._unreported = [] # (kind, name, Failure) nobody waited for
+        self.publishes = 0
+
+    def set_node(self, namex, child, metadata=None, overwrite=True):
+        """
+        Queue the addition of a child.
+
+        :return: a Deferred that fires with the child once it has been
+            added, or fails if it could not be.
+        """
+        return self._queue("set_node", namex, child, metadata, overwrite)
+
+    def delete(self, namex, must_exist=True):
+        """
+        Queue the removal of a child.
+
+        :return: a Deferred that fires with the removed node (or None if
+            there was no such child and ``must_exist`` is false) once it has
+            been removed, or fails if it could not be.
+        """
+        return self._queue("delete", namex, must_exist)
+
+    def queue_unwaited(self, kind, namex, *args):
+        """
+        Queue a change whose caller will not wait for it. If it fails, the
+        failure is reported by a later ``flush``.
+        """
+        d = self._queue(kind, namex, *args)
+        def _failed(f):
+            log.msg(format="queued change to %(name)s failed: %(failure)s",
+                    name=namex, failure=str(f.value), level=log.UNUSUAL)
+            self._unreported.append((kind, namex, f))
+        d.addErrback(_failed)
+
+    def flush(self):
+        """
+        Make everything which is queued now without waiting any longer.
+
+        :return: a Deferred that fires, once all of it has been made, with a
+            list of (kind, name, Failure) for the changes queued by
+            ``queue_unwaited`` which have failed since the last flush.
+        """
+        d = defer.Deferred()
+        if self._batch is not None:
+            self._flushing.append(d)
+            self._due = True
+            self._maybe_apply()
+        elif self._running:
+            self._flushing.append(d)
+        else:
+            d.callback(None)
+        d.addCallback(lambda ign: self.take_unreported())
+        return d
+
+    def is_idle(self):
+        return (self._batch is None and not self._running
+                and not self._unreported)
+
+    def take_unreported(self):
+        """
+        :return: a list of (kind, name, Failure) for the changes queued by
+            ``queue_unwaited`` which have failed since this was last called.
+        """
+        (unreported, self._unreported) = (self._unreported, [])
+        self._maybe_idle()
+        return unreported
+
+    def _maybe_idle(self):
+        if self._on_idle is not None and self.is_idle():
+            self._on_idle(self)
+
+    def _queue(self, kind, *args):
+        if self._batch is None:
+            self._batch = self.node.create_batch()
+        getattr(self._batch, kind)(*args)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if len(self._batch) >= self.max_changes:
+            self._due = True
+        elif self._timer is None and not self._due:
+            self._timer = self._clock.callLater(self.delay, self._timer_fired)
+        self._maybe_apply()
+        return d
+
+    def _timer_fired(self):
+        self._timer = None
+        self._due = True
+        self._maybe_apply()
+
+    def _maybe_apply(self):
+        if not self._due or self._running or self._batch is None:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._batch
+        waiting = self._waiting
+        flushing = self._flushing
+        self._batch = None
+        self._waiting = []
+        self._flushing = []
+        self._due = False
+        self._running = True
+        self.publishes += 1
+        d = defer.maybeDeferred(self.node.apply_batch, batch)
+        def _applied(res):
+            self._running = False
+            if isinstance(res, Failure):
+                results = [res] * len(waiting)
+            else:
+                results = batch.results
+            for (w, result) in zip(waiting, results):
+                if isinstance(result, Failure):
+                    w.errback(result)
+                else:
+                    w.callback(result)
+            for f in flushing:
+                f.callback(None)
+            # whatever was queued meanwhile has waited long enough
+            if self._batch is not None:
+                self._due = True
+                self._maybe_apply()
+            else:
+                # flushes made during this publish with nothing queued
+                # were only waiting for it
+                (leftover, self._flushing) = (self._flushing, [])
+                for f in leftover:
+                    f.callback(None)
+                self._maybe_idle()
+        d.addBoth(_applied)
+
+
+class DirectoryBatchers:
+    """
+    I keep one ``DirectoryBatcher`` for each directory which has changes
+    queued, so that changes to the same directory from different requests
+    are coalesced.
+
+    :param float delay: see ``DirectoryBatcher``.
+    :param int max_changes: see ``DirectoryBatcher``.
+    """
+
+    def __init__(self, delay=0.0, max_changes=1000, clock=None):
+        if clock is None:
+            clock = reactor
+        self.delay = delay
+        self.max_changes = max_changes
+        self._clock = clock
+        self._batchers = {} # write cap -> DirectoryBatcher
+
+    def get(self, node):
+        """
+        :return: the ``DirectoryBatcher`` for a writeable directory.
+        """
+        key = node.get_write_uri()
+        batcher = self._batchers.get(key)
+        if batcher is None:
+            batcher = DirectoryBatcher(node, self.delay, self.max_changes,
+                                       self._clock, self._idle)
+            self._batchers[key] = batcher
+        return batcher
+
+    def _idle(self, batcher):
+        key = batcher.node.get_write_uri()
+        if self._batchers.get(key) is batcher:
+            del self._batchers[key]
+
+    def __len__(self):
+        return len(self._batchers)
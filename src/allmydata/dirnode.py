@@ -7,16 +7,19 @@ import time
 
 from zope.interface import implementer
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 
 from allmydata.crypto import aes
 from allmydata.deep_stats import DeepStats
+from allmydata.lease_renewal import DeepLeaseRenewer
 from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.unknown import UnknownNode, strip_prefix_for_ro
 from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
      ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
      MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError
+from allmydata.check_index import IncrementalCheck
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
@@ -115,6 +118,30 @@ def update_metadata(metadata, new_metadata, now):
 # contents and end by repacking them. It might be better to apply them to
 # the unpacked contents.
 
+def _remove_child(children, name, must_exist, must_be_directory=False,
+                  must_be_file=False):
+    """
+    Remove a child from unpacked directory contents.
+
+    :return: the removed node, or None if there was no such child and
+        ``must_exist`` is false.
+    """
+    if name not in children:
+        if must_exist:
+            raise NoSuchChildError(name)
+        return None
+    old_child, metadata = children[name]
+
+    # Unknown children can be removed regardless of must_be_directory or must_be_file.
+    if must_be_directory and IFileNode.providedBy(old_child):
+        raise ChildOfWrongTypeError("delete required a directory, not a file")
+    if must_be_file and IDirectoryNode.providedBy(old_child):
+        raise ChildOfWrongTypeError("delete required a file, not a directory")
+
+    del children[name]
+    return old_child
+
+
 class Deleter:
     def __init__(self, node, namex, must_exist=True, must_be_directory=False, must_be_file=False):
         self.node = node
@@ -125,20 +152,12 @@ class Deleter:
 
     def modify(self, old_contents, servermap, first_time):
         children = self.node._unpack_contents(old_contents)
-        if self.name not in children:
-            if first_time and self.must_exist:
-                raise NoSuchChildError(self.name)
-            self.old_child = None
+        self.old_child = _remove_child(children, self.name,
+                                       first_time and self.must_exist,
+                                       self.must_be_directory,
+                                       self.must_be_file)
+        if self.old_child is None:
             return None
-        self.old_child, metadata = children[self.name]
-
-        # Unknown children can be removed regardless of must_be_directory or must_be_file.
-        if self.must_be_directory and IFileNode.providedBy(self.old_child):
-            raise ChildOfWrongTypeError("delete required a directory, not a file")
-        if self.must_be_file and IDirectoryNode.providedBy(self.old_child):
-            raise ChildOfWrongTypeError("delete required a file, not a directory")
-
-        del children[self.name]
         new_contents = self.node._pack_contents(children)
         return new_contents
 
@@ -193,30 +212,95 @@ class Adder:
         children = self.node._unpack_contents(old_contents)
         now = time.time()
         for (namex, (child, new_metadata)) in list(self.entries.items()):
-            name = normalize(namex)
-            precondition(IFilesystemNode.providedBy(child), child)
+            _add_child(children, normalize(namex), child, new_metadata,
+                       self.overwrite, now, self.create_readonly_node)
+        new_contents = self.node._pack_contents(children)
+        return new_contents
 
-            # Strictly speaking this is redundant because we would raise the
-            # error again in _pack_normalized_children.
-            child.raise_error()
 
-            metadata = None
-            if name in children:
-                if not self.overwrite:
-                    raise ExistingChildError("child %s already exists" % quote_output(name, encoding='utf-8'))
+def _add_child(children, name, child, new_metadata, overwrite, now,
+               create_readonly_node=None):
+    """
+    Add a child to unpacked directory contents, or replace an existing one
+    as far as ``overwrite`` allows.
+    """
+    precondition(IFilesystemNode.providedBy(child), child)
+
+    # Strictly speaking this is redundant because we would raise the
+    # error again in _pack_normalized_children.
+    child.raise_error()
+
+    metadata = None
+    if name in children:
+        if not overwrite:
+            raise ExistingChildError("child %s already exists" % quote_output(name, encoding='utf-8'))
+
+        if overwrite == ONLY_FILES and IDirectoryNode.providedBy(children[name][0]):
+            raise ExistingChildError("child %s already exists as a directory" % quote_output(name, encoding='utf-8'))
+        metadata = children[name][1].copy()
+
+    metadata = update_metadata(metadata, new_metadata, now)
+    if create_readonly_node and metadata.get('no-write', False):
+        child = create_readonly_node(child, name)
+
+    children[name] = (child, metadata)
+
+
+class Batch:
+    """
+    I am a modifier which adds and removes many children at once, so that
+    they cost a single publish. Each change succeeds or fails on its own:
+    one which cannot be made (such as an addition which may not replace an
+    existing child) leaves the directory as it was and does not stop the
+    others. After a modification, ``results`` holds the outcome of each
+    change, in the order they were made: the added or removed node, or a
+    Failure.
+    """
+    def __init__(self, node, create_readonly_node=None):
+        self.node = node
+        self.create_readonly_node = create_readonly_node
+        self.changes = []
+        self.results = []
+
+    def set_node(self, namex, child, metadata=None, overwrite=True):
+        precondition(IFilesystemNode.providedBy(child), child)
+        precondition(overwrite in (True, False, ONLY_FILES), overwrite)
+        self.changes.append(("set", normalize(namex), (child, metadata, overwrite)))
 
-                if self.overwrite == ONLY_FILES and IDirectoryNode.providedBy(children[name][0]):
-                    raise ExistingChildError("child %s already exists as a directory" % quote_output(name, encoding='utf-8'))
-                metadata = children[name][1].copy()
+    def delete(self, namex, must_exist=True):
+        self.changes.append(("delete", normalize(namex), must_exist))
 
-            metadata = update_metadata(metadata, new_metadata, now)
-            if self.create_readonly_node and metadata.get('no-write', False):
-                child = self.create_readonly_node(child, name)
+    def __len__(self):
+        return len(self.changes)
 
-            children[name] = (child, metadata)
+    def modify(self, old_contents, servermap, first_time):
+        children = self.node._unpack_contents(old_contents)
+        now = time.time()
+        self.results = []
+        changed = False
+        for (kind, name, args) in self.changes:
+            try:
+                if kind == "set":
+                    (child, metadata, overwrite) = args
+                    _add_child(children, name, child, metadata, overwrite,
+                               now, self.create_readonly_node)
+                    result = child
+                else:
+                    # as with Deleter, a child which is gone when we retry
+                    # was probably removed by our first attempt
+                    result = _remove_child(children, name,
+                                           first_time and args)
+            except Exception:
+                result = Failure()
+            else:
+                changed = changed or result is not None
+            self.results.append(result)
+        if not changed:
+            return None
         new_contents = self.node._pack_contents(children)
         return new_contents
 
+
 def _encrypt_rw_uri(writekey, rw_uri):
     precondition(isinstance(rw_uri, bytes), rw_uri)
     precondition(isinstance(writekey, bytes), writekey)
@@ -328,13 +412,55 @@ class DirectoryNode:
         a Deferred that fires with the result."""
         return self._node.get_current_size()
 
+    def _get_path_cache(self):
+        return getattr(self._nodemaker, "path_cache", None)
+
     def _read(self):
+        cache = self._get_path_cache()
+        if cache is not None:
+            token = cache.start_listing()
         if self._node.is_mutable():
             # use the IMutableFileNode API.
             d = self._node.download_best_version()
         else:
             d = download_to_data(self._node)
         d.addCallback(self._unpack_contents)
+        if cache is not None:
+            def _remember(children):
+                cache.remember(self, token, children)
+                return children
+            d.addCallback(_remember)
+        return d
+
+    def _modify(self, modifier):
+        # every change to the directory goes through here, so that paths
+        # through it are resolved afresh afterwards
+        d = self._node.modify(modifier)
+        cache = self._get_path_cache()
+        if cache is not None:
+            def _forget(res):
+                cache.forget(self)
+                return res
+            d.addBoth(_forget)
+        return d
+
+    def _lookup(self, name):
+        """
+        Find the (node, metadata) of a child, from the path cache if the
+        directory was listed recently, otherwise by reading the directory.
+        """
+        cache = self._get_path_cache()
+        if cache is not None:
+            child = cache.lookup(self, name)
+            if child is not None:
+                # the cache holds caps, so the node is made afresh
+                (rw_uri, ro_uri, metadata) = child
+                d = defer.execute(self._create_and_validate_node,
+                                  rw_uri, ro_uri, name)
+                d.addCallback(lambda node: (node, metadata))
+                return d
+        d = self._read()
+        d.addCallback(self._get_with_metadata, name)
         return d
 
     def _decrypt_rwcapdata(self, encwrcap):
@@ -527,7 +653,7 @@ class DirectoryNode:
         assert isinstance(metadata, dict)
         s = MetadataSetter(self, name, metadata,
                            create_readonly_node=self._create_readonly_node)
-        d = self._node.modify(s.modify)
+        d = self._modify(s.modify)
         d.addCallback(lambda res: self)
         return d
 
@@ -560,12 +686,12 @@ class DirectoryNode:
             assert isinstance(p, str), p
         childnamex = pathx[0]
         remaining_pathx = pathx[1:]
+        # Directories listed recently are found in the path cache, so
+        # resolving a deep path does not have to retrieve all of them.
+        d = self._lookup(normalize(childnamex))
         if remaining_pathx:
-            d = self.get(childnamex)
-            d.addCallback(lambda node:
-                          node.get_child_and_metadata_at_path(remaining_pathx))
-            return d
-        d = self.get_child_and_metadata(childnamex)
+            d.addCallback(lambda node_and_metadata:
+                          node_and_metadata[0].get_child_and_metadata_at_path(remaining_pathx))
         return d
 
     def set_uri(self, namex, writecap, readcap=None, metadata=None, overwrite=True):
@@ -598,7 +724,7 @@ class DirectoryNode:
             # for this type of directory.
             child_node = self._create_and_validate_node(writecap, readcap, namex)
             a.set_node(namex, child_node, metadata)
-        d = self._node.modify(a.modify)
+        d = self._modify(a.modify)
         d.addCallback(lambda ign: self)
         return d
 
@@ -619,7 +745,7 @@ class DirectoryNode:
         a = Adder(self, overwrite=overwrite,
                   create_readonly_node=self._create_readonly_node)
         a.set_node(namex, child, metadata)
-        d = self._node.modify(a.modify)
+        d = self._modify(a.modify)
         d.addCallback(lambda res: child)
         return d
 
@@ -629,7 +755,7 @@ class DirectoryNode:
             return defer.fail(NotWriteableError())
         a = Adder(self, entries, overwrite=overwrite,
                   create_readonly_node=self._create_readonly_node)
-        d = self._node.modify(a.modify)
+        d = self._modify(a.modify)
         d.addCallback(lambda res: self)
         return d
 
@@ -661,10 +787,25 @@ class DirectoryNode:
             return defer.fail(NotWriteableError())
         deleter = Deleter(self, namex, must_exist=must_exist,
                           must_be_directory=must_be_directory, must_be_file=must_be_file)
-        d = self._node.modify(deleter.modify)
+        d = self._modify(deleter.modify)
         d.addCallback(lambda res: deleter.old_child)
         return d
 
+    def create_batch(self):
+        """I return an empty Batch of changes, for apply_batch()."""
+        return Batch(self, create_readonly_node=self._create_readonly_node)
+
+    def apply_batch(self, batch):
+        """I make all the changes in a Batch with a single modification of
+        the directory. I return a Deferred that fires with the batch once
+        they are made, after which batch.results holds the outcome of each
+        one."""
+        if self.is_readonly():
+            return defer.fail(NotWriteableError())
+        d = self._modify(batch.modify)
+        d.addCallback(lambda res: batch)
+        return d
+
     # XXX: Too many arguments? Worthwhile to break into mutable/immutable?
     def create_subdirectory(self, namex, initial_children=None, overwrite=True,
                             mutable=True, mutable_version=None, metadata=None):
@@ -687,7 +828,7 @@ class DirectoryNode:
             entries = {name: (child, metadata)}
             a = Adder(self, entries, overwrite=overwrite,
                       create_readonly_node=self._create_readonly_node)
-            d = self._node.modify(a.modify)
+            d = self._modify(a.modify)
             d.addCallback(lambda res: child)
             return d
         d.addCallback(_created)
@@ -744,6 +885,12 @@ class DirectoryNode:
         I call walker.add_node(node, path) for each node (both files and
         directories) I can reach. Most work should be done here.
 
+        If the walker has a should_enter(dirnode) method, I call it after
+        add_node() for each directory, and only list and descend into the
+        directory if it returns True. If the walker has a
+        leave_directory(dirnode) method, I call it once I have finished
+        with everything below a directory I descended into.
+
         I avoid loops by keeping track of verifier-caps and refusing to call
         walker.add_node() or traverse a node that I've seen before. This
         means that any file or directory will only be given to the walker
@@ -780,9 +927,18 @@ class DirectoryNode:
         # process this directory, then walk its children
         monitor.raise_if_cancelled()
         d = defer.maybeDeferred(walker.add_node, node, path)
-        d.addCallback(lambda ignored: node.list())
-        d.addCallback(self._deep_traverse_dirnode_children, node, path,
-                      walker, monitor, found)
+        def _list(ignored):
+            should_enter = getattr(walker, "should_enter", None)
+            if should_enter is not None and not should_enter(node):
+                return None
+            d2 = node.list()
+            d2.addCallback(self._deep_traverse_dirnode_children, node, path,
+                           walker, monitor, found)
+            leave_directory = getattr(walker, "leave_directory", None)
+            if leave_directory is not None:
+                d2.addCallback(lambda ignored: leave_directory(node))
+            return d2
+        d.addCallback(_list)
         return d
 
     def _deep_traverse_dirnode_children(self, children, parent, path,
@@ -840,11 +996,18 @@ class DirectoryNode:
         # children for which we've got both a write-cap and a read-cap
         return self.deep_traverse(DeepStats(self))
 
-    def start_deep_check(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease))
+    def start_deep_renew_leases(self):
+        return self.deep_traverse(DeepLeaseRenewer(
+            self, self._nodemaker.storage_broker,
+            self._nodemaker.secret_holder))
+
+    def start_deep_check(self, verify=False, add_lease=False, check_index=None):
+        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease,
+                                              check_index=check_index))
 
-    def start_deep_check_and_repair(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease))
+    def start_deep_check_and_repair(self, verify=False, add_lease=False, check_index=None):
+        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease,
+                                              check_index=check_index))
 
 
 class ManifestWalker(DeepStats):
@@ -874,7 +1037,7 @@ class ManifestWalker(DeepStats):
 
 
 class DeepChecker:
-    def __init__(self, root, verify, repair, add_lease):
+    def __init__(self, root, verify, repair, add_lease, check_index=None):
         root_si = root.get_storage_index()
         if root_si:
             root_si_base32 = base32.b2a(root_si)
@@ -891,26 +1054,55 @@ class DeepChecker:
         else:
             self._results = DeepCheckResults(root_si)
         self._stats = DeepStats(root)
+        self._incremental = None
+        if check_index is not None:
+            self._incremental = IncrementalCheck(check_index, int(time.time()))
 
     def set_monitor(self, monitor):
         self.monitor = monitor
         monitor.set_status(self._results)
 
     def add_node(self, node, childpath):
+        if self._incremental and not self._incremental.wants_check(node):
+            self._incremental.skipped(node)
+            return self._stats.add_node(node, childpath)
         if self._repair:
             d = node.check_and_repair(self.monitor, self._verify, self._add_lease)
+            d.addCallback(self._record_check, node)
             d.addCallback(self._results.add_check_and_repair, childpath)
         else:
             d = node.check(self.monitor, self._verify, self._add_lease)
+            d.addCallback(self._record_check, node)
             d.addCallback(self._results.add_check, childpath)
         d.addCallback(lambda ignored: self._stats.add_node(node, childpath))
         return d
 
+    def _record_check(self, results, node):
+        if self._incremental:
+            self._incremental.checked(node, results)
+        return results
+
+    def should_enter(self, node):
+        if self._incremental:
+            return self._incremental.should_enter(node)
+        return True
+
+    def leave_directory(self, node):
+        if self._incremental:
+            self._incremental.leave_directory(node)
+
     def enter_directory(self, parent, children):
         return self._stats.enter_directory(parent, children)
 
     def finish(self):
         log.msg("deep-check done", parent=self._lp)
+        if self._incremental:
+            self._incremental.finish()
+            log.msg(format="incremental: %(skipped)d objects skipped,"
+                    " %(pruned)d directories not listed",
+                    skipped=self._incremental.objects_skipped,
+                    pruned=self._incremental.directories_pruned,
+                    parent=self._lp)
         self._results.update_stats(self._stats.get_results())
         return self._results
 
@@ -644,6 +644,109 @@ class ShortReadOnlySFTPFile(PrefixingLogMixin):
         return defer.execute(_denied)
 
 
+@implementer(ISFTPFile)
+class RangedReadOnlySFTPFile(PrefixingLogMixin):
+    """I represent a file handle to a particular file on an SFTP connection.
+    I am used for immutable files that are too large for ShortReadOnlySFTPFile
+    and are opened in read-only mode.
+
+    Rather than downloading the whole file to a temporary file before the
+    first read can be answered, I satisfy each read request with a ranged
+    read of the filenode. The data following the requested range, up to
+    READAHEAD_SIZE bytes in total, is kept in memory so that the small
+    sequential reads issued by a typical SFTP client do not each need a
+    separate download. Requests are queued on self.async_ and handled one
+    at a time, so that pipelined reads are answered from the read-ahead
+    buffer filled by the read before them."""
+
+    READAHEAD_SIZE = 128*1024
+
+    def __init__(self, userpath, filenode, metadata):
+        PrefixingLogMixin.__init__(self, facility="tahoe.sftp", prefix=userpath)
+        if noisy: self.log(".__init__(%r, %r, %r)" % (userpath, filenode, metadata), level=NOISY)
+
+        precondition(isinstance(userpath, bytes) and IFileNode.providedBy(filenode),
+                     userpath=userpath, filenode=filenode)
+        self.filenode = filenode
+        self.metadata = metadata
+        self.size = filenode.get_size()
+        self.async_ = defer.succeed(None)
+        self.closed = False
+
+        # the read-ahead buffer holds the file contents starting at self._buffer_offset
+        self._buffer_offset = 0
+        self._buffer = b""
+
+    def readChunk(self, offset, length):
+        request = ".readChunk(%r, %r)" % (offset, length)
+        self.log(request, level=OPERATIONAL)
+
+        if self.closed:
+            def _closed(): raise createSFTPError(FX_BAD_MESSAGE, "cannot read from a closed file handle")
+            return defer.execute(_closed)
+
+        # We respond with an EOF error iff offset is already at EOF; see the
+        # comment in ShortReadOnlySFTPFile.readChunk.
+        if offset >= self.size:
+            def _eof(): raise createSFTPError(FX_EOF, "read at or past end of file")
+            return defer.execute(_eof)
+
+        length = min(length, self.size - offset)
+        d = defer.Deferred()
+        def _read(ign):
+            if noisy: self.log("_read in readChunk(%r, %r)" % (offset, length), level=NOISY)
+
+            start = offset - self._buffer_offset
+            if start >= 0 and start + length <= len(self._buffer):
+                eventually_callback(d)(self._buffer[start:start+length])
+                return None
+
+            readsize = min(max(length, self.READAHEAD_SIZE), self.size - offset)
+            d2 = download_to_data(self.filenode, offset, readsize)
+            def _got(data):
+                self._buffer_offset = offset
+                self._buffer = data
+                eventually_callback(d)(data[:length])
+            def _err(f):
+                self._buffer = b""
+                eventually_errback(d)(f)
+            d2.addCallbacks(_got, _err)
+            return d2
+        self.async_.addCallback(_read)
+        d.addBoth(_convert_error, request)
+        return d
+
+    def writeChunk(self, offset, data):
+        self.log(".writeChunk(%r, <data of length %r>) denied" % (offset, len(data)), level=OPERATIONAL)
+
+        def _denied(): raise createSFTPError(FX_PERMISSION_DENIED, "file handle was not opened for writing")
+        return defer.execute(_denied)
+
+    def close(self):
+        self.log(".close()", level=OPERATIONAL)
+
+        self.closed = True
+        self._buffer = b""
+        return defer.succeed(None)
+
+    def getAttrs(self):
+        request = ".getAttrs()"
+        self.log(request, level=OPERATIONAL)
+
+        if self.closed:
+            def _closed(): raise createSFTPError(FX_BAD_MESSAGE, "cannot get attributes for a closed file handle")
+            return defer.execute(_closed)
+
+        d = defer.execute(_populate_attrs, self.filenode, self.metadata)
+        d.addBoth(_convert_error, request)
+        return d
+
+    def setAttrs(self, attrs):
+        self.log(".setAttrs(%r) denied" % (attrs,), level=OPERATIONAL)
+        def _denied(): raise createSFTPError(FX_PERMISSION_DENIED, "file handle was not opened for writing")
+        return defer.execute(_denied)
+
+
 @implementer(ISFTPFile)
 class GeneralSFTPFile(PrefixingLogMixin):
     """I represent a file handle to a particular file on an SFTP connection.
@@ -653,10 +756,16 @@ class GeneralSFTPFile(PrefixingLogMixin):
     file handle, and requests to my OverwriteableFileConsumer. This queue is
     implemented by the callback chain of self.async_.
 
+    If random_key is true, a handle that is opened write-only and truncating,
+    and to which the client writes in order, is uploaded with a random
+    encryption key. This avoids reading the whole temporary file an extra time
+    at close in order to compute a convergent key. If the client seeks
+    backwards, the handle falls back to convergent encryption.
+
     When first constructed, I am in an 'unopened' state that causes most
     operations to be delayed until 'open' is called."""
 
-    def __init__(self, userpath, flags, close_notify, convergence):
+    def __init__(self, userpath, flags, close_notify, convergence, random_key=False):
         PrefixingLogMixin.__init__(self, facility="tahoe.sftp", prefix=userpath)
         if noisy: self.log(".__init__(%r, %r = %r, %r, <convergence censored>)" %
                            (userpath, flags, _repr_flags(flags), close_notify), level=NOISY)
@@ -671,6 +780,10 @@ class GeneralSFTPFile(PrefixingLogMixin):
         self.has_changed = (flags & (FXF_CREAT | FXF_TRUNC)) and not (flags & FXF_EXCL)
         self.closed = False
         self.abandoned = False
+        # True while every write has been at or after the end of the previous one.
+        self.sequential = bool(random_key and (flags & FXF_WRITE) and (flags & FXF_TRUNC) and
+                               not (flags & (FXF_READ | FXF_APPEND)))
+        self.next_offset = 0
         self.parent = None
         self.childname = None
         self.filenode = None
@@ -794,6 +907,14 @@ class GeneralSFTPFile(PrefixingLogMixin):
 
         self.has_changed = True
 
+        if self.sequential:
+            if offset < self.next_offset:
+                self.log("write at %r is before the previous end %r; falling back to convergent encryption"
+                         % (offset, self.next_offset), level=OPERATIONAL)
+                self.sequential = False
+            else:
+                self.next_offset = offset + len(data)
+
         # Note that we return without waiting for the write to occur. Reads and
         # close wait for prior writes, and will fail if any prior operation failed.
         # This is ok because SFTP makes no guarantee that the write completes
@@ -879,9 +1000,14 @@ class GeneralSFTPFile(PrefixingLogMixin):
 
                 d2.addCallback(lambda ign: self.filenode.overwrite(MutableFileHandle(self.consumer.get_file())))
             else:
+                # sequential is read here, after all prior writes have been queued.
+                convergence = self.convergence
+                if self.sequential:
+                    convergence = None
                 def _add_file(ign):
-                    self.log("_add_file childname=%r" % (childname,), level=OPERATIONAL)
-                    u = FileHandle(self.consumer.get_file(), self.convergence)
+                    self.log("_add_file childname=%r sequential=%r" % (childname, convergence is None),
+                             level=OPERATIONAL)
+                    u = FileHandle(self.consumer.get_file(), convergence)
                     return parent.add_file(childname, u, metadata=self.metadata)
                 d2.addCallback(_add_file)
             return d2
@@ -995,7 +1121,7 @@ def _reload():
 
 @implementer(ISFTPServer)
 class SFTPUserHandler(ConchUser, PrefixingLogMixin):
-    def __init__(self, client, rootnode, username):
+    def __init__(self, client, rootnode, username, random_key_uploads=False):
         ConchUser.__init__(self)
         PrefixingLogMixin.__init__(self, facility="tahoe.sftp", prefix=username)
         if noisy: self.log(".__init__(%r, %r, %r)" % (client, rootnode, username), level=NOISY)
@@ -1007,6 +1133,7 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
         self._root = rootnode
         self._username = username
         self._convergence = client.convergence
+        self._random_key_uploads = random_key_uploads
 
         # maps from UTF-8 paths for this user, to files written and still open
         self._heisenfiles = {}
@@ -1269,12 +1396,15 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
 
         if not writing and (flags & FXF_READ) and filenode and not filenode.is_mutable() and filenode.get_size() <= SIZE_THRESHOLD:
             d.addCallback(lambda ign: ShortReadOnlySFTPFile(userpath, filenode, metadata))
+        elif not writing and (flags & FXF_READ) and filenode and not filenode.is_mutable() and filenode.get_size() is not None:
+            d.addCallback(lambda ign: RangedReadOnlySFTPFile(userpath, filenode, metadata))
         else:
             close_notify = None
             if writing:
                 close_notify = self._remove_heisenfile
 
-            d.addCallback(lambda ign: existing_file or GeneralSFTPFile(userpath, flags, close_notify, self._convergence))
+            d.addCallback(lambda ign: existing_file or GeneralSFTPFile(userpath, flags, close_notify, self._convergence,
+                                                                       self._random_key_uploads))
             def _got_file(file):
                 file.open(parent=parent, childname=childname, filenode=filenode, metadata=metadata)
                 if writing:
@@ -1318,7 +1448,8 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
         userpath = self._path_to_utf8(path)
 
         if flags & (FXF_WRITE | FXF_CREAT):
-            file = GeneralSFTPFile(userpath, flags, self._remove_heisenfile, self._convergence)
+            file = GeneralSFTPFile(userpath, flags, self._remove_heisenfile, self._convergence,
+                                   self._random_key_uploads)
             self._add_heisenfile_by_path(file)
         else:
             # We haven't decided which file implementation to use yet.
@@ -1980,14 +2111,16 @@ from allmydata.frontends.auth import AccountFileChecker, NeedRootcapLookupScheme
 
 @implementer(portal.IRealm)
 class Dispatcher:
-    def __init__(self, client):
+    def __init__(self, client, random_key_uploads=False):
         self._client = client
+        self._random_key_uploads = random_key_uploads
 
     def requestAvatar(self, avatarId, mind, *interfaces):
         [interface] = interfaces
         _assert(interface == IConchUser, interface=interface)
         rootnode = self._client.create_node_from_uri(avatarId.rootcap)
-        handler = SFTPUserHandler(self._client, rootnode, avatarId.username)
+        handler = SFTPUserHandler(self._client, rootnode, avatarId.username,
+                                  self._random_key_uploads)
         return (interface, handler, handler.logout)
 
 
@@ -1997,13 +2130,14 @@ class SFTPServer(service.MultiService):
     name = "frontend:sftp"  # type: ignore[assignment]
 
     def __init__(self, client, accountfile,
-                 sftp_portstr, pubkey_file, privkey_file):
+                 sftp_portstr, pubkey_file, privkey_file,
+                 random_key_uploads=False):
         precondition(isinstance(accountfile, (str, type(None))), accountfile)
         precondition(isinstance(pubkey_file, str), pubkey_file)
         precondition(isinstance(privkey_file, str), privkey_file)
         service.MultiService.__init__(self)
 
-        r = Dispatcher(client)
+        r = Dispatcher(client, random_key_uploads)
         p = portal.Portal(r)
 
         if accountfile:
@@ -49,10 +49,13 @@ or eat  your children, but it might.  Use at your own risk.
 Ported to Python 3.
 """
 
-from allmydata.util import mathutil # from the pyutil library
+import hashlib
+from functools import lru_cache
+from itertools import chain
 
 from allmydata.util import base32
-from allmydata.util.hashutil import tagged_hash, tagged_pair_hash
+from allmydata.util.hashutil import tagged_hash
+from allmydata.util.netstring import netstring
 
 __version__ = '1.0.0-allmydata'
 
@@ -170,13 +173,42 @@ class CompleteBinaryTreeMixin:
 def depth_of(i):
     """Return the depth or level of the given node. Level 0 contains node 0
     Level 1 contains nodes 1 and 2. Level 2 contains nodes 3,4,5,6."""
-    return mathutil.log_floor(i+1, 2)
+    return (i+1).bit_length() - 1
 
 def empty_leaf_hash(i):
     return tagged_hash(b'Merkle tree empty leaf', b"%d" % i)
 
+@lru_cache(maxsize=16)
+def empty_leaf_hashes(start, end):
+    """Return a tuple of empty_leaf_hash(i) for i in range(start, end).
+
+    Every share of a file has a block hash tree with the same number of
+    leaves, so the same padding is needed several times in a row."""
+    return tuple(empty_leaf_hash(i) for i in range(start, end))
+
+# pair_hash(a, b) is tagged_pair_hash(b'Merkle tree internal node', a, b),
+# that is SHA256d(netstring(tag) + netstring(a) + netstring(b)). Hashing the
+# tag once and copying the hash state saves most of the per-node overhead.
+_PAIR_HASH_PREFIX = hashlib.sha256(netstring(b'Merkle tree internal node'))
+
 def pair_hash(a, b):
-    return tagged_pair_hash(b'Merkle tree internal node', a, b)
+    h = _PAIR_HASH_PREFIX.copy()
+    h.update(b"%d:%s,%d:%s," % (len(a), a, len(b), b))
+    return hashlib.sha256(h.digest()).digest()
+
+def pair_hash_row(row):
+    """Return the row above 'row' (which must have an even length): the
+    list of pair_hash(row[2*i], row[2*i+1])."""
+    prefix = _PAIR_HASH_PREFIX
+    sha256 = hashlib.sha256
+    parents = []
+    for i in range(0, len(row), 2):
+        a = row[i]
+        b = row[i+1]
+        h = prefix.copy()
+        h.update(b"%d:%s,%d:%s," % (len(a), a, len(b), b))
+        parents.append(sha256(h.digest()).digest())
+    return parents
 
 class HashTree(CompleteBinaryTreeMixin, list):
     r"""
@@ -211,18 +243,14 @@ class HashTree(CompleteBinaryTreeMixin, list):
         start = len(L)
         end   = roundup_pow2(len(L))
         self.first_leaf_num = end - 1
-        L     = L + [None] * (end - start)
-        for i in range(start, end):
-            L[i] = empty_leaf_hash(i)
+        L     = list(L) + list(empty_leaf_hashes(start, end))
         # Form each row of the tree.
         rows = [L]
         while len(rows[-1]) != 1:
-            last = rows[-1]
-            rows += [[pair_hash(last[2*i], last[2*i+1])
-                                for i in range(len(last)//2)]]
+            rows.append(pair_hash_row(rows[-1]))
         # Flatten the list of rows into a single list.
         rows.reverse()
-        self[:] = sum(rows, [])
+        self[:] = chain.from_iterable(rows)
 
     def needed_hashes(self, leafnum, include_leaf=False):
         """Which hashes will someone need to validate a given data block?
@@ -285,18 +313,10 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
     """
 
     def __init__(self, num_leaves):
-        L = [None] * num_leaves
-        start = len(L)
-        end   = roundup_pow2(len(L))
+        end   = roundup_pow2(num_leaves)
         self.first_leaf_num = end - 1
-        L     = L + [None] * (end - start)
-        rows = [L]
-        while len(rows[-1]) != 1:
-            last = rows[-1]
-            rows += [[None for i in range(len(last)//2)]]
-        # Flatten the list of rows into a single list.
-        rows.reverse()
-        self[:] = sum(rows, [])
+        # A complete tree with 'end' leaves has 2*end-1 nodes.
+        self[:] = [None] * (2*end - 1)
 
 
     def needed_hashes(self, leafnum, include_leaf=False):
@@ -438,9 +458,12 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
                     remove_upon_failure.add(i)
 
             for level in reversed(range(len(hashes_to_check))):
-                this_level = hashes_to_check[level]
-                while this_level:
-                    i = this_level.pop()
+                # Find the parent of every red-dotted node in this level,
+                # then compute all of those parents with one batch of pair
+                # hashes.
+                parents = []
+                row = []
+                for i in sorted(hashes_to_check[level]):
                     if i == 0:
                         # The root has no sibling. How lonely. You can't
                         # really *check* the root; you either accept it
@@ -450,19 +473,28 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
                         # want to set the root (from a trusted source) before
                         # adding any children from an untrusted source.
                         continue
-                    siblingnum = self.sibling(i)
+                    # left children have odd indices
+                    leftnum = i if i % 2 else i - 1
+                    parentnum = (leftnum - 1) // 2
+                    if parents and parents[-1] == parentnum:
+                        # our sibling is in this level too, and is now as
+                        # valid as this node
+                        continue
+                    siblingnum = leftnum + 1 if i == leftnum else leftnum
                     if self[siblingnum] is None:
                         # without a sibling, we can't compute a parent, and
                         # we can't verify this node
                         raise NotEnoughHashesError("unable to validate [%d]"%i)
-                    parentnum = self.parent(i)
-                    # make sure we know right from left
-                    leftnum, rightnum = sorted([i, siblingnum])
-                    new_parent_hash = pair_hash(self[leftnum], self[rightnum])
+                    parents.append(parentnum)
+                    row.append(self[leftnum])
+                    row.append(self[leftnum+1])
+
+                for parentnum, new_parent_hash in zip(parents, pair_hash_row(row)):
                     if self[parentnum]:
                         if self[parentnum] != new_parent_hash:
                             raise BadHashError("h([%d]+[%d]) != h[%d]" %
-                                               (leftnum, rightnum, parentnum))
+                                               (2*parentnum+1, 2*parentnum+2,
+                                                parentnum))
                     else:
                         self[parentnum] = new_parent_hash
                         remove_upon_failure.add(parentnum)
@@ -470,8 +502,6 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
                         assert parent_level == level-1
                         hashes_to_check[parent_level].add(parentnum)
 
-                    # our sibling is now as valid as this node
-                    this_level.discard(siblingnum)
             # we're done!
 
         except (BadHashError, NotEnoughHashesError):
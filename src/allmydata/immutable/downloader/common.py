@@ -2,6 +2,11 @@
 Ported to Python 3.
 """
 
+# The facility of the downloader's per-request and per-segment trace
+# messages, so that they can be silenced in tahoe.cfg with
+# [logging]threshold.tahoe.immutable.download .
+FACILITY = "tahoe.immutable.download"
+
 (AVAILABLE, PENDING, OVERDUE, COMPLETE, CORRUPT, DEAD, BADSEGNUM) = \
  ("AVAILABLE", "PENDING", "OVERDUE", "COMPLETE", "CORRUPT", "DEAD", "BADSEGNUM")
 
@@ -8,7 +8,7 @@ from allmydata.interfaces import NotEnoughSharesError, NoSharesError
 from allmydata.util import log
 from allmydata.util.dictutil import DictOfSets
 from .common import OVERDUE, COMPLETE, CORRUPT, DEAD, BADSEGNUM, \
-     BadSegmentNumberError
+     BadSegmentNumberError, FACILITY
 
 class SegmentFetcher:
     """I am responsible for acquiring blocks for a single segment. I will use
@@ -233,9 +233,11 @@ class SegmentFetcher:
         # called by Shares, in response to our s.send_request() calls.
         if not self._running:
             return
-        log.msg("SegmentFetcher(%r)._block_request_activity: %s -> %r" %
-                (self._node._si_prefix, repr(share), state),
-                level=log.NOISY, parent=self._lp, umid="vilNWA")
+        if log.is_enabled(log.NOISY, FACILITY):
+            log.msg("SegmentFetcher(%r)._block_request_activity: %s -> %r" %
+                    (self._node._si_prefix, repr(share), state),
+                    facility=FACILITY, level=log.NOISY, parent=self._lp,
+                    umid="vilNWA")
         # COMPLETE, CORRUPT, DEAD, BADSEGNUM are terminal. Remove the share
         # from all our tracking lists.
         if state in (COMPLETE, CORRUPT, DEAD, BADSEGNUM):
@@ -19,7 +19,7 @@ from allmydata.hashtree import IncompleteHashTree, BadHashError, \
 from .finder import ShareFinder
 from .fetcher import SegmentFetcher
 from .segmentation import Segmentation
-from .common import BadCiphertextHashError
+from .common import BadCiphertextHashError, FACILITY
 
 class IDownloadStatusHandlingConsumer(Interface):
     def set_download_status_read_event(read_ev):
@@ -74,6 +74,7 @@ class DownloadNode:
 
         # filled in when we parse a valid UEB
         self.have_UEB = False
+        self.UEB_s = None # the repairer copies this into new shares
         self.segment_size = None
         self.tail_segment_size = None
         self.tail_segment_padded = None
@@ -235,9 +236,10 @@ class DownloadNode:
         if self._active_segment is None and self._segment_requests:
             (segnum, d, c, seg_ev, lp) = self._segment_requests[0]
             k = self._verifycap.needed_shares
-            log.msg(format="%(node)s._start_new_segment: segnum=%(segnum)d",
-                    node=repr(self), segnum=segnum,
-                    level=log.NOISY, parent=lp, umid="wAlnHQ")
+            if log.is_enabled(log.NOISY, FACILITY):
+                log.msg(format="%(node)s._start_new_segment: segnum=%(segnum)d",
+                        node=repr(self), segnum=segnum, facility=FACILITY,
+                        level=log.NOISY, parent=lp, umid="wAlnHQ")
             self._active_segment = fetcher = SegmentFetcher(self, segnum, k, lp)
             seg_ev.activate(now())
             active_shares = [s for s in self._shares if s.is_alive()]
@@ -263,6 +265,7 @@ class DownloadNode:
         if h != self._verifycap.uri_extension_hash:
             raise BadHashError
         self._parse_and_store_UEB(UEB_s) # sets self._stuff
+        self.UEB_s = UEB_s
         # TODO: a malformed (but authentic) UEB could throw an assertion in
         # _parse_and_store_UEB, and we should abandon the download.
         self.have_UEB = True
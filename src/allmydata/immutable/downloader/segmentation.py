@@ -12,7 +12,7 @@ from allmydata.util import log
 from allmydata.util.spans import overlap
 from allmydata.interfaces import DownloadStopped
 
-from .common import BadSegmentNumberError, WrongSegmentError
+from .common import BadSegmentNumberError, WrongSegmentError, FACILITY
 
 @implementer(IPushProducer)
 class Segmentation:
@@ -75,9 +75,11 @@ class Segmentation:
         else:
             # this might be a guess
             wanted_segnum = self._offset // segment_size
-        log.msg(format="_fetch_next(offset=%(offset)d) %(guess)swants segnum=%(segnum)d",
-                offset=self._offset, guess=guess_s, segnum=wanted_segnum,
-                level=log.NOISY, parent=self._lp, umid="5WfN0w")
+        if log.is_enabled(log.NOISY, FACILITY):
+            log.msg(format="_fetch_next(offset=%(offset)d) %(guess)swants segnum=%(segnum)d",
+                    offset=self._offset, guess=guess_s, segnum=wanted_segnum,
+                    facility=FACILITY, level=log.NOISY, parent=self._lp,
+                    umid="5WfN0w")
         self._active_segnum = wanted_segnum
         d,c = n.get_segment(wanted_segnum, self._lp)
         self._cancel_segment_request = c
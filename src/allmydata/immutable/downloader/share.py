@@ -16,7 +16,7 @@ from allmydata.hashtree import IncompleteHashTree, BadHashError, \
 
 from allmydata.immutable.layout import make_write_bucket_proxy
 from allmydata.util.observer import EventStreamObserver
-from .common import COMPLETE, CORRUPT, DEAD, BADSEGNUM
+from .common import COMPLETE, CORRUPT, DEAD, BADSEGNUM, FACILITY
 
 
 class LayoutInvalid(Exception):
@@ -38,6 +38,18 @@ class Share:
     # this is a specific implementation of IShare for tahoe's native storage
     # servers. A different backend would use a different class.
 
+    # Ranges separated by no more than this many bytes are fetched with a
+    # single read: re-reading a few unwanted bytes is cheaper than another
+    # request. This merges the scattered nodes of a hash chain, for example.
+    COALESCE_GAP = 1024
+    # Once the offsets are known, a hash tree (block or ciphertext) up to
+    # this size is fetched whole, instead of one hash chain per segment.
+    MAX_HASHTREE_PREFETCH = 64*1024
+    # During a sequential download, fetch up to this many blocks beyond the
+    # one being asked for, enough to cover the server's measured
+    # bandwidth-delay product.
+    MAX_READAHEAD_BLOCKS = 4
+
     def __init__(self, rref, server, verifycap, commonshare, node,
                  download_status, shnum, dyhb_rtt, logparent):
         self._rref = rref
@@ -87,6 +99,11 @@ class Share:
         # download can re-fetch it.
 
         self._requested_blocks = [] # (segnum, set(observer2..))
+        self._hashtrees_prefetched = False
+        self._last_segnum = None # most recently retired block
+        # measured from our reads, to decide how far to read ahead
+        self._bandwidth = None # bytes per second
+        self._rtt = dyhb_rtt
         v = server.get_version()
         ver = v[b"http://allmydata.org/tahoe/protocols/storage/v1"]
         self._overrun_ok = ver[b"tolerates-immutable-read-overrun"]
@@ -159,8 +176,9 @@ class Share:
          - state=DEAD, f=Failure: the server reported an error, this share
                                   is unusable
         """
-        log.msg("%s.get_block(%d)" % (repr(self), segnum),
-                level=log.NOISY, parent=self._lp, umid="RTo9MQ")
+        if log.is_enabled(log.NOISY, FACILITY):
+            log.msg("%s.get_block(%d)" % (repr(self), segnum), facility=FACILITY,
+                    level=log.NOISY, parent=self._lp, umid="RTo9MQ")
         assert segnum >= 0
         o = EventStreamObserver()
         o.set_canceler(self, "_cancel_block_request")
@@ -202,13 +220,14 @@ class Share:
             return
         try:
             # if any exceptions occur here, kill the download
-            log.msg("%s.loop, reqs=[%s], pending=%s, received=%s,"
-                    " unavailable=%s" %
-                    (repr(self),
-                     ",".join([str(req[0]) for req in self._requested_blocks]),
-                     self._pending.dump(), self._received.dump(),
-                     self._unavailable.dump() ),
-                    level=log.NOISY, parent=self._lp, umid="BaL1zw")
+            if log.is_enabled(log.NOISY, FACILITY):
+                log.msg("%s.loop, reqs=[%s], pending=%s, received=%s,"
+                        " unavailable=%s" %
+                        (repr(self),
+                         ",".join([str(req[0]) for req in self._requested_blocks]),
+                         self._pending.dump(), self._received.dump(),
+                         self._unavailable.dump() ), facility=FACILITY,
+                        level=log.NOISY, parent=self._lp, umid="BaL1zw")
             self._do_loop()
             # all exception cases call self._fail(), which clears self._alive
         except (BadHashError, NotEnoughHashesError, LayoutInvalid) as e:
@@ -240,13 +259,14 @@ class Share:
         except BaseException:
             self._fail(Failure())
             raise
-        log.msg("%s.loop done, reqs=[%s], pending=%s, received=%s,"
-                " unavailable=%s" %
-                (repr(self),
-                 ",".join([str(req[0]) for req in self._requested_blocks]),
-                 self._pending.dump(), self._received.dump(),
-                 self._unavailable.dump() ),
-                level=log.NOISY, parent=self._lp, umid="9lRaRA")
+        if log.is_enabled(log.NOISY, FACILITY):
+            log.msg("%s.loop done, reqs=[%s], pending=%s, received=%s,"
+                    " unavailable=%s" %
+                    (repr(self),
+                     ",".join([str(req[0]) for req in self._requested_blocks]),
+                     self._pending.dump(), self._received.dump(),
+                     self._unavailable.dump() ), facility=FACILITY,
+                    level=log.NOISY, parent=self._lp, umid="9lRaRA")
 
     def _do_loop(self):
         # we are (eventually) called after all state transitions:
@@ -471,10 +491,28 @@ class Share:
             "advise_corrupt_share", reason.encode("utf-8")
         ).addErrback(log.err, "Error from remote call to advise_corrupt_share")
 
+    def _get_whole_hashtree(self, start, end):
+        """Return all the hashes of the tree stored in [start:end) as a
+        dict, if it was prefetched and has arrived, else None."""
+        if not self._hashtrees_prefetched or end <= start:
+            return None
+        hashdata = self._received.get(start, end - start)
+        if not hashdata:
+            return None
+        return dict((i, hashdata[i*HASH_SIZE:(i+1)*HASH_SIZE])
+                    for i in range((end - start) // HASH_SIZE))
+
     def _satisfy_block_hash_tree(self, needed_hashes):
         o_bh = self.actual_offsets["block_hashes"]
-        block_hashes = {}
+        o_end = self.actual_offsets["share_hashes"]
+        block_hashes = self._get_whole_hashtree(o_bh, o_end)
+        if block_hashes is not None:
+            needed_hashes = list(block_hashes.keys())
+        else:
+            block_hashes = {}
         for hashnum in needed_hashes:
+            if hashnum in block_hashes:
+                continue
             hashdata = self._received.get(o_bh+hashnum*HASH_SIZE, HASH_SIZE)
             if hashdata:
                 block_hashes[hashnum] = hashdata
@@ -503,8 +541,15 @@ class Share:
 
     def _satisfy_ciphertext_hash_tree(self, needed_hashes):
         start = self.actual_offsets["crypttext_hash_tree"]
-        hashes = {}
+        end = self.actual_offsets["block_hashes"]
+        hashes = self._get_whole_hashtree(start, end)
+        if hashes is not None:
+            needed_hashes = list(hashes.keys())
+        else:
+            hashes = {}
         for hashnum in needed_hashes:
+            if hashnum in hashes:
+                continue
             hashdata = self._received.get(start+hashnum*HASH_SIZE, HASH_SIZE)
             if hashdata:
                 hashes[hashnum] = hashdata
@@ -543,9 +588,11 @@ class Share:
                                                               blockstart, blocklen),
                     level=log.NOISY, parent=self._lp, umid="aK0RFw")
             return False
-        log.msg(format="%(share)s._satisfy_data_block [%(start)d:+%(length)d]",
-                share=repr(self), start=blockstart, length=blocklen,
-                level=log.NOISY, parent=self._lp, umid="uTDNZg")
+        if log.is_enabled(log.NOISY, FACILITY):
+            log.msg(format="%(share)s._satisfy_data_block [%(start)d:+%(length)d]",
+                    share=repr(self), start=blockstart, length=blocklen,
+                    facility=FACILITY, level=log.NOISY, parent=self._lp,
+                    umid="uTDNZg")
         # this block is being retired, either as COMPLETE or CORRUPT, since
         # no further data reads will help
         assert self._requested_blocks[0][0] == segnum
@@ -556,8 +603,8 @@ class Share:
                 # goes to SegmentFetcher._block_request_activity
                 o.notify(state=COMPLETE, block=block)
             # now clear our received data, to dodge the #1170 spans.py
-            # complexity bug
-            self._received = DataSpans()
+            # complexity bug, but keep any blocks we read ahead
+            self._received = self._readahead_data(blockstart + blocklen)
         except (BadHashError, NotEnoughHashesError) as e:
             # rats, we have a corrupt block. Notify our clients that they
             # need to look elsewhere, and advise the server. Unlike
@@ -573,6 +620,7 @@ class Share:
             self.had_corruption = True
         # in either case, we've retired this block
         self._requested_blocks.pop(0)
+        self._last_segnum = segnum
         # popping the request keeps us from turning around and wanting the
         # block again right away
         return True # got satisfaction
@@ -620,10 +668,17 @@ class Share:
                 # and _desire_data will tolerate that.
                 self._desire_block_hashes(desire, o, segnum)
                 self._desire_data(desire, o, r, segnum, segsize)
-
-        log.msg("end _desire: want_it=%s need_it=%s gotta=%s"
-                % (want_it.dump(), need_it.dump(), gotta_gotta_have_it.dump()),
-                level=log.NOISY, parent=self._lp, umid="IG7CgA")
+            if self.actual_offsets and self._node.have_UEB:
+                # now we know where everything is, and how big it is
+                self._desire_hashtrees(desire, o)
+                if segnum is not None:
+                    self._desire_readahead(desire, o, r, segnum)
+
+        if log.is_enabled(log.NOISY, FACILITY):
+            log.msg("end _desire: want_it=%s need_it=%s gotta=%s"
+                    % (want_it.dump(), need_it.dump(), gotta_gotta_have_it.dump()),
+                    facility=FACILITY, level=log.NOISY, parent=self._lp,
+                    umid="IG7CgA")
         if self.actual_offsets:
             return (want_it, need_it+gotta_gotta_have_it)
         else:
@@ -726,11 +781,75 @@ class Share:
             blocklen = r["tail_block_size"]
         need_it.add(blockstart, blocklen)
 
+    def _desire_hashtrees(self, desire, o):
+        (want_it, need_it, gotta_gotta_have_it) = desire
+        if self._hashtrees_prefetched:
+            return
+        # this is only done once: if some of it gets thrown away before it
+        # is used, we go back to asking for just the hashes we need
+        self._hashtrees_prefetched = True
+        for (start, end) in [(o["crypttext_hash_tree"], o["block_hashes"]),
+                             (o["block_hashes"], o["share_hashes"])]:
+            if 0 < end - start <= self.MAX_HASHTREE_PREFETCH:
+                want_it.add(start, end - start)
+
+    def _desire_readahead(self, desire, o, r, segnum):
+        (want_it, need_it, gotta_gotta_have_it) = desire
+        if self._last_segnum is None or segnum != self._last_segnum + 1:
+            return # not a sequential read
+        last = min(segnum + self._get_readahead_blocks(r["block_size"]),
+                   r["num_segments"] - 1)
+        for n in range(segnum + 1, last + 1):
+            blocklen = r["block_size"]
+            if n == r["num_segments"] - 1:
+                blocklen = r["tail_block_size"]
+            want_it.add(o["data"] + n * r["block_size"], blocklen)
+
+    def _get_readahead_blocks(self, block_size):
+        """Return how many blocks to read ahead: enough to keep the
+        connection busy for one round trip, at the bandwidth we have seen
+        from this server."""
+        if not self._bandwidth or not self._rtt or not block_size:
+            return 1
+        bdp = self._bandwidth * self._rtt
+        return max(1, min(self.MAX_READAHEAD_BLOCKS,
+                          mathutil.div_ceil(int(bdp), block_size)))
+
+    def _readahead_data(self, start):
+        """Return a DataSpans with the data we hold beyond 'start' in the
+        data section of the share, which can only have been read ahead."""
+        end = self.actual_offsets["plaintext_hash_tree"]
+        ahead = DataSpans()
+        for (s_start, s_data) in self._received.get_chunks():
+            s_end = min(s_start + len(s_data), end)
+            if s_end > start:
+                s_start2 = max(s_start, start)
+                ahead.add(s_start2, s_data[s_start2-s_start:s_end-s_start])
+        return ahead
+
+    def _coalesce(self, ask):
+        """Merge the (start, length) spans in 'ask' which are separated by
+        small gaps that are not already being fetched."""
+        merged = []
+        for (start, length) in ask:
+            if merged:
+                (m_start, m_length) = merged[-1]
+                gap_start = m_start + m_length
+                gap = start - gap_start
+                if (gap <= self.COALESCE_GAP and
+                    not (self._pending & Spans(gap_start, gap))):
+                    merged[-1] = (m_start, start + length - m_start)
+                    continue
+            merged.append((start, length))
+        return merged
+
     def _send_requests(self, desired):
         ask = desired - self._pending - self._received.get_spans()
-        log.msg("%s._send_requests, desired=%s, pending=%s, ask=%s" %
-                (repr(self), desired.dump(), self._pending.dump(), ask.dump()),
-                level=log.NOISY, parent=self._lp, umid="E94CVA")
+        if log.is_enabled(log.NOISY, FACILITY):
+            log.msg("%s._send_requests, desired=%s, pending=%s, ask=%s" %
+                    (repr(self), desired.dump(), self._pending.dump(), ask.dump()),
+                    facility=FACILITY, level=log.NOISY, parent=self._lp,
+                    umid="E94CVA")
         # XXX At one time, this code distinguished between data blocks and
         # hashes, and made sure to send (small) requests for hashes before
         # sending (big) requests for blocks. The idea was to make sure that
@@ -739,17 +858,19 @@ class Share:
         # Reconsider the removal: maybe bring it back.
         ds = self._download_status
 
-        for (start, length) in ask:
-            # TODO: quantize to reasonably-large blocks
+        for (start, length) in self._coalesce(ask):
             self._pending.add(start, length)
-            lp = log.msg(format="%(share)s._send_request"
-                         " [%(start)d:+%(length)d]",
-                         share=repr(self),
-                         start=start, length=length,
-                         level=log.NOISY, parent=self._lp, umid="sgVAyA")
+            lp = None
+            if log.is_enabled(log.NOISY, FACILITY):
+                lp = log.msg(format="%(share)s._send_request"
+                             " [%(start)d:+%(length)d]",
+                             share=repr(self),
+                             start=start, length=length, facility=FACILITY,
+                             level=log.NOISY, parent=self._lp, umid="sgVAyA")
             block_ev = ds.add_block_request(self._server, self._shnum,
                                             start, length, now())
             d = self._send_request(start, length)
+            d.addCallback(self._measure, now())
             d.addCallback(self._got_data, start, length, block_ev, lp)
             d.addErrback(self._got_error, start, length, block_ev, lp)
             d.addCallback(self._trigger_loop)
@@ -761,13 +882,32 @@ class Share:
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
+    def _measure(self, data, sent):
+        """Update our estimate of this server's bandwidth and latency."""
+        elapsed = now() - sent
+        if elapsed > 0:
+            if len(data) < 4096:
+                # small reads are dominated by latency
+                if self._rtt is None:
+                    self._rtt = elapsed
+                else:
+                    self._rtt = 0.8 * self._rtt + 0.2 * elapsed
+            else:
+                bandwidth = len(data) / elapsed
+                if self._bandwidth is None:
+                    self._bandwidth = bandwidth
+                else:
+                    self._bandwidth = 0.8 * self._bandwidth + 0.2 * bandwidth
+        return data
+
     def _got_data(self, data, start, length, block_ev, lp):
         block_ev.finished(len(data), now())
         if not self._alive:
             return
-        log.msg(format="%(share)s._got_data [%(start)d:+%(length)d] -> %(datalen)d",
-                share=repr(self), start=start, length=length, datalen=len(data),
-                level=log.NOISY, parent=lp, umid="5Qn6VQ")
+        if log.is_enabled(log.NOISY, FACILITY):
+            log.msg(format="%(share)s._got_data [%(start)d:+%(length)d] -> %(datalen)d",
+                    share=repr(self), start=start, length=length, datalen=len(data),
+                    facility=FACILITY, level=log.NOISY, parent=lp, umid="5Qn6VQ")
         self._pending.remove(start, length)
         self._received.add(start, data)
 
@@ -13,6 +13,8 @@ from allmydata.storage.server import si_b2a
 from allmydata.hashtree import HashTree
 from allmydata.util import mathutil, hashutil, base32, log, happinessutil
 from allmydata.util.assertutil import _assert, precondition
+from allmydata.util.cputhreadpool import defer_to_thread
+from allmydata.util.deferredutil import async_to_deferred
 from allmydata.codec import CRSEncoder
 from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
      IEncryptedUploadable, IUploadStatus, UploadUnhappinessError
@@ -554,19 +556,23 @@ class Encoder:
         d.addErrback(self._remove_shareholder, shareid, "put_crypttext_hashes")
         return d
 
-    def send_all_block_hash_trees(self):
+    @async_to_deferred
+    async def send_all_block_hash_trees(self):
         self.log("sending block hash trees", level=log.NOISY)
         self.set_status("Sending Subshare Hash Trees")
         self.set_encode_and_push_progress(extra=0.4)
+        # self.block_hashes[shareid] is a list of the hashes of all blocks
+        # that were sent to shareholder[shareid]. With many segments,
+        # building these trees takes long enough that it should not be done
+        # in the reactor thread.
+        trees = await defer_to_thread(
+            lambda: [HashTree(hashes) for hashes in self.block_hashes])
         dl = []
-        for shareid,hashes in enumerate(self.block_hashes):
-            # hashes is a list of the hashes of all blocks that were sent
-            # to shareholder[shareid].
-            dl.append(self.send_one_block_hash_tree(shareid, hashes))
-        return self._gather_responses(dl)
+        for shareid,t in enumerate(trees):
+            dl.append(self.send_one_block_hash_tree(shareid, t))
+        return await self._gather_responses(dl)
 
-    def send_one_block_hash_tree(self, shareid, block_hashes):
-        t = HashTree(block_hashes)
+    def send_one_block_hash_tree(self, shareid, t):
         all_hashes = list(t)
         # all_hashes[0] is the root hash, == hash(ah[1]+ah[2])
         # all_hashes[1] is the left child, == hash(ah[3]+ah[4])
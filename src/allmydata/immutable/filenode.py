@@ -81,6 +81,21 @@ class CiphertextFileNode:
         self._maybe_create_download_node()
         return self._node.get_segsize()
 
+    def get_share_hashes(self):
+        """Return a Deferred that fires with (UEB_s, hashes): the file's
+        validated URI extension block, and a dict mapping hash index to hash
+        for every node of the share hash tree that the downloader has
+        validated so far. This fetches the first segment if nothing has been
+        downloaded yet. The repairer uses these to build replacement shares
+        without re-encoding every share."""
+        d = self.get_segment_size()
+        def _got(ign):
+            sht = self._node.share_hash_tree
+            hashes = dict((i, h) for (i, h) in enumerate(sht) if h is not None)
+            return (self._node.UEB_s, hashes)
+        d.addCallback(_got)
+        return d
+
     def get_storage_index(self):
         return self._verifycap.storage_index
     def get_verify_cap(self):
@@ -121,7 +136,7 @@ class CiphertextFileNode:
             return f
         r = Repairer(self, storage_broker=self._storage_broker,
                      secret_holder=self._secret_holder,
-                     monitor=monitor)
+                     monitor=monitor, check_results=cr)
         d = r.start()
         d.addCallbacks(self._gather_repair_results, _repair_error,
                        callbackArgs=(cr, crr,))
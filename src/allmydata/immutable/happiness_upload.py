@@ -95,6 +95,176 @@ def calculate_happiness(mappings):
     return len(unique_peers)
 
 
+class ShareMatching:
+    """
+    I keep a maximum matching between servers and the shares they hold (or
+    will hold). The size of the matching is the servers-of-happiness of the
+    share layout, and the matched pairs are a placement which achieves it.
+
+    Servers and shares are given array indices as they are added, and the
+    graph is kept as a list of share indices per server, so the matching
+    is never rebuilt from scratch: ``add_server`` can be called as each
+    server's answer arrives and costs no more than one search for an
+    augmenting path. The search is Hopcroft-Karp, which also finds the
+    initial matching of a whole layout in O(E * sqrt(V)).
+    """
+
+    def __init__(self, shares=()):
+        """
+        :param shares: shareids to include in ``share_to_server`` even if no
+            server ever holds them.
+        """
+        self._server_index = {} # serverid -> index
+        self._share_index = {} # shareid -> index
+        self._servers = [] # index -> serverid
+        self._shares = [] # index -> shareid
+        self._edges = [] # server index -> [share index]
+        self._server_match = [] # server index -> share index, or -1
+        self._share_match = [] # share index -> server index, or -1
+        self._size = 0
+        for share in shares:
+            self._add_share(share)
+
+    @classmethod
+    def from_servermap(cls, servermap):
+        """
+        :param servermap: a dict of serverid -> iterable of shareids.
+        """
+        matching = cls()
+        for server, shares in servermap.items():
+            matching.add_server(server, shares, maximize=False)
+        matching.maximize()
+        return matching
+
+    def add_server(self, server, shares, maximize=True):
+        """
+        Record that ``server`` holds (or will hold) each of ``shares``. The
+        server may already be known, in which case its new shares are added
+        to the ones it already had.
+
+        :param maximize: if False, leave the matching as it is; call
+            ``maximize`` once all the servers have been added.
+        """
+        try:
+            u = self._server_index[server]
+        except KeyError:
+            u = self._server_index[server] = len(self._servers)
+            self._servers.append(server)
+            self._edges.append([])
+            self._server_match.append(-1)
+        edges = self._edges[u]
+        known = set(edges)
+        added = False
+        for share in shares:
+            s = self._add_share(share)
+            if s not in known:
+                known.add(s)
+                edges.append(s)
+                added = True
+        if added and maximize:
+            self.maximize()
+
+    def _add_share(self, share):
+        try:
+            return self._share_index[share]
+        except KeyError:
+            s = self._share_index[share] = len(self._shares)
+            self._shares.append(share)
+            self._share_match.append(-1)
+            return s
+
+    def maximize(self):
+        """
+        Grow the matching until there is no augmenting path left.
+        """
+        while self._size < min(len(self._servers), len(self._shares)):
+            layer = self._layers()
+            if layer is None:
+                return
+            pos = [0] * len(self._servers)
+            for u in range(len(self._servers)):
+                if self._server_match[u] == -1 and self._augment(u, layer, pos):
+                    self._size += 1
+
+    def _layers(self):
+        """
+        Breadth-first search from every unmatched server, alternating
+        between unused and matched edges.
+
+        :return: each server's distance from an unmatched server (-1 if
+            unreachable), or None if no unmatched share can be reached.
+        """
+        layer = [-1] * len(self._servers)
+        queue = []
+        for u in range(len(self._servers)):
+            if self._server_match[u] == -1:
+                layer[u] = 0
+                queue.append(u)
+        found = False
+        for u in queue:
+            for s in self._edges[u]:
+                v = self._share_match[s]
+                if v == -1:
+                    found = True
+                elif layer[v] == -1:
+                    layer[v] = layer[u] + 1
+                    queue.append(v)
+        if not found:
+            return None
+        return layer
+
+    def _augment(self, root, layer, pos):
+        """
+        Depth-first search along the layers from the unmatched server
+        ``root`` to an unmatched share, and flip the edges of the path if
+        one is found. ``pos`` remembers how far each server's edges have
+        been searched in this phase, so no edge is searched twice.
+        """
+        servers = [root]
+        shares = []
+        while servers:
+            u = servers[-1]
+            edges = self._edges[u]
+            while pos[u] < len(edges):
+                s = edges[pos[u]]
+                pos[u] += 1
+                v = self._share_match[s]
+                if v == -1:
+                    shares.append(s)
+                    for (u, s) in zip(servers, shares):
+                        self._server_match[u] = s
+                        self._share_match[s] = u
+                    return True
+                if layer[v] == layer[u] + 1:
+                    servers.append(v)
+                    shares.append(s)
+                    break
+            else:
+                # a dead end for the rest of this phase
+                layer[u] = -1
+                servers.pop()
+                if shares:
+                    shares.pop()
+        return False
+
+    def size(self):
+        """
+        :return: the number of matched pairs, which is the
+            servers-of-happiness of everything added so far.
+        """
+        return self._size
+
+    def share_to_server(self):
+        """
+        :return: a dict of shareid -> the serverid it is matched with, or
+            None if it is not matched.
+        """
+        return {
+            self._shares[s]: (self._servers[u] if u != -1 else None)
+            for (s, u) in enumerate(self._share_match)
+        }
+
+
 def _calculate_mappings(peers, shares, servermap=None):
     """
     Given a set of peers, a set of shares, and a dictionary of server ->
@@ -113,60 +283,34 @@ def _calculate_mappings(peers, shares, servermap=None):
     of peers should only be one peer when returned, but it is possible to
     duplicate shares by adding additional servers to the set.
     """
-    peer_to_index, index_to_peer = _reindex(peers, 1)
-    share_to_index, index_to_share = _reindex(shares, len(peers) + 1)
-    shareIndices = [share_to_index[s] for s in shares]
-    if servermap:
-        graph = _servermap_flow_graph(peers, shares, servermap)
-    else:
-        peerIndices = [peer_to_index[peer] for peer in peers]
-        graph = _flow_network(peerIndices, shareIndices)
-    max_graph = _compute_maximum_graph(graph, shareIndices)
-    return _convert_mappings(index_to_peer, index_to_share, max_graph)
+    # every share appears in the result, even if no peer can take it
+    matching = ShareMatching(shares)
+    for peer in peers:
+        if servermap:
+            peer_shares = [s for s in servermap.get(peer, ()) if s in shares]
+        else:
+            peer_shares = shares
+        matching.add_server(peer, peer_shares, maximize=False)
+    matching.maximize()
+    return {
+        share: (set([peer]) if peer is not None else None)
+        for (share, peer) in matching.share_to_server().items()
+    }
 
 
 def _compute_maximum_graph(graph, shareIndices):
     """
-    This is an implementation of the Ford-Fulkerson method for finding
-    a maximum flow in a flow network applied to a bipartite graph.
-    Specifically, it is the Edmonds-Karp algorithm, since it uses a
-    BFS to find the shortest augmenting path at each iteration, if one
-    exists.
-
-    The implementation here is an adapation of an algorithm described in
-    "Introduction to Algorithms", Cormen et al, 2nd ed., pp 658-662.
+    Given a flow network in the form built by _servermap_flow_graph, return
+    a dict of shareIndex -> the peerIndex it is matched with, or None.
     """
-
     if graph == []:
         return {}
 
-    dim = len(graph)
-    flow_function = [[0 for sh in range(dim)] for s in range(dim)]
-    residual_graph, residual_function = residual_network(graph, flow_function)
-
-    while augmenting_path_for(residual_graph):
-        path = augmenting_path_for(residual_graph)
-        # Delta is the largest amount that we can increase flow across
-        # all of the edges in path. Because of the way that the residual
-        # function is constructed, f[u][v] for a particular edge (u, v)
-        # is the amount of unused capacity on that edge. Taking the
-        # minimum of a list of those values for each edge in the
-        # augmenting path gives us our delta.
-        delta = min(residual_function[u][v] for (u, v) in path)
-        for (u, v) in path:
-            flow_function[u][v] += delta
-            flow_function[v][u] -= delta
-            residual_graph, residual_function = residual_network(graph,flow_function)
-
-    new_mappings = {}
-    for shareIndex in shareIndices:
-        peer = residual_graph[shareIndex]
-        if peer == [dim - 1]:
-            new_mappings.setdefault(shareIndex, None)
-        else:
-            new_mappings.setdefault(shareIndex, peer[0])
-
-    return new_mappings
+    matching = ShareMatching(shareIndices)
+    for peerIndex in graph[0]:
+        matching.add_server(peerIndex, graph[peerIndex], maximize=False)
+    matching.maximize()
+    return matching.share_to_server()
 
 
 def _extract_ids(mappings):
@@ -294,32 +438,6 @@ def _reindex(items, base):
     return (item_to_index, index_to_item)
 
 
-def _flow_network(peerIndices, shareIndices):
-    """
-    Given set of peerIndices and a set of shareIndices, I create a flow network
-    to be used by _compute_maximum_graph. The return value is a two
-    dimensional list in the form of a flow network, where each index represents
-    a node, and the corresponding list represents all of the nodes it is connected
-    to.
-
-    This function is similar to allmydata.util.happinessutil.flow_network_for, but
-    we connect every peer with all shares instead of reflecting a supplied servermap.
-    """
-    graph = []
-    # The first entry in our flow network is the source.
-    # Connect the source to every server.
-    graph.append(peerIndices)
-    sink_num = len(peerIndices + shareIndices) + 1
-    # Connect every server with every share it can possibly store.
-    for peerIndex in peerIndices:
-        graph.insert(peerIndex, shareIndices)
-    # Connect every share with the sink.
-    for shareIndex in shareIndices:
-        graph.insert(shareIndex, [sink_num])
-    # Add an empty entry for the sink.
-    graph.append([])
-    return graph
-
 def share_placement(peers, readonly_peers, shares, peers_to_shares):
     """
     Generates the allocations the upload should based on the given
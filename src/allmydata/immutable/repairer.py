@@ -2,12 +2,20 @@
 Ported to Python 3.
 """
 
+import time
+
 from zope.interface import implementer
 from twisted.internet import defer
+from allmydata import uri
+from allmydata.codec import CRSEncoder
+from allmydata.hashtree import HashTree, IncompleteHashTree, BadHashError, \
+     empty_leaf_hash
 from allmydata.storage.server import si_b2a
-from allmydata.util import log, consumer
+from allmydata.util import log, consumer, dictutil, hashutil, mathutil
 from allmydata.util.assertutil import precondition
-from allmydata.interfaces import IEncryptedUploadable
+from allmydata.util.cputhreadpool import defer_to_thread
+from allmydata.util.deferredutil import async_to_deferred
+from allmydata.interfaces import IEncryptedUploadable, UploadUnhappinessError
 
 from allmydata.immutable import upload
 
@@ -42,9 +50,15 @@ class Repairer(log.PrefixingLogMixin):
     Before I send any new request to a server, I always ask the 'monitor'
     object that was passed into my constructor whether this task has been
     cancelled (by invoking its raise_if_cancelled() method).
+
+    If I am given the results of checking the file, I know which shares are
+    missing. If the others are well spread out, I hand the job to a
+    TargetedRepairer, which builds and uploads only those shares instead of
+    running a whole upload.
     """
 
-    def __init__(self, filenode, storage_broker, secret_holder, monitor):
+    def __init__(self, filenode, storage_broker, secret_holder, monitor,
+                 check_results=None):
         logprefix = si_b2a(filenode.get_storage_index())[:5]
         log.PrefixingLogMixin.__init__(self, "allmydata.immutable.repairer",
                                        prefix=logprefix)
@@ -52,10 +66,22 @@ class Repairer(log.PrefixingLogMixin):
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._monitor = monitor
+        self._check_results = check_results
         self._offset = 0
 
     def start(self):
         self.log("starting repair")
+        cr = self._check_results
+        # When the surviving shares are each on a server of their own,
+        # replacing the missing ones is all there is to do. Otherwise a full
+        # upload also spreads the doubled-up shares over more servers.
+        if (cr is not None
+            and cr.get_share_counter_good() < cr.get_encoding_expected()
+            and cr.get_happiness() == cr.get_share_counter_good()):
+            tr = TargetedRepairer(self._filenode, self._storage_broker,
+                                  self._secret_holder, self._monitor,
+                                  cr.get_sharemap())
+            return tr.start()
         d = self._filenode.get_segment_size()
         def _got_segsize(segsize):
             vcap = self._filenode.get_verify_cap()
@@ -95,3 +121,295 @@ class Repairer(log.PrefixingLogMixin):
         return self._filenode.get_storage_index()
     def close(self):
         pass
+
+
+def shares_to_encode(share_hash_tree, missing, num_shares):
+    """Decide which shares must be encoded to build replacements for the
+    ``missing`` share numbers.
+
+    Every replacement share carries the share hash tree nodes needed to
+    validate it, so any of those nodes which the downloader did not already
+    validate must be computed from the leaves beneath them: the block hash
+    tree roots of other shares, which means encoding those shares too
+    (although they are never uploaded), or the hashes of empty leaves.
+
+    :param share_hash_tree: An IncompleteHashTree holding every validated
+        node of the file's share hash tree.
+
+    :return: A tuple ``(shnums, padding)`` of the set of share numbers to
+        encode (including ``missing``) and the set of empty leaves whose
+        hashes are needed.
+    """
+    t = share_hash_tree
+    shnums = set(missing)
+    padding = set()
+    def _cover(i):
+        if t[i] is not None:
+            return
+        if i >= t.first_leaf_num:
+            leafnum = i - t.first_leaf_num
+            if leafnum < num_shares:
+                shnums.add(leafnum)
+            else:
+                padding.add(leafnum)
+            return
+        _cover(t.lchild(i))
+        _cover(t.rchild(i))
+    for shnum in missing:
+        for i in t.needed_for(t.first_leaf_num + shnum):
+            _cover(i)
+    return (shnums, padding)
+
+
+class TargetedRepairer(log.PrefixingLogMixin):
+    """I replace the missing shares of an immutable file, and only those.
+
+    A full repair runs the file through a CHKUploader, which encodes all N
+    shares and lets server selection place them again, often pushing copies
+    of shares which were not missing at all. Instead, I download the file
+    one segment at a time, ask the codec for just the missing share numbers
+    (plus any others whose block hash tree roots are needed to fill in the
+    share hash tree), and upload the missing shares to servers which agree
+    to hold them, preferring servers which hold no share of this file yet.
+    The new shares are identical to the ones that were lost: they carry the
+    original URI extension block, which the downloader has validated.
+
+    The ciphertext downloaded is the same as for a full repair (k blocks of
+    every segment), but only the missing shares are uploaded.
+    """
+
+    def __init__(self, filenode, storage_broker, secret_holder, monitor,
+                 sharemap):
+        """
+        :param sharemap: A dict mapping the number of each good share to the
+            set of servers holding it, as found by the checker.
+        """
+        logprefix = si_b2a(filenode.get_storage_index())[:5]
+        log.PrefixingLogMixin.__init__(self, "allmydata.immutable.repairer",
+                                       prefix=logprefix)
+        self._filenode = filenode
+        self._storage_broker = storage_broker
+        self._secret_holder = secret_holder
+        self._monitor = monitor
+        self._sharemap = sharemap
+        self._landlords = {} # shnum -> IStorageBucketWriter
+        self._servers = {} # shnum -> IServer
+        # shares the checker missed, which servers turned out to have
+        self._found = dictutil.DictOfSets()
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+
+    @async_to_deferred
+    async def start(self):
+        """Returns a Deferred that fires with an IUploadResults describing
+        the shares that were placed."""
+        started = time.time()
+        vcap = self._filenode.get_verify_cap()
+        k, N, size = vcap.needed_shares, vcap.total_shares, vcap.size
+        missing = sorted(set(range(N)) - set(self._sharemap))
+        self.log(format="targeted repair of shares %(missing)s",
+                 missing=missing, level=log.OPERATIONAL)
+
+        (UEB_s, known_hashes) = await self._filenode.get_share_hashes()
+        ueb = uri.unpack_extension(UEB_s)
+        segsize = ueb['segment_size']
+        num_segments = ueb['num_segments']
+        share_hash_tree = IncompleteHashTree(N)
+        share_hash_tree.set_hashes(known_hashes)
+        (to_encode, padding) = shares_to_encode(share_hash_tree, missing, N)
+        to_encode = sorted(to_encode)
+
+        num_share_hashes = len(
+            share_hash_tree.needed_for(share_hash_tree.first_leaf_num)) + 1
+        try:
+            await self._place_shares(missing, mathutil.div_ceil(size, k),
+                                     segsize // k, num_segments,
+                                     num_share_hashes, len(UEB_s))
+            if not self._landlords:
+                self.log("no servers would take the missing shares",
+                         level=log.UNUSUAL)
+                return self._make_results(vcap, ueb, started)
+            await self._send_to_all("put_header")
+            self._check_landlords()
+
+            codec = CRSEncoder()
+            codec.set_params(segsize, k, N)
+            tail_size = size - segsize * (num_segments - 1)
+            tail_codec = CRSEncoder()
+            tail_codec.set_params(mathutil.next_multiple(tail_size, k), k, N)
+
+            crypttext_hashes = []
+            block_hashes = dict((shnum, []) for shnum in to_encode)
+            for segnum in range(num_segments):
+                self._monitor.raise_if_cancelled()
+                is_tail = (segnum == num_segments - 1)
+                c = tail_codec if is_tail else codec
+                data = await self._read_segment(
+                    segnum * segsize, tail_size if is_tail else segsize)
+                crypttext_hashes.append(hashutil.crypttext_segment_hash(data))
+                block_size = c.get_block_size()
+                data += b"\x00" * (k * block_size - len(data))
+                pieces = [data[i:i+block_size]
+                          for i in range(0, len(data), block_size)]
+                (blocks, shnums) = await c.encode(pieces, to_encode)
+                dl = []
+                for (block, shnum) in zip(blocks, shnums):
+                    block_hashes[shnum].append(hashutil.block_hash(block))
+                    dl.append(self._send(shnum, "put_block", segnum, block))
+                await defer.gatherResults(dl)
+                self._check_landlords()
+
+            crypttext_hash_tree = HashTree(crypttext_hashes)
+            if crypttext_hash_tree[0] != ueb['crypttext_root_hash']:
+                raise BadHashError("regenerated ciphertext does not "
+                                   "match the crypttext_root_hash")
+            trees = await defer_to_thread(
+                lambda: dict((shnum, HashTree(hashes))
+                             for (shnum, hashes) in block_hashes.items()))
+            # This validates the roots of the regenerated block hash trees
+            # against the share_root_hash from the URI extension block.
+            leaves = dict((shnum, t[0]) for (shnum, t) in trees.items())
+            leaves.update((i, empty_leaf_hash(i)) for i in padding)
+            share_hash_tree.set_hashes(leaves=leaves)
+
+            await self._send_to_all("put_crypttext_hashes",
+                                    lambda shnum: (list(crypttext_hash_tree),))
+            await self._send_to_all("put_block_hashes",
+                                    lambda shnum: (list(trees[shnum]),))
+            def _share_hashes(shnum):
+                leaf = share_hash_tree.first_leaf_num + shnum
+                needed = share_hash_tree.needed_for(leaf) + [leaf]
+                return ([(i, share_hash_tree[i]) for i in sorted(needed)],)
+            await self._send_to_all("put_share_hashes", _share_hashes)
+            await self._send_to_all("put_uri_extension", lambda shnum: (UEB_s,))
+            await self._send_to_all("close")
+            self._check_landlords()
+        except Exception:
+            # don't leave the servers holding space for shares which will
+            # never be finished
+            self._abort_all()
+            raise
+
+        self.bytes_uploaded = sum(self._landlords[shnum].get_allocated_size()
+                                  for shnum in self._landlords)
+        self.log(format="targeted repair placed shares %(placed)s:"
+                 " downloaded %(down)d bytes of ciphertext,"
+                 " uploaded %(up)d bytes of shares",
+                 placed=sorted(self._landlords), down=self.bytes_downloaded,
+                 up=self.bytes_uploaded, level=log.OPERATIONAL)
+        return self._make_results(vcap, ueb, started)
+
+    async def _place_shares(self, missing, share_size, block_size,
+                            num_segments, num_share_hashes,
+                            uri_extension_size):
+        si = self._filenode.get_storage_index()
+        file_renewal_secret = hashutil.file_renewal_secret_hash(
+            self._secret_holder.get_renewal_secret(), si)
+        file_cancel_secret = hashutil.file_cancel_secret_hash(
+            self._secret_holder.get_cancel_secret(), si)
+        holders = set()
+        for servers in self._sharemap.values():
+            holders.update(s.get_serverid() for s in servers)
+
+        trackers = []
+        for server in self._storage_broker.get_servers_for_psi(si, for_upload=True):
+            seed = server.get_lease_seed()
+            tracker = upload.ServerTracker(
+                server, share_size, block_size, num_segments,
+                num_share_hashes, si,
+                hashutil.bucket_renewal_secret_hash(file_renewal_secret, seed),
+                hashutil.bucket_cancel_secret_hash(file_cancel_secret, seed),
+                uri_extension_size)
+            v1 = server.get_version()[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+            if v1[b"maximum-immutable-share-size"] >= tracker.allocated_size:
+                trackers.append(tracker)
+        # Servers which hold no share of this file come first, so that the
+        # new shares add to the file's servers-of-happiness, then the others.
+        trackers.sort(key=lambda t: t.get_serverid() in holders)
+
+        used = set()
+        for shnum in missing:
+            self._monitor.raise_if_cancelled()
+            # spread the new shares over as many servers as possible
+            candidates = ([t for t in trackers if t not in used] +
+                          [t for t in trackers if t in used])
+            for tracker in candidates:
+                try:
+                    (alreadygot, allocated) = await tracker.query({shnum})
+                except Exception as e:
+                    self.log(format="error allocating share %(shnum)d on"
+                             " %(server)s: %(e)s", shnum=shnum,
+                             server=tracker.get_name(), e=str(e),
+                             level=log.UNUSUAL)
+                    trackers.remove(tracker)
+                    continue
+                if shnum in allocated:
+                    self._landlords[shnum] = tracker.buckets[shnum]
+                    self._servers[shnum] = tracker.get_server()
+                    used.add(tracker)
+                    break
+                if shnum in alreadygot:
+                    # The checker did not see this share, but it is there.
+                    self._found.add(shnum, tracker.get_server())
+                    break
+            else:
+                self.log(format="no server would accept share %(shnum)d",
+                         shnum=shnum, level=log.UNUSUAL)
+
+    async def _read_segment(self, offset, length):
+        mc = consumer.MemoryConsumer()
+        await self._filenode.read(mc, offset, length)
+        data = b"".join(mc.chunks)
+        self.bytes_downloaded += len(data)
+        return data
+
+    def _send(self, shnum, method, *args):
+        if shnum not in self._landlords:
+            return defer.succeed(None)
+        d = getattr(self._landlords[shnum], method)(*args)
+        d.addErrback(self._remove_shareholder, shnum, method)
+        return d
+
+    def _send_to_all(self, method, get_args=lambda shnum: ()):
+        return defer.gatherResults([self._send(shnum, method, *get_args(shnum))
+                                    for shnum in list(self._landlords)])
+
+    def _remove_shareholder(self, why, shnum, method):
+        self.log(format="error while sending %(method)s for share %(shnum)d",
+                 method=method, shnum=shnum, failure=why, level=log.UNUSUAL)
+        if shnum in self._landlords:
+            self._landlords.pop(shnum).abort()
+            del self._servers[shnum]
+
+    def _check_landlords(self):
+        """Give up as soon as every server we were uploading to has failed,
+        rather than carrying on with nothing left to upload to."""
+        if not self._landlords:
+            raise UploadUnhappinessError("targeted repair lost every server"
+                                         " it was uploading shares to")
+
+    def _abort_all(self):
+        for shnum in list(self._landlords):
+            self._landlords.pop(shnum).abort()
+            del self._servers[shnum]
+
+    def _make_results(self, vcap, ueb, started):
+        sharemap = dictutil.DictOfSets()
+        servermap = dictutil.DictOfSets()
+        for (shnum, server) in self._servers.items():
+            sharemap.add(shnum, server)
+            servermap.add(server, shnum)
+        for (shnum, servers) in self._found.items():
+            for server in servers:
+                sharemap.add(shnum, server)
+        return upload.UploadResults(
+            file_size=vcap.size,
+            ciphertext_fetched=0,
+            preexisting_shares=len(self._sharemap),
+            pushed_shares=len(self._servers),
+            sharemap=sharemap,
+            servermap=servermap,
+            timings={"total": time.time() - started},
+            uri_extension_data=ueb,
+            uri_extension_hash=vcap.uri_extension_hash,
+            verifycapstr=vcap.to_string())
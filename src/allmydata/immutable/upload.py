@@ -29,8 +29,7 @@ from allmydata import hashtree, uri
 from allmydata.storage.server import si_b2a
 from allmydata.immutable import encode
 from allmydata.util import base32, dictutil, idlib, log, mathutil
-from allmydata.util.happinessutil import servers_of_happiness, \
-    merge_servers, failure_message
+from allmydata.util.happinessutil import merge_servers, failure_message
 from allmydata.util.assertutil import precondition, _assert
 from allmydata.util.rrefutil import add_version_to_remote_reference
 from allmydata.interfaces import IUploadable, IUploader, IUploadResults, \
@@ -40,7 +39,9 @@ from allmydata.interfaces import IUploadable, IUploader, IUploadResults, \
 from allmydata.immutable import layout
 
 from io import BytesIO
-from .happiness_upload import share_placement, calculate_happiness
+from .happiness_upload import (
+    ShareMatching, share_placement, calculate_happiness,
+)
 
 from ..util.eliotutil import (
     log_call_deferred,
@@ -406,6 +407,62 @@ class _QueryStatistics:
             )
 
 
+class RecentServers:
+    """
+    What recent uploads have learned about storage servers: which of them
+    refused shares (because they were full or failed) and how much space
+    has been allocated on each since.  Fast-path server selection uses this
+    to leave out servers which would probably refuse, instead of finding
+    out with another round of queries.
+
+    :param ttl: how many seconds refusals and allocations are remembered
+        for.  Allocations are forgotten too, because by then the server has
+        likely announced how much space it has left again, and their shares
+        may well have been deleted or moved.
+    """
+
+    def __init__(self, ttl=10*60):
+        self._ttl = ttl
+        self._refused = {} # serverid -> when
+        self._allocated = {} # serverid -> [(when, bytes)] by recent uploads
+
+    def record_allocated(self, serverid, size, now):
+        self._refused.pop(serverid, None)
+        self._allocated.setdefault(serverid, []).append((now, size))
+
+    def record_refused(self, serverid, now):
+        self._refused[serverid] = now
+
+    def _recently_allocated(self, serverid, now):
+        allocations = [(when, size)
+                       for (when, size) in self._allocated.get(serverid, [])
+                       if now - when < self._ttl]
+        if allocations:
+            self._allocated[serverid] = allocations
+        else:
+            self._allocated.pop(serverid, None)
+        return sum(size for (when, size) in allocations)
+
+    def is_likely_to_refuse(self, server, allocated_size, now):
+        """
+        :return: ``True`` if ``server`` refused shares recently, or is
+            expected to have less than ``allocated_size`` bytes left: the
+            space it announced, less what recent uploads have allocated.
+        """
+        serverid = server.get_serverid()
+        refused = self._refused.get(serverid)
+        if refused is not None:
+            if now - refused < self._ttl:
+                return True
+            del self._refused[serverid]
+        v1 = server.get_version()[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+        available = v1.get(b"available-space")
+        if available is None:
+            return False
+        allocated = self._recently_allocated(serverid, now)
+        return available - allocated < allocated_size
+
+
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
     def __init__(self, upload_id, logparent=None, upload_status=None, reactor=None):
@@ -470,8 +527,19 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
     def get_shareholders(self, storage_broker, secret_holder,
                          storage_index, share_size, block_size,
                          num_segments, total_shares, needed_shares,
-                         min_happiness, uri_extension_size):
+                         min_happiness, uri_extension_size,
+                         fast_path=False, recent_servers=None):
         """
+        @param fast_path: if True, skip asking the servers which shares they
+                 already hold before the first round of allocations.  This
+                 saves a round trip, and is only right when no shares can
+                 already exist, as for a storage index derived from a random
+                 key.
+
+        @param recent_servers: a RecentServers to learn from and, on the
+                 fast path, to leave out servers which would probably refuse
+                 shares.
+
         @return: (upload_trackers, already_serverids), where upload_trackers
                  is a set of ServerTracker instances that have agreed to hold
                  some shares for us (the shareids are stashed inside the
@@ -492,11 +560,15 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         self.total_shares = total_shares
         self.min_happiness = min_happiness
         self.needed_shares = needed_shares
+        self._recent_servers = recent_servers
 
         self.homeless_shares = set(range(total_shares))
         self.use_trackers = set() # ServerTrackers that have shares assigned
                                   # to them
         self.preexisting_shares = {} # shareid => set(serverids) holding shareid
+        # the servers-of-happiness of the pre-existing shares and those we
+        # have allocated, updated as each server answers
+        self._happiness = ShareMatching()
 
         # These servers have shares -- any shares -- for our SI. We keep
         # track of these to write an error message with them later.
@@ -515,6 +587,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                                              num_share_hashes,
                                              uri_extension_size)
         allocated_size = wbp.get_allocated_size()
+        self._allocated_size = allocated_size
 
         # decide upon the renewal/cancel secrets, to include them in the
         # allocate_buckets query.
@@ -541,6 +614,14 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 storage_index, renew, cancel, uri_extension_size
             )
 
+        if fast_path and recent_servers is not None:
+            now = self._reactor.seconds()
+            likely = [server for server in all_servers
+                      if not recent_servers.is_likely_to_refuse(
+                              server, allocated_size, now)]
+            if len(likely) >= min_happiness:
+                all_servers = likely
+
         readonly_trackers, write_trackers = self._create_trackers(
             all_servers[:(2 * total_shares)],
             allocated_size,
@@ -557,7 +638,12 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         # with error (i.e. just removed from the list)
 
         ds = []
-        if self._status and readonly_trackers:
+        if fast_path:
+            # go straight to allocating
+            readonly_probe, write_probe = [], []
+        else:
+            readonly_probe, write_probe = readonly_trackers, list(write_trackers)
+        if self._status and readonly_probe:
             self._status.set_status(
                 "Contacting readonly servers to find any existing shares"
             )
@@ -569,7 +655,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         # "actual allocation queries" only, because those are the only
         # things that actually affect what the server does.
 
-        for tracker in readonly_trackers:
+        for tracker in readonly_probe:
             assert isinstance(tracker, ServerTracker)
             d = timeout_call(self._reactor, tracker.ask_about_existing_shares(), 15)
             d.addBoth(self._handle_existing_response, tracker)
@@ -577,7 +663,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             self.log("asking server %r for any existing shares" %
                      (tracker.get_name(),), level=log.NOISY)
 
-        for tracker in write_trackers:
+        for tracker in write_probe:
             assert isinstance(tracker, ServerTracker)
             d = timeout_call(self._reactor, tracker.ask_about_existing_shares(), 15)
 
@@ -659,8 +745,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                     placements.append(d)
 
             yield defer.DeferredList(placements)
-            merged = merge_servers(self.peer_selector.get_sharemap_of_preexisting_shares(), self.use_trackers)
-            effective_happiness = servers_of_happiness(merged)
+            effective_happiness = self._happiness.size()
             if effective_happiness == last_happiness:
                 # print("effective happiness still {}".format(last_happiness))
                 # we haven't improved over the last iteration; give up
@@ -676,10 +761,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         # we *do* want to count those shares towards total happiness.
 
         # no more servers. If we haven't placed enough shares, we fail.
-        # XXX note sometimes we're not running the loop at least once,
-        # and so 'merged' must be (re-)computed here.
         merged = merge_servers(self.peer_selector.get_sharemap_of_preexisting_shares(), self.use_trackers)
-        effective_happiness = servers_of_happiness(merged)
+        effective_happiness = self._happiness.size()
 
         # print("placements completed {} vs {}".format(effective_happiness, min_happiness))
         # for k, v in merged.items():
@@ -740,6 +823,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 self.peer_selector.add_peer_with_share(serverid, bucket)
                 self.preexisting_shares.setdefault(bucket, set()).add(serverid)
                 self.homeless_shares.discard(bucket)
+            self._happiness.add_server(serverid, buckets)
 
     def _handle_existing_write_response(self, res, tracker, shares_to_ask):
         """
@@ -756,6 +840,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         else:
             for share in res.keys():
                 self.peer_selector.add_peer_with_share(tracker.get_serverid(), share)
+            self._happiness.add_server(tracker.get_serverid(), res.keys())
 
     def _get_progress_message(self):
         if not self.homeless_shares:
@@ -821,6 +906,9 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             self._query_stats.error += 1
             self._query_stats.bad += 1
             self.homeless_shares |= shares_to_ask
+            if self._recent_servers is not None:
+                self._recent_servers.record_refused(tracker.get_serverid(),
+                                                    self._reactor.seconds())
             try:
                 self.peer_selector.mark_readonly_peer(tracker.get_serverid())
             except KeyError:
@@ -846,6 +934,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             # that peer. We just have to remember to use them.
             if allocated:
                 self.use_trackers.add(tracker)
+                self._happiness.add_server(tracker.get_serverid(), allocated)
                 progress = True
 
             if allocated or alreadygot:
@@ -854,6 +943,16 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             not_yet_present = set(shares_to_ask) - set(alreadygot)
             still_homeless = not_yet_present - set(allocated)
 
+            if self._recent_servers is not None:
+                if still_homeless:
+                    self._recent_servers.record_refused(
+                        tracker.get_serverid(), self._reactor.seconds())
+                elif allocated:
+                    self._recent_servers.record_allocated(
+                        tracker.get_serverid(),
+                        len(allocated) * self._allocated_size,
+                        self._reactor.seconds())
+
             if still_homeless:
                 # In networks with lots of space, this is very unusual and
                 # probably indicates an error. In networks with servers that
@@ -1210,10 +1309,13 @@ class UploadStatus:
 
 class CHKUploader:
 
-    def __init__(self, storage_broker, secret_holder, reactor=None):
+    def __init__(self, storage_broker, secret_holder, reactor=None,
+                 fast_server_selection=False, recent_servers=None):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._fast_server_selection = fast_server_selection
+        self._recent_servers = recent_servers
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._storage_index = None
@@ -1311,7 +1413,9 @@ class CHKUploader:
                                              storage_index,
                                              share_size, block_size,
                                              num_segments, n, k, desired,
-                                             encoder.get_uri_extension_size())
+                                             encoder.get_uri_extension_size(),
+                                             fast_path=self._fast_server_selection,
+                                             recent_servers=self._recent_servers)
         def _done(res):
             self._server_selection_elapsed = time.time() - server_selection_started
             return res
@@ -1733,6 +1837,54 @@ class BaseUploadable:
         d.addCallback(_got_size)
         return d
 
+class ConvergentHashingFile:
+    """
+    A wrapper around a file which is being written with the contents of an
+    upload, which computes the convergent encryption key of those contents
+    as they are written.  A ``FileHandle`` reading from me then need not read
+    the whole file once to compute the key and then again to encrypt it.
+
+    The key depends on the encoding parameters as well as the contents, so
+    it is computed with the parameters the upload is expected to use; if it
+    ends up using others, the ``FileHandle`` computes the key itself.
+
+    :param f: the file to write to.
+    :param size: how many bytes will be written.
+    :param convergence: the convergence secret.
+    :param default_params: the default encoding parameters, as passed to
+        ``IUploadable.set_default_encoding_parameters``.
+    """
+
+    def __init__(self, f, size, convergence, default_params):
+        k = default_params["k"]
+        segsize = min(default_params["max_segment_size"], size)
+        segsize = mathutil.next_multiple(segsize, k)
+        self._f = f
+        self._size = size
+        self._written = 0
+        self._params = (k, default_params["n"], segsize, convergence)
+        self._hasher = convergence_hasher(*self._params)
+
+    def write(self, data):
+        self._f.write(data)
+        self._hasher.update(data)
+        self._written += len(data)
+
+    def get_convergent_key(self, k, n, segsize, convergence):
+        """
+        :return: the encryption key for the contents written to me with these
+            parameters, or ``None`` if I did not compute it.
+        """
+        if (k, n, segsize, convergence) != self._params:
+            return None
+        if self._written != self._size:
+            return None
+        return self._hasher.digest()
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
 @implementer(IUploadable)
 class FileHandle(BaseUploadable):
 
@@ -1759,6 +1911,12 @@ class FileHandle(BaseUploadable):
         def _got(params):
             k, happy, n, segsize = params
             f = self._filehandle
+            if isinstance(f, ConvergentHashingFile):
+                self._key = f.get_convergent_key(k, n, segsize, self.convergence)
+                if self._key is not None:
+                    if self._status:
+                        self._status.set_progress(0, 1.0)
+                    return self._key
             enckey_hasher = convergence_hasher(k, n, segsize, self.convergence)
             f.seek(0)
             BLOCKSIZE = 64*1024
@@ -1851,6 +2009,7 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
         self.stats_provider = stats_provider
         self._history = history
         self._helper = None
+        self._recent_servers = RecentServers()
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         log.PrefixingLogMixin.__init__(self, facility="tahoe.immutable.upload")
         service.MultiService.__init__(self)
@@ -1918,7 +2077,13 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder, reactor=reactor)
+                    # a storage index derived from a random key is new, so
+                    # no server can hold shares for it yet
+                    random_key = getattr(uploadable, "convergence", b"") is None
+                    uploader = CHKUploader(storage_broker, secret_holder,
+                                           reactor=reactor,
+                                           fast_server_selection=random_key,
+                                           recent_servers=self._recent_servers)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
@@ -332,6 +332,27 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.add_lease``
         """
 
+    def add_leases(leases):
+        """
+        Add or renew leases on the shares of many storage indexes, as
+        ``add_lease`` would for each of them, in as few round trips as the
+        server supports.
+
+        :param leases: a sequence of ``(storage_index, renew_secret,
+            cancel_secret)`` tuples.
+
+        :return: a Deferred firing with a 2-tuple of sets of storage indexes:
+            those the server is known to have no shares for, and those whose
+            leases could not be added.  Servers which cannot report missing
+            storage indexes always give an empty first set.
+        """
+
+    def has_batch_leases() -> bool:
+        """
+        :return: whether ``add_leases`` sends a whole batch in one round trip,
+            rather than one request per storage index.
+        """
+
     def get_buckets(
             storage_index,
     ):
@@ -1373,6 +1394,23 @@ class IDirectoryNode(IFilesystemNode):
         equivalent to calling set_node() multiple times, but is much more
         efficient."""
 
+    def create_batch():
+        """I return an empty batch of changes to this directory. Call its
+        set_node(name, child, metadata=None, overwrite=True) and
+        delete(name, must_exist=True) methods to queue additions and
+        removals, then give it to apply_batch()."""
+
+    def apply_batch(batch):
+        """I make all the changes queued in a batch from create_batch() with
+        a single modification of the directory, in the order they were
+        queued. Each change succeeds or fails on its own. I return a Deferred
+        that fires with the batch, whose 'results' attribute is then a list
+        with the added or removed node (None for the removal of a child
+        that did not exist) or a Failure for each change.
+
+        If this directory node is read-only, the Deferred will errback with a
+        NotWriteableError."""
+
     def add_file(name, uploadable, metadata=None, overwrite=True):
         """I upload a file (using the given IUploadable), then attach the
         resulting ImmutableFileNode to the directory at the given name. I set
@@ -1470,6 +1508,28 @@ class IDirectoryNode(IFilesystemNode):
         takes several minutes of 100% CPU for ~1700 directories).
         """
 
+    def start_deep_renew_leases():
+        """Return a Monitor, adding or renewing this client's leases on the
+        shares of all nodes (directories and files) reachable from this one.
+        The leases are sent to every connected storage server in batches of
+        many storage indexes per request. The Monitor's results will be a
+        dictionary with the following keys::
+
+           count-objects: how many objects with shares were found
+           count-servers: how many servers were asked to renew leases
+           count-requests: how many batches the servers handled
+           count-leases-renewed: how many (object, server) leases were
+                                 added or renewed; servers which cannot
+                                 report objects they hold no shares for
+                                 count all of them
+           count-leases-failed: how many (object, server) leases the servers
+                                could not add
+           count-servers-failed: how many batches failed altogether
+
+        The Monitor will also have an .origin_si attribute with the (binary)
+        storage index of the starting point.
+        """
+
 
 class ICodecEncoder(Interface):
     def set_params(data_size, required_shares, max_shares):
@@ -2195,11 +2255,17 @@ class ICheckable(Interface):
 
 
 class IDeepCheckable(Interface):
-    def start_deep_check(verify=False, add_lease=False):
+    def start_deep_check(verify=False, add_lease=False, check_index=None):
         """Check upon the health of me and everything I can reach.
 
         This is a recursive form of check(), useable only on dirnodes.
 
+        If check_index (an allmydata.check_index.CheckIndex) is given, the
+        check is incremental: objects which the index says were checked
+        recently are skipped, directories which have not changed and have
+        nothing due below them are not listed, and the index is updated
+        with everything that was checked.
+
         I return a Monitor, with results that are an IDeepCheckResults
         object.
 
@@ -2210,12 +2276,12 @@ class IDeepCheckable(Interface):
         failure.
         """
 
-    def start_deep_check_and_repair(verify=False, add_lease=False):
+    def start_deep_check_and_repair(verify=False, add_lease=False, check_index=None):
         """Check upon the health of me and everything I can reach. Repair
         anything that isn't healthy.
 
         This is a recursive form of check_and_repair(), useable only on
-        dirnodes.
+        dirnodes. check_index is as for start_deep_check().
 
         I return a Monitor, with results that are an
         IDeepCheckAndRepairResults object.
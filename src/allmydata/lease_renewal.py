@@ -0,0 +1,183 @@
+"""
+Keep a whole tree of files and directories alive by renewing the leases on
+all of their shares, using the batch lease operation of the storage servers.
+
+``DeepLeaseRenewer`` is a ``deep_traverse`` walker.  It collects the storage
+index of everything reachable from a directory and, every
+``MAX_LEASES_PER_REQUEST`` storage indexes, asks each connected server with a
+batch lease operation to add or renew the leases for that whole batch in one
+request.  Servers which do not hold shares for some of the storage indexes
+just say so; this costs them far less than the client finding out which
+servers hold which shares first.
+
+Servers without the batch operation (all Foolscap servers, and HTTP servers
+which predate it) would need one request per storage index anyway, so they
+are first asked which of the storage indexes they hold shares for, and only
+those leases are added.
+"""
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from allmydata.storage.http_common import MAX_LEASES_PER_REQUEST
+from allmydata.util import base32, log
+from allmydata.util.hashutil import (
+    bucket_cancel_secret_hash,
+    bucket_renewal_secret_hash,
+    file_cancel_secret_hash,
+    file_renewal_secret_hash,
+)
+
+
+# How many requests to have outstanding at once on a server without the batch
+# lease operation.
+PER_SERVER_QUERIES = 10
+
+
+class DeepLeaseRenewer:
+    """
+    :param origin: the directory the walk starts from.
+    :param storage_broker: supplies the servers to renew leases on.
+    :param secret_holder: supplies the client's lease secrets.
+    :param batch_size: how many storage indexes to send in each request.
+    """
+
+    def __init__(self, origin, storage_broker, secret_holder,
+                 batch_size=MAX_LEASES_PER_REQUEST):
+        self.monitor = None
+        self.origin = origin
+        self._storage_broker = storage_broker
+        self._renewal_secret = secret_holder.get_renewal_secret()
+        self._cancel_secret = secret_holder.get_cancel_secret()
+        self._batch_size = batch_size
+        self._pending = []
+        self._servers = set()
+        # the storage indexes of mutable objects, whose shares are found
+        # differently
+        self._mutable = set()
+        self.stats = {}
+        for k in ["count-objects",
+                  "count-requests",
+                  "count-leases-renewed",
+                  "count-leases-failed",
+                  "count-servers-failed",
+                  ]:
+            self.stats[k] = 0
+
+    def set_monitor(self, monitor):
+        self.monitor = monitor
+        monitor.origin_si = self.origin.get_storage_index()
+        monitor.set_status(self.get_results())
+
+    def add_node(self, node, childpath):
+        si = node.get_storage_index()
+        if si is None:
+            # LIT files and unknown nodes have no shares
+            return None
+        self.stats["count-objects"] += 1
+        self._pending.append(si)
+        if node.is_mutable():
+            self._mutable.add(si)
+        if len(self._pending) >= self._batch_size:
+            return self._flush()
+        return None
+
+    def enter_directory(self, parent, children):
+        pass
+
+    def _flush(self):
+        (batch, self._pending) = (self._pending, [])
+        if not batch:
+            return defer.succeed(None)
+        mutable = self._mutable.intersection(batch)
+        self._mutable.difference_update(mutable)
+        dl = []
+        for server in self._storage_broker.get_connected_servers():
+            storage_server = server.get_storage_server()
+            if storage_server is None:
+                continue
+            self._servers.add(server.get_serverid())
+            leases = self._make_leases(batch, server.get_lease_seed())
+            if storage_server.has_batch_leases():
+                d = storage_server.add_leases(leases)
+            else:
+                d = self._add_leases_to_holders(server, storage_server,
+                                                leases, mutable)
+            d.addCallbacks(self._renewed, self._server_failed,
+                           callbackArgs=(len(batch),),
+                           errbackArgs=(server,))
+            dl.append(d)
+        d = defer.DeferredList(dl)
+        d.addCallback(lambda ignored: self.monitor.set_status(
+            self.get_results()))
+        return d
+
+    def _make_leases(self, storage_indexes, lease_seed):
+        leases = []
+        for si in storage_indexes:
+            frs = file_renewal_secret_hash(self._renewal_secret, si)
+            fcs = file_cancel_secret_hash(self._cancel_secret, si)
+            leases.append((si,
+                           bucket_renewal_secret_hash(frs, lease_seed),
+                           bucket_cancel_secret_hash(fcs, lease_seed)))
+        return leases
+
+    def _add_leases_to_holders(self, server, storage_server, leases, mutable):
+        """
+        Add leases one storage index at a time, on only those storage indexes
+        the server says it holds shares for.
+
+        :param mutable: the storage indexes which belong to mutable objects.
+
+        :return: a Deferred firing with the same ``(missing, failed)`` 2-tuple
+            as ``IStorageServer.add_leases``.
+        """
+        missing = set()
+        failed = set()
+        limiter = defer.DeferredSemaphore(PER_SERVER_QUERIES)
+
+        @defer.inlineCallbacks
+        def add_lease(si, renew_secret, cancel_secret):
+            try:
+                if si in mutable:
+                    shares = yield storage_server.slot_readv(si, [], [(0, 0)])
+                else:
+                    shares = yield storage_server.get_buckets(si)
+                if not shares:
+                    missing.add(si)
+                    return
+                yield storage_server.add_lease(si, renew_secret,
+                                               cancel_secret)
+            except Exception:
+                log.msg(format="unable to renew lease on %(si)s on %(server)s",
+                        si=base32.b2a(si), server=server.get_name(),
+                        failure=Failure(), level=log.UNUSUAL, umid="dH6vKe")
+                failed.add(si)
+
+        d = defer.gatherResults([
+            limiter.run(add_lease, si, renew_secret, cancel_secret)
+            for (si, renew_secret, cancel_secret) in leases])
+        d.addCallback(lambda ignored: (missing, failed))
+        return d
+
+    def _renewed(self, result, count):
+        (missing, failed) = result
+        self.stats["count-requests"] += 1
+        self.stats["count-leases-renewed"] += count - len(missing) - len(failed)
+        self.stats["count-leases-failed"] += len(failed)
+
+    def _server_failed(self, f, server):
+        log.msg(format="unable to renew leases on %(server)s",
+                server=server.get_name(), failure=f,
+                level=log.UNUSUAL, umid="lR3nWq")
+        self.stats["count-servers-failed"] += 1
+
+    def get_results(self):
+        stats = self.stats.copy()
+        stats["count-servers"] = len(self._servers)
+        return stats
+
+    def finish(self):
+        d = self._flush()
+        d.addCallback(lambda ignored: self.get_results())
+        return d
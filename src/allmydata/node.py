@@ -49,6 +49,12 @@ from . import (
 from .protocol_switch import create_tub_with_https_support
 
 
+def _is_valid_logging_item(section_name, item_name):
+    """
+    [logging] accepts threshold.<facility> for any facility.
+    """
+    return section_name == "logging" and item_name.startswith("threshold.")
+
 def _common_valid_config():
     return configutil.ValidConfiguration({
         "connections": (
@@ -87,7 +93,10 @@ def _common_valid_config():
             "onion.external_port",
             "onion.private_key_file",
         ),
-    })
+        "logging": (
+            "threshold",
+        ),
+    }, is_valid_item=_is_valid_logging_item)
 
 # group 1 will be addr (dotted quad string), group 3 if any will be portnum (string)
 ADDR_RE = re.compile(r"^([1-9][0-9]*\.[1-9][0-9]*\.[1-9][0-9]*\.[1-9][0-9]*)(:([1-9][0-9]*))?$")
@@ -1091,6 +1100,12 @@ class Node(service.MultiService):
         self.log_tub.setOption("log-gatherer-furlfile",
                                self.config.get_config_path("log_gatherer.furl"))
 
+        for (name, value) in self.config.items("logging", []):
+            if name == "threshold":
+                log.set_threshold(log.parse_level(value))
+            elif name.startswith("threshold."):
+                log.set_threshold(log.parse_level(value), name[len("threshold."):])
+
         incident_dir = self.config.get_config_path("logs", "incidents")
         foolscap.logging.log.setLogDir(incident_dir)
         twlog.msg("Foolscap logging initialized")
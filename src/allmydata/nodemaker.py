@@ -27,7 +27,7 @@ class NodeMaker:
     def __init__(self, storage_broker, secret_holder, history,
                  uploader, terminator,
                  default_encoding_parameters, mutable_file_default,
-                 key_generator, blacklist=None):
+                 key_generator, blacklist=None, path_cache=None):
         self.storage_broker = storage_broker
         self.secret_holder = secret_holder
         self.history = history
@@ -37,6 +37,7 @@ class NodeMaker:
         self.mutable_file_default = mutable_file_default
         self.key_generator = key_generator
         self.blacklist = blacklist
+        self.path_cache = path_cache
 
         self._node_cache = weakref.WeakValueDictionary() # uri -> node
 
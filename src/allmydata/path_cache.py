@@ -0,0 +1,140 @@
+"""
+A bounded cache of directory contents, for resolving paths below a
+directory without retrieving every directory along the way.
+
+Looking up ``a/b/c/file`` below a directory retrieves four directories, one
+after another. The ``PathCache`` remembers the children of directories that
+were listed recently, so when the directories along a path are all
+remembered, resolving it costs no retrieves, and only the file at the end
+has to be downloaded.
+
+Only the caps and metadata of the children are remembered, not their nodes,
+so that the directory builds a fresh node through the ``NodeMaker`` (with
+its node cache and blacklist) whenever a child is looked up.
+
+Nothing checks whether a remembered mutable directory has since been
+changed by another client, since that would cost the retrieve the cache is
+there to save. So the cache is off unless the client is configured with
+``path_cache.max_entries``.
+
+A remembered listing is forgotten:
+
+* when the directory is modified through this client. A listing which was
+  started before the modification finished is not remembered at all, so a
+  slow read cannot bring back the old contents;
+* ``ttl`` seconds after a mutable directory was listed, which bounds how
+  long a change made by another client can go unnoticed;
+* when it is the least recently used and the cache is full.
+
+Immutable directories never change, so their listings are only evicted.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class PathCache:
+    """
+    :param int max_entries: the most children to remember, across all
+        directories. A directory with more children than this is never
+        remembered.
+    :param float ttl: how many seconds the listing of a mutable directory is
+        used for.
+    """
+
+    def __init__(self, max_entries=10000, ttl=30, now=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._now = now
+        # dircap -> (expires, {name: (writecap, readcap, metadata)})
+        self._listings = OrderedDict()
+        self._size = 0
+        self._generation = 0
+        # storage index -> generation in which the directory was modified
+        self._modified = {}
+        # listings started before this generation may have missed a
+        # modification which is no longer in self._modified
+        self._modified_before = 0
+        self.hits = 0
+        self.misses = 0
+
+    def start_listing(self):
+        """
+        :return: a token to give to ``remember`` once the listing started now
+            has been read.
+        """
+        return self._generation
+
+    def remember(self, dirnode, token, children):
+        """
+        Remember the children of a directory which were just read, unless
+        the directory was modified since the listing was started.
+
+        :param token: the result of ``start_listing`` before the read.
+        :param dict children: maps child name to (node, metadata). Only the
+            caps of the nodes are remembered.
+        """
+        si = dirnode.get_storage_index()
+        if token < self._modified_before or token < self._modified.get(si, 0):
+            return
+        key = dirnode.get_uri()
+        self._discard(key)
+        if len(children) >= self.max_entries:
+            return
+        expires = None
+        if dirnode.is_mutable():
+            expires = self._now() + self.ttl
+        self._listings[key] = (expires, {
+            name: (node.get_write_uri(), node.get_readonly_uri(), metadata)
+            for (name, (node, metadata)) in children.items()
+        })
+        # even an empty directory takes up an entry
+        self._size += len(children) + 1
+        while self._size > self.max_entries:
+            (ignored, (expires, old)) = self._listings.popitem(last=False)
+            self._size -= len(old) + 1
+
+    def lookup(self, dirnode, name):
+        """
+        :param str name: a normalized child name.
+
+        :return: the (writecap, readcap, metadata) of the named child of a
+            directory, or None if it is not known without reading the
+            directory.
+        """
+        key = dirnode.get_uri()
+        entry = self._listings.get(key)
+        if entry is not None:
+            (expires, children) = entry
+            if expires is not None and expires <= self._now():
+                self._discard(key)
+            else:
+                self._listings.move_to_end(key)
+                child = children.get(name)
+                if child is not None:
+                    self.hits += 1
+                    return child
+        self.misses += 1
+        return None
+
+    def forget(self, dirnode):
+        """
+        Forget a directory which was modified through this client, under both
+        its write and read caps.
+        """
+        self._generation += 1
+        if len(self._modified) >= self.max_entries:
+            self._modified_before = self._generation
+            self._modified.clear()
+        self._modified[dirnode.get_storage_index()] = self._generation
+        if dirnode.get_write_uri() is not None:
+            self._discard(dirnode.get_write_uri())
+        self._discard(dirnode.get_readonly_uri())
+
+    def _discard(self, key):
+        entry = self._listings.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1]) + 1
+
+    def __len__(self):
+        return self._size
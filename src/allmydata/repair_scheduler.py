@@ -0,0 +1,539 @@
+"""
+A long-running repair service for the client node.
+
+Without it, files are only repaired when somebody runs ``deep-check
+--repair`` by hand.  The ``RepairScheduler`` instead walks the trees below a
+configured set of root caps, checking one object at a time, and remembers
+every unhealthy but recoverable object in a small sqlite queue in the
+node's private directory.  Entries are repaired most-at-risk first (the
+fewest shares left beyond the number needed to recover the file), with at
+most ``concurrency`` repairs in flight and, if a ``bandwidth`` budget is
+given, new repairs held back until the estimated traffic of earlier ones
+has been paid for.  Because the queue is on disk, a node which restarts
+in the middle of a walk starts repairing what it already found straight
+away instead of waiting for the next walk to find it again.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from typing import Optional
+
+from twisted.application import service
+from twisted.internet import defer
+from zope.interface import implementer
+
+from allmydata.interfaces import IDirectoryNode, IStatsProducer
+from allmydata.monitor import Monitor
+from allmydata.util import base32, log
+from allmydata.util.dbutil import get_db
+from allmydata.util.observer import OneShotObserverList
+
+
+SCHEMA_v1 = """
+CREATE TABLE version -- added in v1
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE unhealthy -- added in v1
+(
+ storage_index VARCHAR(26) PRIMARY KEY, -- base32(storage_index)
+ cap TEXT NOT NULL,                     -- the strongest cap we were given
+ shares_good INTEGER NOT NULL,
+ shares_needed INTEGER NOT NULL,
+ shares_expected INTEGER NOT NULL,
+ size INTEGER NOT NULL,                 -- bytes, or 0 if unknown
+ first_seen INTEGER NOT NULL,
+ attempts INTEGER NOT NULL,             -- failed repair attempts so far
+ next_attempt INTEGER NOT NULL,         -- do not retry before this time
+ last_error TEXT
+);
+
+CREATE INDEX unhealthy_by_risk ON unhealthy (next_attempt, shares_good);
+"""
+
+# After a failed repair, wait this long (doubling each time, up to a day)
+# before trying the same object again.
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 24 * 60 * 60
+
+
+class RepairQueue:
+    """
+    The persistent set of objects which were found to need repair, ordered
+    by how close they are to being lost.
+    """
+
+    def __init__(self, dbfile: str):
+        (self._sqlite, self._db) = get_db(
+            dbfile, create_version=(SCHEMA_v1, 1), dbname="repairdb",
+        )
+        self._cursor = self._db.cursor()
+
+    def add(self, storage_index: bytes, cap: str, results, size: int,
+            now: int) -> None:
+        """
+        Remember that the object described by ``results`` (an
+        ``ICheckResults``) needs repair.  An object which is already queued
+        keeps its place in line and its retry schedule, but its share
+        counts are brought up to date.
+        """
+        si_s = str(base32.b2a(storage_index), "ascii")
+        counts = (results.get_share_counter_good(),
+                  results.get_encoding_needed(),
+                  results.get_encoding_expected())
+        self._cursor.execute(
+            "UPDATE unhealthy SET shares_good=?, shares_needed=?,"
+            " shares_expected=?, size=? WHERE storage_index=?",
+            counts + (size, si_s))
+        if self._cursor.rowcount == 0:
+            self._cursor.execute(
+                "INSERT INTO unhealthy VALUES (?,?,?,?,?,?,?,0,?,NULL)",
+                (si_s, cap) + counts + (size, now, now))
+        self._db.commit()
+
+    def remove(self, storage_index: bytes) -> None:
+        si_s = str(base32.b2a(storage_index), "ascii")
+        self._cursor.execute("DELETE FROM unhealthy WHERE storage_index=?",
+                             (si_s,))
+        self._db.commit()
+
+    def record_failure(self, storage_index: bytes, error: str,
+                       now: int) -> None:
+        """
+        Note a failed repair, and put off the next attempt at this object
+        for a while so that it does not crowd out the others.
+        """
+        si_s = str(base32.b2a(storage_index), "ascii")
+        self._cursor.execute("SELECT attempts FROM unhealthy"
+                             " WHERE storage_index=?", (si_s,))
+        row = self._cursor.fetchone()
+        if row is None:
+            return
+        attempts = row[0] + 1
+        delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+        self._cursor.execute(
+            "UPDATE unhealthy SET attempts=?, next_attempt=?, last_error=?"
+            " WHERE storage_index=?", (attempts, now + delay, error, si_s))
+        self._db.commit()
+
+    def get_most_at_risk(self, now: int, exclude=()) -> list[dict]:
+        """
+        :return: the entries which are due for a repair attempt, most at
+            risk first, leaving out the storage indexes in ``exclude``.
+        """
+        exclude = set(str(base32.b2a(si), "ascii") for si in exclude)
+        self._cursor.execute(
+            "SELECT storage_index, cap, shares_good, shares_needed,"
+            " shares_expected, size, attempts FROM unhealthy"
+            " WHERE next_attempt <= ?"
+            " ORDER BY shares_good - shares_needed,"
+            "  1.0 * shares_good / shares_expected, first_seen",
+            (now,))
+        return [
+            {"storage_index": base32.a2b(si_s.encode("ascii")),
+             "cap": cap,
+             "shares_good": good,
+             "shares_needed": needed,
+             "shares_expected": expected,
+             "size": size,
+             "attempts": attempts,
+             }
+            for (si_s, cap, good, needed, expected, size, attempts)
+            in self._cursor.fetchall()
+            if si_s not in exclude
+        ]
+
+    def get_entries(self) -> list[dict]:
+        """
+        :return: every queued entry, most at risk first, for display.
+        """
+        self._cursor.execute(
+            "SELECT storage_index, shares_good, shares_needed,"
+            " shares_expected, size, attempts, next_attempt, last_error"
+            " FROM unhealthy"
+            " ORDER BY shares_good - shares_needed,"
+            "  1.0 * shares_good / shares_expected, first_seen")
+        return [
+            {"storage_index": si_s,
+             "shares_good": good,
+             "shares_needed": needed,
+             "shares_expected": expected,
+             "size": size,
+             "attempts": attempts,
+             "next_attempt": next_attempt,
+             "last_error": last_error,
+             }
+            for (si_s, good, needed, expected, size, attempts, next_attempt,
+                 last_error) in self._cursor.fetchall()
+        ]
+
+    def __len__(self):
+        self._cursor.execute("SELECT COUNT(*) FROM unhealthy")
+        return self._cursor.fetchone()[0]
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def estimate_repair_cost(entry: dict) -> int:
+    """
+    Guess how many bytes a repair of the given queue entry will move: the
+    repairer downloads enough shares to recover the file (about ``size``
+    bytes) and uploads the missing ones (each ``size / needed`` bytes).
+    """
+    size = entry["size"]
+    needed = max(entry["shares_needed"], 1)
+    missing = max(entry["shares_expected"] - entry["shares_good"], 0)
+    return size + size * missing // needed
+
+
+class BandwidthBudget:
+    """
+    Spread repair traffic out so that, on average, no more than ``rate``
+    bytes per second are spent on it.  Each repair is charged its estimated
+    cost up front, and the next one may only start once that cost has been
+    paid off.  A ``rate`` of ``None`` means no limit.
+    """
+
+    def __init__(self, clock, rate: Optional[int]):
+        self._clock = clock
+        self._rate = rate
+        self._available_at = 0.0
+
+    def delay(self) -> float:
+        """
+        :return: how many seconds to wait before the next repair may start.
+        """
+        if self._rate is None:
+            return 0.0
+        return max(0.0, self._available_at - self._clock.seconds())
+
+    def spend(self, cost: int) -> None:
+        if self._rate is None:
+            return
+        now = self._clock.seconds()
+        self._available_at = max(self._available_at, now) + cost / self._rate
+
+
+@implementer(IStatsProducer)
+class RepairScheduler(service.MultiService):
+    """
+    Check the trees below ``root_caps`` over and over, one object at a time,
+    and repair whatever is found to be unhealthy.
+
+    :param nodemaker: used to turn caps into filesystem nodes.
+    :param root_caps: the caps of the files and directories to look after.
+    :param dbfile: where the repair queue is kept.
+    :param concurrency: the most repairs to run at once.
+    :param bandwidth: the average number of bytes per second repairs may
+        use, or ``None`` for no limit.
+    :param check_delay: seconds to wait between checking one object and the
+        next, to keep the walk from competing with real work.
+    :param cycle_interval: seconds from the start of one walk over all the
+        roots to the start of the next.
+    """
+    name = "repair_scheduler"  # type: ignore[assignment]
+
+    def __init__(self, nodemaker, root_caps, dbfile, concurrency=1,
+                 bandwidth=None, check_delay=0.0, cycle_interval=24*60*60,
+                 clock=None):
+        service.MultiService.__init__(self)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self._nodemaker = nodemaker
+        self.root_caps = list(root_caps)
+        self._dbfile = dbfile
+        self.queue = None
+        self.concurrency = concurrency
+        self.bandwidth = bandwidth
+        self.check_delay = check_delay
+        self.cycle_interval = cycle_interval
+        self._budget = BandwidthBudget(clock, bandwidth)
+
+        self._active = {} # storage index -> queue entry
+        self._pump_timer = None
+        self._cycle_timer = None
+        self._walking = None
+        self._idle_observers = OneShotObserverList()
+        self._lp = log.msg("RepairScheduler starting, %d roots"
+                           % len(self.root_caps), facility="tahoe.repair")
+
+        self.counters = {
+            "objects-checked": 0,
+            "objects-unhealthy": 0,
+            "objects-unrecoverable": 0,
+            "repairs-attempted": 0,
+            "repairs-succeeded": 0,
+            "repairs-failed": 0,
+            "bytes-repaired": 0,
+            "cycles-completed": 0,
+        }
+        self.started = None
+        self.last_cycle_started = None
+        self.last_cycle_finished = None
+
+    def log(self, *args, **kwargs):
+        if "parent" not in kwargs:
+            kwargs["parent"] = self._lp
+        if "facility" not in kwargs:
+            kwargs["facility"] = "tahoe.repair"
+        return log.msg(*args, **kwargs)
+
+    def startService(self):
+        service.MultiService.startService(self)
+        if self.queue is None:
+            self.queue = RepairQueue(self._dbfile)
+        self.started = self._clock.seconds()
+        self._pump()
+        self._cycle_timer = self._clock.callLater(0, self._run_cycle)
+
+    def stopService(self):
+        for timer in (self._pump_timer, self._cycle_timer):
+            if timer is not None and timer.active():
+                timer.cancel()
+        self._pump_timer = self._cycle_timer = None
+        d = service.MultiService.stopService(self)
+        # the repairs and the walk which are under way still use the queue,
+        # so it is closed once they are done
+        dl = [d, self.when_idle()]
+        if self._walking is not None:
+            dl.append(self._walking.when_fired())
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda ign: self._close_queue())
+        return d
+
+    def _close_queue(self):
+        if self.queue is not None:
+            self.queue.close()
+            self.queue = None
+
+    def _run_cycle(self):
+        self._cycle_timer = None
+        start = self._clock.seconds()
+        d = self.check_all()
+        def _schedule_next(ignored):
+            if self.running:
+                delay = max(0, start + self.cycle_interval
+                            - self._clock.seconds())
+                self._cycle_timer = self._clock.callLater(delay,
+                                                          self._run_cycle)
+        d.addCallback(_schedule_next)
+        d.addErrback(log.err, "repair cycle failed",
+                     facility="tahoe.repair", parent=self._lp)
+
+    # checking
+
+    def check_all(self):
+        """
+        Walk every tree below the root caps once, checking each object and
+        updating the repair queue to match.  If a walk is already under way,
+        wait for it instead of starting another.
+
+        :return: a Deferred which fires when the walk is done.
+        """
+        if self._walking is not None:
+            return self._walking.when_fired()
+        self._walking = OneShotObserverList()
+        d = self._walk()
+        def _done(res):
+            (walking, self._walking) = (self._walking, None)
+            walking.fire(None)
+            return res
+        d.addBoth(_done)
+        return d
+
+    @defer.inlineCallbacks
+    def _walk(self):
+        self.last_cycle_started = self._clock.seconds()
+        self.log("starting a walk over %d roots" % len(self.root_caps))
+        pending = deque()
+        for cap in self.root_caps:
+            try:
+                pending.append((self._create_node(cap), cap))
+            except Exception:
+                self.log("unusable root cap", level=log.WEIRD)
+        seen = set()
+        while pending and self.running:
+            (node, cap) = pending.popleft()
+            si = node.get_storage_index()
+            if si is None:
+                # literal files and unknown nodes have nothing to repair
+                continue
+            if si in seen:
+                continue
+            seen.add(si)
+            try:
+                yield self._check_node(node, cap)
+                if IDirectoryNode.providedBy(node):
+                    children = yield node.list()
+                    for (child, metadata) in children.values():
+                        child_cap = child.get_uri()
+                        if child_cap is not None:
+                            pending.append((child, str(child_cap, "ascii")))
+            except Exception as e:
+                self.log(format="check of %(si)s failed: %(error)s",
+                         si=str(base32.b2a(si), "ascii"), error=str(e),
+                         level=log.UNUSUAL)
+            if self.check_delay:
+                yield self._sleep(self.check_delay)
+        self.last_cycle_finished = self._clock.seconds()
+        self.counters["cycles-completed"] += 1
+        self.log("walk done, %d objects queued for repair" % len(self.queue))
+
+    def _create_node(self, cap):
+        return self._nodemaker.create_from_cap(cap.encode("utf-8"))
+
+    def _sleep(self, seconds):
+        d = defer.Deferred()
+        self._clock.callLater(seconds, d.callback, None)
+        return d
+
+    @defer.inlineCallbacks
+    def _check_node(self, node, cap):
+        results = yield node.check(Monitor())
+        if results is None:
+            return
+        self.counters["objects-checked"] += 1
+        si = node.get_storage_index()
+        if results.is_healthy():
+            self.queue.remove(si)
+        elif not results.is_recoverable():
+            # nothing we can do about this one
+            self.counters["objects-unrecoverable"] += 1
+            self.queue.remove(si)
+            self.log(format="%(si)s is unrecoverable",
+                     si=str(base32.b2a(si), "ascii"), level=log.UNUSUAL)
+        else:
+            self.counters["objects-unhealthy"] += 1
+            self.queue.add(si, cap, results, node.get_size() or 0,
+                           int(self._clock.seconds()))
+            self._pump()
+
+    # repairing
+
+    def _pump(self):
+        """
+        Start as many repairs as the concurrency and bandwidth limits allow,
+        most-at-risk first.
+        """
+        if not self.running:
+            self._notify_if_idle()
+            return
+        if self._pump_timer is not None:
+            if self._pump_timer.active():
+                return
+            self._pump_timer = None
+        while len(self._active) < self.concurrency:
+            entries = self.queue.get_most_at_risk(int(self._clock.seconds()),
+                                                  exclude=self._active)
+            if not entries:
+                break
+            delay = self._budget.delay()
+            if delay > 0:
+                self._pump_timer = self._clock.callLater(delay, self._pump)
+                return
+            entry = entries[0]
+            self._budget.spend(estimate_repair_cost(entry))
+            self._active[entry["storage_index"]] = entry
+            d = self._repair(entry)
+            d.addErrback(log.err, "repair scheduling failed",
+                         facility="tahoe.repair", parent=self._lp)
+        self._notify_if_idle()
+
+    @defer.inlineCallbacks
+    def _repair(self, entry):
+        si = entry["storage_index"]
+        si_s = str(base32.b2a(si), "ascii")
+        self.counters["repairs-attempted"] += 1
+        self.log(format="repairing %(si)s (%(good)d of %(expected)d shares)",
+                 si=si_s, good=entry["shares_good"],
+                 expected=entry["shares_expected"])
+        try:
+            node = self._create_node(entry["cap"])
+            crr = yield node.check_and_repair(Monitor())
+            post = crr.get_post_repair_results()
+            if not post.is_healthy():
+                raise ValueError("still unhealthy after repair: %s"
+                                 % (post.get_summary(),))
+        except Exception as e:
+            self.counters["repairs-failed"] += 1
+            self.log(format="repair of %(si)s failed: %(error)s",
+                     si=si_s, error=str(e), level=log.UNUSUAL)
+            self.queue.record_failure(si, str(e), int(self._clock.seconds()))
+        else:
+            self.counters["repairs-succeeded"] += 1
+            if crr.get_repair_attempted():
+                self.counters["bytes-repaired"] += estimate_repair_cost(entry)
+            self.queue.remove(si)
+        finally:
+            del self._active[si]
+        self._pump()
+
+    def _notify_if_idle(self):
+        if self._active:
+            return
+        if self.running and self._pump_timer is not None:
+            return
+        if self.running and self.queue.get_most_at_risk(
+                int(self._clock.seconds())):
+            return
+        (observers, self._idle_observers) = (self._idle_observers,
+                                             OneShotObserverList())
+        observers.fire(None)
+
+    def when_idle(self):
+        """
+        :return: a Deferred which fires once no repairs are running and none
+            are due, for example because the queue is empty.
+        """
+        d = self._idle_observers.when_fired()
+        self._notify_if_idle()
+        return d
+
+    # status
+
+    def get_status(self) -> dict:
+        now = self._clock.seconds()
+        elapsed = now - self.started if self.started is not None else 0
+        status = {
+            "roots": len(self.root_caps),
+            "concurrency": self.concurrency,
+            "bandwidth": self.bandwidth,
+            "active": len(self._active),
+            "queue": self.queue.get_entries() if self.queue else [],
+            "walking": self._walking is not None,
+            "last-cycle-started": self.last_cycle_started,
+            "last-cycle-finished": self.last_cycle_finished,
+            "throughput": (self.counters["bytes-repaired"] / elapsed
+                           if elapsed > 0 else 0.0),
+        }
+        status.update(self.counters)
+        return status
+
+    def get_stats(self) -> dict:
+        stats = dict(("repair.%s" % (name.replace("-", "_"),), value)
+                     for (name, value) in self.counters.items())
+        stats["repair.queue_length"] = len(self.queue) if self.queue else 0
+        stats["repair.active"] = len(self._active)
+        return stats
+
+
+def load_root_caps(filename: str) -> list[str]:
+    """
+    Read the caps the repair service should look after: one per line, with
+    blank lines and ``#`` comments ignored.  A missing file means no roots.
+    """
+    try:
+        with open(filename, "r") as f:
+            lines = f.readlines()
+    except EnvironmentError:
+        return []
+    caps = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            caps.append(line)
+    return caps
@@ -439,6 +439,19 @@ class StatsOptions(FileStoreOptions):
     Print statistics about of all files and directories reachable from the
     given starting point."""
 
+class RenewLeasesOptions(FileStoreOptions):
+    optFlags = [
+        ("raw", "r", "Display raw JSON data instead of parsed"),
+        ]
+    def parseArgs(self, where=''):
+        self.where = argv_to_unicode(where)
+
+    synopsis = "[options] [ALIAS:PATH]"
+    description = """
+    Add or renew this client's leases on all files and directories reachable
+    from the given starting point, sending many of them to each storage
+    server in each request."""
+
 class CheckOptions(FileStoreOptions):
     optFlags = [
         ("raw", None, "Display raw JSON data instead of parsed."),
@@ -462,6 +475,7 @@ class DeepCheckOptions(FileStoreOptions):
         ("verify", None, "Verify all hashes, instead of merely querying share presence."),
         ("repair", None, "Automatically repair any problems found."),
         ("add-lease", None, "Add/renew lease on all shares."),
+        ("incremental", None, "Skip objects the node has checked recently."),
         ("verbose", "v", "Be noisy about what is happening."),
         ]
     def parseArgs(self, *locations):
@@ -471,7 +485,12 @@ class DeepCheckOptions(FileStoreOptions):
     description = """
     Check all files and directories reachable from the given starting point
     (which must be a directory), like 'tahoe check' but for multiple files.
-    Optionally repair any problems found."""
+    Optionally repair any problems found.
+
+    With --incremental, the node remembers when it last checked each object,
+    skips objects it checked within [client]deep_check.recheck_interval, and
+    does not even list directories which have not changed since it last
+    listed them and have nothing below them that is due for a check."""
 
 subCommands : SubCommands = [
     ("mkdir", None, MakeDirectoryOptions, "Create a new directory."),
@@ -489,6 +508,7 @@ subCommands : SubCommands = [
     ("webopen", None, WebopenOptions, "Open a web browser to a grid file or directory."),
     ("manifest", None, ManifestOptions, "List all files/directories in a subtree."),
     ("stats", None, StatsOptions, "Print statistics about all files/directories in a subtree."),
+    ("renew-leases", None, RenewLeasesOptions, "Renew leases on all files/directories in a subtree."),
     ("check", None, CheckOptions, "Check a single file or directory."),
     ("deep-check", None, DeepCheckOptions, "Check all files/directories reachable from a starting point."),
     ("status", None, TahoeStatusCommand, "Various status information."),
@@ -581,6 +601,11 @@ def stats(options):
     rc = tahoe_manifest.stats(options)
     return rc
 
+def renew_leases(options):
+    from allmydata.scripts import tahoe_renew_leases
+    rc = tahoe_renew_leases.renew_leases(options)
+    return rc
+
 def check(options):
     from allmydata.scripts import tahoe_check
     rc = tahoe_check.check(options)
@@ -612,6 +637,7 @@ dispatch = {
     "webopen": webopen,
     "manifest": manifest,
     "stats": stats,
+    "renew-leases": renew_leases,
     "check": check,
     "deep-check": deepcheck,
     "status": status,
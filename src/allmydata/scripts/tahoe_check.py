@@ -132,6 +132,7 @@ class DeepCheckOutput(LineOnlyReceiver, object):
         self.stdout = options.stdout
         self.stderr = options.stderr
         self.num_objects = 0
+        self.num_skipped = 0
         self.files_healthy = 0
         self.files_unhealthy = 0
         self.in_error = False
@@ -150,6 +151,9 @@ class DeepCheckOutput(LineOnlyReceiver, object):
         stdout = self.stdout
         if d["type"] not in ("file", "directory"):
             return
+        if d.get("skipped"):
+            self.num_skipped += 1
+            return
         self.num_objects += 1
         # non-verbose means print a progress marker every 100 files
         if self.num_objects % 100 == 0:
@@ -182,6 +186,9 @@ class DeepCheckOutput(LineOnlyReceiver, object):
         stdout = self.stdout
         print("done: %d objects checked, %d healthy, %d unhealthy" \
               % (self.num_objects, self.files_healthy, self.files_unhealthy), file=stdout)
+        if self.num_skipped:
+            print("%d objects skipped (checked recently)" % self.num_skipped,
+                  file=stdout)
 
 class DeepCheckAndRepairOutput(LineOnlyReceiver, object):
     delimiter = b"\n"
@@ -193,6 +200,7 @@ class DeepCheckAndRepairOutput(LineOnlyReceiver, object):
         self.stdout = options.stdout
         self.stderr = options.stderr
         self.num_objects = 0
+        self.num_skipped = 0
         self.pre_repair_files_healthy = 0
         self.pre_repair_files_unhealthy = 0
         self.repairs_attempted = 0
@@ -215,6 +223,9 @@ class DeepCheckAndRepairOutput(LineOnlyReceiver, object):
         stdout = self.stdout
         if d["type"] not in ("file", "directory"):
             return
+        if d.get("skipped"):
+            self.num_skipped += 1
+            return
         self.num_objects += 1
         # non-verbose means print a progress marker every 100 files
         if self.num_objects % 100 == 0:
@@ -281,6 +292,9 @@ class DeepCheckAndRepairOutput(LineOnlyReceiver, object):
         print(" post-repair: %d healthy, %d unhealthy" \
               % (self.post_repair_files_healthy,
                  self.post_repair_files_unhealthy), file=stdout)
+        if self.num_skipped:
+            print(" %d objects skipped (checked recently)" % self.num_skipped,
+                  file=stdout)
 
 class DeepCheckStreamer(LineOnlyReceiver, object):
 
@@ -316,6 +330,8 @@ class DeepCheckStreamer(LineOnlyReceiver, object):
             output = DeepCheckOutput(self, options)
         if options["add-lease"]:
             url += "&add-lease=true"
+        if options["incremental"]:
+            url += "&incremental=true"
         resp = do_http("POST", url)
         if resp.status not in (200, 302):
             print(format_http_error("ERROR", resp), file=stderr)
@@ -327,11 +327,16 @@ class TahoeMissingTarget:
         return PUT(self.url + "?t=uri", filecap)
 
 class TahoeDirectoryTarget:
+    # how many new children to send to the node at a time. The node makes
+    # the ones which arrive close together with a single publish.
+    BATCH_SIZE = 1000
+
     def __init__(self, nodeurl, cache, progressfunc):
         self.nodeurl = nodeurl
         self.cache = cache
         self.progressfunc = progressfunc
         self.new_children = {}
+        self.batches_sent = 0
 
     def init_from_parsed(self, parsed):
         nodetype, d = parsed
@@ -441,28 +446,45 @@ class TahoeDirectoryTarget:
             # TODO: this always creates immutable files. We might want an option
             # to always create mutable files, or to copy mutable files into new
             # mutable files.
-            self.new_children[name] = filecap
+            self._add_new_child(name, filecap)
 
     def put_uri(self, name, filecap):
         precondition(isinstance(name, str), name)
+        self._add_new_child(name, filecap)
+
+    def _add_new_child(self, name, filecap):
         self.new_children[name] = filecap
+        if len(self.new_children) >= self.BATCH_SIZE:
+            # don't wait for them to be added: set_children() will tell us
+            # if any of them could not be
+            self._send_batch(wait=False)
 
-    def set_children(self):
-        if not self.new_children:
-            return
+    def _send_batch(self, wait):
         url = (self.nodeurl + "uri/" + url_quote(self.writecap)
-               + "?t=set_children")
+               + "?t=batch&wait=%s" % ("true" if wait else "false"))
         set_data = {}
         for (name, filecap) in list(self.new_children.items()):
-            # it just so happens that ?t=set_children will accept both file
+            # it just so happens that ?t=batch will accept both file
             # read-caps and write-caps as ['rw_uri'], and will handle either
             # correctly. So don't bother trying to figure out whether the one
             # we have is read-only or read-write.
             # TODO: think about how this affects forward-compatibility for
             # unknown caps
             set_data[name] = ["filenode", {"rw_uri": filecap}]
-        body = json.dumps_bytes(set_data)
-        POST(url, body)
+        body = json.dumps_bytes({"set": set_data})
+        self.new_children = {}
+        self.batches_sent += 1
+        return json.loads(POST(url, body))
+
+    def set_children(self):
+        if not self.new_children and not self.batches_sent:
+            return
+        # this also waits for the batches we did not wait for before
+        results = self._send_batch(wait=True)
+        if results["failures"]:
+            raise TahoeError("Error adding %s" % ", ".join(
+                "%s: %s" % (quote_output(failure["name"]), failure["error"])
+                for failure in results["failures"]))
 
 FileSources = (LocalFileSource, TahoeFileSource)
 DirectorySources = (LocalDirectorySource, TahoeDirectorySource)
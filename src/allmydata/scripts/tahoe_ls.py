@@ -12,6 +12,10 @@ from allmydata.scripts.common import get_alias, DEFAULT_ALIAS, escape_path, \
 from allmydata.scripts.common_http import do_http, format_http_error
 from allmydata.util.encodingutil import unicode_to_output, quote_output, is_printable_ascii, to_bytes
 
+# How many children of a large directory to line up in columns and print at
+# once, rather than waiting for the whole listing.
+ROWS_PER_BATCH = 1000
+
 def ls(options):
     nodeurl = options['node-url']
     aliases = options.aliases
@@ -35,8 +39,18 @@ def ls(options):
         # move where.endswith check here?
         url += "/" + escape_path(path)
     assert not url.endswith("/")
-    url += "?t=json"
-    resp = do_http("GET", url)
+    streamed = not options['json']
+    if streamed:
+        # ask for one line per child, so that the children of a large
+        # directory can be shown as they arrive
+        resp = do_http("GET", url + "?t=stream-json")
+        if resp.status == 400:
+            # not a directory, or a webapi server which does not know
+            # t=stream-json
+            resp.read()
+            streamed = False
+    if not streamed:
+        resp = do_http("GET", url + "?t=json")
     if resp.status == 404:
         print("No such file or directory", file=stderr)
         return 2
@@ -47,8 +61,8 @@ def ls(options):
         else:
             return resp.status
 
-    data = resp.read()
     if options['json']:
+        data = resp.read()
         # The webapi server should always output printable ASCII.
         if is_printable_ascii(data):
             data = str(data, "ascii")
@@ -59,104 +73,178 @@ def ls(options):
             print(quote_output(data, quotemarks=False), file=stderr)
             return 1
 
+    if streamed:
+        # the directory itself, then one line per child
+        data = resp.readline()
+    else:
+        data = resp.read()
     try:
         parsed = json.loads(data)
     except Exception as e:
-        print("error: %s" % quote_output(e.args[0], quotemarks=False), file=stderr)
-        print("Could not parse JSON response:", file=stderr)
-        print(quote_output(data, quotemarks=False), file=stderr)
+        _parse_error(e, data, stderr)
         return 1
 
     nodetype, d = parsed
-    children = {}
     if nodetype == "dirnode":
-        children = d['children']
+        if streamed:
+            children = _streamed_children(resp)
+        else:
+            children = _sorted_children(d['children'])
     else:
         # paths returned from get_alias are always valid UTF-8
         childname = path.split("/")[-1]
-        children = {childname: (nodetype, d)}
+        children = [(childname, (nodetype, d))]
         if "metadata" not in d:
             d["metadata"] = {}
-    childnames = sorted(children.keys())
     now = time.time()
 
     # we build up a series of rows, then we loop through them to compute a
     # maxwidth so we can format them tightly. Size, filename, and URI are the
-    # variable-width ones.
+    # variable-width ones. Large directories are shown ROWS_PER_BATCH rows at
+    # a time, each batch formatted on its own.
     rows = []
+    rc = 0
     has_unknowns = False
 
-    for name in childnames:
-        child = children[name]
-        name = str(name)
-        childtype = child[0]
-
-        # See webapi.txt for a discussion of the meanings of unix local
-        # filesystem mtime and ctime, Tahoe mtime and ctime, and Tahoe
-        # linkmotime and linkcrtime.
-        ctime = child[1].get("metadata", {}).get('tahoe', {}).get("linkcrtime")
-        if not ctime:
-            ctime = child[1]["metadata"].get("ctime")
-
-        mtime = child[1].get("metadata", {}).get('tahoe', {}).get("linkmotime")
-        if not mtime:
-            mtime = child[1]["metadata"].get("mtime")
-        rw_uri = to_bytes(child[1].get("rw_uri"))
-        ro_uri = to_bytes(child[1].get("ro_uri"))
-        if ctime:
-            # match for formatting that GNU 'ls' does
-            if (now - ctime) > 6*30*24*60*60:
-                # old files
-                fmt = "%b %d  %Y"
-            else:
-                fmt = "%b %d %H:%M"
-            ctime_s = time.strftime(fmt, time.localtime(ctime))
-        else:
-            ctime_s = "-"
-        if childtype == "dirnode":
-            t0 = "d"
-            size = "-"
-            classify = "/"
-        elif childtype == "filenode":
-            t0 = "-"
-            size = str(child[1].get("size", "?"))
-            classify = ""
-            if rw_uri:
-                classify = "*"
+    try:
+        for (name, child) in children:
+            row, unknown = _format_child(options, name, child, now)
+            rows.append(row)
+            has_unknowns = has_unknowns or unknown
+            if len(rows) >= ROWS_PER_BATCH:
+                rc = max(rc, _print_rows(rows, stdout, stderr))
+                rows = []
+    except _StreamError as e:
+        (err, line) = e.args
+        _parse_error(err, line, stderr)
+        return 1
+    rc = max(rc, _print_rows(rows, stdout, stderr))
+
+    if rc == 1:
+        print("\nThis listing included files whose names could not be converted to the terminal" \
+                        "\noutput encoding. Their names are shown using backslash escapes and in quotes.", file=stderr)
+    if has_unknowns:
+        print("\nThis listing included unknown objects. Using a webapi server that supports" \
+                        "\na later version of Tahoe may help.", file=stderr)
+
+    return rc
+
+
+class _StreamError(Exception):
+    """
+    A line of a t=stream-json listing could not be parsed.
+    """
+
+
+def _parse_error(e, data, stderr):
+    print("error: %s" % quote_output(e.args[0], quotemarks=False), file=stderr)
+    print("Could not parse JSON response:", file=stderr)
+    print(quote_output(data, quotemarks=False), file=stderr)
+
+
+def _sorted_children(children):
+    return [(name, children[name]) for name in sorted(children.keys())]
+
+
+def _streamed_children(resp):
+    """
+    Yield (name, child) for each line of a t=stream-json listing, which
+    arrive in order of name.
+    """
+    while True:
+        line = resp.readline()
+        if not line:
+            return
+        try:
+            entry = json.loads(line)
+        except Exception as e:
+            raise _StreamError(e, line)
+        yield (entry["name"], entry["node"])
+
+
+def _format_child(options, name, child, now):
+    """
+    :return: (the cells of the row for this child, whether it is of an
+        unknown type)
+    """
+    unknown = False
+    name = str(name)
+    childtype = child[0]
+
+    # See webapi.txt for a discussion of the meanings of unix local
+    # filesystem mtime and ctime, Tahoe mtime and ctime, and Tahoe
+    # linkmotime and linkcrtime.
+    ctime = child[1].get("metadata", {}).get('tahoe', {}).get("linkcrtime")
+    if not ctime:
+        ctime = child[1]["metadata"].get("ctime")
+
+    mtime = child[1].get("metadata", {}).get('tahoe', {}).get("linkmotime")
+    if not mtime:
+        mtime = child[1]["metadata"].get("mtime")
+    rw_uri = to_bytes(child[1].get("rw_uri"))
+    ro_uri = to_bytes(child[1].get("ro_uri"))
+    if ctime:
+        # match for formatting that GNU 'ls' does
+        if (now - ctime) > 6*30*24*60*60:
+            # old files
+            fmt = "%b %d  %Y"
         else:
-            has_unknowns = True
-            t0 = "?"
-            size = "?"
-            classify = "?"
-        t1 = "-"
-        if ro_uri:
-            t1 = "r"
-        t2 = "-"
+            fmt = "%b %d %H:%M"
+        ctime_s = time.strftime(fmt, time.localtime(ctime))
+    else:
+        ctime_s = "-"
+    if childtype == "dirnode":
+        t0 = "d"
+        size = "-"
+        classify = "/"
+    elif childtype == "filenode":
+        t0 = "-"
+        size = str(child[1].get("size", "?"))
+        classify = ""
         if rw_uri:
-            t2 = "w"
-        t3 = "-"
-        if childtype == "dirnode":
-            t3 = "x"
+            classify = "*"
+    else:
+        unknown = True
+        t0 = "?"
+        size = "?"
+        classify = "?"
+    t1 = "-"
+    if ro_uri:
+        t1 = "r"
+    t2 = "-"
+    if rw_uri:
+        t2 = "w"
+    t3 = "-"
+    if childtype == "dirnode":
+        t3 = "x"
+
+    uri = rw_uri or ro_uri
+
+    line = []
+    if options["long"]:
+        line.append(t0+t1+t2+t3)
+        line.append(size)
+        line.append(ctime_s)
+    if not options["classify"]:
+        classify = ""
 
-        uri = rw_uri or ro_uri
+    line.append(name + classify)
 
-        line = []
-        if options["long"]:
-            line.append(t0+t1+t2+t3)
-            line.append(size)
-            line.append(ctime_s)
-        if not options["classify"]:
-            classify = ""
+    if options["uri"]:
+        line.append(ensure_text(uri))
+    if options["readonly-uri"]:
+        line.append(quote_output(ensure_text(ro_uri) or "-", quotemarks=False))
 
-        line.append(name + classify)
+    return (line, unknown)
 
-        if options["uri"]:
-            line.append(ensure_text(uri))
-        if options["readonly-uri"]:
-            line.append(quote_output(ensure_text(ro_uri) or "-", quotemarks=False))
 
-        rows.append(line)
+def _print_rows(rows, stdout, stderr):
+    """
+    Print rows of cells in aligned columns.
 
+    :return: 1 if some row could not be converted to the output encoding,
+        otherwise 0.
+    """
     max_widths = []
     left_justifys = []
     for row in rows:
@@ -195,11 +283,4 @@ def ls(options):
         else:
             print(row, file=stdout)
 
-    if rc == 1:
-        print("\nThis listing included files whose names could not be converted to the terminal" \
-                        "\noutput encoding. Their names are shown using backslash escapes and in quotes.", file=stderr)
-    if has_unknowns:
-        print("\nThis listing included unknown objects. Using a webapi server that supports" \
-                        "\na later version of Tahoe may help.", file=stderr)
-
     return rc
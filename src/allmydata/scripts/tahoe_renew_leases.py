@@ -0,0 +1,29 @@
+"""
+Add or renew leases on everything reachable from a directory.
+"""
+
+from allmydata.scripts.slow_operation import SlowOperationRunner
+
+
+class LeaseRenewer(SlowOperationRunner):
+
+    def make_url(self, base, ophandle):
+        return base + "?t=start-renew-leases&ophandle=" + ophandle
+
+    def write_results(self, data):
+        stdout = self.options.stdout
+        print("%d objects, leases renewed on %d servers"
+              % (data["count-objects"], data["count-servers"]), file=stdout)
+        print(" %d leases renewed in %d requests"
+              % (data["count-leases-renewed"], data["count-requests"]),
+              file=stdout)
+        if data["count-leases-failed"]:
+            print(" %d leases could not be renewed"
+                  % data["count-leases-failed"], file=stdout)
+        if data["count-servers-failed"]:
+            print(" %d requests failed" % data["count-servers-failed"],
+                  file=stdout)
+
+
+def renew_leases(options):
+    return LeaseRenewer().run(options)
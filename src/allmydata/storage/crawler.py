@@ -8,7 +8,9 @@ import os
 import time
 import json
 import struct
-from twisted.internet import reactor
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from twisted.internet import reactor, threads
 from twisted.application import service
 from twisted.python.filepath import FilePath
 from allmydata.storage.common import si_b2a
@@ -150,31 +152,130 @@ def _dump_json_to_file(js, afile):
         f.write(data.encode("utf8"))
 
 
+def _json_key(k):
+    """
+    :return: the string which JSON will use for the dictionary key `k`
+    """
+    if isinstance(k, str):
+        return k
+    return json.dumps(k)
+
+
+def _apply_state_changes(state, changes):
+    """
+    Apply edits to `state`, and return the result. Each edit is one of:
+
+     ["set", path, value]: replace the value at path (the root if empty)
+     ["del", path]: delete the dictionary key at path
+
+    Edits whose parent no longer exists are skipped (a later edit will have
+    replaced that parent).
+    """
+    for change in changes:
+        path = change[1]
+        if not path:
+            if change[0] == "set":
+                state = change[2]
+            continue
+        parent = state
+        for k in path[:-1]:
+            parent = parent.get(k) if isinstance(parent, dict) else None
+        if not isinstance(parent, dict):
+            continue
+        elif change[0] == "set":
+            parent[path[-1]] = change[2]
+        elif change[0] == "del":
+            parent.pop(path[-1], None)
+    return state
+
+
 class _LeaseStateSerializer:
     """
     Read and write state for LeaseCheckingCrawler. This understands
     how to read the legacy pickle format files and upgrade them to the
     new JSON format (which will occur automatically).
+
+    The state is kept as a JSON snapshot plus a journal (a sibling file
+    with a ".journal" extension) holding one line of changes per save, so
+    that saving after every prefixdir only writes what changed since the
+    previous save rather than the whole (possibly large) state. The
+    journal is folded into a new snapshot whenever a complete state is
+    saved, which the crawler does at the end of every cycle and when
+    needs_compaction() says so.
     """
 
     def __init__(self, state_path):
         self._path = _confirm_json_format(FilePath(state_path))
+        self._journal_path = self._path.siblingExtension(".journal")
+        # whether we have written a snapshot which the journal extends
+        self._compacted = False
+        self._snapshot_size = 0
+        self._journal_size = 0
 
     def load(self):
         """
         :returns: deserialized JSON state
         """
         with self._path.open("rb") as f:
-            return json.load(f)
+            data = f.read()
+        state = json.loads(data)
+        self._snapshot_size = len(data)
+        self._journal_size = 0
+        if self._journal_path.exists():
+            with self._journal_path.open("rb") as f:
+                for line in f:
+                    self._journal_size += len(line)
+                    try:
+                        changes = json.loads(line)
+                    except ValueError:
+                        # a partial line from an interrupted write, which
+                        # can only be the last one
+                        break
+                    state = _apply_state_changes(state, changes)
+        return state
 
     def save(self, data):
         """
-        Serialize the given data as JSON into the state-path
+        Serialize the given data as JSON into the state-path, as a complete
+        new snapshot which replaces the journal.
+
         :returns: None
         """
         tmpfile = self._path.siblingExtension(".tmp")
         _dump_json_to_file(data, tmpfile)
+        # the journal must never be replayed onto a newer snapshot, so it
+        # goes first: if we die in between, we lose some progress, like
+        # any crawler which is interrupted
+        if self._journal_path.exists():
+            self._journal_path.remove()
         fileutil.move_into_place(tmpfile.path, self._path.path)
+        self._snapshot_size = os.stat(self._path.path).st_size
+        self._journal_size = 0
+        self._compacted = True
+        return None
+
+    def needs_compaction(self):
+        """
+        :return bool: True if the next save must be a complete snapshot,
+            because we have not written one yet (the state may have been
+            changed since it was loaded, without a record of what changed),
+            or because the journal has grown larger than the snapshot.
+        """
+        return (not self._compacted or
+                self._journal_size > max(self._snapshot_size, 64*1024))
+
+    def append(self, changes):
+        """
+        Append the given edits (see _apply_state_changes()) to the journal.
+
+        :returns: None
+        """
+        if not changes:
+            return None
+        line = json.dumps(changes).encode("utf8") + b"\n"
+        with self._journal_path.open("ab") as f:
+            f.write(line)
+        self._journal_size += len(line)
         return None
 
 
@@ -186,9 +287,18 @@ class ShareCrawler(service.MultiService):
     million files, which can take hours or days to read.
 
     Once the crawler starts a cycle, it will proceed at a rate limited by the
-    allowed_cpu_percentage= and cpu_slice= parameters: yielding the reactor
-    after it has worked for 'cpu_slice' seconds, and not resuming right away,
-    always trying to use less than 'allowed_cpu_percentage'.
+    allowed_cpu_percentage= and cpu_slice= parameters: pausing after it has
+    worked for 'cpu_slice' seconds, and not resuming right away, always
+    trying to use less than 'allowed_cpu_percentage'. The pause is further
+    stretched when the disk is slower than usual or the storage server is
+    busy handling requests, and shortened when the server is idle: see
+    pacing_factor().
+
+    The directory listing and share examination of each time slice is done
+    in a worker thread (unless use_thread is False), so that a slow disk
+    does not block the reactor. Only process_prefixdir() and
+    process_bucket() run in that thread: all other hooks, and anything
+    passed to call_in_reactor(), run in the reactor thread.
 
     Once the crawler finishes a cycle, it will put off starting the next one
     long enough to ensure that 'minimum_cycle_time' elapses between the start
@@ -204,7 +314,9 @@ class ShareCrawler(service.MultiService):
 
     To use a crawler, create a subclass which implements the process_bucket()
     method. It will be called with a prefixdir and a base32 storage index
-    string. process_bucket() must run synchronously. Any keys added to
+    string. process_bucket() must run synchronously, and must use
+    call_in_reactor() for anything which is not safe to do outside the
+    reactor thread, such as modifying shares. Any keys added to
     self.state will be preserved. Override add_initial_state() to set up
     initial state keys. Override finished_cycle() to perform additional
     processing when the cycle is complete. Any status that the crawler
@@ -217,12 +329,14 @@ class ShareCrawler(service.MultiService):
     filename where it can store persistent state. The statefile is used to
     keep track of how far around the ring the process has travelled, as well
     as timing history to allow the pace to be predicted and controlled. The
-    statefile will be updated and written to disk after each time slice (just
+    statefile will be updated after each prefixdir and each time slice (just
     before the crawler yields to the reactor), and also after each cycle is
-    finished, and also when stopService() is called. Note that this means
-    that a crawler which is interrupted with SIGKILL while it is in the
-    middle of a time slice will lose progress: the next time the node is
-    started, the crawler will repeat some unknown amount of work.
+    finished, and also when stopService() is called. Only the changes are
+    written each time, to a journal which is compacted into the statefile at
+    the end of each cycle. Note that this means that a crawler which is
+    interrupted with SIGKILL while it is in the middle of a prefixdir will
+    lose progress: the next time the node is started, the crawler will
+    repeat some unknown amount of work.
 
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
@@ -233,6 +347,13 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    # do the work of each time slice in a worker thread
+    use_thread = True
+    # pacing: see pacing_factor()
+    idle_speedup = 0.5 # sleep this much less when the server is idle
+    busy_request_rate = 10.0 # requests/second which double the sleep time
+    busy_uploads = 5 # in-progress uploads which double the sleep time
+    max_backoff = 10.0 # never sleep more than this many times longer
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -240,19 +361,37 @@ class ShareCrawler(service.MultiService):
             self.allowed_cpu_percentage = allowed_cpu_percentage
         self.server = server
         self.sharedir = server.sharedir
+        # a server with several disks keeps buckets in all of them
+        self.sharedirs = getattr(server, "sharedirs", [server.sharedir])
+        # one thread per disk lists prefixdirs ahead of the crawl, so all
+        # the disks are busy at once: see list_buckets()
+        self._disk_queues = None
+        self._listings = {}
         self._state_serializer = _LeaseStateSerializer(statefile)
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
                          for i in range(2**10)]
         self.prefixes = [p.decode("ascii") for p in self.prefixes]
         self.prefixes.sort()
         self.timer = None
-        self.bucket_cache = (None, [])
+        self.bucket_cache = (None, [], {})
         self.current_sleep_time = None
         self.next_wake_time = None
         self.last_prefix_finished_time = None
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        # seconds per bucket spent in the most recent prefixes, and a
+        # long-running average of the same, to detect a slow disk
+        self.io_latency = None
+        self.io_latency_baseline = None
+        # requests per second handled by the server since the last slice
+        self.request_rate = None
+        self._last_request_sample = None
+        self._slice_d = None
+        self._worker_ident = None
+        self._stopping = False
+        # paths into self.state changed since the last save_state()
+        self._changed_paths = set()
         self.load_state()
 
     def minus_or_none(self, a, b):
@@ -390,18 +529,65 @@ class ShareCrawler(service.MultiService):
         """
         pass
 
-    def save_state(self):
+    def state_changed(self, *path):
+        """Note that the value at 'path' (a sequence of dictionary keys)
+        in self.state has been changed, added or deleted, so that the next
+        save_state() writes it out. This must be called in the reactor
+        thread, like anything else which changes self.state.
+        """
+        self._changed_paths.add(path)
+
+    def get_saved_value(self, path, value):
+        """Return the form in which get_state() reports 'value', found at
+        'path' in self.state.
+
+        Subclasses can override this if their get_state() converts parts of
+        the state to make them JSON-safe.
+        """
+        return value
+
+    def save_state(self, compact=False):
+        """Persist self.state. Normally only the values passed to
+        state_changed() since the last save are written; pass compact=True
+        to write out all of it."""
         lcpi = self.last_complete_prefix_index
         if lcpi == -1:
             last_complete_prefix = None
         else:
             last_complete_prefix = self.prefixes[lcpi]
         self.state["last-complete-prefix"] = last_complete_prefix
-        self._state_serializer.save(self.get_state())
+        serializer = self._state_serializer
+        if compact or serializer.needs_compaction():
+            serializer.save(self.get_state())
+        else:
+            # our own position changes with every bucket
+            self.state_changed("last-complete-prefix")
+            self.state_changed("last-complete-bucket")
+            serializer.append(self._get_state_changes())
+        self._changed_paths = set()
+
+    def _get_state_changes(self):
+        changes = []
+        # parents sort before their children, so a child is set after the
+        # parent that holds it
+        paths = sorted((list(map(_json_key, path)), path)
+                       for path in self._changed_paths)
+        for (json_path, path) in paths:
+            value = self.state
+            for k in path:
+                if not isinstance(value, dict) or k not in value:
+                    changes.append(["del", json_path])
+                    break
+                value = value[k]
+            else:
+                changes.append(["set", json_path,
+                                self.get_saved_value(path, value)])
+        return changes
 
     def startService(self):
         # arrange things to look like we were just sleeping, so
         # status/progress values work correctly
+        self._stopping = False
         self.sleeping_between_cycles = True
         self.current_sleep_time = self.slow_start
         self.next_wake_time = time.time() + self.slow_start
@@ -409,25 +595,87 @@ class ShareCrawler(service.MultiService):
         service.MultiService.startService(self)
 
     def stopService(self):
+        self._stopping = True
         if self.timer:
             self.timer.cancel()
             self.timer = None
+        if self._slice_d is not None:
+            # let the worker thread notice that we are stopping and finish
+            # its slice first
+            d = self._slice_d
+            d.addCallback(lambda ign: self._stop())
+            return d
+        return self._stop()
+
+    def _stop(self):
         self.save_state()
+        if self._disk_queues is not None:
+            for queue in self._disk_queues:
+                queue.shutdown(wait=False)
+            self._disk_queues = None
+            self._listings = {}
         return service.MultiService.stopService(self)
 
+    def call_in_reactor(self, f, *args, **kwargs):
+        """Call f(*args, **kwargs) in the reactor thread and return its
+        result. process_bucket() and process_prefixdir() must use this for
+        anything that could conflict with the storage server or the
+        reactor, like modifying shares, leases or self.state, since they may
+        run in a worker thread.
+        """
+        if threading.get_ident() != self._worker_ident:
+            return f(*args, **kwargs)
+        return threads.blockingCallFromThread(reactor, f, *args, **kwargs)
+
+    def time_slice_exceeded(self, start_slice):
+        """Return True if the current time slice is used up (or if we are
+        being stopped), meaning that TimeSliceExceeded should be raised."""
+        return (self._stopping or
+                time.time() >= start_slice + self.cpu_slice)
+
     def start_slice(self):
         start_slice = time.time()
         self.timer = None
         self.sleeping_between_cycles = False
         self.current_sleep_time = None
         self.next_wake_time = None
+        if not self.use_thread:
+            try:
+                self.start_current_prefix(start_slice)
+                finished_cycle = True
+            except TimeSliceExceeded:
+                finished_cycle = False
+            self.finish_slice(start_slice, finished_cycle)
+            return
+        self.start_cycle_if_needed()
+        self._slice_d = threads.deferToThread(self._work_in_thread,
+                                              start_slice)
+        def _done(finished_prefixes):
+            self._slice_d = None
+            if finished_prefixes:
+                self.finish_cycle()
+            self.finish_slice(start_slice, finished_prefixes)
+        def _failed(f):
+            self._slice_d = None
+            self.save_state()
+            return f
+        self._slice_d.addCallbacks(_done, _failed)
+
+    def _work_in_thread(self, start_slice):
+        """Process prefixes in the worker thread until the time slice is
+        used up. Return True if the cycle has been completed."""
+        self._worker_ident = threading.get_ident()
         try:
-            self.start_current_prefix(start_slice)
-            finished_cycle = True
+            self.process_prefixes(start_slice)
+            return True
         except TimeSliceExceeded:
-            finished_cycle = False
+            return False
+        finally:
+            self._worker_ident = None
+
+    def finish_slice(self, start_slice, finished_cycle):
         self.save_state()
-        if not self.running:
+        if not self.running or self._stopping:
             # someone might have used stopService() to shut us down
             return
         # either we finished a whole cycle, or we ran out of time
@@ -437,6 +685,8 @@ class ShareCrawler(service.MultiService):
         # this_slice/percentage = this_slice+sleep_time
         # sleep_time = (this_slice/percentage) - this_slice
         sleep_time = (this_slice / self.allowed_cpu_percentage) - this_slice
+        self.sample_request_rate(now)
+        sleep_time *= self.pacing_factor()
         # if the math gets weird, or a timequake happens, don't sleep
         # forever. Note that this means that, while a cycle is running, we
         # will process at least one bucket every 5 minutes, no matter how
@@ -455,7 +705,58 @@ class ShareCrawler(service.MultiService):
         self.yielding(sleep_time)
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
+    def sample_request_rate(self, now):
+        """Measure how many requests per second the storage server has
+        handled since the last time this was called."""
+        count = self.server.request_count
+        if self._last_request_sample is not None:
+            then, last_count = self._last_request_sample
+            if now > then:
+                self.request_rate = (count - last_count) / (now - then)
+        self._last_request_sample = (now, count)
+
+    def record_io_latency(self, elapsed, buckets):
+        """Record that processing a prefixdir with 'buckets' buckets took
+        'elapsed' seconds."""
+        latency = elapsed / (buckets + 1)
+        if self.io_latency is None:
+            self.io_latency = self.io_latency_baseline = latency
+        else:
+            self.io_latency = 0.5 * self.io_latency + 0.5 * latency
+            self.io_latency_baseline = (0.95 * self.io_latency_baseline +
+                                        0.05 * latency)
+
+    def pacing_factor(self):
+        """Return how much longer (or shorter) than allowed_cpu_percentage
+        alone would suggest the crawler should sleep between slices.
+
+        The crawler backs off in proportion to how much slower than its
+        long-term average the disk has recently been, and to how busy the
+        storage server is (requests per second handled since the last
+        slice, plus uploads in progress). If the server has been completely
+        idle, the crawler speeds up instead.
+        """
+        io_factor = 1.0
+        if self.io_latency is not None and self.io_latency_baseline:
+            io_factor = max(1.0, self.io_latency / self.io_latency_baseline)
+        rate = self.request_rate or 0.0
+        uploads = self.server.get_in_progress_upload_count()
+        if not rate and not uploads:
+            load_factor = self.idle_speedup
+        else:
+            load_factor = (1.0 + rate / self.busy_request_rate
+                           + uploads / self.busy_uploads)
+        factor = io_factor * load_factor
+        return max(self.idle_speedup, min(factor, self.max_backoff))
+
     def start_current_prefix(self, start_slice):
+        """Do all of the work of a time slice synchronously, in the current
+        thread."""
+        self.start_cycle_if_needed()
+        self.process_prefixes(start_slice)
+        self.finish_cycle()
+
+    def start_cycle_if_needed(self):
         state = self.state
         if state["current-cycle"] is None:
             self.last_cycle_started_time = time.time()
@@ -464,36 +765,101 @@ class ShareCrawler(service.MultiService):
                 state["current-cycle"] = 0
             else:
                 state["current-cycle"] = state["last-cycle-finished"] + 1
+            self.state_changed("current-cycle-start-time")
+            self.state_changed("current-cycle")
             self.started_cycle(state["current-cycle"])
-        cycle = state["current-cycle"]
+
+    def process_prefixes(self, start_slice):
+        """Process the remaining prefixdirs of the current cycle, raising
+        TimeSliceExceeded if the time slice is used up first."""
+        cycle = self.state["current-cycle"]
 
         for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
             # if we want to yield earlier, just raise TimeSliceExceeded()
             prefix = self.prefixes[i]
             prefixdir = os.path.join(self.sharedir, prefix)
+            started = time.time()
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
-                self.bucket_cache = (i, buckets)
+                (buckets, homes) = self.list_buckets(i)
+                self.bucket_cache = (i, buckets, homes)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
             self.last_complete_prefix_index = i
 
             now = time.time()
+            self.record_io_latency(now - started, len(buckets))
             if self.last_prefix_finished_time is not None:
                 elapsed = now - self.last_prefix_finished_time
                 self.last_prefix_elapsed_time = elapsed
             self.last_prefix_finished_time = now
 
-            self.finished_prefix(cycle, prefix)
-            if time.time() >= start_slice + self.cpu_slice:
+            self.call_in_reactor(self.finished_prefix, cycle, prefix)
+            # this only writes what changed, so it is cheap enough to do
+            # for every prefix, which limits the work a crash can repeat
+            self.call_in_reactor(self.save_state)
+            if self.time_slice_exceeded(start_slice):
                 raise TimeSliceExceeded()
 
+    def list_buckets(self, i):
+        """Return a sorted list of the buckets in the i'th prefixdir of every
+        share directory, and a dict mapping the name of each bucket which is
+        not in self.sharedir to the prefixdirs it was found in.
+
+        With several share directories, the listing of each is done by a
+        thread dedicated to that disk, and the next prefixdir is listed in
+        the background while this one is being processed.
+        """
+        if len(self.sharedirs) == 1:
+            try:
+                buckets = os.listdir(os.path.join(self.sharedir,
+                                                  self.prefixes[i]))
+                buckets.sort()
+            except EnvironmentError:
+                buckets = []
+            return (buckets, {})
+        if self._disk_queues is None:
+            self._disk_queues = [ThreadPoolExecutor(max_workers=1)
+                                 for d in self.sharedirs]
+        listings = self._listings.pop(i, None) or self._start_listing(i)
+        self._listings = {}
+        if i + 1 < len(self.prefixes):
+            self._listings[i + 1] = self._start_listing(i + 1)
+        buckets = set()
+        homes = {}
+        for (sharedir, listing) in zip(self.sharedirs, listings):
+            prefixdir = os.path.join(sharedir, self.prefixes[i])
+            for bucket in listing.result():
+                buckets.add(bucket)
+                if sharedir != self.sharedir:
+                    homes.setdefault(bucket, []).append(prefixdir)
+        return (sorted(buckets), homes)
+
+    def _start_listing(self, i):
+        def _listdir(prefixdir):
+            try:
+                return os.listdir(prefixdir)
+            except EnvironmentError:
+                return []
+        return [queue.submit(_listdir, os.path.join(d, self.prefixes[i]))
+                for (queue, d) in zip(self._disk_queues, self.sharedirs)]
+
+    def get_bucket_prefixdirs(self, prefixdir, bucket):
+        """Return the prefixdirs (one per share directory) which contain
+        the given bucket from the current prefix, given the prefixdir in
+        self.sharedir that was passed to process_prefixdir()."""
+        homes = self.bucket_cache[2].get(bucket)
+        if homes is None:
+            return [prefixdir]
+        if os.path.isdir(os.path.join(prefixdir, bucket)):
+            return [prefixdir] + homes
+        return homes
+
+    def finish_cycle(self):
+        """Wrap up a cycle whose prefixdirs have all been processed."""
+        state = self.state
+        cycle = state["current-cycle"]
         # yay! we finished the whole cycle
         self.last_complete_prefix_index = -1
         self.last_prefix_finished_time = None # don't include the sleep
@@ -504,11 +870,13 @@ class ShareCrawler(service.MultiService):
         state["last-cycle-finished"] = cycle
         state["current-cycle"] = None
         self.finished_cycle(cycle)
-        self.save_state()
+        self.save_state(compact=True)
 
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
-        base32-encoded) in sorted order.
+        base32-encoded) in sorted order, from all of the server's share
+        directories. prefixdir is the one in self.sharedir: use
+        get_bucket_prefixdirs() to find where each bucket really is.
 
         You can override this if your crawler doesn't care about the actual
         shares, for example a crawler which merely keeps track of how many
@@ -518,14 +886,26 @@ class ShareCrawler(service.MultiService):
         method along, and implement process_bucket() instead.
         """
 
-        for bucket in buckets:
-            last_complete = self.state["last-complete-bucket"]
-            if last_complete is not None and bucket <= last_complete:
-                continue
-            self.process_bucket(cycle, prefix, prefixdir, bucket)
-            self.state["last-complete-bucket"] = bucket
-            if time.time() >= start_slice + self.cpu_slice:
-                raise TimeSliceExceeded()
+        # only the reactor changes self.state, so it is safe to read here
+        last_complete = self.state["last-complete-bucket"]
+        try:
+            for bucket in buckets:
+                if last_complete is not None and bucket <= last_complete:
+                    continue
+                for bucket_prefixdir in self.get_bucket_prefixdirs(prefixdir,
+                                                                   bucket):
+                    self.process_bucket(cycle, prefix, bucket_prefixdir,
+                                        bucket)
+                last_complete = bucket
+                if self.time_slice_exceeded(start_slice):
+                    raise TimeSliceExceeded()
+        finally:
+            self.call_in_reactor(self.set_last_complete_bucket, last_complete)
+
+    def set_last_complete_bucket(self, bucket):
+        """Record how far process_prefixdir() got through the current
+        prefix. This runs in the reactor thread."""
+        self.state["last-complete-bucket"] = bucket
 
     # the remaining methods are explictly for subclasses to implement.
 
@@ -539,21 +919,25 @@ class ShareCrawler(service.MultiService):
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
         """Examine a single bucket. Subclasses should do whatever they want
         to do to the shares therein, then update self.state as necessary.
+        Since this may run in a worker thread while the reactor reads
+        self.state, make those updates with self.call_in_reactor(), and
+        pass what they changed to self.state_changed() so that it is saved.
 
         If the crawler is never interrupted by SIGKILL, this method will be
         called exactly once per share (per cycle). If it *is* interrupted,
         then the next time the node is started, some amount of work will be
         duplicated, according to when self.save_state() was last called. By
-        default, save_state() is called at the end of each timeslice, and
-        after finished_cycle() returns, and when stopService() is called.
+        default, save_state() is called after each prefixdir, at the end of
+        each timeslice, after finished_cycle() returns, and when
+        stopService() is called.
 
         To reduce the chance of duplicate work (i.e. to avoid adding multiple
-        records to a database), you can call save_state() at the end of your
+        records to a database), you can call
+        self.call_in_reactor(self.save_state) at the end of your
         process_bucket() method. This will reduce the maximum duplicated work
-        to one bucket per SIGKILL. It will also add overhead, probably 1-20ms
-        per bucket (and some disk writes), which will count against your
-        allowed_cpu_percentage, and which may be considerable if
-        process_bucket() runs quickly.
+        to one bucket per SIGKILL. It will also add overhead (and some disk
+        writes), which will count against your allowed_cpu_percentage, and
+        which may be considerable if process_bucket() runs quickly.
 
         This method is for subclasses to override. No upcall is necessary.
         """
@@ -562,10 +946,7 @@ class ShareCrawler(service.MultiService):
     def finished_prefix(self, cycle, prefix):
         """Notify a subclass that the crawler has just finished processing a
         prefix directory (all buckets with the same two-character/10bit
-        prefix). To impose a limit on how much work might be duplicated by a
-        SIGKILL that occurs during a timeslice, you can call
-        self.save_state() here, but be aware that it may represent a
-        significant performance hit.
+        prefix). The state is saved right after this returns.
 
         This method is for subclasses to override. No upcall is necessary.
         """
@@ -629,11 +1010,19 @@ class BucketCountingCrawler(ShareCrawler):
         # the individual buckets. We'll save state after each one. On my
         # laptop, a mostly-empty storage server can process about 70
         # prefixdirs in a 1.0s slice.
+        self.call_in_reactor(self.count_buckets, cycle, prefix, buckets)
+
+    def count_buckets(self, cycle, prefix, buckets):
+        # this runs in the reactor thread, which is the only one that may
+        # touch self.state while a slice is running
         if cycle not in self.state["bucket-counts"]:
             self.state["bucket-counts"][cycle] = {}
+            self.state_changed("bucket-counts", cycle)
         self.state["bucket-counts"][cycle][prefix] = len(buckets)
+        self.state_changed("bucket-counts", cycle, prefix)
         if prefix in self.prefixes[:self.num_sample_prefixes]:
             self.state["storage-index-samples"][prefix] = (cycle, buckets)
+            self.state_changed("storage-index-samples", prefix)
 
     def finished_cycle(self, cycle):
         last_counts = self.state["bucket-counts"].get(cycle, [])
@@ -10,7 +10,7 @@ from allmydata.storage.crawler import (
 )
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
+     UnknownImmutableContainerVersionError, si_a2b
 from twisted.python import log as twlog
 from twisted.python.filepath import FilePath
 
@@ -63,9 +63,11 @@ class _HistorySerializer:
 
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
-    and which have expired. I can remove the expired leases (if so
-    configured), and the share will be deleted when the last lease is
-    removed.
+    and which have expired, and bring the server's lease database up to date
+    with what I find. If so configured, I also delete the shares which the
+    lease database says have no unexpired leases left (see expire_shares()),
+    after every prefixdir. This does not need to wait for me to reach those
+    shares, since the storage server keeps the database up to date itself.
 
     I collect statistics on the leases and make these available to a web
     status page, including::
@@ -103,6 +105,7 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     slow_start = 360 # wait 6 minutes after startup
     minimum_cycle_time = 12*60*60 # not more than twice per day
+    expire_batch_size = 100 # shares deleted by each expire_shares() call
 
     def __init__(self, server, statefile, historyfile,
                  expiration_enabled, mode,
@@ -157,39 +160,50 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def started_cycle(self, cycle):
         self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+        self.state_changed("cycle-to-date")
 
     def stat(self, fn):
         return os.stat(fn)
 
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
         bucketdir = os.path.join(prefixdir, storage_index_b32)
+        storage_index = si_a2b(storage_index_b32.encode("ascii"))
         s = self.stat(bucketdir)
         would_keep_shares = []
         wks = None
+        shnums = []
+        shares = []
+        # This may run in a worker thread while the reactor reads
+        # self.state, so count into a dict of our own and add it to
+        # self.state in the reactor once the bucket is done.
+        so_far = self.create_empty_cycle_dict()
 
         for fn in os.listdir(bucketdir):
             try:
                 shnum = int(fn)
             except ValueError:
                 continue # non-numeric means not a sharefile
+            shnums.append(shnum)
             sharefile = os.path.join(bucketdir, fn)
             try:
-                wks = self.process_share(sharefile)
+                (wks, share) = self.process_share(sharefile, storage_index,
+                                                  shnum, so_far)
+                shares.append(share)
             except (UnknownMutableContainerVersionError,
                     UnknownImmutableContainerVersionError,
                     struct.error):
                 twlog.msg("lease-checker error processing %s" % sharefile)
                 twlog.err()
                 which = [storage_index_b32, shnum]
-                self.state["cycle-to-date"]["corrupt-shares"].append(which)
-                wks = (1, 1, 1, "unknown")
+                so_far["corrupt-shares"].append(which)
+                wks = (1, 1, "unknown")
             would_keep_shares.append(wks)
 
         sharetype = None
         if wks:
             # use the last share's sharetype as the buckettype
-            sharetype = wks[3]
-        rec = self.state["cycle-to-date"]["space-recovered"]
+            sharetype = wks[2]
+        rec = so_far["space-recovered"]
         self.increment(rec, "examined-buckets", 1)
         if sharetype:
             self.increment(rec, "examined-buckets-"+sharetype, 1)
@@ -200,79 +214,217 @@ class LeaseCheckingCrawler(ShareCrawler):
         except AttributeError:
             bucket_diskbytes = 0 # no stat().st_blocks on windows
         if sum([wks[0] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("original", bucket_diskbytes, sharetype)
+            self.increment_bucketspace(so_far, "original", bucket_diskbytes,
+                                       sharetype)
         if sum([wks[1] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("configured", bucket_diskbytes, sharetype)
-        if sum([wks[2] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
-
-    def process_share(self, sharefilename):
+            self.increment_bucketspace(so_far, "configured", bucket_diskbytes,
+                                       sharetype)
+        # let expire_shares() delete what has expired straight away
+        expiring = (self.expiration_enabled and
+                    0 in [wks[1] for wks in would_keep_shares])
+        # one trip to the reactor for the whole bucket
+        self.call_in_reactor(self.finished_bucket, storage_index, shnums,
+                             shares, so_far, expiring)
+
+    def finished_bucket(self, storage_index, shnums, shares, so_far,
+                        expiring):
+        """Reconcile the lease database with what process_bucket() found in
+        one bucket, and add what it counted to self.state. If it found a
+        share which has expired, let expire_shares() delete it right away.
+        This runs in the reactor thread, so it cannot race with the storage
+        server.
+        """
+        leasedb = self.server.leasedb
+        leasedb.retain_shares(storage_index, shnums)
+        leasedb.record_shares((storage_index, shnum, sharetype, leases)
+                              for (shnum, sharetype, leases) in shares)
+        self.add_to_cycle_to_date(so_far)
+        if expiring:
+            self.expire_shares()
+
+    def add_to_cycle_to_date(self, so_far):
+        """Add the counts made by process_bucket() for one bucket to
+        self.state["cycle-to-date"]."""
+        cycle_to_date = self.state["cycle-to-date"]
+        if so_far["corrupt-shares"]:
+            cycle_to_date["corrupt-shares"].extend(so_far["corrupt-shares"])
+            self.state_changed("cycle-to-date", "corrupt-shares")
+        for k in ("space-recovered", "leases-per-share-histogram"):
+            for (key, count) in so_far[k].items():
+                if count:
+                    self.increment(cycle_to_date[k], key, count)
+                    self.state_changed("cycle-to-date", k, key)
+        lah = cycle_to_date["lease-age-histogram"]
+        for (key, count) in so_far["lease-age-histogram"].items():
+            self.increment(lah, key, count)
+        if so_far["lease-age-histogram"]:
+            self.state_changed("cycle-to-date", "lease-age-histogram")
+
+    def finished_prefix(self, cycle, prefix):
+        self.expire_shares()
+
+    def get_saved_value(self, path, value):
+        # get_state() reports the lease-age histogram as a list, since its
+        # keys are tuples, so a change to it is saved as the whole list
+        if path == ("cycle-to-date",):
+            value = value.copy()
+            lah = value["lease-age-histogram"]
+            value["lease-age-histogram"] = self.convert_lease_age_histogram(lah)
+        elif path == ("cycle-to-date", "lease-age-histogram"):
+            value = self.convert_lease_age_histogram(value)
+        return value
+
+    def process_share(self, sharefilename, storage_index, shnum, so_far):
         # first, find out what kind of a share it is
         sf = get_share_file(sharefilename)
         sharetype = sf.sharetype
         now = time.time()
+        cutoff = self.get_expiration_cutoff(now)
         s = self.stat(sharefilename)
 
         num_leases = 0
         num_valid_leases_original = 0
         num_valid_leases_configured = 0
-        expired_leases_configured = []
+        leases = list(sf.get_leases())
 
-        for li in sf.get_leases():
+        for li in leases:
             num_leases += 1
             original_expiration_time = li.get_expiration_time()
-            grant_renew_time = li.get_grant_renew_time_time()
             age = li.get_age()
-            self.add_lease_age_to_histogram(age)
+            self.add_lease_age_to_histogram(so_far, age)
 
             #  expired-or-not according to original expiration time
             if original_expiration_time > now:
                 num_valid_leases_original += 1
 
-            #  expired-or-not according to our configured age limit
-            expired = False
-            if self.mode == "age":
-                age_limit = original_expiration_time
-                if self.override_lease_duration is not None:
-                    age_limit = self.override_lease_duration
-                if age > age_limit:
-                    expired = True
-            else:
-                assert self.mode == "cutoff-date"
-                if grant_renew_time < self.cutoff_date:
-                    expired = True
-            if sharetype not in self.sharetypes_to_expire:
-                expired = False
-
-            if expired:
-                expired_leases_configured.append(li)
-            else:
+            #  expired-or-not according to our configured policy, the same
+            #  way that expire_shares() decides it
+            if (sharetype not in self.sharetypes_to_expire
+                or original_expiration_time >= cutoff):
                 num_valid_leases_configured += 1
 
-        so_far = self.state["cycle-to-date"]
         self.increment(so_far["leases-per-share-histogram"], str(num_leases), 1)
-        self.increment_space("examined", s, sharetype)
-
-        would_keep_share = [1, 1, 1, sharetype]
+        self.increment_space(so_far, "examined", s, sharetype)
 
-        if self.expiration_enabled:
-            for li in expired_leases_configured:
-                sf.cancel_lease(li.cancel_secret)
+        would_keep_share = [1, 1, sharetype]
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
-            self.increment_space("original", s, sharetype)
+            self.increment_space(so_far, "original", s, sharetype)
 
         if num_valid_leases_configured == 0:
             would_keep_share[1] = 0
-            self.increment_space("configured", s, sharetype)
-            if self.expiration_enabled:
-                would_keep_share[2] = 0
-                self.increment_space("actual", s, sharetype)
+            self.increment_space(so_far, "configured", s, sharetype)
 
-        return would_keep_share
+        return (would_keep_share, (shnum, sharetype, leases))
 
-    def increment_space(self, a, s, sharetype):
+    def get_expiration_cutoff(self, now=None):
+        """Translate the configured expiration policy into a lease
+        expiration time: a share is expired if every one of its leases
+        expires before the returned time.
+
+        This relies on the same fixed 31-day lease duration as
+        ``LeaseInfo.get_grant_renew_time_time``.
+        """
+        if now is None:
+            now = time.time()
+        lease_duration = 31*24*60*60
+        if self.mode == "age":
+            if self.override_lease_duration is None:
+                return now
+            return now - self.override_lease_duration + lease_duration
+        assert self.mode == "cutoff-date"
+        return self.cutoff_date + lease_duration
+
+    def find_expired_shares(self, now=None, limit=None):
+        """Use the server's lease database to find the shares which the
+        configured expiration policy would delete, without opening any of
+        them. The database is only as fresh as the last crawler cycle for
+        shares whose leases were changed behind the server's back.
+
+        :return: an iterator of (storage_index, shnum, sharetype,
+            expiration_time) tuples, oldest first
+        """
+        return self.server.leasedb.get_expired_shares(
+            self.get_expiration_cutoff(now),
+            self.sharetypes_to_expire,
+            limit,
+        )
+
+    def expire_shares(self, now=None):
+        """Cancel the expired leases of the shares which the lease database
+        says have no unexpired lease left, which deletes them, and count
+        what was recovered. This does nothing unless expiration is enabled.
+
+        Each share is checked again before anything is cancelled, so a
+        lease which was renewed behind the database's back is left alone.
+        This runs in the reactor thread, and handles at most
+        expire_batch_size shares per call: the rest are left for the next
+        one.
+        """
+        if not self.expiration_enabled:
+            return
+        if now is None:
+            now = time.time()
+        cutoff = self.get_expiration_cutoff(now)
+        so_far = self.create_empty_cycle_dict()
+        gone = []
+        kept = []
+        for (storage_index, shnum, sharetype, expiration_time) in \
+                list(self.find_expired_shares(now, self.expire_batch_size)):
+            leases = self.expire_share(storage_index, shnum, cutoff, so_far)
+            if leases is None:
+                gone.append((storage_index, shnum))
+            else:
+                kept.append((storage_index, shnum, sharetype, leases))
+        leasedb = self.server.leasedb
+        if gone:
+            leasedb.remove_shares(gone)
+        if kept:
+            leasedb.record_shares(kept)
+        self.add_to_cycle_to_date(so_far)
+
+    def expire_share(self, storage_index, shnum, cutoff, so_far):
+        """Cancel the leases on one share which expire before 'cutoff',
+        counting what this recovers in 'so_far'.
+
+        :return: the leases left on the share, or None if it is gone
+        """
+        sharefilename = dict(self.server.get_shares(storage_index)).get(shnum)
+        if sharefilename is None:
+            return None
+        bucketdir = os.path.dirname(sharefilename)
+        try:
+            sf = get_share_file(sharefilename)
+            leases = list(sf.get_leases())
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error):
+            # the crawler reports these, and leaves them out of the database
+            twlog.msg("lease-checker error expiring %s" % sharefilename)
+            twlog.err()
+            return None
+        s = self.stat(sharefilename)
+        bucket_s = self.stat(bucketdir)
+        expired = set(li.cancel_secret for li in leases
+                      if li.get_expiration_time() < cutoff)
+        for cancel_secret in expired:
+            sf.cancel_lease(cancel_secret)
+        if os.path.exists(sharefilename):
+            # some lease was renewed since the database was updated
+            return list(sf.get_leases())
+
+        self.increment_space(so_far, "actual", s, sf.sharetype)
+        if not list(self.server.get_shares(storage_index)):
+            try:
+                bucket_diskbytes = bucket_s.st_blocks * 512
+            except AttributeError:
+                bucket_diskbytes = 0 # no stat().st_blocks on windows
+            self.increment_bucketspace(so_far, "actual", bucket_diskbytes,
+                                       sf.sharetype)
+        return None
+
+    def increment_space(self, so_far, a, s, sharetype):
         sharebytes = s.st_size
         try:
             # note that stat(2) says that st_blocks is 512 bytes, and that
@@ -283,7 +435,7 @@ class LeaseCheckingCrawler(ShareCrawler):
             # the docs say that st_blocks is only on linux. I also see it on
             # MacOS. But it isn't available on windows.
             diskbytes = sharebytes
-        so_far_sr = self.state["cycle-to-date"]["space-recovered"]
+        so_far_sr = so_far["space-recovered"]
         self.increment(so_far_sr, a+"-shares", 1)
         self.increment(so_far_sr, a+"-sharebytes", sharebytes)
         self.increment(so_far_sr, a+"-diskbytes", diskbytes)
@@ -292,8 +444,8 @@ class LeaseCheckingCrawler(ShareCrawler):
             self.increment(so_far_sr, a+"-sharebytes-"+sharetype, sharebytes)
             self.increment(so_far_sr, a+"-diskbytes-"+sharetype, diskbytes)
 
-    def increment_bucketspace(self, a, bucket_diskbytes, sharetype):
-        rec = self.state["cycle-to-date"]["space-recovered"]
+    def increment_bucketspace(self, so_far, a, bucket_diskbytes, sharetype):
+        rec = so_far["space-recovered"]
         self.increment(rec, a+"-diskbytes", bucket_diskbytes)
         self.increment(rec, a+"-buckets", 1)
         if sharetype:
@@ -305,13 +457,13 @@ class LeaseCheckingCrawler(ShareCrawler):
             d[k] = 0
         d[k] += delta
 
-    def add_lease_age_to_histogram(self, age):
+    def add_lease_age_to_histogram(self, so_far, age):
         bucket_interval = 24*60*60
         bucket_number = int(age/bucket_interval)
         bucket_start = bucket_number * bucket_interval
         bucket_end = bucket_start + bucket_interval
         k = (bucket_start, bucket_end)
-        self.increment(self.state["cycle-to-date"]["lease-age-histogram"], k, 1)
+        self.increment(so_far["lease-age-histogram"], k, 1)
 
     def convert_lease_age_histogram(self, lah):
         # convert { (minage,maxage) : count } into [ (minage,maxage,count) ]
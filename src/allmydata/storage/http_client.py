@@ -54,6 +54,7 @@ from .http_common import (
     CBOR_MIME_TYPE,
     get_spki_hash,
     response_is_not_html,
+    MAX_LEASES_PER_REQUEST,
 )
 from ..interfaces import VersionMessage
 from .common import si_b2a, si_to_human_readable
@@ -126,6 +127,14 @@ _SCHEMAS: Mapping[str, Schema] = {
     }
     """
     ),
+    "add_or_renew_leases": Schema(
+        """
+    response = {
+      missing: [* bstr]
+      failed: [* bstr]
+    }
+    """
+    ),
     "list_shares": Schema(
         """
     response = #6.258([0*256 uint])
@@ -315,6 +324,79 @@ class _StorageClientHTTPSPolicy:
         )
 
 
+class AdaptiveHTTPConnectionPool(HTTPConnectionPool):
+    """
+    A connection pool for talking to one storage server, which keeps as many
+    idle connections around as recent demand needs, and records how long
+    requests wait to get a connection.
+
+    Twisted never makes a request wait for a busy connection: if none is
+    idle, a new one is opened.  ``maxPersistentPerHost`` only bounds how many
+    are kept for reuse once their requests finish.  With a fixed bound, a
+    download that keeps more block reads outstanding than that closes the
+    surplus connections after every round and pays for new TCP and TLS
+    handshakes on the next.  So whenever a finished connection finds the
+    cache already full, the bound grows by one, up to ``MAX_PERSISTENT``.
+    Idle connections still time out after ``cachedConnectionTimeout``, so a
+    burst does not hold connections open forever.
+    """
+
+    MIN_PERSISTENT = 10
+    MAX_PERSISTENT = 100
+
+    def __init__(self, reactor, persistent: bool = True):
+        super().__init__(reactor, persistent)
+        self.maxPersistentPerHost = self.MIN_PERSISTENT
+        self.connections_opened = 0
+        self.connections_reused = 0
+        # Seconds spent by requests waiting for a connection, in total and
+        # for the slowest.  Reused connections cost (almost) nothing; new
+        # ones cost the TCP and TLS handshakes.
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def getConnection(self, key, endpoint):
+        start = self._reactor.seconds()
+        returned = []
+        d = super().getConnection(key, endpoint)
+
+        def got_connection(connection):
+            waited = self._reactor.seconds() - start
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            # A cached connection is handed over before getConnection()
+            # returns, a new one only once it has connected.
+            if returned:
+                self.connections_opened += 1
+            else:
+                self.connections_reused += 1
+            return connection
+
+        d.addCallback(got_connection)
+        returned.append(True)
+        return d
+
+    def _putConnection(self, key, connection):
+        if (
+            len(self._connections.get(key, ())) >= self.maxPersistentPerHost
+            and self.maxPersistentPerHost < self.MAX_PERSISTENT
+        ):
+            self.maxPersistentPerHost += 1
+        super()._putConnection(key, connection)
+
+    def get_stats(self) -> dict[str, float]:
+        """
+        :return: the connection counters for this pool.
+        """
+        return {
+            "connections_opened": self.connections_opened,
+            "connections_reused": self.connections_reused,
+            "connection_wait_time": self.wait_time,
+            "connection_max_wait_time": self.max_wait_time,
+            "max_persistent": self.maxPersistentPerHost,
+        }
+
+
 @define
 class StorageClientFactory:
     """
@@ -394,8 +476,7 @@ class StorageClientFactory:
         assert nurl.fragment == "v=1"
         assert nurl.scheme in ("pb", "pb+tor")
         if pool is None:
-            pool = HTTPConnectionPool(reactor)
-            pool.maxPersistentPerHost = 10
+            pool = AdaptiveHTTPConnectionPool(reactor)
 
         certificate_hash = nurl.user.encode("ascii")
         agent = await self._create_agent(
@@ -574,6 +655,15 @@ class StorageClient:
                 ).read()
                 raise ClientException(response.code, response.phrase, data)
 
+    def get_connection_stats(self) -> Optional[dict[str, float]]:
+        """
+        :return: the connection counters of the pool, or ``None`` if it does
+            not keep any.
+        """
+        if isinstance(self._pool, AdaptiveHTTPConnectionPool):
+            return self._pool.get_stats()
+        return None
+
     def shutdown(self) -> Deferred[object]:
         """Shutdown any connections."""
         return self._pool.closeCachedConnections()
@@ -657,6 +747,65 @@ class StorageClientGeneral:
         else:
             raise ClientException(response.code)
 
+    @async_to_deferred
+    async def add_or_renew_leases(
+        self, leases: Sequence[tuple[bytes, bytes, bytes]]
+    ) -> tuple[set[bytes], set[bytes]]:
+        """
+        Add or renew leases on the shares of many storage indexes, using as
+        few requests as the server allows.
+
+        :param leases: ``(storage_index, renew_secret, cancel_secret)``
+            tuples.
+
+        :return: the storage indexes the server had no shares for, and those
+            whose leases it could not add.
+
+        Servers which predate the batch endpoint respond with
+        ``ClientException`` for ``http.NOT_FOUND``.
+        """
+        with start_action(
+            action_type="allmydata:storage:http-client:add-or-renew-leases",
+            count=len(leases),
+        ):
+            missing: set[bytes] = set()
+            failed: set[bytes] = set()
+            for start in range(0, len(leases), MAX_LEASES_PER_REQUEST):
+                (batch_missing, batch_failed) = await self._add_or_renew_leases(
+                    leases[start : start + MAX_LEASES_PER_REQUEST]
+                )
+                missing |= batch_missing
+                failed |= batch_failed
+            return (missing, failed)
+
+    async def _add_or_renew_leases(
+        self, leases: Sequence[tuple[bytes, bytes, bytes]]
+    ) -> tuple[set[bytes], set[bytes]]:
+        url = self._client.relative_url("/storage/v1/lease")
+        message = {
+            "leases": [
+                {
+                    "storage-index": storage_index,
+                    "renew-secret": renew_secret,
+                    "cancel-secret": cancel_secret,
+                }
+                for (storage_index, renew_secret, cancel_secret) in leases
+            ]
+        }
+        response = await self._client.request(
+            "POST", url, message_to_serialize=message
+        )
+        if response.code == http.OK:
+            body = cast(
+                Mapping[str, Sequence[bytes]],
+                await self._client.decode_cbor(
+                    response, _SCHEMAS["add_or_renew_leases"]
+                ),
+            )
+            return (set(body["missing"]), set(body["failed"]))
+        else:
+            raise ClientException(response.code)
+
 
 @define
 class UploadProgress:
@@ -40,6 +40,11 @@ def response_is_not_html(response: IResponse) -> None:
         assert get_content_type(response.headers) != "text/html"
 
 
+# The most leases a client may add or renew in one request to the batch lease
+# endpoint.  Larger batches must be split up by the client.
+MAX_LEASES_PER_REQUEST = 5000
+
+
 def swissnum_auth_header(swissnum: bytes) -> bytes:
     """Return value for ``Authorization`` header."""
     return b"Tahoe-LAFS " + b64encode(swissnum).strip()
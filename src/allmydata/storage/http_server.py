@@ -65,6 +65,7 @@ from .http_common import (
     get_content_type,
     CBOR_MIME_TYPE,
     get_spki_hash,
+    MAX_LEASES_PER_REQUEST,
 )
 
 from .common import si_a2b
@@ -395,6 +396,19 @@ _SCHEMAS = {
         share_number = uint
         """
     ),
+    "add_or_renew_leases": Schema(
+        """
+    request = {
+      leases: [0*%d lease]
+    }
+    lease = {
+      storage-index: bstr .size 16
+      renew-secret: bstr .size 32
+      cancel-secret: bstr .size 32
+    }
+    """
+        % (MAX_LEASES_PER_REQUEST,)
+    ),
 }
 
 
@@ -917,6 +931,35 @@ class HTTPServer(BaseApp):
         request.setResponseCode(http.NO_CONTENT)
         return b""
 
+    @_authorized_route(
+        _app,
+        set(),
+        "/storage/v1/lease",
+        methods=["POST"],
+    )
+    @async_to_deferred
+    async def add_or_renew_leases(
+        self, request: Request, authorization: SecretsDict
+    ) -> KleinRenderable:
+        """
+        Update the leases for the shares of many storage indexes at once.
+        """
+        info = await read_encoded(
+            self._reactor,
+            request,
+            _SCHEMAS["add_or_renew_leases"],
+            # Each lease is a little over 100 bytes of CBOR.
+            max_size=128 * MAX_LEASES_PER_REQUEST,
+        )
+        # Checking of the renewal secrets is done by the backend.
+        (missing, failed) = self._storage_server.add_leases(
+            (lease["storage-index"], lease["renew-secret"], lease["cancel-secret"])
+            for lease in info["leases"]
+        )
+        return await self._send_encoded(
+            request, {"missing": sorted(missing), "failed": sorted(failed)}
+        )
+
     @_authorized_route(
         _app,
         set(),
@@ -0,0 +1,208 @@
+"""
+An index of share lease expiration times, kept by the storage server.
+
+The leases themselves still live inside each share file (see
+``allmydata.storage.immutable`` and ``allmydata.storage.mutable``), which
+remain the authoritative record.  This database only remembers, for every
+share, the latest expiration time of any lease on it.  That is enough to
+answer "which shares have no unexpired leases left?" with a single range
+query over an index, instead of opening and parsing every share on the
+disk.
+
+The ``StorageServer`` updates the index whenever it adds, renews or cancels
+a lease, and the ``LeaseCheckingCrawler`` reconciles it with what it finds
+on disk, so an index which is lost or out of date repairs itself over the
+course of one crawler cycle.  When expiration is enabled, the crawler asks
+the index which shares have expired, and only opens those.
+"""
+
+from __future__ import annotations
+
+from typing import Iterable, Iterator
+
+from allmydata.storage.common import si_b2a, si_a2b
+from allmydata.storage.lease import ILeaseInfo
+from allmydata.util.dbutil import get_db
+
+
+SCHEMA_v1 = """
+CREATE TABLE version -- added in v1
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares -- added in v1
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32(storage_index)
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(9) NOT NULL,      -- "mutable" or "immutable"
+ expiration_time INTEGER NOT NULL,   -- latest expiration of any lease, or 0
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX shares_by_expiration ON shares (expiration_time);
+"""
+
+
+def _latest_expiration(leases: Iterable[ILeaseInfo]) -> int:
+    """
+    :return: The latest expiration time of any of the given leases, or 0 if
+        there are none.
+    """
+    return int(max(
+        (lease.get_expiration_time() for lease in leases),
+        default=0,
+    ))
+
+
+class LeaseDB:
+    """
+    Keep track of the lease expiration time of every share on this server.
+
+    Storage indexes are given and returned as binary strings.
+    """
+
+    def __init__(self, dbfile: str):
+        """
+        :param dbfile: The path of the sqlite database, which is created if
+            it does not already exist.
+
+        :raise DBError: If the database cannot be opened.
+        """
+        (self._sqlite, self._db) = get_db(
+            dbfile, create_version=(SCHEMA_v1, 1), dbname="leasedb",
+        )
+        # The share files remain authoritative and the crawler reconciles
+        # this index against them, so there is no need to pay for an fsync
+        # on every lease operation.
+        self._db.execute("PRAGMA synchronous = OFF;")
+
+    def close(self) -> None:
+        self._db.close()
+
+    def record_share(self, storage_index: bytes, shnum: int, sharetype: str,
+                     leases: Iterable[ILeaseInfo]) -> None:
+        """
+        Remember the current leases on a share, replacing whatever was
+        recorded for it before.
+
+        :param leases: All of the leases currently on the share.
+        """
+        self._db.execute(
+            "INSERT OR REPLACE INTO shares VALUES (?,?,?,?)",
+            (si_b2a(storage_index).decode("ascii"), shnum, sharetype,
+             _latest_expiration(leases)),
+        )
+        self._db.commit()
+
+    def record_shares(self, shares: Iterable[tuple[bytes, int, str,
+                                                   Iterable[ILeaseInfo]]]
+                      ) -> None:
+        """
+        Like ``record_share`` for many shares at once, committing only once
+        at the end.
+
+        :param shares: ``(storage_index, shnum, sharetype, leases)`` tuples.
+        """
+        self._db.executemany(
+            "INSERT OR REPLACE INTO shares VALUES (?,?,?,?)",
+            [(si_b2a(storage_index).decode("ascii"), shnum, sharetype,
+              _latest_expiration(leases))
+             for (storage_index, shnum, sharetype, leases) in shares],
+        )
+        self._db.commit()
+
+    def remove_share(self, storage_index: bytes, shnum: int) -> None:
+        """
+        Forget about a share which has been deleted.
+        """
+        self._db.execute(
+            "DELETE FROM shares WHERE storage_index=? AND shnum=?",
+            (si_b2a(storage_index).decode("ascii"), shnum),
+        )
+        self._db.commit()
+
+    def remove_shares(self, shares: Iterable[tuple[bytes, int]]) -> None:
+        """
+        Like ``remove_share`` for many shares at once, committing only once
+        at the end.
+
+        :param shares: ``(storage_index, shnum)`` tuples.
+        """
+        self._db.executemany(
+            "DELETE FROM shares WHERE storage_index=? AND shnum=?",
+            [(si_b2a(storage_index).decode("ascii"), shnum)
+             for (storage_index, shnum) in shares],
+        )
+        self._db.commit()
+
+    def retain_shares(self, storage_index: bytes,
+                      shnums: Iterable[int]) -> None:
+        """
+        Forget about any share for ``storage_index`` which is not one of
+        ``shnums``.  This is used to reconcile the index with the shares
+        actually found on disk.
+        """
+        si_s = si_b2a(storage_index).decode("ascii")
+        shnums = set(shnums)
+        c = self._db.execute(
+            "SELECT shnum FROM shares WHERE storage_index=?", (si_s,),
+        )
+        stale = [(si_s, shnum) for (shnum,) in c.fetchall()
+                 if shnum not in shnums]
+        if stale:
+            self._db.executemany(
+                "DELETE FROM shares WHERE storage_index=? AND shnum=?", stale,
+            )
+            self._db.commit()
+
+    def get_expiration_time(self, storage_index: bytes,
+                            shnum: int) -> int | None:
+        """
+        :return: The recorded latest lease expiration time for the share, or
+            ``None`` if nothing is known about it.
+        """
+        c = self._db.execute(
+            "SELECT expiration_time FROM shares"
+            " WHERE storage_index=? AND shnum=?",
+            (si_b2a(storage_index).decode("ascii"), shnum),
+        )
+        row = c.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_expired_shares(
+            self, cutoff: float, sharetypes: Iterable[str] = ("mutable", "immutable"),
+            limit: int | None = None,
+    ) -> Iterator[tuple[bytes, int, str, int]]:
+        """
+        Find the shares on which every lease expires before ``cutoff``,
+        oldest first.
+
+        :param sharetypes: Only consider shares of these types.
+
+        :param limit: If not ``None``, return at most this many shares.
+
+        :return: An iterator of ``(storage_index, shnum, sharetype,
+            expiration_time)`` tuples.
+        """
+        sharetypes = list(sharetypes)
+        query = (
+            "SELECT storage_index, shnum, sharetype, expiration_time"
+            " FROM shares WHERE expiration_time < ?"
+            " AND sharetype IN (%s)"
+            " ORDER BY expiration_time" % (",".join("?" * len(sharetypes)),)
+        )
+        args: list = [int(cutoff)] + sharetypes
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        for (si_s, shnum, sharetype, expiration_time) in self._db.execute(query, args).fetchall():
+            yield (si_a2b(si_s.encode("ascii")), shnum, sharetype, expiration_time)
+
+    def count_shares(self) -> int:
+        """
+        :return: The number of shares in the index.
+        """
+        return self._db.execute("SELECT COUNT(*) FROM shares").fetchone()[0]
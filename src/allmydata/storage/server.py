@@ -10,7 +10,8 @@ import os, re
 from foolscap.api import Referenceable
 from foolscap.ipb import IRemoteReference
 from twisted.application import service
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 
 from zope.interface import implementer
 from allmydata.interfaces import RIStorageServer, IStatsProducer
@@ -29,6 +30,7 @@ from allmydata.storage.immutable import (
 )
 from allmydata.storage.crawler import BucketCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.leasedb import LeaseDB
 
 # storage/
 # storage/shares/incoming
@@ -40,6 +42,10 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
 
+# Additional share directories (usually on other disks) have the same layout,
+# with their own incoming/ directory, and hold whole buckets: all the shares
+# of a storage index are kept in the same share directory.
+
 # $SHARENUM matches this regex:
 NUM_RE=re.compile("^[0-9]+$")
 
@@ -68,7 +74,18 @@ class StorageServer(service.MultiService):
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
                  expiration_sharetypes=("mutable", "immutable"),
-                 clock=reactor):
+                 clock=reactor,
+                 extra_sharedirs=(),
+                 share_placement="hash"):
+        """
+        :param extra_sharedirs: Directories, usually on other disks, which
+            will hold shares in addition to ``storedir/shares``.
+
+        :param str share_placement: How to choose the share directory for
+            a new storage index: "hash" spreads them evenly by storage
+            index, "free-space" picks the directory with the most available
+            space.
+        """
         service.MultiService.__init__(self)
         assert isinstance(nodeid, bytes)
         assert len(nodeid) == 20
@@ -78,6 +95,15 @@ class StorageServer(service.MultiService):
         sharedir = os.path.join(storedir, "shares")
         fileutil.make_dirs(sharedir)
         self.sharedir = sharedir
+        self.sharedirs = [sharedir]
+        for extra in extra_sharedirs:
+            extra = os.path.abspath(extra)
+            fileutil.make_dirs(extra)
+            self.sharedirs.append(extra)
+        if share_placement not in ("hash", "free-space"):
+            raise ValueError("share placement '%s' must be 'hash' or "
+                             "'free-space'" % (share_placement,))
+        self.share_placement = share_placement
         self.corruption_advisory_dir = os.path.join(storedir,
                                                     "corruption-advisories")
         fileutil.make_dirs(self.corruption_advisory_dir)
@@ -89,7 +115,8 @@ class StorageServer(service.MultiService):
             self.stats_provider.register_producer(self)
         self.incomingdir = os.path.join(sharedir, 'incoming')
         self._clean_incomplete()
-        fileutil.make_dirs(self.incomingdir)
+        for d in self.sharedirs:
+            fileutil.make_dirs(os.path.join(d, 'incoming'))
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
@@ -105,11 +132,17 @@ class StorageServer(service.MultiService):
                           "writev": [], # mutable
                           "readv": [],
                           "add-lease": [], # both
+                          "add-leases": [],
                           "renew": [],
                           "cancel": [],
                           }
+        self.request_count = 0
         self.add_bucket_counter()
 
+        # An index of lease expiration times, kept in sync with the leases
+        # stored in the share files themselves.
+        self.leasedb = LeaseDB(os.path.join(self.storedir, "leasedb.sqlite"))
+
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
         klass = self.LeaseCheckerClass
@@ -131,7 +164,10 @@ class StorageServer(service.MultiService):
         # Cancel any in-progress uploads:
         for bw in list(self._bucket_writers.values()):
             bw.disconnected()
-        return service.MultiService.stopService(self)
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        # the crawlers are stopped by now, so nothing else uses the index
+        d.addCallback(lambda ign: self.leasedb.close())
+        return d
 
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
@@ -139,7 +175,8 @@ class StorageServer(service.MultiService):
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
-        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+        return any(set(os.listdir(d)) - set(["incoming"])
+                   for d in self.sharedirs)
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
@@ -147,6 +184,9 @@ class StorageServer(service.MultiService):
         self.bucket_counter.setServiceParent(self)
 
     def count(self, name, delta=1):
+        # every request is counted, which lets background work like the
+        # crawlers tell how busy we are
+        self.request_count += 1
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
@@ -202,7 +242,8 @@ class StorageServer(service.MultiService):
         return log.msg(*args, **kwargs)
 
     def _clean_incomplete(self):
-        fileutil.rm_dir(self.incomingdir)
+        for d in self.sharedirs:
+            fileutil.rm_dir(os.path.join(d, 'incoming'))
 
     def get_stats(self):
         # remember: RIStatsProvider requires that our return dict
@@ -214,7 +255,19 @@ class StorageServer(service.MultiService):
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
 
         try:
-            disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
+            keys = ('total', 'used', 'free_for_root', 'free_for_nonroot',
+                    'avail')
+            totals = dict.fromkeys(keys, 0)
+            for i, d in enumerate(self.sharedirs):
+                disk = fileutil.get_disk_stats(d, self.reserved_space)
+                for k in keys:
+                    totals[k] += disk[k]
+                    if len(self.sharedirs) > 1:
+                        stats['storage_server.disks.%d.%s' % (i, k)] = disk[k]
+                if len(self.sharedirs) > 1:
+                    stats['storage_server.disks.%d.allocated' % (i,)] = \
+                        self.allocated_size(d)
+            disk = totals
             writeable = disk['avail'] > 0
 
             # spacetime predictors should use disk_avail / (d(disk_used)/dt)
@@ -240,18 +293,67 @@ class StorageServer(service.MultiService):
             stats['storage_server.total_bucket_count'] = bucket_count
         return stats
 
-    def get_available_space(self):
+    def get_available_space(self, sharedir=None):
         """Returns available space for share storage in bytes, or None if no
-        API to get this information is available."""
+        API to get this information is available.
+
+        :param sharedir: If given, only count the space available in this
+            one of self.sharedirs, rather than in all of them.
+        """
 
         if self.readonly_storage:
             return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
-
-    def allocated_size(self):
+        if sharedir is not None:
+            return fileutil.get_available_space(sharedir, self.reserved_space)
+        total = 0
+        for d in self.sharedirs:
+            avail = fileutil.get_available_space(d, self.reserved_space)
+            if avail is None:
+                return None
+            total += avail
+        return total
+
+    def _get_bucket_dir(self, storage_index):
+        """
+        :return: The directory holding the shares of ``storage_index``: the
+            one where it already has a bucket if there is one, or else the
+            one where a new bucket should be created.
+        """
+        si_dir = storage_index_to_dir(storage_index)
+        if len(self.sharedirs) == 1:
+            return os.path.join(self.sharedir, si_dir)
+        for d in self.sharedirs:
+            bucketdir = os.path.join(d, si_dir)
+            if os.path.isdir(bucketdir):
+                return bucketdir
+        return os.path.join(self._place_bucket(storage_index), si_dir)
+
+    def _place_bucket(self, storage_index):
+        """
+        :return: The share directory where a new bucket for
+            ``storage_index`` should go, according to self.share_placement.
+        """
+        if self.share_placement == "free-space" and not self.readonly_storage:
+            spaces = [(self.get_available_space(d), -i, d)
+                      for (i, d) in enumerate(self.sharedirs)]
+            if None not in [space for (space, _, _) in spaces]:
+                return max(spaces)[2]
+        i = int.from_bytes(storage_index[:4], "big") % len(self.sharedirs)
+        return self.sharedirs[i]
+
+    def get_in_progress_upload_count(self):
+        """Return the number of immutable shares currently being uploaded."""
+        return len(self._bucket_writers)
+
+    def allocated_size(self, sharedir=None):
+        """
+        :param sharedir: If given, only count uploads into this one of
+            self.sharedirs.
+        """
         space = 0
         for bw in self._bucket_writers.values():
-            space += bw.allocated_size()
+            if sharedir is None or bw.finalhome.startswith(sharedir + os.sep):
+                space += bw.allocated_size()
         return space
 
     def get_version(self):
@@ -259,11 +361,18 @@ class StorageServer(service.MultiService):
         if remaining_space is None:
             # We're on a platform that has no API to get disk stats.
             remaining_space = 2**64
+            max_share_size = remaining_space
+        elif len(self.sharedirs) > 1:
+            # a share has to fit on one disk
+            max_share_size = max(self.get_available_space(d) or 0
+                                 for d in self.sharedirs)
+        else:
+            max_share_size = remaining_space
 
         # Unicode strings might be nicer, but for now sticking to bytes since
         # this is what the wire protocol has always been.
         version = { b"http://allmydata.org/tahoe/protocols/storage/v1" :
-                    { b"maximum-immutable-share-size": remaining_space,
+                    { b"maximum-immutable-share-size": max_share_size,
                       b"maximum-mutable-share-size": MAX_MUTABLE_SHARE_SIZE,
                       b"available-space": remaining_space,
                       b"tolerates-immutable-read-overrun": True,
@@ -300,9 +409,9 @@ class StorageServer(service.MultiService):
         log.msg("storage: allocate_buckets %r" % si_s)
 
         # in this implementation, the lease information (including secrets)
-        # goes into the share files themselves. It could also be put into a
-        # separate database. Note that the lease should not be added until
-        # the BucketWriter has been closed.
+        # goes into the share files themselves, and only the expiration
+        # times are indexed in self.leasedb. Note that the lease should not
+        # be added to the index until the BucketWriter has been closed.
         expire_time = self._clock.seconds() + DEFAULT_RENEWAL_TIME
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
@@ -310,13 +419,18 @@ class StorageServer(service.MultiService):
 
         max_space_per_bucket = allocated_size
 
-        remaining_space = self.get_available_space()
+        # all the shares of a storage index go into the same share directory
+        bucketdir = self._get_bucket_dir(storage_index)
+        sharedir = os.path.dirname(os.path.dirname(bucketdir))
+        incomingdir = os.path.join(sharedir, 'incoming')
+
+        remaining_space = self.get_available_space(sharedir)
         limited = remaining_space is not None
         if limited:
             # this is a bit conservative, since some of this allocated_size()
             # has already been written to disk, where it will show up in
             # get_available_space.
-            remaining_space -= self.allocated_size()
+            remaining_space -= self.allocated_size(sharedir)
         # self.readonly_storage causes remaining_space <= 0
 
         # fill alreadygot with all shares that we have, not just the ones
@@ -326,11 +440,11 @@ class StorageServer(service.MultiService):
         for (shnum, fn) in self.get_shares(storage_index):
             alreadygot[shnum] = ShareFile(fn)
         if renew_leases:
-            self._add_or_renew_leases(alreadygot.values(), lease_info)
+            self._add_or_renew_leases(storage_index, alreadygot.values(), lease_info)
 
         for shnum in sharenums:
-            incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
-            finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
+            incominghome = os.path.join(incomingdir, si_dir, "%d" % shnum)
+            finalhome = os.path.join(bucketdir, "%d" % shnum)
             if os.path.exists(finalhome):
                 # great! we already have it. easy.
                 pass
@@ -359,7 +473,7 @@ class StorageServer(service.MultiService):
                 pass
 
         if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
+            fileutil.make_dirs(bucketdir)
 
         self.add_latency("allocate", self._clock.seconds() - start)
         return set(alreadygot), bucketwriters
@@ -387,12 +501,65 @@ class StorageServer(service.MultiService):
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
         self._add_or_renew_leases(
+            storage_index,
             self._iter_share_files(storage_index),
             lease_info,
         )
         self.add_latency("add-lease", self._clock.seconds() - start)
         return None
 
+    def add_leases(self, leases, owner_num=1):
+        """
+        Add or renew leases on the shares of many storage indexes in one
+        pass, as ``add_lease`` would for each of them.
+
+        The storage indexes are visited in the order their directories are
+        laid out on disk, the available space is measured once rather than
+        for every share, and the lease database is updated in a single
+        transaction at the end.
+
+        :param leases: ``(storage_index, renew_secret, cancel_secret)``
+            tuples.
+
+        :return: a 2-tuple of sets of storage indexes: those for which no
+            shares were found, and those whose leases could not be added
+            (for example because there was no room for a new lease).
+        """
+        start = self._clock.seconds()
+        self.count("add-leases")
+        new_expire_time = self._clock.seconds() + DEFAULT_RENEWAL_TIME
+        available_space = self.get_available_space()
+        missing = set()
+        failed = set()
+        records = []
+        for (storage_index, renew_secret, cancel_secret) in sorted(
+                leases, key=lambda lease: storage_index_to_dir(lease[0])):
+            lease_info = LeaseInfo(owner_num,
+                                   renew_secret, cancel_secret,
+                                   new_expire_time, self.my_nodeid)
+            found = False
+            try:
+                for share in self._iter_share_files(storage_index):
+                    found = True
+                    share.add_or_renew_lease(available_space, lease_info)
+                    records.append((
+                        storage_index, int(os.path.basename(share.home)),
+                        share.sharetype, share.get_leases(),
+                    ))
+            except Exception:
+                # handled: the client hears about it in the result
+                log.msg(format="failed to add lease on %(si)s",
+                        si=si_b2a(storage_index), failure=Failure(),
+                        facility="tahoe.storage", level=log.WEIRD,
+                        umid="f8Kq2w")
+                failed.add(storage_index)
+                continue
+            if not found:
+                missing.add(storage_index)
+        self.leasedb.record_shares(records)
+        self.add_latency("add-leases", self._clock.seconds() - start)
+        return (missing, failed)
+
     def renew_lease(self, storage_index, renew_secret):
         start = self._clock.seconds()
         self.count("renew")
@@ -401,6 +568,7 @@ class StorageServer(service.MultiService):
         for sf in self._iter_share_files(storage_index):
             found_buckets = True
             sf.renew_lease(renew_secret, new_expire_time)
+            self._record_leases(storage_index, sf)
         self.add_latency("renew", self._clock.seconds() - start)
         if not found_buckets:
             raise IndexError("no such lease to renew")
@@ -409,6 +577,12 @@ class StorageServer(service.MultiService):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
         del self._bucket_writers[bw.incominghome]
+        if consumed_size:
+            # The share (and the lease it was created with) is now in its
+            # final home, which is named after the storage index.
+            si_s = os.path.basename(os.path.dirname(bw.finalhome))
+            self._record_leases(si_a2b(si_s.encode("ascii")),
+                                ShareFile(bw.finalhome))
         for handler in self._call_on_bucket_writer_close:
             handler(bw)
 
@@ -424,15 +598,17 @@ class StorageServer(service.MultiService):
         shares for this storage_index. In each tuple, 'shnum' will always be
         the integer form of the last component of 'pathname'.
         """
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
-        try:
-            for f in os.listdir(storagedir):
-                if NUM_RE.match(f):
-                    filename = os.path.join(storagedir, f)
-                    yield (int(f), filename)
-        except OSError:
-            # Commonly caused by there being no buckets at all.
-            pass
+        si_dir = storage_index_to_dir(storage_index)
+        for sharedir in self.sharedirs:
+            storagedir = os.path.join(sharedir, si_dir)
+            try:
+                for f in os.listdir(storagedir):
+                    if NUM_RE.match(f):
+                        filename = os.path.join(storagedir, f)
+                        yield (int(f), filename)
+            except OSError:
+                # Commonly caused by there being no buckets at all.
+                pass
 
     def get_buckets(self, storage_index):
         """
@@ -611,10 +787,12 @@ class StorageServer(service.MultiService):
                                expire_time, self.my_nodeid)
         return lease_info
 
-    def _add_or_renew_leases(self, shares, lease_info):
+    def _add_or_renew_leases(self, storage_index, shares, lease_info):
         """
         Put the given lease onto the given shares.
 
+        :param bytes storage_index: The storage index the shares belong to.
+
         :param Iterable[Union[MutableShareFile, ShareFile]] shares: The shares
             to put the lease onto.
 
@@ -622,6 +800,21 @@ class StorageServer(service.MultiService):
         """
         for share in shares:
             share.add_or_renew_lease(self.get_available_space(), lease_info)
+            self._record_leases(storage_index, share)
+
+    def _record_leases(self, storage_index, share):
+        """
+        Update the lease database with the current leases on a share.
+
+        :param bytes storage_index: The storage index the share belongs to.
+
+        :param Union[MutableShareFile, ShareFile] share: The share, whose
+            share number is the last component of its filename.
+        """
+        shnum = int(os.path.basename(share.home))
+        self.leasedb.record_share(
+            storage_index, shnum, share.sharetype, share.get_leases(),
+        )
 
     def slot_testv_and_readv_and_writev(  # type: ignore # warner/foolscap#78
             self,
@@ -647,9 +840,8 @@ class StorageServer(service.MultiService):
         self.count("writev")
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %r" % si_s)
-        si_dir = storage_index_to_dir(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
-        bucketdir = os.path.join(self.sharedir, si_dir)
+        bucketdir = self._get_bucket_dir(storage_index)
 
         # If collection succeeds we know the write_enabler is good for all
         # existing shares.
@@ -681,7 +873,13 @@ class StorageServer(service.MultiService):
             )
             if renew_leases:
                 lease_info = self._make_lease_info(renew_secret, cancel_secret)
-                self._add_or_renew_leases(remaining_shares.values(), lease_info)
+                self._add_or_renew_leases(
+                    storage_index, remaining_shares.values(), lease_info,
+                )
+            for sharenum, (_, _, new_length) in test_and_write_vectors.items():
+                if new_length == 0:
+                    # A zero-length write deletes the share.
+                    self.leasedb.remove_share(storage_index, sharenum)
 
         # all done
         self.add_latency("writev", self._clock.seconds() - start)
@@ -699,9 +897,8 @@ class StorageServer(service.MultiService):
 
     def enumerate_mutable_shares(self, storage_index: bytes) -> set[int]:
         """Return all share numbers for the given mutable."""
-        si_dir = storage_index_to_dir(storage_index)
         # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
+        bucketdir = self._get_bucket_dir(storage_index)
         if not os.path.isdir(bucketdir):
             return set()
         result = set()
@@ -718,9 +915,8 @@ class StorageServer(service.MultiService):
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %r %r" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
         # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
+        bucketdir = self._get_bucket_dir(storage_index)
         if not os.path.isdir(bucketdir):
             self.add_latency("readv", self._clock.seconds() - start)
             return {}
@@ -798,14 +994,14 @@ class StorageServer(service.MultiService):
 
     def get_immutable_share_length(self, storage_index: bytes, share_number: int) -> int:
         """Returns the length (in bytes) of an immutable."""
-        si_dir = storage_index_to_dir(storage_index)
-        path = os.path.join(self.sharedir, si_dir, str(share_number))
+        path = os.path.join(self._get_bucket_dir(storage_index),
+                            str(share_number))
         return ShareFile(path).get_length()
 
     def get_mutable_share_length(self, storage_index: bytes, share_number: int) -> int:
         """Returns the length (in bytes) of a mutable."""
-        si_dir = storage_index_to_dir(storage_index)
-        path = os.path.join(self.sharedir, si_dir, str(share_number))
+        path = os.path.join(self._get_bucket_dir(storage_index),
+                            str(share_number))
         if not os.path.exists(path):
             raise KeyError("No such storage index or share number")
         return MutableShareFile(path).get_length()
@@ -74,6 +74,7 @@ from allmydata.interfaces import (
     IServer,
     IStorageServer,
     IFoolscapStoragePlugin,
+    IStatsProducer,
     VersionMessage
 )
 from allmydata.grid_manager import (
@@ -212,7 +213,7 @@ class StorageClientConfig:
         return configured
 
 
-@implementer(IStorageBroker)
+@implementer(IStorageBroker, IStatsProducer)
 class StorageFarmBroker(service.MultiService):
     """I live on the client, and know about storage servers. For each server
     that is participating in a grid, I either maintain a connection to it or
@@ -555,6 +556,24 @@ class StorageFarmBroker(service.MultiService):
     def get_known_servers(self):
         return frozenset(self.servers.values())
 
+    def get_stats(self):
+        """
+        Sum up the connection counters of the HTTP storage servers.
+        """
+        stats = {}
+        for server in self.servers.values():
+            get_connection_stats = getattr(server, "get_connection_stats", None)
+            server_stats = get_connection_stats() if get_connection_stats else None
+            if server_stats is None:
+                continue
+            for (k, v) in server_stats.items():
+                key = "storage_client.http." + k
+                if k.startswith("connection_max") or k == "max_persistent":
+                    stats[key] = max(stats.get(key, 0), v)
+                else:
+                    stats[key] = stats.get(key, 0) + v
+        return stats
+
     def get_nickname_for_serverid(self, serverid):
         if serverid in self.servers:
             return self.servers[serverid].get_nickname()
@@ -1269,6 +1288,15 @@ class HTTPNativeStorageServer(service.MultiService):
             return None
         return self._istorage_server
 
+    def get_connection_stats(self) -> Optional[dict[str, float]]:
+        """
+        :return: the HTTP connection pool counters for this server, or
+            ``None`` if we have not connected to it yet.
+        """
+        if self._istorage_server is None:
+            return None
+        return self._istorage_server.get_connection_stats()
+
     def stop_connecting(self):
         self._lc.stop()
         if self._connecting_deferred is not None:
@@ -1377,6 +1405,30 @@ class UnknownServerTypeError(Exception):
     pass
 
 
+async def _add_leases_one_at_a_time(add_lease, leases):
+    """
+    Implement ``IStorageServer.add_leases`` with one ``add_lease`` call per
+    storage index, for servers without a batch operation.
+
+    :param add_lease: a function like ``IStorageServer.add_lease``.  If its
+        result is ``False`` the server had no shares for the storage index.
+    """
+    missing = set()
+    failed = set()
+    for (storage_index, renew_secret, cancel_secret) in leases:
+        try:
+            found = await add_lease(storage_index, renew_secret, cancel_secret)
+        except Exception:
+            log.msg(format="failed to add lease on %(si)s",
+                    si=base32.b2a(storage_index), failure=Failure(),
+                    level=log.UNUSUAL, umid="Xq3ZbA")
+            failed.add(storage_index)
+        else:
+            if found is False:
+                missing.add(storage_index)
+    return (missing, failed)
+
+
 @implementer(IStorageServer)
 @attr.s
 class _StorageServer:
@@ -1427,6 +1479,15 @@ class _StorageServer:
             cancel_secret,
         )
 
+    def add_leases(self, leases):
+        # The Foolscap protocol has no batch operation.
+        return defer.Deferred.fromCoroutine(
+            _add_leases_one_at_a_time(self.add_lease, leases)
+        )
+
+    def has_batch_leases(self):
+        return False
+
     def get_buckets(
             self,
             storage_index,
@@ -1575,6 +1636,7 @@ class _HTTPStorageServer:
     Talk to remote storage server over HTTP.
     """
     _http_client = attr.ib(type=StorageClient)
+    _batch_leases_unsupported = attr.ib(default=False, init=False)
 
     @staticmethod
     def from_http_client(http_client: StorageClient) -> _HTTPStorageServer:
@@ -1586,6 +1648,9 @@ class _HTTPStorageServer:
     def get_version(self) -> defer.Deferred[VersionMessage]:
         return StorageClientGeneral(self._http_client).get_version()
 
+    def get_connection_stats(self) -> Optional[dict[str, float]]:
+        return self._http_client.get_connection_stats()
+
     @defer.inlineCallbacks
     def allocate_buckets(
             self,
@@ -1649,6 +1714,34 @@ class _HTTPStorageServer:
                 return
             raise
 
+    @async_to_deferred
+    async def add_leases(self, leases):
+        if not self._batch_leases_unsupported:
+            client = StorageClientGeneral(self._http_client)
+            try:
+                return await client.add_or_renew_leases(leases)
+            except ClientException as e:
+                if e.code != http.NOT_FOUND:
+                    raise
+                # The server predates the batch endpoint; don't ask again.
+                self._batch_leases_unsupported = True
+
+        async def add_lease(storage_index, renew_secret, cancel_secret):
+            client = StorageClientGeneral(self._http_client)
+            try:
+                await client.add_or_renew_lease(
+                    storage_index, renew_secret, cancel_secret
+                )
+            except ClientException as e:
+                if e.code == http.NOT_FOUND:
+                    return False
+                raise
+            return True
+        return await _add_leases_one_at_a_time(add_lease, leases)
+
+    def has_batch_leases(self):
+        return not self._batch_leases_unsupported
+
     def advise_corrupt_share(
         self,
         share_type,
@@ -2,6 +2,7 @@ from six import ensure_text
 
 import os.path
 import json
+from twisted.internet import defer
 from twisted.trial import unittest
 from io import StringIO
 
@@ -388,6 +389,54 @@ class Check(GridTestMixin, CLITestMixin, unittest.TestCase):
 
         return d
 
+    @defer.inlineCallbacks
+    def test_deep_check_incremental(self):
+        self.basedir = "cli/Check/deep_check_incremental"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        rootnode = yield c0.create_dirnode()
+        rooturi = rootnode.get_uri()
+        yield rootnode.add_file(u"good", upload.Data(b"data" * 100,
+                                                     convergence=b""))
+        subdir = yield rootnode.create_subdirectory(u"subdir")
+        yield subdir.add_file(u"other", upload.Data(b"other" * 100,
+                                                    convergence=b""))
+
+        (rc, out, err) = yield self.do_cli("deep-check", "--incremental",
+                                           rooturi)
+        self.failUnlessReallyEqual(rc, 0)
+        lines = out.splitlines()
+        self.failUnlessIn("done: 4 objects checked, 4 healthy, 0 unhealthy",
+                          lines)
+        self.assertNotIn("skipped", out)
+
+        # the root is mutable, so it is checked again, and it has not
+        # changed, so nothing below it is even listed
+        (rc, out, err) = yield self.do_cli("deep-check", "--incremental",
+                                           rooturi)
+        self.failUnlessReallyEqual(rc, 0)
+        lines = out.splitlines()
+        self.failUnlessIn("done: 1 objects checked, 1 healthy, 0 unhealthy",
+                          lines)
+
+        # a change to the root means listing it again, but its children
+        # were checked recently
+        yield rootnode.add_file(u"new", upload.Data(b"new" * 100,
+                                                    convergence=b""))
+        (rc, out, err) = yield self.do_cli("deep-check", "--incremental",
+                                           "--verbose", rooturi)
+        self.failUnlessReallyEqual(rc, 0)
+        lines = out.splitlines()
+        self.failUnlessIn("done: 3 objects checked, 3 healthy, 0 unhealthy",
+                          lines)
+        self.failUnlessIn("1 objects skipped (checked recently)", lines)
+        self.failUnlessIn("'new': Healthy", lines)
+
+        # without --incremental, everything is checked
+        (rc, out, err) = yield self.do_cli("deep-check", rooturi)
+        self.failUnlessIn("done: 5 objects checked, 5 healthy, 0 unhealthy",
+                          out.splitlines())
+
     def test_check_without_alias(self):
         # 'tahoe check' should output a sensible error message if it needs to
         # find the default alias and can't
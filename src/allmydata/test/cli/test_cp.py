@@ -7,7 +7,7 @@ from twisted.trial import unittest
 from twisted.python import usage
 from twisted.internet import defer
 
-from allmydata.scripts import cli
+from allmydata.scripts import cli, tahoe_cp
 from allmydata.util import fileutil
 from allmydata.util.encodingutil import (quote_output, unicode_to_output, to_bytes)
 from allmydata.util.assertutil import _assert
@@ -714,6 +714,27 @@ starting copy, 2 files, 1 directories
         d.addCallback(_check_local_fs)
         return d
 
+    @defer.inlineCallbacks
+    def test_cp_many_files_in_batches(self):
+        """
+        New children are sent to the node a batch at a time as they are
+        uploaded, and all of them end up in the target directory.
+        """
+        self.patch(tahoe_cp.TahoeDirectoryTarget, "BATCH_SIZE", 2)
+        self.basedir = "cli/Cp/cp_many_files_in_batches"
+        self.set_up_grid(oneshare=True)
+        subdir = os.path.join(self.basedir, "foo")
+        os.mkdir(subdir)
+        names = ["file%d" % i for i in range(5)]
+        for name in names:
+            fileutil.write(os.path.join(subdir, name), name)
+
+        yield self.do_cli("create-alias", "tahoe")
+        rc, out, err = yield self.do_cli("cp", "-r", subdir, "tahoe:")
+        self.assertEqual(rc, 0, (out, err))
+        rc, out, err = yield self.do_cli("ls", "tahoe:foo")
+        self.assertEqual(out.split(), names)
+
     def test_ticket_2027(self):
         # This test ensures that tahoe will copy a file from the grid to
         # a local directory without a specified file name.
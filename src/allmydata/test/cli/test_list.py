@@ -8,6 +8,7 @@ from twisted.internet import defer
 from allmydata.immutable import upload
 from allmydata.interfaces import MDMF_VERSION, SDMF_VERSION
 from allmydata.mutable.publish import MutableData
+from allmydata.scripts import tahoe_ls
 from ..no_network import GridTestMixin
 from allmydata.util.encodingutil import quote_output
 from .common import CLITestMixin
@@ -201,6 +202,33 @@ class List(GridTestMixin, CLITestMixin, unittest.TestCase):
         rc, out, err = yield self.do_cli("list-aliases", "--readonly-uri")
         self.assertTrue('URI:DIR2-RO' in out)
 
+    @defer.inlineCallbacks
+    def test_list_batches(self):
+        """
+        The children of a large directory are printed a batch at a time, each
+        batch lined up in columns of its own.
+        """
+        self.basedir = "cli/List/list_batches"
+        self.patch(tahoe_ls, "ROWS_PER_BATCH", 2)
+        yield self.set_up_grid(oneshare=True)
+        c0 = self.g.clients[0]
+        root = yield c0.create_dirnode()
+        for (name, size) in [(u"a", 1), (u"b", 22), (u"c", 333), (u"d", 4444),
+                             (u"e", 5)]:
+            yield root.add_file(name, upload.Data(b"x" * size, None))
+        yield self.do_cli("add-alias", "tahoe", root.get_uri())
+        rc, out, err = yield self.do_cli("ls", "-l")
+        self.assertEqual((rc, err), (0, ""))
+        # the size column is only as wide as each batch needs
+        prefixes = ["-r--  1 ", "-r-- 22 ", "-r--  333 ", "-r-- 4444 ",
+                    "-r-- 5 "]
+        self.assertEqual(
+            [line[:len(prefix)]
+             for (line, prefix) in zip(out.splitlines(), prefixes)],
+            prefixes,
+        )
+        self.assertEqual(len(out.splitlines()), 5)
+
 
     def _create_directory_structure(self):
         # Create a simple directory structure that we can use for MDMF,
@@ -0,0 +1,151 @@
+"""
+Tests for allmydata.check_index.
+"""
+
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from allmydata.check_index import CheckIndex
+from allmydata.immutable import upload
+from allmydata.test.no_network import GridTestMixin
+from allmydata.util import fileutil
+
+
+class FakeCheckResults:
+    def __init__(self, healthy, good=10):
+        self._healthy = healthy
+        self._good = good
+
+    def is_healthy(self):
+        return self._healthy
+
+    def get_share_counter_good(self):
+        return self._good
+
+
+class Index(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        fileutil.make_dirs(basedir)
+        self.dbfile = os.path.join(basedir, "check-index.sqlite")
+        self.index = CheckIndex(self.dbfile, 1000)
+        self.addCleanup(lambda: self.index.close())
+
+    def test_first_check_is_spread(self):
+        """
+        The first re-check of a healthy object comes due somewhere within one
+        interval, depending on its storage index; later ones a whole
+        interval after the check.
+        """
+        early = self.index.record_check(b"\x00" * 16, FakeCheckResults(True), 0)
+        late = self.index.record_check(b"\xff" * 16, FakeCheckResults(True), 0)
+        middle = self.index.record_check(b"\x80" + b"\x00" * 15, FakeCheckResults(True), 0)
+        self.assertEqual(early, 0)
+        self.assertEqual(late, 1000)
+        self.assertEqual(middle, 500)
+        self.assertEqual(
+            self.index.record_check(b"\x00" * 16, FakeCheckResults(True), 10),
+            1010)
+
+    def test_unhealthy_is_always_due(self):
+        si = b"\x80" + b"\x00" * 15
+        self.assertEqual(
+            self.index.record_check(si, FakeCheckResults(False, 7), 50), 50)
+        entry = self.index.get(si)
+        self.assertEqual(entry["healthy"], 0)
+        self.assertEqual(entry["shares_good"], 7)
+        # once it is healthy again, it is spread like a new object
+        self.assertEqual(
+            self.index.record_check(si, FakeCheckResults(True), 60), 560)
+
+    def test_directory(self):
+        si = b"\x01" * 16
+        self.index.record_check(si, FakeCheckResults(True), 0)
+        self.index.record_directory(si, "3-abc", 700)
+        self.index.close()
+        self.index = CheckIndex(self.dbfile, 1000)
+        entry = self.index.get(si)
+        self.assertEqual(entry["dir_version"], "3-abc")
+        self.assertEqual(entry["subtree_next_check"], 700)
+        self.assertIs(self.index.get(b"\x02" * 16), None)
+
+
+class DeepCheck(GridTestMixin, unittest.TestCase):
+    @defer.inlineCallbacks
+    def _set_up(self):
+        self.basedir = "check_index/DeepCheck/" + self._testMethodName
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        self.root = yield c0.create_dirnode()
+        self.sub = yield self.root.create_subdirectory(u"sub")
+        for (parent, name) in [(self.root, u"a"), (self.sub, u"b"),
+                               (self.sub, u"c")]:
+            yield parent.add_file(
+                name, upload.Data(name.encode("ascii") * 1000, None))
+        # an immutable directory, which needs no check to know it is
+        # unchanged
+        kids = yield self.sub.list()
+        kids = dict((name, (node, {})) for (name, (node, md))
+                    in kids.items())
+        imm = yield c0.create_immutable_dirnode(kids)
+        yield self.root.set_node(u"imm", imm)
+
+    def _deep_check(self, index):
+        return self.root.start_deep_check(check_index=index).when_done()
+
+    @defer.inlineCallbacks
+    def test_skips_recent(self):
+        yield self._set_up()
+        index = CheckIndex(os.path.join(self.basedir, "index.sqlite"),
+                           30 * 24 * 60 * 60)
+        self.addCleanup(index.close)
+
+        r = yield self._deep_check(index)
+        # root, sub, imm, a, b, c
+        self.assertEqual(r.get_counters()["count-objects-checked"], 6)
+
+        # the root needs a check to find out that it has not changed, and
+        # then nothing below it is listed
+        r = yield self._deep_check(index)
+        self.assertEqual(r.get_counters()["count-objects-checked"], 1)
+
+        # a change to "sub" alone is not noticed until the root changes or
+        # something below it is due
+        yield self.sub.add_file(u"d", upload.Data(b"d" * 1000, None))
+        r = yield self._deep_check(index)
+        self.assertEqual(r.get_counters()["count-objects-checked"], 1)
+
+        # now the root is listed; "sub" has changed too, so it is listed, but
+        # "imm" is immutable and was checked recently, so it is not
+        yield self.root.add_file(u"e", upload.Data(b"e" * 1000, None))
+        r = yield self._deep_check(index)
+        self.assertEqual(sorted(r.get_all_results().keys()),
+                         [(), (u"e",), (u"sub",), (u"sub", u"d")])
+
+    @defer.inlineCallbacks
+    def test_interval_elapsed(self):
+        yield self._set_up()
+        index = CheckIndex(os.path.join(self.basedir, "index.sqlite"), 0)
+        self.addCleanup(index.close)
+        r = yield self._deep_check(index)
+        self.assertEqual(r.get_counters()["count-objects-checked"], 6)
+        r = yield self._deep_check(index)
+        self.assertEqual(r.get_counters()["count-objects-checked"], 6)
+
+    @defer.inlineCallbacks
+    def test_unhealthy_rechecked(self):
+        yield self._set_up()
+        index = CheckIndex(os.path.join(self.basedir, "index.sqlite"),
+                           30 * 24 * 60 * 60)
+        self.addCleanup(index.close)
+        (a, md) = yield self.root.get_child_and_metadata(u"a")
+        self.delete_shares_numbered(a.get_uri(), [0])
+        r = yield self._deep_check(index)
+        self.assertEqual(r.get_counters()["count-objects-unhealthy"], 1)
+        # the root has not changed, but "a" is due, so it is listed again
+        r = yield self._deep_check(index)
+        self.assertEqual(sorted(r.get_all_results().keys()),
+                         [(), (u"a",), (u"sub",)])
+        self.assertEqual(r.get_counters()["count-objects-unhealthy"], 1)
@@ -396,6 +396,73 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         with self.assertRaises(ValueError):
             yield client.create_client(basedir)
 
+    @defer.inlineCallbacks
+    def test_extra_share_dirs(self):
+        """
+        extra_share_dirs and share_placement options are propagated
+        """
+        basedir = "client.Basic.test_extra_share_dirs"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "extra_share_dirs = disk1, disk2\n" + \
+                           "share_placement = free-space\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.sharedirs[1:],
+                             [os.path.abspath(os.path.join(basedir, d))
+                              for d in ("disk1", "disk2")])
+        self.failUnlessEqual(ss.share_placement, "free-space")
+
+    @defer.inlineCallbacks
+    def test_repair_scheduler(self):
+        """
+        The [repair] section enables the repair service, which reads its
+        roots from private/repair-roots.
+        """
+        basedir = "client.Basic.test_repair_scheduler"
+        os.mkdir(basedir)
+        fileutil.make_dirs(os.path.join(basedir, "private"))
+        fileutil.write(os.path.join(basedir, "private", "repair-roots"),
+                       "# roots\nURI:DIR2:aaaa:bbbb\n\n")
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[repair]\n" + \
+                           "enabled = true\n" + \
+                           "concurrency = 3\n" + \
+                           "bandwidth = 2MB\n" + \
+                           "cycle_interval = 2 hours\n")
+        c = yield client.create_client(basedir)
+        rs = c.getServiceNamed("repair_scheduler")
+        self.assertIs(rs, c.repair_scheduler)
+        self.assertEqual(rs.root_caps, ["URI:DIR2:aaaa:bbbb"])
+        self.assertEqual(rs.concurrency, 3)
+        self.assertEqual(rs.bandwidth, 2000000)
+        self.assertEqual(rs.cycle_interval, 2 * 60 * 60)
+
+    @defer.inlineCallbacks
+    def test_path_cache(self):
+        """
+        The path cache is off unless ``path_cache.max_entries`` is set.
+        """
+        basedir = "client.Basic.test_path_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertIs(c.nodemaker.path_cache, None)
+
+        basedir = "client.Basic.test_path_cache_enabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "path_cache.max_entries = 500\n" + \
+                           "path_cache.ttl = 60 seconds\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.nodemaker.path_cache.max_entries, 500)
+        self.assertEqual(c.nodemaker.path_cache.ttl, 60)
+
     @defer.inlineCallbacks
     def test_web_apiauthtoken(self):
         """
@@ -6,7 +6,9 @@ Ported to Python 3.
 
 
 import time
+import json
 import os.path
+import threading
 from twisted.trial import unittest
 from twisted.application import service
 from twisted.internet import defer
@@ -14,7 +16,11 @@ from foolscap.api import eventually, fireEventually
 
 from allmydata.util import fileutil, hashutil, pollmixin
 from allmydata.storage.server import StorageServer, si_b2a
-from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.crawler import (
+    ShareCrawler,
+    TimeSliceExceeded,
+    _LeaseStateSerializer,
+)
 
 from allmydata.test.common_util import StallMixin
 
@@ -93,6 +99,34 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class LocatingCrawler(BucketEnumeratingCrawler):
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        BucketEnumeratingCrawler.process_bucket(self, cycle, prefix,
+                                                prefixdir, storage_index_b32)
+        self.homes.append(os.path.isdir(os.path.join(prefixdir,
+                                                     storage_index_b32)))
+
+class ThreadRecordingCrawler(ShareCrawler):
+    cpu_slice = 500 # make sure it can complete in a single slice
+    slow_start = 0
+    def __init__(self, *args, **kwargs):
+        ShareCrawler.__init__(self, *args, **kwargs)
+        self.bucket_threads = set()
+        self.prefix_threads = set()
+        self.state_threads = set()
+        self.reactor_calls = []
+        self.finished_d = defer.Deferred()
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        self.bucket_threads.add(threading.get_ident())
+        self.reactor_calls.append(self.call_in_reactor(threading.get_ident))
+    def set_last_complete_bucket(self, bucket):
+        self.state_threads.add(threading.get_ident())
+        ShareCrawler.set_last_complete_bucket(self, bucket)
+    def finished_prefix(self, cycle, prefix):
+        self.prefix_threads.add(threading.get_ident())
+    def finished_cycle(self, cycle):
+        self.finished_d.callback(threading.get_ident())
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -148,6 +182,31 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         c2.start_current_prefix(time.time())
         self.failUnlessEqual(sorted(sis), sorted(c2.all_buckets))
 
+    def test_multiple_disks(self):
+        self.basedir = "crawler/Basic/multiple_disks"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        extra = [os.path.join(self.basedir, "disk1"),
+                 os.path.join(self.basedir, "disk2")]
+        ss = StorageServer(self.basedir, serverid, extra_sharedirs=extra)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(30)]
+        for d in extra:
+            self.failUnless(os.listdir(d) != ["incoming"])
+        statefile = os.path.join(self.basedir, "statefile")
+        c = LocatingCrawler(ss, statefile)
+        c.homes = []
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+            # each bucket was handed over with the prefixdir it lives in
+            self.failUnlessEqual(c.homes, [True] * len(sis))
+        d.addCallback(_check)
+        return d
+
     def test_service(self):
         self.basedir = "crawler/Basic/service"
         fileutil.make_dirs(self.basedir)
@@ -418,6 +477,138 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         return d
 
 
+    def test_worker_thread(self):
+        """
+        Buckets are processed in a worker thread, while the other hooks and
+        anything passed to call_in_reactor() run in the reactor thread.
+        """
+        self.basedir = "crawler/Basic/worker_thread"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        for i in range(5):
+            self.write(i, ss, serverid)
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ThreadRecordingCrawler(ss, statefile)
+        c.setServiceParent(self.s)
+        reactor_thread = threading.get_ident()
+
+        d = c.finished_d
+        def _check(finished_cycle_thread):
+            self.failUnlessEqual(finished_cycle_thread, reactor_thread)
+            self.failUnlessEqual(c.prefix_threads, {reactor_thread})
+            self.failUnlessEqual(c.state_threads, {reactor_thread})
+            self.failUnlessEqual(len(c.bucket_threads), 1)
+            self.failIfIn(reactor_thread, c.bucket_threads)
+            self.failUnlessEqual(c.reactor_calls, [reactor_thread] * 5)
+        d.addCallback(_check)
+        return d
+
+    def test_stop_during_slice(self):
+        """
+        Stopping the crawler while a worker thread is busy waits for it to
+        give up its slice.
+        """
+        self.basedir = "crawler/Basic/stop_during_slice"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        for i in range(5):
+            self.write(i, ss, serverid)
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ConsumingCrawler(ss, statefile)
+        c.cpu_slice = 500
+        c.setServiceParent(self.s)
+
+        def _started():
+            return c._slice_d is not None and c.accumulated > 0
+        d = self.poll(_started)
+        d.addCallback(lambda ign: c.disownServiceParent())
+        def _stopped(ign):
+            self.failIf(c.running)
+            self.failIf(c.timer)
+            self.failUnlessEqual(c._slice_d, None)
+            # it gave up part way through the cycle
+            self.failIfEqual(c.state["current-cycle"], None)
+            self.failUnlessEqual(c.cycles, 0)
+        d.addCallback(_stopped)
+        return d
+
+    def test_restart(self):
+        """
+        A crawler which was stopped does its work again once it is restarted.
+        """
+        self.basedir = "crawler/Basic/restart"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(5)]
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        d.addCallback(lambda ign: c.disownServiceParent())
+        def _restart(ign):
+            c.all_buckets = []
+            c.finished_d = defer.Deferred()
+            c.minimum_cycle_time = 0
+            c.setServiceParent(self.s)
+            return c.finished_d
+        d.addCallback(_restart)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(sorted(c.all_buckets), sorted(sis)))
+        return d
+
+    def test_pacing(self):
+        """
+        The crawler sleeps less when the storage server is idle, and more when
+        the server is busy or the disk has slowed down.
+        """
+        self.basedir = "crawler/Basic/pacing"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ShareCrawler(ss, statefile)
+
+        # idle
+        c.sample_request_rate(100.0)
+        c.sample_request_rate(110.0)
+        self.failUnlessEqual(c.request_rate, 0.0)
+        self.failUnlessEqual(c.pacing_factor(), c.idle_speedup)
+
+        # 200 requests in 10 seconds
+        ss.request_count += 200
+        c.sample_request_rate(120.0)
+        self.failUnlessEqual(c.request_rate, 20.0)
+        self.failUnlessEqual(c.pacing_factor(), 3.0)
+
+        # an upload in progress
+        ss._bucket_writers["fake"] = None
+        self.failUnlessEqual(c.pacing_factor(), 3.0 + 1.0 / c.busy_uploads)
+        del ss._bucket_writers["fake"]
+
+        # the disk gets four times slower than it used to be
+        for i in range(10):
+            c.record_io_latency(1.0, 99)
+        self.failUnlessEqual(c.pacing_factor(), 3.0)
+        c.record_io_latency(4.0, 99)
+        c.record_io_latency(4.0, 99)
+        self.failUnless(c.pacing_factor() > 5.0, c.pacing_factor())
+
+        # but never back off too much
+        c.record_io_latency(1000.0, 99)
+        self.failUnlessEqual(c.pacing_factor(), c.max_backoff)
+
     def test_oneshot(self):
         self.basedir = "crawler/Basic/oneshot"
         fileutil.make_dirs(self.basedir)
@@ -448,3 +639,98 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+
+
+class StateJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = self.mktemp()
+        fileutil.make_dirs(self.basedir)
+        self.statefile = os.path.join(self.basedir, "statefile")
+
+    def read_snapshot(self):
+        with open(self.statefile + ".json") as f:
+            return json.load(f)
+
+    def test_changes_are_journaled(self):
+        serial = _LeaseStateSerializer(self.statefile)
+        self.assertTrue(serial.needs_compaction())
+        state = {"version": 1,
+                 "counts": {"1": 2},
+                 "corrupt-shares": [["aaaa", 0]],
+                 "old": True}
+        serial.save(state)
+        self.assertFalse(serial.needs_compaction())
+        snapshot = self.read_snapshot()
+
+        serial.append([["set", ["counts", "2"], 3],
+                       ["set", ["corrupt-shares"], [["aaaa", 0], ["bbbb", 1]]],
+                       ["del", ["old"]]])
+        serial.append([]) # nothing changed, so nothing is written
+
+        # the snapshot was left alone, and the journal holds only the changes
+        self.assertEqual(self.read_snapshot(), snapshot)
+        with open(self.statefile + ".json.journal") as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertNotIn("version", lines[0])
+
+        expected = {"version": 1,
+                    "counts": {"1": 2, "2": 3},
+                    "corrupt-shares": [["aaaa", 0], ["bbbb", 1]]}
+        self.assertEqual(_LeaseStateSerializer(self.statefile).load(),
+                         expected)
+
+        serial.save(expected)
+        self.assertFalse(os.path.exists(self.statefile + ".json.journal"))
+        self.assertEqual(self.read_snapshot(), expected)
+
+    def test_journal_too_large(self):
+        """
+        Once the journal is larger than the snapshot, a new snapshot is due.
+        """
+        serial = _LeaseStateSerializer(self.statefile)
+        serial.save({"version": 1, "count": 0})
+        for i in range(1000):
+            serial.append([["set", ["count"], i]])
+        self.assertFalse(serial.needs_compaction())
+        for i in range(10000):
+            serial.append([["set", ["count"], i]])
+        self.assertTrue(serial.needs_compaction())
+
+    def test_interrupted(self):
+        serial = _LeaseStateSerializer(self.statefile)
+        serial.save({"version": 1, "corrupt-shares": []})
+        serial.append([["set", ["corrupt-shares"], [["aaaa", 0]]]])
+
+        # as if we died in the middle of writing another line
+        with open(self.statefile + ".json.journal", "ab") as f:
+            f.write(b'[["set", ["versi')
+        self.assertEqual(_LeaseStateSerializer(self.statefile).load(),
+                         {"version": 1, "corrupt-shares": [["aaaa", 0]]})
+
+    def test_crawler_saves_changes(self):
+        """
+        Once a crawler has saved its whole state, save_state() only writes
+        what was passed to state_changed(), without calling get_state().
+        """
+        ss = StorageServer(self.basedir, b"\x00" * 20)
+        c = BucketEnumeratingCrawler(ss, self.statefile)
+        c.state["counts"] = {}
+        c.save_state()
+
+        c.get_state = None # must not be called
+        c.state["counts"][1] = 2
+        c.state["counts"][2] = 3
+        c.state["unsaved"] = True
+        c.state_changed("counts", 1)
+        c.state_changed("gone")
+        c.save_state()
+        c.save_state() # nothing more to write
+        with open(self.statefile + ".json.journal") as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 2)
+
+        c2 = BucketEnumeratingCrawler(ss, self.statefile)
+        self.assertEqual(c2.state["counts"], {"1": 2})
+        self.assertNotIn("unsaved", c2.state)
@@ -619,6 +619,17 @@ class DeepCheckWebGood(DeepCheckBase, unittest.TestCase):
                                     t="start-deep-stats", output="json"))
         d.addCallback(self.json_check_stats_good, "deep-stats")
 
+        # renew leases
+        d.addCallback(lambda ign:
+                      self.slow_web(self.root,
+                                    t="start-renew-leases", output="json"))
+        def _check_renewed(data):
+            self.failUnless(data["finished"])
+            # root, mutable, large
+            self.failUnlessEqual(data["count-objects"], 3)
+            self.failUnlessEqual(data["count-leases-failed"], 0)
+        d.addCallback(_check_renewed)
+
         # check, no verify
         d.addCallback(lambda ign: self.web_json(self.root, t="check"))
         d.addCallback(self.json_check_is_healthy, self.root, "root")
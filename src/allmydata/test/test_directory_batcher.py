@@ -0,0 +1,149 @@
+"""
+Tests for allmydata.directory_batcher.
+"""
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from allmydata.directory_batcher import DirectoryBatchers
+from allmydata.interfaces import ExistingChildError
+
+
+class FakeBatch:
+    def __init__(self):
+        self.changes = []
+        self.results = []
+
+    def set_node(self, namex, child, metadata=None, overwrite=True):
+        self.changes.append(("set", namex, child, overwrite))
+
+    def delete(self, namex, must_exist=True):
+        self.changes.append(("delete", namex))
+
+    def __len__(self):
+        return len(self.changes)
+
+
+class FakeDirectory:
+    """
+    Applies batches only when told to, failing the additions which may not
+    overwrite.
+    """
+    def __init__(self):
+        self.applying = []
+
+    def get_write_uri(self):
+        return b"URI:DIR2:fake"
+
+    def create_batch(self):
+        return FakeBatch()
+
+    def apply_batch(self, batch):
+        d = defer.Deferred()
+        self.applying.append((batch, d))
+        return d
+
+    def finish(self):
+        (batch, d) = self.applying.pop(0)
+        for change in batch.changes:
+            if change[0] == "set" and not change[3]:
+                batch.results.append(Failure(ExistingChildError(change[1])))
+            else:
+                batch.results.append(change[1])
+        d.callback(batch)
+
+
+class Batching(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.batchers = DirectoryBatchers(delay=1.0, max_changes=3,
+                                          clock=self.clock)
+        self.node = FakeDirectory()
+        self.batcher = self.batchers.get(self.node)
+
+    def test_delay(self):
+        """
+        Changes queued within the delay are made together, and each one's
+        Deferred gets its own result.
+        """
+        self.batcher.max_changes = 10
+        d1 = self.batcher.set_node(u"a", "child")
+        d2 = self.batcher.delete(u"b")
+        self.clock.advance(0.5)
+        d3 = self.batcher.set_node(u"c", "child", overwrite=False)
+        self.clock.advance(0.4)
+        self.failUnlessEqual(self.node.applying, [])
+        self.clock.advance(0.1)
+        self.failUnlessEqual(len(self.node.applying), 1)
+        self.node.finish()
+        self.failUnlessEqual(self.successResultOf(d1), u"a")
+        self.failUnlessEqual(self.successResultOf(d2), u"b")
+        self.failureResultOf(d3, ExistingChildError)
+        self.failUnlessEqual(self.batcher.publishes, 1)
+
+    def test_max_changes(self):
+        """
+        A batch is made as soon as it is full.
+        """
+        ds = [self.batcher.set_node(u"%d" % i, "child") for i in range(3)]
+        self.failUnlessEqual(len(self.node.applying), 1)
+        self.node.finish()
+        self.failUnlessEqual([self.successResultOf(d) for d in ds],
+                             [u"0", u"1", u"2"])
+        self.failUnlessEqual(self.batcher.publishes, 1)
+
+    def test_queued_while_applying(self):
+        """
+        Changes queued while a batch is being made wait for it and then go
+        out together in the next one.
+        """
+        self.batcher.set_node(u"a", "child")
+        self.batcher.flush()
+        self.failUnlessEqual(len(self.node.applying), 1)
+        later = [self.batcher.set_node(u"b", "child"),
+                 self.batcher.delete(u"c")]
+        self.clock.advance(1.0)
+        self.failUnlessEqual(len(self.node.applying), 1)
+        self.node.finish()
+        self.failUnlessEqual(len(self.node.applying), 1)
+        self.failUnlessEqual(len(self.node.applying[0][0]), 2)
+        self.node.finish()
+        self.failUnlessEqual([self.successResultOf(d) for d in later],
+                             [u"b", u"c"])
+        self.failUnlessEqual(self.batcher.publishes, 2)
+
+    def test_flush_while_applying(self):
+        """
+        A flush made while a batch is being made, with nothing else queued,
+        fires once that batch has been made.
+        """
+        d1 = self.batcher.set_node(u"a", "child")
+        self.batcher.flush()
+        self.failUnlessEqual(len(self.node.applying), 1)
+        d2 = self.batcher.flush()
+        self.assertNoResult(d2)
+        self.node.finish()
+        self.failUnlessEqual(self.successResultOf(d1), u"a")
+        self.failUnlessEqual(self.successResultOf(d2), [])
+        self.failUnlessEqual(self.node.applying, [])
+        self.failUnlessEqual(self.batcher.publishes, 1)
+        self.failUnlessEqual(len(self.batchers), 0)
+
+    def test_unwaited(self):
+        """
+        The failures of changes nobody waited for are reported by the next
+        flush, and the batcher is forgotten once it has nothing left to do.
+        """
+        self.batcher.queue_unwaited("set_node", u"a", "child", None, False)
+        self.batcher.queue_unwaited("set_node", u"b", "child", None, True)
+        d = self.batcher.flush()
+        self.failUnlessEqual(len(self.node.applying), 1)
+        self.failUnlessEqual(len(self.batchers), 1)
+        self.node.finish()
+        [(kind, name, f)] = self.successResultOf(d)
+        self.failUnlessEqual((kind, name), ("set_node", u"a"))
+        f.trap(ExistingChildError)
+        self.failUnlessEqual(len(self.batchers), 0)
+        self.failUnlessEqual(self.successResultOf(self.batcher.flush()), [])
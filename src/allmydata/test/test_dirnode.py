@@ -3,6 +3,7 @@
 Ported to Python 3.
 """
 
+import json
 import time
 import unicodedata
 from zope.interface import implementer
@@ -1821,6 +1822,41 @@ class Dirnode2(testutil.ReallyEqualMixin, testutil.ShouldFailMixin, unittest.Tes
         for (i, n) in imm_prefixed:
             self.failUnless(n.get_readonly_uri().startswith(b"imm."), i)
 
+    @defer.inlineCallbacks
+    def test_batch(self):
+        """
+        apply_batch() makes all the changes in a batch with a single
+        modification, and each one succeeds or fails on its own.
+        """
+        one = self.nodemaker.create_from_cap(one_uri)
+        node = yield self.nodemaker.create_new_mutable_directory(
+            {u"old": (one, {}), u"keep": (one, {})})
+        modifications = []
+        real_modify = node._node.modify
+        def modify(modifier):
+            modifications.append(modifier)
+            return real_modify(modifier)
+        node._node.modify = modify
+
+        batch = node.create_batch()
+        for i in range(5):
+            batch.set_node(u"new%d" % i, one)
+        batch.set_node(u"keep", one, overwrite=False)
+        batch.delete(u"old")
+        batch.delete(u"missing")
+        batch.delete(u"missing", must_exist=False)
+        yield node.apply_batch(batch)
+
+        self.failUnlessEqual(len(modifications), 1)
+        self.failUnlessEqual(batch.results[:5], [one] * 5)
+        batch.results[5].trap(ExistingChildError)
+        self.failUnlessEqual(batch.results[6].get_uri(), one_uri)
+        batch.results[7].trap(NoSuchChildError)
+        self.failUnlessEqual(batch.results[8], None)
+        children = yield node.list()
+        self.failUnlessEqual(sorted(children),
+                             [u"keep"] + [u"new%d" % i for i in range(5)])
+
 
 
 class DeepStats(testutil.ReallyEqualMixin, unittest.TestCase):
@@ -1866,6 +1902,52 @@ class DeepStats(testutil.ReallyEqualMixin, unittest.TestCase):
                                      (3162277660169, 10000000000000, 1),
                                      ])
 
+    def test_buckets(self):
+        ds = dirnode.DeepStats(None)
+        self.failUnlessReallyEqual(ds.which_bucket(0), (0, 0))
+        self.failUnlessReallyEqual(ds.which_bucket(3), (1, 3))
+        self.failUnlessReallyEqual(ds.which_bucket(4), (4, 10))
+        self.failUnlessReallyEqual(ds.which_bucket(3162), (1001, 3162))
+        self.failUnlessReallyEqual(ds.which_bucket(3163), (3163, 10000))
+        # sizes beyond the precomputed buckets still get one
+        (low, high) = ds.which_bucket(2**70)
+        self.failUnless(low <= 2**70 <= high)
+
+    def test_partial_results(self):
+        class FakeDirectory(object):
+            def get_storage_index(self):
+                return None
+            def get_size(self):
+                return 1000
+        ds = dirnode.DeepStats(FakeDirectory())
+        monitor = Monitor()
+        ds.set_monitor(monitor)
+        ds.add("count-files", 3)
+        ds.enter_directory(FakeDirectory(), {u"a": None, u"b": None})
+        s = monitor.get_status()
+        self.failUnlessReallyEqual(s["count-files"], 3)
+        self.failUnlessReallyEqual(s["size-directories"], 1000)
+        self.failUnlessReallyEqual(s["largest-directory-children"], 2)
+
+    def test_merge(self):
+        sizes = [0, 5, 5, 123, 70000, 4*1000*1000]
+        whole = dirnode.DeepStats(None)
+        parts = [dirnode.DeepStats(None), dirnode.DeepStats(None)]
+        for (i, size) in enumerate(sizes):
+            for ds in [whole, parts[i % 2]]:
+                ds.add("count-files")
+                ds.add("size-immutable-files", size)
+                ds.max("largest-immutable-file", size)
+                ds.histogram("size-files-histogram", size)
+
+        merged = dirnode.DeepStats(None)
+        for part in parts:
+            # results which have been through JSON can be merged too
+            merged.merge(json.loads(json.dumps(part.get_results())))
+        self.failUnlessReallyEqual(merged.get_results(), whole.get_results())
+        self.failUnlessReallyEqual(merged.get_results()["largest-immutable-file"],
+                                   4*1000*1000)
+
 class UCWEingMutableFileNode(MutableFileNode):
     please_ucwe_after_next_upload = False
 
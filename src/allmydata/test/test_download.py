@@ -447,6 +447,35 @@ class DownloadTest(_Base, unittest.TestCase):
         return d
 
 
+    def test_sequential_reads_are_merged(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        data = (plaintext*100)[:30000] # multiple of k
+
+        # 10 segments, with 1000-byte blocks
+        u = upload.Data(data, None)
+        u.max_segment_size = 3000
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.n = self.c0.create_node_from_uri(ur.get_uri())
+            return download_to_data(self.n)
+        d.addCallback(_uploaded)
+        def _downloaded(newdata):
+            self.failUnlessEqual(newdata, data)
+            ds = self.n._cnode._node._download_status
+            requests = {}
+            for r in ds.block_requests:
+                requests.setdefault((r["server"], r["shnum"]), []).append(r)
+            for reqs in requests.values():
+                # the hash trees are fetched whole, and the blocks two at a
+                # time, so there are fewer reads than segments
+                self.failUnless(len(reqs) < 10, reqs)
+            lengths = [r["length"] for r in ds.block_requests]
+            self.failUnlessIn(2000, lengths)
+        d.addCallback(_downloaded)
+        return d
+
     def test_simultaneous_get_blocks(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
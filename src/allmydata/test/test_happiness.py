@@ -8,7 +8,7 @@ Ported to Python 3.
 
 from twisted.trial import unittest
 from hypothesis import given
-from hypothesis.strategies import text, sets
+from hypothesis.strategies import text, sets, dictionaries, integers
 
 from allmydata.immutable import happiness_upload
 from allmydata.util.happinessutil import servers_of_happiness, \
@@ -282,6 +282,78 @@ class PlacementTests(unittest.TestCase):
         assert happiness == min(len(peers), len(shares))
 
 
+class ShareMatchingTests(unittest.TestCase):
+    """
+    Tests for happiness_upload.ShareMatching.
+    """
+
+    def assertValidMatching(self, matching, servermap):
+        placements = {
+            share: server
+            for (share, server) in matching.share_to_server().items()
+            if server is not None
+        }
+        for (share, server) in placements.items():
+            self.assertIn(share, servermap[server])
+        self.assertEqual(len(set(placements.values())), len(placements))
+        self.assertEqual(len(placements), matching.size())
+
+    def test_incremental(self):
+        """
+        Adding shares to a server which is already matched can make room for
+        another server.
+        """
+        matching = happiness_upload.ShareMatching()
+        matching.add_server("server0", [0])
+        matching.add_server("server1", [0])
+        self.assertEqual(1, matching.size())
+        matching.add_server("server0", [1])
+        self.assertEqual(2, matching.size())
+        self.assertValidMatching(
+            matching, {"server0": {0, 1}, "server1": {0}})
+
+    def test_unplaced_shares(self):
+        """
+        Shares given to the constructor are reported even if no server holds
+        them.
+        """
+        matching = happiness_upload.ShareMatching([0, 1, 2])
+        matching.add_server("server0", [1])
+        self.assertEqual(
+            {0: None, 1: "server0", 2: None},
+            matching.share_to_server(),
+        )
+
+    @given(
+        dictionaries(
+            keys=integers(min_value=0, max_value=30),
+            values=sets(integers(min_value=0, max_value=20), max_size=6),
+            max_size=30,
+        ),
+    )
+    def test_incremental_is_maximum(self, servermap):
+        """
+        Adding servers one at a time, in two halves each, finds a matching as
+        large as matching the whole layout at once.
+        """
+        whole = happiness_upload.ShareMatching.from_servermap(servermap)
+        self.assertValidMatching(whole, servermap)
+        matching = happiness_upload.ShareMatching()
+        for (server, shares) in servermap.items():
+            shares = sorted(shares)
+            matching.add_server(server, shares[::2])
+        for (server, shares) in servermap.items():
+            shares = sorted(shares)
+            matching.add_server(server, shares[1::2])
+        self.assertValidMatching(matching, servermap)
+        self.assertEqual(whole.size(), matching.size())
+        sharemap = {}
+        for (server, shares) in servermap.items():
+            for share in shares:
+                sharemap.setdefault(share, set()).add(server)
+        self.assertEqual(whole.size(), servers_of_happiness(sharemap))
+
+
 class FakeServerTracker:
     def __init__(self, serverid, buckets):
         self._serverid = serverid
@@ -7,7 +7,7 @@ from __future__ import annotations
 from .common import SyncTestCase
 
 from base64 import b32encode
-from allmydata.util.hashutil import tagged_hash
+from allmydata.util.hashutil import tagged_hash, tagged_pair_hash
 from allmydata import hashtree
 
 def make_tree(numleaves):
@@ -67,6 +67,19 @@ class Complete(SyncTestCase):
         self.failUnless("\n        8:" in d)
         self.failUnless("\n      4:" in d)
 
+    def test_pair_hash_row(self):
+        # the batch row hash gives the same results as hashing each pair
+        row = [tagged_hash(b"tag", b"%d" % i) for i in range(8)] + [b"", b"x"*100]
+        expected = [tagged_pair_hash(b"Merkle tree internal node", row[i], row[i+1])
+                    for i in range(0, len(row), 2)]
+        self.failUnlessEqual(hashtree.pair_hash_row(row), expected)
+        self.failUnlessEqual(hashtree.pair_hash(row[0], row[1]), expected[0])
+
+    def test_empty_leaf_hashes(self):
+        self.failUnlessEqual(hashtree.empty_leaf_hashes(5, 8),
+                             tuple(hashtree.empty_leaf_hash(i) for i in (5, 6, 7)))
+        self.failUnlessEqual(hashtree.empty_leaf_hashes(8, 8), ())
+
 class Incomplete(SyncTestCase):
 
     def test_create(self):
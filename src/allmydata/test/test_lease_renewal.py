@@ -0,0 +1,205 @@
+"""
+Tests for allmydata.lease_renewal.
+"""
+
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from allmydata.immutable import upload
+from allmydata.lease_renewal import DeepLeaseRenewer
+from allmydata.mutable.publish import MutableData
+from allmydata.storage.immutable import ShareFile
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.test.no_network import GridTestMixin
+
+
+def count_leases(sharefile):
+    with open(sharefile, "rb") as f:
+        header = f.read(32)
+    if MutableShareFile.is_valid_header(header):
+        return len(list(MutableShareFile(sharefile).get_leases()))
+    return len(list(ShareFile(sharefile).get_leases()))
+
+
+class FakeStorageServer:
+    def __init__(self, fail=False):
+        self.batches = []
+        self._fail = fail
+
+    def add_leases(self, leases):
+        self.batches.append(leases)
+        if self._fail:
+            return defer.fail(Exception("nope"))
+        return defer.succeed(({leases[0][0]}, set()))
+
+    def has_batch_leases(self):
+        return True
+
+
+class FakeFoolscapStorageServer:
+    """
+    A server without the batch lease operation, which holds shares for some
+    storage indexes.
+    """
+    def __init__(self, holding):
+        self.holding = holding
+        self.leased = []
+        self.queried = []
+
+    def has_batch_leases(self):
+        return False
+
+    def get_buckets(self, storage_index):
+        self.queried.append(storage_index)
+        if storage_index in self.holding:
+            return defer.succeed({0: object()})
+        return defer.succeed({})
+
+    def slot_readv(self, storage_index, shares, readv):
+        self.queried.append(storage_index)
+        if storage_index in self.holding:
+            return defer.succeed({0: [b""]})
+        return defer.succeed({})
+
+    def add_lease(self, storage_index, renew_secret, cancel_secret):
+        self.leased.append(storage_index)
+        return defer.succeed(None)
+
+
+class FakeServer:
+    def __init__(self, serverid, storage_server):
+        self._serverid = serverid
+        self._storage_server = storage_server
+
+    def get_serverid(self):
+        return self._serverid
+
+    def get_name(self):
+        return self._serverid.decode("ascii")
+
+    def get_lease_seed(self):
+        return self._serverid.ljust(20, b"\x00")
+
+    def get_storage_server(self):
+        return self._storage_server
+
+
+class FakeStorageBroker:
+    def __init__(self, servers):
+        self._servers = servers
+
+    def get_connected_servers(self):
+        return frozenset(self._servers)
+
+
+class Renewal(GridTestMixin, unittest.TestCase):
+    @defer.inlineCallbacks
+    def _set_up(self):
+        self.basedir = "lease_renewal/Renewal/" + self._testMethodName
+        self.set_up_grid(num_clients=2)
+        c1 = self.g.clients[1]
+        self.root = yield c1.create_dirnode()
+        sub = yield self.root.create_subdirectory(u"sub")
+        self.uris = [self.root.get_uri(), sub.get_uri()]
+        for (parent, name) in [(self.root, u"a"), (sub, u"b")]:
+            node = yield parent.add_file(
+                name, upload.Data(name.encode("ascii") * 1000, None))
+            self.uris.append(node.get_uri())
+        node = yield c1.create_mutable_file(MutableData(b"c" * 1000))
+        yield sub.set_node(u"c", node)
+        self.uris.append(node.get_uri())
+        # a LIT file has no shares
+        yield sub.add_file(u"lit", upload.Data(b"small", None))
+
+    def _lease_counts(self):
+        return set(count_leases(sharefile)
+                   for uri in self.uris
+                   for (shnum, serverid, sharefile)
+                   in self.find_uri_shares(uri))
+
+    @defer.inlineCallbacks
+    def test_renew_leases(self):
+        """
+        Renewing leases from another client adds that client's lease to every
+        share of everything reachable from the directory.
+        """
+        yield self._set_up()
+        # one server loses its shares, so it has no leases to renew
+        for uri in self.uris:
+            for (shnum, serverid, sharefile) in self.find_uri_shares(uri):
+                if serverid == self.g.servers_by_number[0].my_nodeid:
+                    os.unlink(sharefile)
+        self.assertEqual(self._lease_counts(), {1})
+        c0 = self.g.clients[0]
+        root = c0.create_node_from_uri(self.root.get_uri())
+        results = yield root.start_deep_renew_leases().when_done()
+        self.assertEqual(self._lease_counts(), {2})
+        self.assertEqual(results["count-objects"], 5)
+        self.assertEqual(results["count-servers"], 10)
+        self.assertEqual(results["count-requests"], 10)
+        # the no-network grid speaks Foolscap, so only the servers holding
+        # shares were asked to renew them
+        self.assertEqual(results["count-leases-renewed"], 5 * 9)
+        self.assertEqual(results["count-leases-failed"], 0)
+        self.assertEqual(results["count-servers-failed"], 0)
+
+        # doing it again renews the same leases
+        yield root.start_deep_renew_leases().when_done()
+        self.assertEqual(self._lease_counts(), {2})
+
+    @defer.inlineCallbacks
+    def test_batches(self):
+        """
+        Storage indexes are sent to every server in batches, and servers
+        which fail are counted.
+        """
+        yield self._set_up()
+        good = FakeStorageServer()
+        bad = FakeStorageServer(fail=True)
+        broker = FakeStorageBroker([FakeServer(b"good", good),
+                                    FakeServer(b"bad", bad),
+                                    FakeServer(b"gone", None)])
+
+        walker = DeepLeaseRenewer(self.root, broker,
+                                  self.g.clients[0]._secret_holder,
+                                  batch_size=2)
+        results = yield self.root.deep_traverse(walker).when_done()
+        self.assertEqual([len(batch) for batch in good.batches], [2, 2, 1])
+        self.assertEqual(sorted(si for batch in good.batches
+                                for (si, renew, cancel) in batch),
+                         sorted(self.g.clients[0].create_node_from_uri(uri)
+                                .get_storage_index() for uri in self.uris))
+        # the secrets differ from server to server
+        self.assertNotEqual(good.batches[0][0][1], bad.batches[0][0][1])
+        self.assertEqual(results["count-servers"], 2)
+        self.assertEqual(results["count-requests"], 3)
+        # the fake reports the first of each batch as missing
+        self.assertEqual(results["count-leases-renewed"], 2)
+        self.assertEqual(results["count-servers-failed"], 3)
+
+    @defer.inlineCallbacks
+    def test_without_batches(self):
+        """
+        Servers without the batch lease operation are asked which storage
+        indexes they hold shares for, and only those leases are added.
+        """
+        yield self._set_up()
+        c0 = self.g.clients[0]
+        sis = [c0.create_node_from_uri(uri).get_storage_index()
+               for uri in self.uris]
+        holder = FakeFoolscapStorageServer(set(sis[:3]))
+        empty = FakeFoolscapStorageServer(set())
+        broker = FakeStorageBroker([FakeServer(b"holder", holder),
+                                    FakeServer(b"empty", empty)])
+
+        walker = DeepLeaseRenewer(self.root, broker, c0._secret_holder,
+                                  batch_size=2)
+        results = yield self.root.deep_traverse(walker).when_done()
+        self.assertEqual(sorted(holder.queried), sorted(sis))
+        self.assertEqual(sorted(empty.queried), sorted(sis))
+        self.assertEqual(sorted(holder.leased), sorted(sis[:3]))
+        self.assertEqual(empty.leased, [])
+        self.assertEqual(results["count-leases-renewed"], 3)
+        self.assertEqual(results["count-leases-failed"], 0)
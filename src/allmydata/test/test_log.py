@@ -159,3 +159,80 @@ class Log(unittest.TestCase):
         for message in self.messages:
             for k in message[-1].keys():
                 self.assertIsInstance(k, str)
+
+
+class Thresholds(unittest.TestCase):
+    """
+    Tests for the per-facility log thresholds.
+    """
+    def setUp(self):
+        self.messages = []
+
+        def msg(*args, **kwargs):
+            self.messages.append((args, kwargs))
+            return len(self.messages)
+
+        self.patch(log, "msg", msg)
+        self.addCleanup(tahoe_log.reset_thresholds)
+
+    def test_parse_level(self):
+        """
+        Levels can be given by name, in any case, or by number.
+        """
+        self.assertEqual(tahoe_log.parse_level("NOISY"), tahoe_log.NOISY)
+        self.assertEqual(tahoe_log.parse_level("unusual"), tahoe_log.UNUSUAL)
+        self.assertEqual(tahoe_log.parse_level("22"), 22)
+        self.assertRaises(ValueError, tahoe_log.parse_level, "chatty")
+
+    def test_default(self):
+        """
+        The default threshold applies to every facility without one of its
+        own, and suppresses both ``msg`` and ``LogMixin.log``.
+        """
+        tahoe_log.set_threshold(tahoe_log.UNUSUAL)
+        self.assertFalse(tahoe_log.is_enabled(tahoe_log.OPERATIONAL))
+        self.assertFalse(tahoe_log.is_enabled(tahoe_log.OPERATIONAL, "a.b"))
+        self.assertTrue(tahoe_log.is_enabled(tahoe_log.UNUSUAL, "a.b"))
+
+        self.assertIsNone(tahoe_log.msg("quiet", level=tahoe_log.NOISY))
+        self.assertEqual(tahoe_log.msg("loud", level=tahoe_log.WEIRD), 1)
+        obj = tahoe_log.PrefixingLogMixin()
+        self.assertIsNone(obj.log("quiet"))
+        self.assertEqual(obj.log("loud", level=tahoe_log.BAD), 2)
+        self.assertEqual(len(self.messages), 2)
+
+    def test_facility_hierarchy(self):
+        """
+        A facility threshold applies to the facilities below it, unless they
+        have a more specific one.
+        """
+        tahoe_log.set_threshold(tahoe_log.UNUSUAL, "tahoe.immutable")
+        tahoe_log.set_threshold(tahoe_log.NOISY, "tahoe.immutable.upload")
+        self.assertTrue(tahoe_log.is_enabled(tahoe_log.NOISY, "tahoe"))
+        self.assertFalse(
+            tahoe_log.is_enabled(tahoe_log.OPERATIONAL, "tahoe.immutable"))
+        self.assertFalse(tahoe_log.is_enabled(
+            tahoe_log.OPERATIONAL, "tahoe.immutable.download"))
+        self.assertTrue(tahoe_log.is_enabled(
+            tahoe_log.NOISY, "tahoe.immutable.upload.encode"))
+        # Not a child, just a shared prefix.
+        self.assertTrue(
+            tahoe_log.is_enabled(tahoe_log.NOISY, "tahoe.immutablefoo"))
+
+        tahoe_log.msg("quiet", facility="tahoe.immutable.download",
+                      level=tahoe_log.NOISY)
+        tahoe_log.msg("loud", facility="tahoe.immutable.upload",
+                      level=tahoe_log.NOISY)
+        self.assertEqual([args for (args, kwargs) in self.messages],
+                         [("loud",)])
+
+    def test_reset(self):
+        """
+        ``reset_thresholds`` removes the thresholds again.
+        """
+        before = tahoe_log.get_threshold("x")
+        tahoe_log.set_threshold(tahoe_log.BAD, "x")
+        self.assertEqual(tahoe_log.get_threshold("x.y"), tahoe_log.BAD)
+        tahoe_log.reset_thresholds()
+        self.assertEqual(tahoe_log.get_threshold("x"), before)
+        self.assertEqual(tahoe_log.get_threshold("x.y"), before)
@@ -979,6 +979,30 @@ class Configuration(unittest.TestCase):
             str(ctx.exception),
         )
 
+    def test_read_logging_config(self):
+        """
+        ``[logging]`` accepts a default ``threshold`` and a
+        ``threshold.<facility>`` for any facility, but nothing else.
+        """
+        with open(os.path.join(self.basedir, 'tahoe.cfg'), 'w') as f:
+            f.write(
+                '[logging]\n'
+                'threshold = UNUSUAL\n'
+                'threshold.tahoe.immutable.download = NOISY\n'
+            )
+        config = read_config(self.basedir, "client.port")
+        self.assertEqual(
+            sorted(config.items("logging")),
+            [("threshold", "UNUSUAL"),
+             ("threshold.tahoe.immutable.download", "NOISY")],
+        )
+
+        with open(os.path.join(self.basedir, 'tahoe.cfg'), 'a') as f:
+            f.write('verbosity = 3\n')
+        with self.assertRaises(UnknownConfigError) as ctx:
+            read_config(self.basedir, "client.port")
+        self.assertIn("verbosity", str(ctx.exception))
+
     @defer.inlineCallbacks
     def test_create_client_invalid_config(self):
         with open(os.path.join(self.basedir, 'tahoe.cfg'), 'w') as f:
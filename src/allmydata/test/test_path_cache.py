@@ -0,0 +1,209 @@
+"""
+Tests for allmydata.path_cache.
+"""
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from allmydata import dirnode
+from allmydata.blacklist import ProhibitedNode
+from allmydata.immutable import upload
+from allmydata.interfaces import NoSuchChildError
+from allmydata.path_cache import PathCache
+from allmydata.test.no_network import GridTestMixin
+
+
+class FakeDirnode:
+    def __init__(self, name, mutable=True):
+        self._name = name
+        self._mutable = mutable
+
+    def get_storage_index(self):
+        return b"si-" + self._name
+
+    def get_uri(self):
+        return b"rw-" + self._name
+
+    def get_write_uri(self):
+        return b"rw-" + self._name
+
+    def get_readonly_uri(self):
+        return b"ro-" + self._name
+
+    def is_mutable(self):
+        return self._mutable
+
+
+class FakeNode:
+    def __init__(self, name):
+        self._name = name
+
+    def get_write_uri(self):
+        return b"rw-" + self._name
+
+    def get_readonly_uri(self):
+        return b"ro-" + self._name
+
+
+def child(name):
+    return (FakeNode(name), {})
+
+
+def cached(name):
+    return (b"rw-" + name, b"ro-" + name, {})
+
+
+class Cache(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = PathCache(max_entries=10, ttl=30, now=self.clock.seconds)
+
+    def _remember(self, dn, children):
+        self.cache.remember(dn, self.cache.start_listing(), children)
+
+    def test_lookup(self):
+        dn = FakeDirnode(b"a")
+        self.failUnlessEqual(self.cache.lookup(dn, u"x"), None)
+        self._remember(dn, {u"x": child(b"x")})
+        self.failUnlessEqual(self.cache.lookup(dn, u"x"), cached(b"x"))
+        self.failUnlessEqual(self.cache.lookup(dn, u"y"), None)
+        self.failUnlessEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_mutable_expires(self):
+        """
+        Listings of mutable directories are only used for ``ttl`` seconds,
+        those of immutable ones until they are evicted.
+        """
+        mutable = FakeDirnode(b"m")
+        immutable = FakeDirnode(b"i", mutable=False)
+        self._remember(mutable, {u"x": child(b"x")})
+        self._remember(immutable, {u"x": child(b"x")})
+        self.clock.advance(29)
+        self.failIfEqual(self.cache.lookup(mutable, u"x"), None)
+        self.clock.advance(1)
+        self.failUnlessEqual(self.cache.lookup(mutable, u"x"), None)
+        self.failIfEqual(self.cache.lookup(immutable, u"x"), None)
+        self.failUnlessEqual(len(self.cache), 2)
+
+    def test_forget(self):
+        dn = FakeDirnode(b"a")
+        self._remember(dn, {u"x": child(b"x")})
+        self.cache.forget(dn)
+        self.failUnlessEqual(self.cache.lookup(dn, u"x"), None)
+        self.failUnlessEqual(len(self.cache), 0)
+
+    def test_listing_overtaken_by_modification(self):
+        """
+        A listing started before the directory was modified is not
+        remembered, since it may hold the old contents.
+        """
+        dn = FakeDirnode(b"a")
+        other = FakeDirnode(b"b")
+        token = self.cache.start_listing()
+        self.cache.forget(dn)
+        self.cache.remember(dn, token, {u"x": child(b"old")})
+        self.cache.remember(other, token, {u"x": child(b"x")})
+        self.failUnlessEqual(self.cache.lookup(dn, u"x"), None)
+        self.failIfEqual(self.cache.lookup(other, u"x"), None)
+        # a listing started afterwards is fine
+        self._remember(dn, {u"x": child(b"new")})
+        self.failUnlessEqual(self.cache.lookup(dn, u"x"), cached(b"new"))
+
+    def test_bounded(self):
+        """
+        The least recently used listings are evicted to keep the number of
+        entries under the limit, and a directory which would not fit is not
+        remembered at all.
+        """
+        dirs = [FakeDirnode(b"%d" % i) for i in range(3)]
+        for dn in dirs:
+            self._remember(dn, {u"x": child(b"x"), u"y": child(b"y")})
+        self.failIfEqual(self.cache.lookup(dirs[0], u"x"), None)
+        self._remember(FakeDirnode(b"new"), {u"x": child(b"x")})
+        self.failUnlessEqual(self.cache.lookup(dirs[1], u"x"), None)
+        self.failIfEqual(self.cache.lookup(dirs[0], u"x"), None)
+        self.failUnless(len(self.cache) <= 10)
+
+        big = FakeDirnode(b"big")
+        self._remember(big, {u"%d" % i: child(b"%d" % i) for i in range(10)})
+        self.failUnlessEqual(self.cache.lookup(big, u"1"), None)
+
+
+class Paths(GridTestMixin, unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        GridTestMixin.setUp(self)
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        self.clock = Clock()
+        c0.nodemaker.path_cache = PathCache(ttl=30, now=self.clock.seconds)
+        self.root = yield c0.create_dirnode()
+        node = self.root
+        for name in [u"a", u"b", u"c"]:
+            node = yield node.create_subdirectory(name)
+        self.parent = node
+        self.file = yield node.add_file(u"file", upload.Data(b"data", None))
+
+        self.reads = []
+        real_read = dirnode.DirectoryNode._read
+        def _read(dn):
+            self.reads.append(dn)
+            return real_read(dn)
+        self.patch(dirnode.DirectoryNode, "_read", _read)
+
+    @defer.inlineCallbacks
+    def test_repeated_lookup(self):
+        """
+        Once the directories along a path have been listed, resolving it again
+        does not read any of them.
+        """
+        node = yield self.root.get_child_at_path(u"a/b/c/file")
+        self.failUnlessEqual(node.get_uri(), self.file.get_uri())
+        self.failUnlessEqual(len(self.reads), 4)
+        node = yield self.root.get_child_at_path(u"a/b/c/file")
+        self.failUnlessEqual(node.get_uri(), self.file.get_uri())
+        self.failUnlessEqual(len(self.reads), 4)
+
+        # after a while the mutable directories are read again
+        self.clock.advance(30)
+        yield self.root.get_child_at_path(u"a/b/c/file")
+        self.failUnlessEqual(len(self.reads), 8)
+
+    @defer.inlineCallbacks
+    def test_modification(self):
+        """
+        Changing a directory makes paths through it be resolved afresh.
+        """
+        yield self.root.get_child_at_path(u"a/b/c/file")
+        new = yield self.parent.add_file(u"file", upload.Data(b"new", None))
+        node = yield self.root.get_child_at_path(u"a/b/c/file")
+        self.failUnlessEqual(node.get_uri(), new.get_uri())
+        # only the modified directory was read again
+        self.failUnlessEqual(self.reads[-1].get_uri(), self.parent.get_uri())
+        self.failUnlessEqual(len(self.reads), 5)
+
+        yield self.parent.delete(u"file")
+        yield self.assertFailure(
+            self.root.get_child_at_path(u"a/b/c/file"), NoSuchChildError)
+
+    @defer.inlineCallbacks
+    def test_nodes_made_afresh(self):
+        """
+        The cache holds caps rather than nodes, so a child found through it is
+        made by the ``NodeMaker``, which for example applies the blacklist.
+        """
+        yield self.root.get_child_at_path(u"a/b/c/file")
+        file_si = self.file.get_storage_index()
+
+        class Blacklist:
+            def check_storageindex(self, si):
+                if si == file_si:
+                    return u"prohibited"
+                return None
+        self.g.clients[0].nodemaker.blacklist = Blacklist()
+
+        node = yield self.root.get_child_at_path(u"a/b/c/file")
+        self.failUnlessEqual(len(self.reads), 4)
+        self.failUnless(isinstance(node, ProhibitedNode))
@@ -0,0 +1,251 @@
+"""
+Tests for allmydata.repair_scheduler.
+"""
+
+import os
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from allmydata.immutable import upload
+from allmydata.monitor import Monitor
+from allmydata.repair_scheduler import (
+    BandwidthBudget,
+    RepairQueue,
+    RepairScheduler,
+    estimate_repair_cost,
+    load_root_caps,
+)
+from allmydata.test.common_web import render
+from allmydata.test.no_network import GridTestMixin
+from allmydata.util import fileutil, jsonbytes as json
+from allmydata.web.status import RepairStatus
+
+
+class FakeCheckResults:
+    def __init__(self, good, needed=3, expected=10):
+        self._good = good
+        self._needed = needed
+        self._expected = expected
+
+    def get_share_counter_good(self):
+        return self._good
+
+    def get_encoding_needed(self):
+        return self._needed
+
+    def get_encoding_expected(self):
+        return self._expected
+
+
+class Queue(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        fileutil.make_dirs(basedir)
+        self.dbfile = os.path.join(basedir, "repair.sqlite")
+        self.queue = RepairQueue(self.dbfile)
+        self.addCleanup(lambda: self.queue.close())
+
+    def test_most_at_risk_first(self):
+        self.queue.add(b"\x01" * 16, "URI:one", FakeCheckResults(9), 100, 0)
+        self.queue.add(b"\x02" * 16, "URI:two", FakeCheckResults(4), 100, 1)
+        self.queue.add(b"\x03" * 16, "URI:three", FakeCheckResults(6), 100, 2)
+        self.assertEqual(
+            [e["cap"] for e in self.queue.get_most_at_risk(10)],
+            ["URI:two", "URI:three", "URI:one"])
+        self.assertEqual(
+            [e["cap"] for e in
+             self.queue.get_most_at_risk(10, exclude=[b"\x02" * 16])],
+            ["URI:three", "URI:one"])
+
+    def test_update_and_remove(self):
+        si = b"\x01" * 16
+        self.queue.add(si, "URI:one", FakeCheckResults(9), 100, 0)
+        self.queue.add(si, "URI:one", FakeCheckResults(5), 100, 5)
+        self.assertEqual(len(self.queue), 1)
+        [entry] = self.queue.get_most_at_risk(10)
+        self.assertEqual(entry["shares_good"], 5)
+        self.queue.remove(si)
+        self.assertEqual(len(self.queue), 0)
+
+    def test_failure_backs_off(self):
+        si = b"\x01" * 16
+        self.queue.add(si, "URI:one", FakeCheckResults(4), 100, 0)
+        self.queue.record_failure(si, "oops", 100)
+        self.assertEqual(self.queue.get_most_at_risk(100), [])
+        [entry] = self.queue.get_most_at_risk(160)
+        self.assertEqual(entry["attempts"], 1)
+        self.queue.record_failure(si, "oops again", 160)
+        self.assertEqual(self.queue.get_most_at_risk(270), [])
+        self.assertEqual(len(self.queue.get_most_at_risk(280)), 1)
+        [entry] = self.queue.get_entries()
+        self.assertEqual(entry["last_error"], "oops again")
+
+    def test_persistent(self):
+        self.queue.add(b"\x01" * 16, "URI:one", FakeCheckResults(4), 100, 0)
+        self.queue.close()
+        self.queue = RepairQueue(self.dbfile)
+        self.assertEqual([e["cap"] for e in self.queue.get_most_at_risk(0)],
+                         ["URI:one"])
+
+
+class Budget(unittest.TestCase):
+    def test_cost(self):
+        # download the whole file, upload 3 shares of a third of it each
+        entry = {"size": 300, "shares_good": 7, "shares_needed": 3,
+                 "shares_expected": 10}
+        self.assertEqual(estimate_repair_cost(entry), 600)
+
+    def test_unlimited(self):
+        budget = BandwidthBudget(task.Clock(), None)
+        budget.spend(10**9)
+        self.assertEqual(budget.delay(), 0)
+
+    def test_limited(self):
+        clock = task.Clock()
+        budget = BandwidthBudget(clock, 1000)
+        self.assertEqual(budget.delay(), 0)
+        budget.spend(5000)
+        self.assertEqual(budget.delay(), 5)
+        budget.spend(1000)
+        self.assertEqual(budget.delay(), 6)
+        clock.advance(10)
+        self.assertEqual(budget.delay(), 0)
+        # idle time is not saved up for later bursts
+        budget.spend(2000)
+        self.assertEqual(budget.delay(), 2)
+
+
+class RootCaps(unittest.TestCase):
+    def test_load(self):
+        fn = self.mktemp()
+        fileutil.write(fn, "# my roots\nURI:DIR2:a:b\n\n  URI:CHK:c:d:3:10:99  \n")
+        self.assertEqual(load_root_caps(fn),
+                         ["URI:DIR2:a:b", "URI:CHK:c:d:3:10:99"])
+
+    def test_missing(self):
+        self.assertEqual(load_root_caps(self.mktemp()), [])
+
+
+class Scheduler(GridTestMixin, unittest.TestCase):
+    timeout = 240
+
+    @defer.inlineCallbacks
+    def _set_up(self):
+        self.basedir = "repair_scheduler/Scheduler/" + self._testMethodName
+        self.set_up_grid(num_servers=10)
+        c0 = self.g.clients[0]
+        self.root = yield c0.create_dirnode()
+        subdir = yield self.root.create_subdirectory(u"sub")
+        self.files = {}
+        for (parent, name) in [(self.root, u"a"), (self.root, u"b"),
+                               (subdir, u"c")]:
+            node = yield parent.add_file(
+                name, upload.Data(name.encode("ascii") * 1000, None))
+            self.files[name] = node.get_uri()
+        # leave "a" at four shares and "c" at seven
+        self.delete_shares_numbered(self.files[u"a"], range(6))
+        self.delete_shares_numbered(self.files[u"c"], range(3))
+
+    def _make_scheduler(self, **kwargs):
+        c0 = self.g.clients[0]
+        dbfile = os.path.join(self.basedir, "repair.sqlite")
+        s = RepairScheduler(c0.nodemaker, [str(self.root.get_uri(), "ascii")], dbfile,
+                            cycle_interval=3600, **kwargs)
+        s.setServiceParent(self.s)
+        self.addCleanup(s.disownServiceParent)
+        return s
+
+    @defer.inlineCallbacks
+    def _healthy(self, name):
+        node = self.g.clients[0].create_node_from_uri(self.files[name])
+        cr = yield node.check(Monitor())
+        return cr.is_healthy()
+
+    @defer.inlineCallbacks
+    def test_check_and_repair(self):
+        yield self._set_up()
+        s = self._make_scheduler(concurrency=2)
+        yield s.check_all()
+        yield s.when_idle()
+        for name in self.files:
+            healthy = yield self._healthy(name)
+            self.assertTrue(healthy, name)
+        status = s.get_status()
+        # two directories and three files
+        self.assertEqual(status["objects-checked"], 5)
+        self.assertEqual(status["objects-unhealthy"], 2)
+        self.assertEqual(status["repairs-succeeded"], 2)
+        self.assertEqual(status["repairs-failed"], 0)
+        self.assertEqual(status["cycles-completed"], 1)
+        self.assertEqual(status["queue"], [])
+        self.assertTrue(status["bytes-repaired"] > 0)
+        stats = s.get_stats()
+        self.assertEqual(stats["repair.repairs_succeeded"], 2)
+        self.assertEqual(stats["repair.queue_length"], 0)
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        """
+        Stopping the service waits for the repairs under way and then closes
+        the queue, which is opened again when the service is restarted.
+        """
+        yield self._set_up()
+        s = self._make_scheduler()
+        yield s.check_all()
+        self.assertEqual(len(s._active), 1)
+        yield s.disownServiceParent()
+        self.assertEqual(s._active, {})
+        self.assertIdentical(s.queue, None)
+        self.assertEqual(s.get_stats()["repair.queue_length"], 0)
+        s.setServiceParent(self.s)
+        self.assertEqual(len(s.queue), 1)
+        yield s.when_idle()
+        self.assertEqual(len(s.queue), 0)
+
+    @defer.inlineCallbacks
+    def test_repairs_queued_before_restart(self):
+        """
+        Objects left in the queue by an earlier run are repaired as soon as
+        the service starts, most at risk first, without waiting for a walk
+        to find them again.
+        """
+        yield self._set_up()
+        dbfile = os.path.join(self.basedir, "repair.sqlite")
+        queue = RepairQueue(dbfile)
+        c0 = self.g.clients[0]
+        for (name, good) in [(u"c", 7), (u"a", 4)]:
+            node = c0.create_node_from_uri(self.files[name])
+            queue.add(node.get_storage_index(), str(self.files[name], "ascii"),
+                      FakeCheckResults(good), node.get_size(), 0)
+        queue.close()
+
+        repaired = []
+        s = RepairScheduler(c0.nodemaker, [], dbfile, concurrency=1)
+        original = s._repair
+        def _repair(entry):
+            repaired.append(entry["cap"])
+            return original(entry)
+        s._repair = _repair
+        s.setServiceParent(self.s)
+        self.addCleanup(s.disownServiceParent)
+        yield s.when_idle()
+        self.assertEqual(repaired, [str(self.files[u"a"], "ascii"),
+                                    str(self.files[u"c"], "ascii")])
+        for name in self.files:
+            healthy = yield self._healthy(name)
+            self.assertTrue(healthy, name)
+
+    @defer.inlineCallbacks
+    def test_status_page(self):
+        yield self._set_up()
+        s = self._make_scheduler()
+        yield s.check_all()
+        yield s.when_idle()
+        body = yield render(RepairStatus(s), {b"t": [b"json"]})
+        data = json.loads(body)
+        self.assertEqual(data["repairs-succeeded"], 2)
+        self.assertEqual(data["roots"], 1)
+        body = yield render(RepairStatus(s), {})
+        self.assertIn(b"Repair Service Status", body)
+        self.assertIn(b"Nothing needs repair.", body)
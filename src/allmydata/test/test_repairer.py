@@ -6,10 +6,15 @@ Ported to Python 3.
 from allmydata.test import common
 from allmydata.monitor import Monitor
 from allmydata import check_results
-from allmydata.interfaces import NotEnoughSharesError
-from allmydata.immutable import upload
+from allmydata.interfaces import NotEnoughSharesError, UploadUnhappinessError
+from allmydata.immutable import layout, repairer, upload
+from allmydata.immutable.repairer import shares_to_encode
+from allmydata.hashtree import HashTree, IncompleteHashTree
+from allmydata.storage.immutable import ShareFile
+from allmydata.util import hashutil
 from allmydata.util.consumer import download_to_data
 from twisted.internet import defer
+from foolscap.api import fireEventually
 from twisted.trial import unittest
 import random
 from allmydata.test.no_network import GridTestMixin
@@ -555,6 +560,123 @@ class Repairer(GridTestMixin, unittest.TestCase, RepairTestMixin,
         d.addCallback(_check_results)
         return d
 
+    def _test_targeted_repair(self, shnum):
+        self.basedir = "repairer/Repairer/targeted_repair_%d" % (shnum,)
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        def _delete(ignored):
+            [(_, _, sharefile)] = [s for s in self.find_uri_shares(self.uri)
+                                   if s[0] == shnum]
+            sf = ShareFile(sharefile)
+            self.old_share_data = sf.read_share_data(0, sf.get_length())
+            self.delete_shares_numbered(self.uri, [shnum])
+            self._stash_counts()
+        d.addCallback(_delete)
+        d.addCallback(lambda ignored:
+                      self.c0_filenode.check_and_repair(Monitor(),
+                                                        verify=False))
+        def _check_results(crr):
+            self.failUnless(crr.get_repair_successful())
+            self.failUnless(crr.get_post_repair_results().is_healthy())
+            # Only the missing share was allocated, and it is a faithful
+            # copy of the one that was deleted.
+            delta_reads, delta_allocates, delta_writes = self._get_delta_counts()
+            self.failUnlessEqual(delta_allocates, 1)
+            shares = self.find_uri_shares(self.uri)
+            self.failUnlessEqual(sorted(s[0] for s in shares), list(range(10)))
+            [(_, _, sharefile)] = [s for s in shares if s[0] == shnum]
+            sf = ShareFile(sharefile)
+            self.failUnlessEqual(sf.read_share_data(0, sf.get_length()),
+                                 self.old_share_data)
+        d.addCallback(_check_results)
+        d.addCallback(lambda ignored:
+                      self.c0_filenode.check(Monitor(), verify=True))
+        d.addCallback(lambda vr: self.failUnless(vr.is_healthy()))
+        return d
+
+    def test_targeted_repair(self):
+        """
+        A repair replaces a lost share with a copy of that share alone.
+        """
+        return self._test_targeted_repair(2)
+
+    def test_targeted_repair_needs_other_shares(self):
+        """
+        Replacing share 9 needs the block hash tree root of share 8, which the
+        download of shares 0-2 does not reveal, so share 8 is encoded too, but
+        only share 9 is uploaded.
+        """
+        return self._test_targeted_repair(9)
+
+    def test_targeted_repair_failure_aborts(self):
+        """
+        If a targeted repair fails part way through, the shares it was
+        uploading are aborted rather than left allocated on the servers.
+        """
+        self.basedir = "repairer/Repairer/targeted_repair_failure_aborts"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        d.addCallback(lambda ignored:
+                      self.delete_shares_numbered(self.uri, [2]))
+        def _fail(*args, **kwargs):
+            raise ValueError("read failed")
+        d.addCallback(lambda ignored:
+                      self.patch(repairer.TargetedRepairer, "_read_segment",
+                                 _fail))
+        d.addCallback(lambda ignored:
+                      self.shouldFail(ValueError, "repair", "read failed",
+                                      self.c0_filenode.check_and_repair,
+                                      Monitor(), verify=False))
+        d.addCallback(fireEventually)
+        def _check(ignored):
+            for ss in self.g.servers_by_number.values():
+                self.failUnlessEqual(ss.get_in_progress_upload_count(), 0)
+            self.failUnlessEqual(sorted(s[0] for s in
+                                        self.find_uri_shares(self.uri)),
+                                 [0, 1] + list(range(3, 10)))
+        d.addCallback(_check)
+        return d
+
+    def test_targeted_repair_all_servers_fail(self):
+        """
+        If every server taking a new share fails part way through a targeted
+        repair, the repair fails with ``UploadUnhappinessError`` rather than
+        reporting the file as corrupt.
+        """
+        self.basedir = "repairer/Repairer/targeted_repair_all_servers_fail"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        d.addCallback(lambda ignored:
+                      self.delete_shares_numbered(self.uri, [2, 5]))
+        def _fail(*args, **kwargs):
+            return defer.fail(ConnectionError("server went away"))
+        d.addCallback(lambda ignored:
+                      self.patch(layout.WriteBucketProxy, "put_block", _fail))
+        d.addCallback(lambda ignored:
+                      self.shouldFail(UploadUnhappinessError, "repair",
+                                      "lost every server",
+                                      self.c0_filenode.check_and_repair,
+                                      Monitor(), verify=False))
+        d.addCallback(fireEventually)
+        def _check(ignored):
+            for ss in self.g.servers_by_number.values():
+                self.failUnlessEqual(ss.get_in_progress_upload_count(), 0)
+        d.addCallback(_check)
+        return d
+
+    def test_shares_to_encode(self):
+        leaves = [hashutil.tagged_hash(b"tag", b"%d" % i) for i in range(10)]
+        ht = HashTree(leaves)
+        iht = IncompleteHashTree(10)
+        for shnum in range(3):
+            needed = ht.needed_hashes(shnum, include_leaf=True)
+            iht.set_hashes(dict((i, ht[i]) for i in needed) | {0: ht[0]})
+        self.failUnlessEqual(shares_to_encode(iht, [2], 10), ({2}, set()))
+        self.failUnlessEqual(shares_to_encode(iht, [9], 10),
+                             ({8, 9}, set(range(10, 16))))
+        self.failUnlessEqual(shares_to_encode(iht, [3, 5], 10),
+                             ({3, 4, 5, 6, 7}, set()))
+
     # why is test_repair_from_corruption_of_1 disabled? Read on:
     #
     # As recently documented in NEWS.rst for the 1.3.0 release, the current
@@ -561,6 +561,49 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
         d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
         return d
 
+    def test_openFile_read_ranged(self):
+        # Read-only handles for large immutable files read ranges of the
+        # file as they are requested, rather than downloading all of it
+        # first, and serve sequential reads from a read-ahead buffer.
+        contents = b"".join(b"%05d" % (i,) for i in range(2000))
+        large = upload.Data(contents, None)
+        d = self._set_up("openFile_read_ranged")
+        d.addCallback(lambda ign: self.root.add_file(u"large", large))
+        d.addCallback(lambda ign: self.handler.openFile(b"large", sftp.FXF_READ, {}))
+        def _read_large(rf):
+            self.assertIsInstance(rf, sftpd.RangedReadOnlySFTPFile)
+            rf.READAHEAD_SIZE = 1000
+            reads = []
+            original_read = rf.filenode.read
+            def _read(consumer, offset=0, size=None):
+                reads.append((offset, size))
+                return original_read(consumer, offset, size)
+            rf.filenode.read = _read
+
+            # issue several requests at once, as an SFTP client would
+            ds = [rf.readChunk(offset, 100) for offset in range(0, 1000, 100)]
+            d2 = defer.gatherResults(ds)
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(b"".join(data), contents[:1000]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(reads, [(0, 1000)]))
+
+            # a read outside the buffer starts a new ranged read
+            d2.addCallback(lambda ign: rf.readChunk(5000, 2000))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, contents[5000:7000]))
+            d2.addCallback(lambda ign: rf.readChunk(9950, 100))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, contents[9950:]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(reads, [(0, 1000), (5000, 2000), (9950, 50)]))
+
+            d2.addCallback(lambda ign:
+                self.shouldFailWithSFTPError(sftp.FX_EOF, "readChunk starting at EOF",
+                                             rf.readChunk, 10000, 1))
+            d2.addCallback(lambda ign: rf.close())
+            return d2
+        d.addCallback(_read_large)
+
+        d.addCallback(lambda ign: self.failUnlessEqual(sftpd.all_heisenfiles, {}))
+        d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
+        return d
+
     def test_openFile_write(self):
         d = self._set_up("openFile_write")
         d.addCallback(lambda ign: self._set_up_tree())
@@ -1044,6 +1087,74 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
         d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
         return d
 
+    def test_openFile_write_sequential(self):
+        # With random_key_uploads, files written in order through a write-only
+        # truncating handle are uploaded with a random key; a backwards seek
+        # falls back to the convergent key.
+        contents = b"0123456789" * 100
+        flags = sftp.FXF_WRITE | sftp.FXF_CREAT | sftp.FXF_TRUNC
+        d = self._set_up("openFile_write_sequential")
+        def _random_key_uploads(ign):
+            self.handler = sftpd.SFTPUserHandler(self.client, self.root, self.username,
+                                                 random_key_uploads=True)
+        d.addCallback(_random_key_uploads)
+
+        def _write(name, offsets):
+            d2 = self.handler.openFile(name, flags, {})
+            def _opened(wf):
+                for offset in offsets:
+                    wf.writeChunk(offset, contents[offset:offset+100])
+                return wf.close()
+            d2.addCallback(_opened)
+            d2.addCallback(lambda ign: self.root.get(name.decode("utf-8")))
+            d2.addCallback(lambda node: node.get_uri())
+            return d2
+
+        uris = {}
+        def _record(uri, name):
+            uris[name] = uri
+        in_order = list(range(0, 1000, 100))
+        d.addCallback(lambda ign: _write(b"seq1", in_order))
+        d.addCallback(_record, "seq1")
+        d.addCallback(lambda ign: _write(b"seq2", in_order))
+        d.addCallback(_record, "seq2")
+        d.addCallback(lambda ign: _write(b"backwards", [100, 0] + in_order[2:]))
+        d.addCallback(_record, "backwards")
+        d.addCallback(lambda ign: self.root.add_file(u"convergent", upload.Data(contents, self.client.convergence)))
+        d.addCallback(lambda node: _record(node.get_uri(), "convergent"))
+
+        def _check(ign):
+            self.failIfEqual(uris["seq1"], uris["seq2"])
+            self.failUnlessReallyEqual(uris["backwards"], uris["convergent"])
+        d.addCallback(_check)
+        for name in (u"seq1", u"seq2", u"backwards"):
+            d.addCallback(lambda ign, name=name: self.root.get(name))
+            d.addCallback(lambda node: download_to_data(node))
+            d.addCallback(lambda data: self.failUnlessReallyEqual(data, contents))
+
+        d.addCallback(lambda ign: self.failUnlessEqual(sftpd.all_heisenfiles, {}))
+        d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
+        return d
+
+    def test_openFile_write_sequential_convergent(self):
+        # By default, files written in order are uploaded with the convergent key.
+        contents = b"0123456789" * 100
+        flags = sftp.FXF_WRITE | sftp.FXF_CREAT | sftp.FXF_TRUNC
+        d = self._set_up("openFile_write_sequential_convergent")
+        d.addCallback(lambda ign: self.handler.openFile(b"seq", flags, {}))
+        def _write(wf):
+            for offset in range(0, 1000, 100):
+                wf.writeChunk(offset, contents[offset:offset+100])
+            return wf.close()
+        d.addCallback(_write)
+        d.addCallback(lambda ign: self.root.get(u"seq"))
+        def _check(seq):
+            d2 = self.root.add_file(u"convergent", upload.Data(contents, self.client.convergence))
+            d2.addCallback(lambda node: self.failUnlessReallyEqual(seq.get_uri(), node.get_uri()))
+            return d2
+        d.addCallback(_check)
+        return d
+
     def test_removeFile(self):
         d = self._set_up("removeFile")
         d.addCallback(lambda ign: self._set_up_tree())
@@ -159,6 +159,26 @@ class ByteSpans(unittest.TestCase):
         self.failUnless((4,2) in s)
         self.failUnless((2**65,2) in s)
 
+    def test_many_fragments(self):
+        # thousands of separate spans, added out of order
+        s = Spans()
+        starts = list(range(0, 30000, 3))
+        starts.reverse()
+        for start in starts:
+            s.add(start, 2)
+        self.failUnlessEqual(s.len(), 20000)
+        self.failUnlessEqual(len(list(s)), 10000)
+        self.failUnless((300, 2) in s)
+        self.failIf((301, 2) in s)
+        # filling the gaps merges everything into a single span
+        for start in starts:
+            s.add(start+2, 1)
+        self.failUnlessEqual(list(s), [(0, 30000)])
+        self.failUnlessEqual(s.len(), 30000)
+        s.remove(10, 29980)
+        self.failUnlessEqual(list(s), [(0, 10), (29990, 10)])
+        self.failUnlessEqual(s.len(), 20)
+
     def test_math(self):
         s1 = Spans(0, 10) # 0,1,2,3,4,5,6,7,8,9
         s2 = Spans(5, 3) # 5,6,7
@@ -601,3 +621,27 @@ class StringSpans(unittest.TestCase):
                 length = max(1, int(what[5:6], 16))
                 d1 = s1.get(start, length); d2 = s2.get(start, length)
                 self.failUnlessEqual(d1, d2, "%d+%d" % (start, length))
+
+    def test_many_fragments(self):
+        ds = DataSpans()
+        for start in range(1000, 0, -1):
+            ds.add(start*4, b"%04d" % (start,))
+        self.failUnlessEqual(ds.len(), 4000)
+        # adjacent chunks are read as one
+        self.failUnlessEqual(ds.get(6, 8), b"01000200")
+        self.failUnlessEqual(ds.get(6, 8), b"01000200")
+        self.failUnlessEqual(ds.get_chunks(), [(4, b"".join([b"%04d" % (i,) for i in range(1, 1001)]))])
+        self.failUnlessEqual(list(ds.get_spans()), [(4, 4000)])
+        self.failUnlessEqual(ds.pop(400, 8), b"01000101")
+        self.failUnlessEqual(ds.len(), 3992)
+        self.failUnlessEqual(ds.get(398, 4), None)
+        ds.assert_invariants()
+
+    def test_copies_mutable_data(self):
+        data = bytearray(b"four")
+        ds = DataSpans()
+        ds.add(2, data)
+        data[0:4] = b"five"
+        self.failUnlessEqual(ds.get(2, 4), b"four")
+        self.failUnlessEqual(type(ds.get(2, 4)), bytes)
+        self.failUnlessEqual(type(ds.pop(2, 2)), bytes)
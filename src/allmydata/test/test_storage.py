@@ -59,6 +59,7 @@ from allmydata.storage.common import storage_index_to_dir, \
      UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
      si_b2a, si_a2b
 from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.leasedb import LeaseDB
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy, _WriteBuffer
 from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
@@ -1146,6 +1147,39 @@ class Server(AsyncTestCase):
         [lease] = ss.get_leases(b"si0")
         self.assertThat(lease.get_expiration_time(), Equals(123 + 123456 + DEFAULT_RENEWAL_TIME))
 
+    def test_add_leases(self):
+        """
+        ``StorageServer.add_leases`` renews or adds leases on many storage
+        indexes at once, and reports those it has no shares for.
+        """
+        clock = Clock()
+        clock.advance(123)
+        ss = self.create("test_add_leases", clock=clock)
+        secrets = {
+            si: self.create_bucket_5_shares(ss, si)
+            for si in [b"si0", b"si1"]
+        }
+        clock.advance(123456)
+
+        rs, cs = (hashutil.my_renewal_secret_hash(b"new"),
+                  hashutil.my_cancel_secret_hash(b"new"))
+        (missing, failed) = ss.add_leases([
+            (b"si1",) + secrets[b"si1"],
+            (b"si0",) + secrets[b"si0"],
+            (b"si0", rs, cs),
+            (b"si2", rs, cs),
+        ])
+        self.assertThat(missing, Equals({b"si2"}))
+        self.assertThat(failed, Equals(set()))
+        for si in [b"si0", b"si1"]:
+            lease = list(ss.get_leases(si))[0]
+            self.assertThat(lease.get_expiration_time(),
+                            Equals(123 + 123456 + DEFAULT_RENEWAL_TIME))
+        self.assertThat(list(ss.get_leases(b"si0")), HasLength(2))
+        self.assertThat(
+            ss.leasedb.get_expiration_time(b"si1", 0),
+            Equals(123 + 123456 + DEFAULT_RENEWAL_TIME))
+
     def test_have_shares(self):
         """By default the StorageServer has no shares."""
         workdir = self.workdir("test_have_shares")
@@ -3412,6 +3446,218 @@ class Stats(SyncTestCase):
         self.assertTrue(output["get"]["99_0_percentile"] is None, output)
         self.assertTrue(output["get"]["99_9_percentile"] is None, output)
 
+class MultiDiskServer(SyncTestCase):
+    """
+    Tests for a ``StorageServer`` with more than one share directory.
+    """
+
+    def setUp(self):
+        super(MultiDiskServer, self).setUp()
+        self.sparent = LoggingServiceParent()
+        self.addCleanup(self.sparent.stopService)
+
+    def create(self, name, **kwargs):
+        basedir = os.path.join("storage", "MultiDiskServer", name)
+        self.extra = [os.path.abspath(os.path.join(basedir, "disk%d" % i))
+                      for i in (1, 2)]
+        ss = StorageServer(os.path.join(basedir, "storage"), b"\x00" * 20,
+                           extra_sharedirs=self.extra, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def sharedir_of(self, ss, storage_index):
+        # sharedir/prefix/storage_index/shnum
+        homes = set(os.path.dirname(os.path.dirname(os.path.dirname(fn)))
+                    for (_, fn) in ss.get_shares(storage_index))
+        self.assertThat(homes, HasLength(1))
+        return homes.pop()
+
+    def test_hash_placement(self):
+        """
+        With hash placement, buckets are spread over all the share
+        directories, and all the shares of one bucket stay together.
+        """
+        ss = self.create("test_hash_placement")
+        self.assertThat(ss.sharedirs, Equals([ss.sharedir] + self.extra))
+        used = set()
+        for i in range(12):
+            storage_index = bchr(i) * 16
+            upload_immutable(ss, storage_index, b"r" * 32, b"c" * 32,
+                             {0: b"a" * 10, 1: b"b" * 10})
+            used.add(self.sharedir_of(ss, storage_index))
+            readers = ss.get_buckets(storage_index)
+            self.assertThat(readers[1].read(0, 10), Equals(b"b" * 10))
+        self.assertThat(used, Equals(set(ss.sharedirs)))
+
+        # a new share for an existing bucket joins the others
+        storage_index = bchr(0) * 16
+        upload_immutable(ss, storage_index, b"r" * 32, b"c" * 32,
+                         {2: b"c" * 10})
+        self.assertThat(ss.get_buckets(storage_index), HasLength(3))
+        self.sharedir_of(ss, storage_index)
+
+    def test_free_space_placement(self):
+        """
+        With free-space placement, a new bucket goes into the share
+        directory with the most available space, and each directory has its
+        own reserved space and stats.
+        """
+        disks = {}
+        def get_disk_stats(whichdir, reserved_space=0):
+            return disks[whichdir].get_disk_stats(whichdir, reserved_space)
+        self.patch(fileutil, "get_disk_stats", get_disk_stats)
+
+        ss = self.create("test_free_space_placement",
+                         share_placement="free-space")
+        for (d, used) in zip(ss.sharedirs, [500, 100, 900]):
+            disks[d] = FakeDisk(total=1000, used=used)
+        self.assertThat(ss.get_available_space(), Equals(1500))
+        self.assertThat(ss.get_available_space(self.extra[0]), Equals(900))
+
+        upload_immutable(ss, b"x" * 16, b"r" * 32, b"c" * 32, {0: b"a" * 10})
+        self.assertThat(self.sharedir_of(ss, b"x" * 16),
+                        Equals(self.extra[0]))
+
+        # the biggest share we can take is what fits on one disk
+        sv1 = ss.get_version()[b'http://allmydata.org/tahoe/protocols/storage/v1']
+        self.assertThat(sv1[b"maximum-immutable-share-size"], Equals(900))
+        self.assertThat(sv1[b"available-space"], Equals(1500))
+
+        stats = ss.get_stats()
+        self.assertThat(stats["storage_server.disk_avail"], Equals(1500))
+        self.assertThat(stats["storage_server.disks.1.avail"], Equals(900))
+        self.assertThat(stats["storage_server.disks.2.used"], Equals(900))
+
+    def test_mutable(self):
+        """
+        Mutable shares can be written and read in any share directory.
+        """
+        ss = self.create("test_mutable")
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        used = set()
+        for i in range(12):
+            storage_index = bchr(i) * 16
+            upload_mutable(ss, storage_index, secrets, {0: b"data%02d" % i})
+            used.add(self.sharedir_of(ss, storage_index))
+            self.assertThat(
+                ss.slot_readv(storage_index, [0], [(0, 6)]),
+                Equals({0: [b"data%02d" % i]}),
+            )
+            self.assertThat(ss.enumerate_mutable_shares(storage_index),
+                            Equals({0}))
+        self.assertThat(used, Equals(set(ss.sharedirs)))
+
+
+class LeaseDatabase(SyncTestCase):
+    """
+    Tests for ``allmydata.storage.leasedb.LeaseDB`` and for how
+    ``StorageServer`` keeps it in sync with the leases in share files.
+    """
+    def setUp(self):
+        super(LeaseDatabase, self).setUp()
+        self.sparent = LoggingServiceParent()
+        self.addCleanup(self.sparent.stopService)
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "LeaseDatabase", name)
+        return basedir
+
+    def create(self, name, clock):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, b"\x00" * 20, clock=clock)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def make_lease(self, expiration_time):
+        return LeaseInfo(0, os.urandom(32), os.urandom(32),
+                         expiration_time, b"\x00" * 20)
+
+    def test_record_and_query(self):
+        """
+        ``LeaseDB.get_expired_shares`` returns the shares whose latest lease
+        expires before the cutoff, oldest first.
+        """
+        fileutil.make_dirs(self.workdir("test_record_and_query"))
+        db = LeaseDB(os.path.join(self.workdir("test_record_and_query"), "db"))
+        self.addCleanup(db.close)
+        db.record_share(b"si1", 0, "immutable",
+                        [self.make_lease(100), self.make_lease(300)])
+        db.record_share(b"si2", 0, "mutable", [self.make_lease(200)])
+        db.record_share(b"si2", 1, "mutable", [])
+        self.assertThat(db.count_shares(), Equals(3))
+        self.assertThat(db.get_expiration_time(b"si1", 0), Equals(300))
+        self.assertThat(db.get_expiration_time(b"si1", 1), Equals(None))
+
+        self.assertThat(
+            list(db.get_expired_shares(250)),
+            Equals([(b"si2", 1, "mutable", 0), (b"si2", 0, "mutable", 200)]),
+        )
+        self.assertThat(
+            list(db.get_expired_shares(1000, sharetypes=["immutable"])),
+            Equals([(b"si1", 0, "immutable", 300)]),
+        )
+        self.assertThat(list(db.get_expired_shares(1000, limit=1)), HasLength(1))
+
+        db.retain_shares(b"si2", [0])
+        db.remove_share(b"si1", 0)
+        self.assertThat(
+            list(db.get_expired_shares(1000)),
+            Equals([(b"si2", 0, "mutable", 200)]),
+        )
+        db.remove_shares([(b"si2", 0)])
+        self.assertThat(db.count_shares(), Equals(0))
+
+    def test_immutable_leases(self):
+        """
+        Closing a ``BucketWriter`` and adding or renewing leases update the
+        lease database.
+        """
+        clock = Clock()
+        clock.advance(1000)
+        ss = self.create("test_immutable_leases", clock)
+        rs, cs = os.urandom(32), os.urandom(32)
+        _, writers = ss.allocate_buckets(b"si1", rs, cs, {0, 1}, 10)
+        self.assertThat(ss.leasedb.count_shares(), Equals(0))
+        for bw in writers.values():
+            bw.write(0, b"x" * 10)
+            bw.close()
+        for shnum in (0, 1):
+            self.assertThat(ss.leasedb.get_expiration_time(b"si1", shnum),
+                            Equals(1000 + DEFAULT_RENEWAL_TIME))
+
+        clock.advance(500)
+        ss.renew_lease(b"si1", rs)
+        self.assertThat(ss.leasedb.get_expiration_time(b"si1", 0),
+                        Equals(1500 + DEFAULT_RENEWAL_TIME))
+
+        clock.advance(500)
+        ss.add_lease(b"si1", os.urandom(32), os.urandom(32))
+        self.assertThat(ss.leasedb.get_expiration_time(b"si1", 1),
+                        Equals(2000 + DEFAULT_RENEWAL_TIME))
+
+    def test_mutable_leases(self):
+        """
+        Writing a mutable share records its lease, and deleting it with a
+        zero-length write removes it from the lease database.
+        """
+        clock = Clock()
+        ss = self.create("test_mutable_leases", clock)
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        ss.slot_testv_and_readv_and_writev(
+            b"si1", secrets, {0: ([], [(0, b"data")], None),
+                              1: ([], [(0, b"data")], None)}, [],
+        )
+        self.assertThat(ss.leasedb.get_expiration_time(b"si1", 0),
+                        Equals(DEFAULT_RENEWAL_TIME))
+        ss.slot_testv_and_readv_and_writev(
+            b"si1", secrets, {0: ([], [], 0)}, [],
+        )
+        self.assertThat(ss.leasedb.get_expiration_time(b"si1", 0),
+                        Equals(None))
+        self.assertThat(ss.leasedb.get_expiration_time(b"si1", 1),
+                        Equals(DEFAULT_RENEWAL_TIME))
+
+
 immutable_schemas = strategies.sampled_from(list(ALL_IMMUTABLE_SCHEMAS))
 
 class ShareFileTests(SyncTestCase):
@@ -82,6 +82,7 @@ from ..storage.http_client import (
     ReadTestWriteResult,
     TestVector,
     limited_content,
+    AdaptiveHTTPConnectionPool,
 )
 
 
@@ -104,6 +105,118 @@ class HTTPUtilities(SyncTestCase):
         assert_header_values_result(["text/html;encoding=utf-8"], "text/html")
 
 
+class _FakeTransport:
+    def __init__(self):
+        self.disconnected = False
+
+    def loseConnection(self):
+        self.disconnected = True
+
+
+class _FakeConnection:
+    state = "QUIESCENT"
+
+    def __init__(self):
+        self.transport = _FakeTransport()
+
+
+class _SlowEndpoint:
+    """
+    An endpoint whose connections take ``delay`` seconds to set up.
+    """
+
+    def __init__(self, clock, delay):
+        self._clock = clock
+        self._delay = delay
+
+    def connect(self, factory):
+        d = Deferred()
+        self._clock.callLater(self._delay, d.callback, _FakeConnection())
+        return d
+
+
+class AdaptiveHTTPConnectionPoolTests(SyncTestCase):
+    """Tests for ``AdaptiveHTTPConnectionPool``."""
+
+    def setUp(self):
+        super().setUp()
+        self.clock = Clock()
+        self.pool = AdaptiveHTTPConnectionPool(self.clock)
+        self.pool.retryAutomatically = False
+        self.endpoint = _SlowEndpoint(self.clock, 0.5)
+
+    def open_connections(self, count):
+        connections = []
+        for _ in range(count):
+            self.pool.getConnection("key", self.endpoint).addCallback(
+                connections.append
+            )
+        self.clock.advance(0.5)
+        return connections
+
+    def test_grows_with_demand(self):
+        """
+        When more connections were in use at once than the pool keeps, the
+        pool keeps all of them once they are finished, instead of closing
+        the surplus.
+        """
+        connections = self.open_connections(15)
+        for connection in connections:
+            self.pool._putConnection("key", connection)
+        self.assertEqual(self.pool.maxPersistentPerHost, 15)
+        self.assertEqual(
+            [c for c in connections if c.transport.disconnected], []
+        )
+
+        # So the next round of requests reuses them all:
+        self.assertEqual(len(self.open_connections(15)), 15)
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["connections_opened"], 15)
+        self.assertEqual(stats["connections_reused"], 15)
+        self.assertEqual(stats["connection_wait_time"], 15 * 0.5)
+        self.assertEqual(stats["connection_max_wait_time"], 0.5)
+
+    def test_bounded(self):
+        """
+        The pool keeps no more than ``MAX_PERSISTENT`` idle connections.
+        """
+        self.pool.MAX_PERSISTENT = 12
+        connections = self.open_connections(15)
+        for connection in connections:
+            self.pool._putConnection("key", connection)
+        self.assertEqual(self.pool.maxPersistentPerHost, 12)
+        self.assertEqual(
+            len([c for c in connections if c.transport.disconnected]), 3
+        )
+        # Idle connections still time out:
+        self.clock.advance(self.pool.cachedConnectionTimeout)
+        self.assertEqual(
+            len([c for c in connections if c.transport.disconnected]), 15
+        )
+
+
+class StorageClientFactoryTests(SyncTestCase):
+    """Tests for ``StorageClientFactory``."""
+
+    def test_create_storage_client(self):
+        """
+        ``StorageClientFactory.create_storage_client`` gives a client for the
+        NURL's server which uses an ``AdaptiveHTTPConnectionPool``.
+        """
+        factory = StorageClientFactory({"tcp": "tcp"}, None)
+        nurl = DecodedURL.from_text(
+            "pb://abcde@127.0.0.1:1234/swissnum#v=1"
+        )
+        client = result_of(
+            Deferred.fromCoroutine(factory.create_storage_client(nurl, Clock()))
+        )
+        self.assertEqual(
+            client.relative_url("/x"),
+            DecodedURL.from_text("https://127.0.0.1:1234/x"),
+        )
+        self.assertEqual(client.get_connection_stats()["max_persistent"], 10)
+
+
 def _post_process(params):
     secret_types, secrets = params
     secrets = {t: s for (t, s) in zip(secret_types, secrets)}
@@ -1614,6 +1727,37 @@ class SharedImmutableMutableTestsMixin:
         self.assertEqual(lease1.get_expiration_time(), initial_expiration_time + 167)
         self.assertEqual(lease2.get_expiration_time(), initial_expiration_time + 177)
 
+    def test_lease_renew_batch(self):
+        """
+        Leases on many storage indexes can be renewed or added in one request,
+        and the storage indexes without shares are reported as missing.
+        """
+        uploads = [self.upload(i) for i in range(3)]
+        expirations = [
+            lease.get_expiration_time()
+            for (storage_index, _, _) in uploads
+            for lease in self.get_leases(storage_index)
+        ]
+        self.http.clock.advance(167)
+
+        unknown = urandom(16)
+        secret2 = urandom(32)
+        leases = [
+            (storage_index, lease_secret, lease_secret)
+            for (storage_index, _, lease_secret) in uploads
+        ] + [(uploads[0][0], secret2, secret2), (unknown, secret2, secret2)]
+        (missing, failed) = self.http.result_of_with_flush(
+            self.general_client.add_or_renew_leases(leases)
+        )
+        self.assertEqual((missing, failed), ({unknown}, set()))
+
+        for ((storage_index, _, _), expiration) in zip(uploads, expirations):
+            leases_now = list(self.get_leases(storage_index))
+            self.assertEqual(
+                leases_now[0].get_expiration_time(), expiration + 167
+            )
+        self.assertEqual(len(list(self.get_leases(uploads[0][0]))), 2)
+
     def test_read_of_wrong_storage_index_fails(self):
         """
         Reading from unknown storage index results in 404.
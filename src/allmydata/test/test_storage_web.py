@@ -6,6 +6,7 @@ Partially ported to Python 3.
 
 import time
 import os.path
+import threading
 import re
 import json
 from unittest import skipIf
@@ -235,6 +236,9 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         return d
 
 class InstrumentedLeaseCheckingCrawler(LeaseCheckingCrawler):
+    # these tests inspect the state right after the first bucket, which
+    # would race with a worker thread
+    use_thread = False
     stop_after_first_bucket = False
     def process_bucket(self, *args, **kwargs):
         LeaseCheckingCrawler.process_bucket(self, *args, **kwargs)
@@ -349,6 +353,9 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
         self.failIfIn("estimated-current-cycle", initial_state)
         self.failUnlessIn("history", initial_state)
         self.failUnlessEqual(initial_state["history"], {})
+        # the whole state is saved once, and after that only the changes
+        lc.save_state()
+        statefile = os.path.join(ss.storedir, "lease_checker.state")
 
         ss.setServiceParent(self.s)
 
@@ -393,6 +400,15 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
             self.failIfEqual(sr2["actual-shares"], None)
             self.failIfEqual(sr2["configured-diskbytes"], None)
             self.failIfEqual(sr2["original-sharebytes"], None)
+
+            self.failUnless(os.path.exists(statefile + ".json.journal"))
+            saved = _LeaseStateSerializer(statefile).load()
+            self.failUnlessEqual(saved["current-cycle"], 0)
+            saved_so_far = saved["cycle-to-date"]
+            for k in ("lease-age-histogram", "leases-per-share-histogram",
+                      "corrupt-shares", "space-recovered"):
+                self.failUnlessEqual(saved_so_far[k],
+                                     json.loads(json.dumps(so_far[k])))
         d.addCallback(_after_first_bucket)
         d.addCallback(lambda ign: renderDeferred(webstatus))
         def _check_html_in_cycle(html):
@@ -528,8 +544,10 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
         # each share, to make it look like it expired already (age=1000s).
         # Some shares have an extra lease which is set to expire at the
         # default time in 31 days from now (age=31days). We then run the
-        # crawler, which will expire the first lease, making some shares get
-        # deleted and others stay alive (with one remaining lease)
+        # crawler, which will find the expired first leases, making the
+        # shares without an extra lease get deleted. The others stay alive,
+        # and keep both leases: an expired lease is only cancelled once its
+        # share has no unexpired lease left.
         now = time.time()
 
         sf0 = _get_sharefile(immutable_si_0)
@@ -583,10 +601,10 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
         def _after_first_cycle(ignored):
             self.failUnlessEqual(count_shares(immutable_si_0), 0)
             self.failUnlessEqual(count_shares(immutable_si_1), 1)
-            self.failUnlessEqual(count_leases(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 2)
             self.failUnlessEqual(count_shares(mutable_si_2), 0)
             self.failUnlessEqual(count_shares(mutable_si_3), 1)
-            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 2)
 
             s = lc.get_state()
             last = s["history"]["0"]
@@ -673,8 +691,10 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
 
         # Some shares have an extra lease which is set to expire at the
         # default time in 31 days from now (age=31days). We then run the
-        # crawler, which will expire the first lease, making some shares get
-        # deleted and others stay alive (with one remaining lease)
+        # crawler, which will find the expired first leases, making the
+        # shares without an extra lease get deleted. The others stay alive,
+        # and keep both leases: an expired lease is only cancelled once its
+        # share has no unexpired lease left.
 
         sf0 = _get_sharefile(immutable_si_0)
         self.backdate_lease(sf0, self.renew_secrets[0], new_expiration_time)
@@ -727,10 +747,10 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
         def _after_first_cycle(ignored):
             self.failUnlessEqual(count_shares(immutable_si_0), 0)
             self.failUnlessEqual(count_shares(immutable_si_1), 1)
-            self.failUnlessEqual(count_leases(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 2)
             self.failUnlessEqual(count_shares(mutable_si_2), 0)
             self.failUnlessEqual(count_shares(mutable_si_3), 1)
-            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 2)
 
             s = lc.get_state()
             last = s["history"]["0"]
@@ -891,6 +911,162 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_leasedb_reconciliation(self):
+        """
+        Leases changed behind the storage server's back are picked up by the
+        lease checker, after which the lease database can answer which shares
+        the configured policy would expire.
+        """
+        basedir = "storage/LeaseCrawler/leasedb_reconciliation"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.cpu_slice = 500
+
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        self.failUnlessEqual(list(lc.find_expired_shares()), [])
+
+        now = time.time()
+        for (si, rs) in [(immutable_si_0, self.renew_secrets[0]),
+                         (mutable_si_2, self.renew_secrets[3])]:
+            sf = list(ss._iter_share_files(si))[0]
+            self.backdate_lease(sf, rs, now - 1000)
+        # the lease database does not know about this yet
+        self.failUnlessEqual(list(lc.find_expired_shares()), [])
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+
+        def _check(ignored):
+            expired = sorted(si for (si, shnum, sharetype, expiration_time)
+                             in lc.find_expired_shares())
+            self.failUnlessEqual(expired, [immutable_si_0, mutable_si_2])
+            # expiration is disabled, so the shares are still there
+            self.failUnlessEqual(ss.leasedb.count_shares(), 4)
+        d.addCallback(_check)
+        return d
+
+    def test_expire_from_leasedb(self):
+        """
+        ``expire_shares`` deletes the shares which the lease database says
+        have expired, without waiting for the crawler to reach them, but
+        leaves alone a share whose lease was renewed behind the database's
+        back.
+        """
+        basedir = "storage/LeaseCrawler/expire_from_leasedb"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000)
+        lc = ss.lease_checker
+        ss.setServiceParent(self.s)
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+
+        now = time.time()
+        sf0 = list(ss._iter_share_files(immutable_si_0))[0]
+        self.backdate_lease(sf0, self.renew_secrets[0], now - 1000)
+        ss.leasedb.record_share(immutable_si_0, 0, "immutable",
+                                sf0.get_leases())
+        # the database is out of date: this share still has a lease
+        ss.leasedb.record_share(mutable_si_2, 0, "mutable", [])
+        self.failUnlessEqual(
+            sorted(si for (si, shnum, sharetype, expiration_time)
+                   in lc.find_expired_shares()),
+            [immutable_si_0, mutable_si_2])
+
+        lc.expire_shares()
+
+        self.failUnlessEqual(list(ss._iter_share_files(immutable_si_0)), [])
+        self.failUnlessEqual(len(list(ss._iter_share_files(mutable_si_2))), 1)
+        self.failUnlessEqual(list(lc.find_expired_shares()), [])
+        self.failUnlessEqual(ss.leasedb.count_shares(), 3)
+        rec = lc.state["cycle-to-date"]["space-recovered"]
+        self.failUnlessEqual(rec["actual-shares"], 1)
+        self.failUnlessEqual(rec["actual-buckets-immutable"], 1)
+        self.failUnlessEqual(rec["actual-buckets-mutable"], 0)
+
+    def test_counted_in_reactor(self):
+        """
+        The buckets are examined in a worker thread, but what was found is
+        added to the state in the reactor thread, which reads it.
+        """
+        basedir = "storage/LeaseCrawler/counted_in_reactor"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.cpu_slice = 500
+        self.make_shares(ss)
+
+        threads = []
+        real_add = lc.add_to_cycle_to_date
+        def _add(so_far):
+            threads.append(threading.get_ident())
+            return real_add(so_far)
+        lc.add_to_cycle_to_date = _add
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+
+        def _check(ignored):
+            self.failUnlessEqual(threads, [threading.get_ident()] * 4)
+            last = lc.get_state()["history"]["0"]
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(last["leases-per-share-histogram"],
+                                 {"1": 2, "2": 2})
+        d.addCallback(_check)
+        return d
+
+    def test_one_trip_per_bucket(self):
+        """
+        The lease database is brought up to date with a single call into the
+        reactor thread per bucket, and the shares are only opened again
+        there if they have expired.
+        """
+        basedir = "storage/LeaseCrawler/one_trip_per_bucket"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.cpu_slice = 500
+        self.make_shares(ss)
+        # lose track of the shares, so that the crawler has to find them
+        for si in self.sis:
+            ss.leasedb.retain_shares(si, [])
+
+        buckets = []
+        real_finished = lc.finished_bucket
+        def _finished(storage_index, *args):
+            buckets.append((threading.get_ident(), storage_index))
+            return real_finished(storage_index, *args)
+        lc.finished_bucket = _finished
+        expired = []
+        lc.expire_share = lambda *args: expired.append(args)
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+
+        def _check(ignored):
+            self.failUnlessEqual(sorted(buckets),
+                                 [(threading.get_ident(), si)
+                                  for si in self.sis])
+            self.failUnlessEqual(expired, [])
+            self.failUnlessEqual(ss.leasedb.count_shares(), 4)
+        d.addCallback(_check)
+        return d
+
     def test_bad_mode(self):
         basedir = "storage/LeaseCrawler/bad_mode"
         fileutil.make_dirs(basedir)
@@ -91,6 +91,18 @@ class TimeFormat(unittest.TestCase, TimezoneMixin):
         self.failUnlessEqual(p("60 SECONDS"), 60)
         self.failUnlessEqual(p("86400s"), DAY)
 
+        # minutes
+        self.failUnlessEqual(p("1 min"), 60)
+        self.failUnlessEqual(p("1 minute"), 60)
+        self.failUnlessEqual(p("30minutes"), 30*60)
+        self.failUnlessEqual(p("5 MINUTES"), 5*60)
+
+        # hours
+        self.failUnlessEqual(p("1h"), 60*60)
+        self.failUnlessEqual(p("1 hour"), 60*60)
+        self.failUnlessEqual(p("12 hours"), 12*60*60)
+        self.failUnlessEqual(p("48 HOURS"), 2*DAY)
+
         # days
         self.failUnlessEqual(p("1 day"), DAY)
         self.failUnlessEqual(p("2 days"), 2*DAY)
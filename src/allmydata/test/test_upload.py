@@ -178,6 +178,7 @@ class FakeStorageServer:
                     )
 
     def get_buckets(self, storage_index, **kw):
+        self._get_queries += 1
         # this should map shnum to a BucketReader but there isn't a
         # handy FakeBucketReader and we don't actually read the shares
         # back anyway (just the keys)
@@ -610,6 +611,93 @@ class FullServer(unittest.TestCase):
         d.addBoth(self._should_fail)
         return d
 
+class FastServerSelection(unittest.TestCase, SetDEPMixin):
+    def make_client(self, mode):
+        self.node = FakeClient(mode=mode, num_servers=10)
+        self.u = upload.Uploader()
+        self.u.running = True
+        self.u.parent = self.node
+        self.set_encoding_parameters(3, 5, 10)
+
+    def test_random_key_skips_probe(self):
+        """
+        A random-key upload goes straight to allocating shares, without first
+        asking the servers which shares they already hold.
+        """
+        self.make_client("good")
+        d = upload_data(self.u, DATA)
+        def _check(ign):
+            for s in self.node.last_servers:
+                self.assertEqual(s._get_queries, 0)
+                self.assertEqual(s._alloc_queries, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_convergent_probes(self):
+        """
+        A convergent upload first asks the servers which shares they already
+        hold.
+        """
+        self.make_client("good")
+        d = self.u.upload(upload.Data(DATA, convergence=b""))
+        def _check(ign):
+            for s in self.node.last_servers:
+                self.assertEqual(s._get_queries, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_recently_full_servers_skipped(self):
+        """
+        Servers which recently refused shares are left out of the next
+        random-key upload, as long as enough other servers remain.
+        """
+        self.make_client(dict((i, "full" if i < 3 else "good")
+                              for i in range(10)))
+        full = self.node.last_servers[:3]
+        d = upload_data(self.u, DATA)
+        def _uploaded(ign):
+            self.assertEqual([s._alloc_queries for s in full], [1, 1, 1])
+            return upload_data(self.u, DATA + b"more")
+        d.addCallback(_uploaded)
+        def _check(ign):
+            self.assertEqual([s._alloc_queries for s in full], [1, 1, 1])
+        d.addCallback(_check)
+        return d
+
+
+class FakeAnnouncedServer:
+    def __init__(self, serverid, available_space):
+        self._serverid = serverid
+        self._available_space = available_space
+
+    def get_serverid(self):
+        return self._serverid
+
+    def get_version(self):
+        return {b"http://allmydata.org/tahoe/protocols/storage/v1":
+                {b"available-space": self._available_space}}
+
+
+class RecentServersTests(unittest.TestCase):
+    def test_allocations_expire(self):
+        """
+        Space allocated by recent uploads counts against the space a server
+        announced, but only for as long as refusals are remembered.
+        """
+        recent = upload.RecentServers(ttl=100)
+        server = FakeAnnouncedServer(b"server", 1000)
+        recent.record_allocated(b"server", 600, 0)
+        recent.record_allocated(b"server", 500, 50)
+        # more has been allocated than the server announced
+        self.assertTrue(recent.is_likely_to_refuse(server, 1, 60))
+        # the first allocation has been forgotten
+        self.assertFalse(recent.is_likely_to_refuse(server, 500, 100))
+        self.assertTrue(recent.is_likely_to_refuse(server, 600, 100))
+        # and now both have
+        self.assertFalse(recent.is_likely_to_refuse(server, 1000, 150))
+        self.assertEqual(recent._allocated, {})
+
+
 class ServerSelection(unittest.TestCase):
 
     def make_client(self, num_servers=50):
@@ -888,6 +976,14 @@ def is_happy_enough(servertoshnums, h, k):
     return True
 
 
+class ReadCountingBytesIO(BytesIO):
+    reads = 0
+
+    def read(self, *args):
+        self.reads += 1
+        return BytesIO.read(self, *args)
+
+
 class FileHandleTests(unittest.TestCase):
     """
     Tests for ``FileHandle``.
@@ -915,6 +1011,46 @@ class FileHandleTests(unittest.TestCase):
             b"oBcuR/wKdCgCV2GKKXqiNg==",
         )
 
+    def _hashing_file(self, data, params):
+        f = upload.ConvergentHashingFile(ReadCountingBytesIO(), len(data),
+                                         b"\x42" * 16, params)
+        f.write(data[:5])
+        f.write(data[5:])
+        return f
+
+    def test_get_encryption_key_precomputed(self):
+        """
+        When ``FileHandle`` reads from a ``ConvergentHashingFile`` written
+        with the same encoding parameters, it uses the key that file computed
+        instead of reading the data, and the key is the same.
+        """
+        params = {"k": 3, "happy": 5, "n": 10, "max_segment_size": 128 * 1024}
+        f = self._hashing_file(b"hello world", params)
+        handle = upload.FileHandle(f, b"\x42" * 16)
+        handle.set_default_encoding_parameters(params)
+        self.assertEqual(
+            b64encode(self.successResultOf(handle.get_encryption_key())),
+            b"oBcuR/wKdCgCV2GKKXqiNg==",
+        )
+        # it never read the data
+        self.assertEqual(f.reads, 0)
+
+    def test_get_encryption_key_other_parameters(self):
+        """
+        When the upload uses other encoding parameters than the
+        ``ConvergentHashingFile`` expected, ``FileHandle`` computes the key
+        itself.
+        """
+        f = self._hashing_file(b"hello world", {
+            "k": 2, "happy": 5, "n": 10, "max_segment_size": 128 * 1024})
+        handle = upload.FileHandle(f, b"\x42" * 16)
+        handle.set_default_encoding_parameters({
+            "k": 3, "happy": 5, "n": 10, "max_segment_size": 128 * 1024})
+        self.assertEqual(
+            b64encode(self.successResultOf(handle.get_encryption_key())),
+            b"oBcuR/wKdCgCV2GKKXqiNg==",
+        )
+
 
 class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
     ShouldFailMixin):
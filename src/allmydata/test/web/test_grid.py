@@ -9,6 +9,7 @@ from io import StringIO
 
 from bs4 import BeautifulSoup
 
+from twisted.internet import defer
 from twisted.web import resource
 from allmydata import uri, dirnode
 from allmydata.util import base32
@@ -1067,6 +1068,40 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
         return d
 
 
+    @defer.inlineCallbacks
+    def test_put_random_key_streamed(self):
+        """
+        A large ``PUT /uri?random-key=true`` is uploaded as it arrives, and
+        can be downloaded again.  Uploading the same data again gives a
+        different file, because the key is random.
+        """
+        self.basedir = "web/Grid/put_random_key_streamed"
+        self.set_up_grid(num_clients=1)
+        DATA = os.urandom(1024 * 1024 + 1000)
+        cap1 = yield self.PUT("uri?random-key=true", data=DATA)
+        cap2 = yield self.PUT("uri?random-key=true", data=DATA)
+        self.assertThat(cap1, Not(Equals(cap2)))
+        node = self.g.clients[0].create_node_from_uri(cap1)
+        self.assertThat(node.get_size(), Equals(len(DATA)))
+        data = yield self.GET("uri/" + url_quote(cap1))
+        self.assertThat(data, Equals(DATA))
+
+    @defer.inlineCallbacks
+    def test_put_convergent_large(self):
+        """
+        A large convergent ``PUT /uri`` has the key computed while its body is
+        spooled, and gets the same cap as the same data uploaded directly.
+        """
+        self.basedir = "web/Grid/put_convergent_large"
+        self.set_up_grid(num_clients=1)
+        c0 = self.g.clients[0]
+        DATA = os.urandom(1024 * 1024 + 1000)
+        cap = yield self.PUT("uri", data=DATA)
+        results = yield c0.upload(upload.Data(DATA, c0.convergence))
+        self.assertThat(cap, Equals(results.get_uri()))
+        data = yield self.GET("uri/" + url_quote(cap))
+        self.assertThat(data, Equals(DATA))
+
     def test_exceptions(self):
         self.basedir = "web/Grid/exceptions"
         self.set_up_grid(num_clients=1, num_servers=2)
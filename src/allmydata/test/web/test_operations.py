@@ -0,0 +1,173 @@
+"""
+Tests for ``allmydata.web.operations``.
+"""
+
+import os
+
+from twisted.internet.task import Clock
+from twisted.web.test.requesthelper import DummyRequest
+
+from testtools.matchers import (
+    Equals,
+    HasLength,
+)
+
+from allmydata.web import operations
+from allmydata.web.operations import (
+    DAY,
+    OphandleTable,
+    ResultSpool,
+)
+
+from ..common import (
+    SyncTestCase,
+)
+
+
+def start_request(ophandle):
+    req = DummyRequest(b"")
+    req.args = {b"ophandle": [ophandle]}
+    return req
+
+
+class ResultSpoolTests(SyncTestCase):
+    """
+    Tests for ``ResultSpool``.
+    """
+
+    def setUp(self):
+        super(ResultSpoolTests, self).setUp()
+        self.patch(ResultSpool, "INDEX_INTERVAL", 3)
+        self.path = self.mktemp()
+
+    def test_pages(self):
+        """
+        Items can be read back a page at a time, from anywhere in the spool,
+        while more are still being added.
+        """
+        spool = ResultSpool.create(self.path, {"operation": "test"})
+        for i in range(5):
+            spool.add([i])
+        self.assertThat(spool.items(1, 3), Equals([[1], [2], [3]]))
+        for i in range(5, 10):
+            spool.add([i])
+        self.assertThat(spool, HasLength(10))
+        self.assertThat(spool.items(4, 2), Equals([[4], [5]]))
+        self.assertThat(spool.items(8), Equals([[8], [9]]))
+        self.assertThat(spool.items(10), Equals([]))
+        self.assertThat(spool.items(), HasLength(10))
+        self.assertThat(spool.is_finished(), Equals(False))
+
+    def test_load(self):
+        """
+        A finished spool can be loaded again from its file.
+        """
+        spool = ResultSpool.create(self.path, {"operation": "test"})
+        for i in range(7):
+            spool.add({"i": i})
+        spool.finish({"count": 7})
+        spool.close()
+
+        spool = ResultSpool.load(self.path)
+        self.addCleanup(spool.close)
+        self.assertThat(spool.header, Equals({"operation": "test"}))
+        self.assertThat(spool.summary, Equals({"count": 7}))
+        self.assertThat(spool.is_finished(), Equals(True))
+        self.assertThat(spool.items(5), Equals([{"i": 5}, {"i": 6}]))
+
+    def test_load_cut_short(self):
+        """
+        A spool whose last line was not completely written is loaded as an
+        unfinished operation.
+        """
+        spool = ResultSpool.create(self.path, {"operation": "test"})
+        spool.add([1])
+        spool.finish({})
+        spool.close()
+        with open(self.path, "rb+") as f:
+            f.truncate(os.path.getsize(self.path) - 2)
+
+        spool = ResultSpool.load(self.path)
+        self.addCleanup(spool.close)
+        self.assertThat(spool.is_finished(), Equals(False))
+        self.assertThat(spool.items(), Equals([[1]]))
+
+    def test_in_memory(self):
+        """
+        A spool which has nowhere to go on disk works the same way.
+        """
+        spool = ResultSpool.in_memory({"operation": "test"})
+        spool.add([1])
+        spool.add([2])
+        spool.finish({})
+        self.assertThat(spool.items(1), Equals([[2]]))
+        spool.remove()
+        # results of a cancelled operation are thrown away
+        spool.add([3])
+
+
+class OphandleTableSpoolTests(SyncTestCase):
+    """
+    Tests for the spooled results of ``OphandleTable``.
+    """
+
+    def setUp(self):
+        super(OphandleTableSpoolTests, self).setUp()
+        self.spooldir = self.mktemp()
+        self.clock = Clock()
+
+    def _run(self):
+        table = OphandleTable(self.clock, self.spooldir)
+        table.startService()
+        finished = table.create_spool(start_request(b"done"), "test", None)
+        finished.add(["a"])
+        finished.finish({})
+        running = table.create_spool(start_request(b"running"), "test",
+                                     b"\x00" * 16)
+        running.add(["b"])
+        table.stopService()
+
+    def _restore(self):
+        table = OphandleTable(self.clock, self.spooldir)
+        table.restore(lambda spool: ("monitor", spool))
+        return table
+
+    def test_restore(self):
+        """
+        Finished results are served again after a restart, and unfinished
+        ones are thrown away.
+        """
+        self._run()
+        table = self._restore()
+        self.assertThat(list(table.handles), Equals([b"done"]))
+        (monitor, spool, when_added) = table.handles[b"done"]
+        self.assertThat(spool.items(), Equals([["a"]]))
+        self.assertThat(os.listdir(self.spooldir), HasLength(1))
+
+        # the restored handle expires like any other
+        self.clock.advance(OphandleTable.UNCOLLECTED_HANDLE_LIFETIME)
+        self.assertThat(table.handles, Equals({}))
+        self.assertThat(os.listdir(self.spooldir), Equals([]))
+
+    def test_restore_expired(self):
+        """
+        Results which were finished longer ago than an uncollected handle is
+        kept are thrown away rather than restored.
+        """
+        self._run()
+        now = operations.time.time()
+        self.patch(operations.time, "time", lambda: now + 5 * DAY)
+        table = self._restore()
+        self.assertThat(table.handles, Equals({}))
+        self.assertThat(os.listdir(self.spooldir), Equals([]))
+
+    def test_restore_unknown(self):
+        """
+        Results which the renderer factory does not know how to serve are
+        thrown away.
+        """
+        self._run()
+        table = OphandleTable(self.clock, self.spooldir)
+        table.restore(lambda spool: None)
+        self.assertThat(table.handles, Equals({}))
+        self.assertThat(os.listdir(self.spooldir), Equals([]))
@@ -0,0 +1,79 @@
+"""
+Tests for ``allmydata.web.tracing``.
+"""
+
+from testtools.matchers import (
+    Equals,
+)
+
+from allmydata.web.tracing import (
+    RequestTrace,
+    SlowRequests,
+)
+
+from ..common import (
+    SyncTestCase,
+)
+
+
+def finished_trace(uri, started, duration):
+    trace = RequestTrace(b"GET", uri, started)
+    trace.finished = started + duration
+    trace.code = 200
+    return trace
+
+
+class SlowRequestsTests(SyncTestCase):
+    """
+    Tests for ``SlowRequests``.
+    """
+
+    def test_keeps_slowest(self):
+        """
+        Only the slowest requests are kept, slowest first.
+        """
+        slow = SlowRequests(size=2)
+        for (i, duration) in enumerate([3, 1, 5, 2, 4]):
+            slow.add(finished_trace(b"/%d" % (i,), 100 + i, duration))
+        self.assertThat(
+            [t.uri for t in slow.get_slowest(now=110)],
+            Equals([b"/2", b"/4"]),
+        )
+
+    def test_window(self):
+        """
+        Requests which finished longer ago than the window are forgotten, so
+        that they make room for newer ones.
+        """
+        slow = SlowRequests(size=1, window=60)
+        slow.add(finished_trace(b"/old", 0, 10))
+        self.assertThat(len(slow.get_slowest(now=69)), Equals(1))
+        self.assertThat(slow.get_slowest(now=71), Equals([]))
+        slow.add(finished_trace(b"/new", 100, 1))
+        self.assertThat([t.uri for t in slow.get_slowest(now=101)],
+                        Equals([b"/new"]))
+
+    def test_chrome_trace(self):
+        """
+        The traces can be rendered as Chrome trace events, one thread per
+        request.
+        """
+        slow = SlowRequests(window=10**10)
+        trace = finished_trace(b"/uri/[CENSORED]", 1.0, 2.0)
+        span = trace.start_span("traverse", "Root.getChild")
+        span[2:] = [1.5, 2.0]
+        trace.wrote(2.5, 2.75, 100)
+        slow.add(trace)
+
+        events = slow.to_chrome_trace()["traceEvents"]
+        self.assertThat(
+            [(e["ph"], e["name"], e.get("ts"), e.get("dur")) for e in events],
+            Equals([("M", "thread_name", None, None),
+                    ("X", "GET /uri/[CENSORED]", 1000000, 2000000),
+                    ("X", "Root.getChild", 1500000, 500000),
+                    ("X", "write", 2500000, 250000)]),
+        )
+        self.assertThat(set(e["tid"] for e in events), Equals({0}))
+        self.assertThat(trace.get_phase_times(),
+                        Equals({"traverse": 0.5, "first-byte": 1.5,
+                                "write": 0.25}))
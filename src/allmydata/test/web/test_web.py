@@ -27,8 +27,10 @@ from allmydata.storage_client import StorageFarmBroker, StubServer
 from allmydata.immutable import upload
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.dirnode import DirectoryNode
+from allmydata.directory_batcher import DirectoryBatchers
 from allmydata.nodemaker import NodeMaker
 from allmydata.web.common import MultiFormatResource
+from allmydata.web.directory import ChildrenJSONProducer
 from allmydata.util import fileutil, base32, hashutil, jsonbytes as json
 from allmydata.util.consumer import download_to_data
 from allmydata.util.encodingutil import to_bytes
@@ -285,6 +287,7 @@ class FakeClient(_Client):  # type: ignore  # tahoe-lafs/ticket/3573
         self.stats_provider = FakeStatsProvider()
         self._secret_holder = SecretHolder(b"lease secret", b"convergence secret")
         self.helper = None
+        self.repair_scheduler = None
         self.convergence = b"some random string"
         self.storage_broker = StorageFarmBroker(
             permute_peers=True,
@@ -310,6 +313,7 @@ class FakeClient(_Client):  # type: ignore  # tahoe-lafs/ticket/3573
                                        self.uploader, None,
                                        None, None, None)
         self.nodemaker.all_contents = self.all_contents
+        self.directory_batchers = DirectoryBatchers()
         self.mutable_file_default = SDMF_VERSION
         self.addService(FakeStorageServer(self.nodeid, self.nickname))
 
@@ -1010,6 +1014,13 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_check)
         return d
 
+    @defer.inlineCallbacks
+    def test_repair_status_disabled(self):
+        res = yield self.GET("/repair_status")
+        self.failUnlessIn(b"No repair service is running", res)
+        res = yield self.GET("/repair_status?t=json")
+        self.assertEqual(json.loads(res), {})
+
     def test_status(self):
         h = self.s.get_history()
         dl_num = h.list_all_download_statuses()[0].get_counter()
@@ -1096,6 +1107,35 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
                                 self.GET,
                                 "/status/nodash")
 
+    @inlineCallbacks
+    def test_status_slow_requests(self):
+        """
+        ``/status/slow-requests`` lists the recent requests with the time
+        each spent looking up its target and rendering, in HTML, JSON or
+        Chrome trace format.
+        """
+        yield self.GET(self.public_url + "/foo/bar.txt")
+        res = yield self.GET("/status/slow-requests?t=json")
+        traces = json.loads(res)
+        [trace] = [t for t in traces if t["uri"] == "/uri/[CENSORED]"]
+        self.assertEqual(trace["method"], "GET")
+        self.assertEqual(trace["code"], 200)
+        self.assertEqual(trace["bytes-written"], len(self.BAR_CONTENTS))
+        self.assertIn("traverse", trace["phases"])
+        self.assertIn("render", trace["phases"])
+        self.assertIn("DirectoryNodeHandler.getChild",
+                      [span["name"] for span in trace["spans"]])
+
+        res = yield self.GET("/status/slow-requests?t=trace")
+        events = json.loads(res)["traceEvents"]
+        self.assertIn("GET /uri/[CENSORED]",
+                      [e["args"]["name"] for e in events if e["ph"] == "M"])
+
+        res = yield self.GET("/status/slow-requests")
+        soup = BeautifulSoup(res, 'html5lib')
+        assert_soup_has_text(self, soup, "Slowest Recent Web Requests")
+        assert_soup_has_text(self, soup, "GET /uri/[CENSORED]")
+
     def test_status_page_contains_links(self):
         """
         Check that the rendered `/status` page contains all the
@@ -2174,6 +2214,93 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got_json)
         return d
 
+    @inlineCallbacks
+    def test_GET_DIRURL_json_paginated(self):
+        """
+        ``limit=`` lists at most that many children, in order of name, and
+        ``next-after`` tells where the next page starts.
+        """
+        res = yield self.GET(self.public_url + "/foo?t=json&limit=3")
+        data = json.loads(res)[1]
+        self.assertEqual(sorted(data["children"]),
+                         [self._htmlname_unicode, u"bar.txt", u"baz.txt"])
+        self.assertEqual(data["next-after"], u"baz.txt")
+
+        res = yield self.GET(self.public_url +
+                             "/foo?t=json&limit=3&after=baz.txt")
+        data = json.loads(res)[1]
+        self.assertEqual(sorted(data["children"]),
+                         [u"blockingfile", u"empty", u"n\u00fc.txt"])
+        self.assertEqual(data["next-after"], u"n\u00fc.txt")
+
+        res = yield self.GET(self.public_url +
+                             "/foo?t=json&limit=3&after=n%C3%BC.txt")
+        data = json.loads(res)[1]
+        self.assertEqual(sorted(data["children"]), [u"quux.txt", u"sub"])
+        self.assertNotIn("next-after", data)
+
+        res = yield self.GET(self.public_url + "/foo?t=json&offset=6")
+        data = json.loads(res)[1]
+        self.assertEqual(sorted(data["children"]), [u"quux.txt", u"sub"])
+
+    def test_GET_DIRURL_json_bad_limit(self):
+        return self.shouldFail2(error.Error, "test_GET_DIRURL_json_bad_limit",
+                                "400 Bad Request",
+                                "limit= must be a non-negative integer",
+                                self.GET, self.public_url + "/foo?t=json&limit=-1")
+
+    @inlineCallbacks
+    def test_GET_DIRURL_stream_json(self):
+        """
+        ``t=stream-json`` gives the directory itself on the first line and
+        then each child on a line of its own, with the same information as
+        ``t=json``.
+        """
+        self.patch(ChildrenJSONProducer, "BATCH_SIZE", 3)
+        res = yield self.GET(self.public_url + "/foo?t=json")
+        expected = json.loads(res)
+        res = yield self.GET(self.public_url + "/foo?t=stream-json")
+        lines = [json.loads(line) for line in res.splitlines()]
+        (nodetype, data) = lines[0]
+        self.assertEqual(nodetype, "dirnode")
+        data["children"] = {line["name"]: line["node"] for line in lines[1:]}
+        self.assertEqual([nodetype, data], expected)
+        self.assertEqual([line["name"] for line in lines[1:]],
+                         sorted(expected[1]["children"]))
+
+    @inlineCallbacks
+    def test_GET_DIRURL_stream_json_paginated(self):
+        res = yield self.GET(self.public_url + "/foo?t=stream-json&offset=1&limit=2")
+        lines = [json.loads(line) for line in res.splitlines()]
+        self.assertEqual(lines[0][1]["next-after"], u"baz.txt")
+        self.assertEqual([line["name"] for line in lines[1:]],
+                         [u"bar.txt", u"baz.txt"])
+
+    def test_stream_json_stop_producing(self):
+        """
+        If the connection goes away part way through a ``t=stream-json``
+        response, the producer unregisters itself and its ``Deferred``
+        fires, instead of waiting forever.
+        """
+        class Request(object):
+            channel = object()
+            producer = None
+            def registerProducer(self, producer, streaming):
+                self.producer = producer
+            def unregisterProducer(self):
+                self.producer = None
+            def write(self, data):
+                pass
+
+        self.patch(ChildrenJSONProducer, "BATCH_SIZE", 1)
+        req = Request()
+        producer = ChildrenJSONProducer(req, [u"a", u"b"], {})
+        d = producer.start()
+        self.assertIs(req.producer, producer)
+        producer.stopProducing()
+        self.assertIs(req.producer, None)
+        self.failureResultOf(d, defer.CancelledError)
+
 
     def test_POST_DIRURL_manifest_no_ophandle(self):
         d = self.shouldFail2(error.Error,
@@ -2229,6 +2356,45 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got_json)
         return d
 
+    @inlineCallbacks
+    def test_POST_DIRURL_manifest_paginated(self):
+        """
+        The results of a manifest operation can be fetched a page at a time
+        with offset= and limit=.
+        """
+        url = self.webish_url + self.public_url + "/foo?t=start-manifest&ophandle=126"
+        yield do_http("post", url, allow_redirects=True,
+                      browser_like_redirects=True)
+        yield self.wait_for_operation(None, "126")
+        everything = yield self.get_operation_results(None, "126", "JSON")
+        self.assertNotIn("next-offset", everything)
+
+        manifest = []
+        verifycaps = []
+        offset = 0
+        while offset is not None:
+            res = yield self.GET("/operations/126?output=JSON&limit=2&offset=%d"
+                                 % (offset,))
+            page = json.loads(res)
+            self.assertTrue(len(page["manifest"]) <= 2)
+            manifest.extend(page["manifest"])
+            verifycaps.extend(page["verifycaps"])
+            offset = page.get("next-offset")
+        self.assertEqual(manifest, everything["manifest"])
+        self.assertEqual(verifycaps, everything["verifycaps"])
+
+        text = yield self.GET("/operations/126?output=text&limit=1&offset=1")
+        self.assertEqual(text.splitlines()[1:],
+                         [b"next-offset: 2",
+                          b"/".join(p.encode("utf-8") for p in manifest[1][0])
+                          + b" " + manifest[1][1].encode("ascii")])
+
+        yield self.shouldFail2(error.Error,
+                               "test_POST_DIRURL_manifest_paginated",
+                               "400 Bad Request",
+                               "limit= must be a non-negative integer",
+                               self.GET, "/operations/126?output=JSON&limit=x")
+
     def test_POST_DIRURL_deepsize_no_ophandle(self):
         d = self.shouldFail2(error.Error,
                              "test_POST_DIRURL_deepsize_no_ophandle",
@@ -3886,6 +4052,49 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
     def test_POST_set_children_with_hyphen(self):
         return self.test_POST_set_children(command_name="set-children")
 
+    @inlineCallbacks
+    def test_POST_batch(self):
+        """
+        t=batch queues additions and removals of children, and reports the
+        ones which failed once they have been made, including those queued
+        earlier with wait=false.
+        """
+        contents, n, newuri = self.makefile(9)
+        url = self.webish_url + self.public_url + "/foo?t=batch"
+
+        body = json.dumps_bytes({
+            "set": {"new1.txt": ["filenode", {"rw_uri": newuri}]},
+            "unlink": ["missing"],
+        })
+        res = yield do_http("post", url + "&wait=false", data=body)
+        self.failUnlessEqual(json.loads(res), {"queued": 2})
+
+        body = json.dumps_bytes({
+            "set": {"bar.txt": ["filenode", {"rw_uri": newuri}],
+                    "new2.txt": ["filenode", {"rw_uri": newuri}]},
+            "unlink": ["baz.txt"],
+        })
+        res = yield do_http("post", url + "&replace=false", data=body)
+        failures = json.loads(res)["failures"]
+        self.failUnlessEqual(sorted((f["op"], f["name"]) for f in failures),
+                             [("set", "bar.txt"), ("unlink", "missing")])
+        self.failUnlessURIMatchesROChild(newuri, self._foo_node, u"new1.txt")
+        self.failUnlessURIMatchesROChild(newuri, self._foo_node, u"new2.txt")
+        self.failUnlessURIMatchesROChild(self._bar_txt_uri, self._foo_node,
+                                         u"bar.txt")
+        yield self.failIfNodeHasChild(self._foo_node, u"baz.txt")
+
+        # with nothing queued, an empty request has nothing to report
+        res = yield do_http("post", url, data=b"")
+        self.failUnlessEqual(json.loads(res), {"failures": []})
+
+    def test_POST_batch_readonly(self):
+        d = self.shouldFail2(error.Error, "POST_batch_readonly",
+                             "403 Forbidden",
+                             "read-only",
+                             self.POST, "/uri/%s?t=batch" % str(self._foo_readonly_uri, "ascii"))
+        return d
+
     def test_POST_link_uri(self):
         contents, n, newuri = self.makefile(8)
         d = self.POST(self.public_url + "/foo", t="uri", name="new.txt", uri=newuri)
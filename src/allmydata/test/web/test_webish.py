@@ -27,6 +27,12 @@ from testtools.matchers import (
     HasLength,
 )
 
+from twisted.internet.testing import (
+    StringTransport,
+)
+from twisted.python.failure import (
+    Failure,
+)
 from twisted.python.filepath import (
     FilePath,
 )
@@ -36,12 +42,26 @@ from twisted.web.test.requesthelper import (
 from twisted.web.resource import (
     Resource,
 )
+from twisted.web.server import (
+    NOT_DONE_YET,
+)
 
 from ..common import (
     SyncTestCase,
 )
 
+from ...immutable.upload import (
+    ConvergentHashingFile,
+)
+from ...web.common import (
+    exception_to_child,
+    render_exception,
+)
+from ...web.tracing import (
+    SlowRequests,
+)
 from ...webish import (
+    StreamingRequestBody,
     TahoeLAFSRequest,
     TahoeLAFSSite,
     anonymous_tempfile_factory,
@@ -315,6 +335,187 @@ class TahoeLAFSSiteTests(SyncTestCase):
         self._large_request_test(request_body_size)
 
 
+class FakeProducer:
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class StreamingRequestBodyTests(SyncTestCase):
+    """
+    Tests for ``StreamingRequestBody``.
+    """
+    def test_reads_wait_for_data(self):
+        """
+        A read fires once enough of the body has arrived, with exactly the
+        bytes asked for, or with what is left at the end of the body.
+        """
+        body = StreamingRequestBody(10, FakeProducer())
+        results = []
+        body.read(4).addCallback(results.append)
+        body.write(b"ab")
+        self.assertThat(results, Equals([]))
+        body.write(b"cdef")
+        self.assertThat(results, Equals([[b"ab", b"cd"]]))
+        body.write(b"ghij")
+        body.read(100).addCallback(results.append)
+        self.assertThat(results[1], Equals([b"ef", b"ghij"]))
+        body.read(100).addCallback(results.append)
+        self.assertThat(results[2], Equals([]))
+
+    def test_flow_control(self):
+        """
+        The producer is paused while too much of the body is waiting to be
+        read, and resumed once the reader has caught up.
+        """
+        producer = FakeProducer()
+        body = StreamingRequestBody(100, producer)
+        body.HIGH_WATER = 10
+        body.write(b"x" * 8)
+        self.assertThat(producer.paused, Equals(False))
+        body.write(b"x" * 8)
+        self.assertThat(producer.paused, Equals(True))
+        body.read(4)
+        self.assertThat(producer.paused, Equals(True))
+        body.read(8)
+        self.assertThat(producer.paused, Equals(False))
+
+    def test_discard(self):
+        """
+        Once discarded, the body is thrown away as it arrives and the
+        producer is never paused.
+        """
+        producer = FakeProducer()
+        body = StreamingRequestBody(100, producer)
+        body.HIGH_WATER = 10
+        body.write(b"x" * 20)
+        body.discard()
+        self.assertThat(producer.paused, Equals(False))
+        body.write(b"x" * 20)
+        self.assertThat(producer.paused, Equals(False))
+
+    def test_abort(self):
+        """
+        Reads waiting for a body which will never arrive fail.
+        """
+        body = StreamingRequestBody(100, FakeProducer())
+        failures = []
+        body.read(10).addErrback(failures.append)
+        body.abort(Failure(ValueError("gone")))
+        self.assertThat(failures, HasLength(1))
+
+
+class UploadResource(Resource):
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+
+    def render_PUT(self, request):
+        self.requests.append(request)
+        return NOT_DONE_YET
+
+
+class FakeClient:
+    convergence = b"\x42" * 16
+
+    def get_encoding_parameters(self):
+        return {"k": 3, "happy": 7, "n": 10, "max_segment_size": 128 * 1024}
+
+
+class StreamingUploadTests(SyncTestCase):
+    """
+    Tests for the way ``TahoeLAFSRequest`` streams large random-key uploads.
+    """
+    def setUp(self):
+        super(StreamingUploadTests, self).setUp()
+        tempdir = FilePath(self.mktemp())
+        tempdir.makedirs()
+        root = Resource()
+        self.upload = UploadResource()
+        root.putChild(b"uri", self.upload)
+        site = TahoeLAFSSite(
+            anonymous_tempfile_factory(tempdir.path),
+            root,
+            logPath=self.mktemp(),
+            timeout=None,
+            client=FakeClient(),
+        )
+        self.transport = StringTransport()
+        self.channel = site.buildProtocol(None)
+        self.channel.makeConnection(self.transport)
+        self.addCleanup(self.channel.connectionLost, Failure(Exception()))
+
+    def _headers(self, query, length):
+        self.channel.dataReceived(
+            b"PUT /uri?%s HTTP/1.1\r\n"
+            b"Host: example.invalid\r\n"
+            b"Content-Length: %d\r\n\r\n" % (query, length))
+
+    def test_processed_before_body(self):
+        """
+        A large ``PUT /uri?random-key=true`` is processed as soon as its
+        headers arrive, with its body readable as it arrives.
+        """
+        size = 2 * 1024 * 1024
+        self._headers(b"random-key=true", size)
+        [request] = self.upload.requests
+        self.assertThat(request.content, IsInstance(StreamingRequestBody))
+        results = []
+        request.content.read(size).addCallback(results.append)
+        self.channel.dataReceived(b"x" * (size - 1))
+        self.assertThat(results, Equals([]))
+        self.channel.dataReceived(b"y")
+        self.assertThat(b"".join(results[0]), Equals(b"x" * (size - 1) + b"y"))
+        request.write(b"URI:CHK:...")
+        request.finish()
+        self.assertThat(self.transport.value(), Contains(b"200 OK"))
+
+    def test_response_waits_for_body(self):
+        """
+        If the response is finished before the whole body has arrived, the
+        rest of the body is discarded and the request finished once it has
+        all arrived.
+        """
+        size = 2 * 1024 * 1024
+        self._headers(b"random-key=true", size)
+        [request] = self.upload.requests
+        self.channel.dataReceived(b"x" * 1024)
+        request.setResponseCode(500)
+        request.finish()
+        self.assertThat(self.transport.value(), Not(Contains(b"500")))
+        self.channel.dataReceived(b"x" * (size - 1024))
+        self.assertThat(self.transport.value(), Contains(b"500"))
+
+    def test_convergent_hashed(self):
+        """
+        The body of a large convergent upload is spooled to a file which
+        computes its encryption key as it is written.
+        """
+        size = 2 * 1024 * 1024
+        self._headers(b"format=CHK", size)
+        self.channel.dataReceived(b"x" * size)
+        [request] = self.upload.requests
+        self.assertThat(request.content, IsInstance(ConvergentHashingFile))
+
+    def test_convergent_not_streamed(self):
+        """
+        Uploads which are not random-key are processed only once the whole
+        body has arrived.
+        """
+        size = 2 * 1024 * 1024
+        self._headers(b"format=CHK", size)
+        self.assertThat(self.upload.requests, Equals([]))
+        self.channel.dataReceived(b"x" * size)
+        [request] = self.upload.requests
+        self.assertThat(request.content, Not(IsInstance(StreamingRequestBody)))
+
+
 def param(name, value):
     return u"; {}={}".format(name, value)
 
@@ -323,6 +524,89 @@ def body(value):
     return u"\r\n\r\n{}".format(value)
 
 
+class TracedChildren(Resource):
+    @exception_to_child
+    def getChild(self, name, request):
+        if name == b"hang":
+            return HangingResource()
+        return HelloResource()
+
+
+class HelloResource(Resource):
+    isLeaf = True
+
+    @render_exception
+    def render_GET(self, request):
+        return b"hello"
+
+
+class HangingResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        return NOT_DONE_YET
+
+
+class RequestTraceTests(SyncTestCase):
+    """
+    Tests for the traces ``TahoeLAFSRequest`` keeps of its timings.
+    """
+    def setUp(self):
+        super(RequestTraceTests, self).setUp()
+        tempdir = FilePath(self.mktemp())
+        tempdir.makedirs()
+        root = Resource()
+        root.putChild(b"uri", TracedChildren())
+        self.slow_requests = SlowRequests()
+        site = TahoeLAFSSite(
+            anonymous_tempfile_factory(tempdir.path),
+            root,
+            logPath=self.mktemp(),
+            timeout=None,
+            slow_requests=self.slow_requests,
+        )
+        self.transport = StringTransport()
+        self.channel = site.buildProtocol(None)
+        self.channel.makeConnection(self.transport)
+
+    def _get(self, path):
+        self.channel.dataReceived(
+            b"GET %s HTTP/1.1\r\nHost: example.invalid\r\n\r\n" % (path,))
+
+    def test_finished(self):
+        """
+        A finished request's trace has the time spent in each phase of its
+        processing, and its URI with the capability censored.
+        """
+        self._get(b"/uri/URI:CHK:aaa:bbb/hello?t=json")
+        self.channel.connectionLost(Failure(Exception()))
+        [trace] = self.slow_requests.get_slowest()
+        self.assertThat(trace.uri, Equals(b"/uri/[CENSORED]?t=json"))
+        self.assertThat(trace.code, Equals(200))
+        self.assertThat(
+            [(phase, name) for (phase, name, start, end) in trace.spans],
+            Equals([("traverse", "TracedChildren.getChild"),
+                    ("render", "HelloResource.render_GET")]),
+        )
+        self.assertThat(
+            sorted(trace.get_phase_times()),
+            Equals(["first-byte", "render", "traverse", "write"]),
+        )
+        self.assertThat(trace.bytes_written, Equals(len(b"hello")))
+
+    def test_connection_lost(self):
+        """
+        A request whose connection is lost before it is finished is traced
+        without a response code.
+        """
+        self._get(b"/uri/hang")
+        self.assertThat(self.slow_requests.get_slowest(), Equals([]))
+        self.channel.connectionLost(Failure(Exception()))
+        [trace] = self.slow_requests.get_slowest()
+        self.assertThat(trace.code, Equals(None))
+        self.assertThat(sorted(trace.get_phase_times()), Equals(["traverse"]))
+
+
 def _field(field):
     yield u"Content-Disposition: form-data"
     for param in field:
@@ -6,8 +6,7 @@ Ported to Python 3.
 """
 
 from copy import deepcopy
-from allmydata.immutable.happiness_upload import residual_network
-from allmydata.immutable.happiness_upload import augmenting_path_for
+from allmydata.immutable.happiness_upload import ShareMatching
 
 
 def failure_message(peer_count, k, happy, effective_happy):
@@ -132,109 +131,4 @@ def servers_of_happiness(sharemap):
     """
     if sharemap == {}:
         return 0
-    servermap = shares_by_server(sharemap)
-    graph = _flow_network_for(servermap)
-
-    # XXX this core stuff is identical to
-    # happiness_upload._compute_maximum_graph and we should find a way
-    # to share the code.
-
-    # This is an implementation of the Ford-Fulkerson method for finding
-    # a maximum flow in a flow network applied to a bipartite graph.
-    # Specifically, it is the Edmonds-Karp algorithm, since it uses a
-    # BFS to find the shortest augmenting path at each iteration, if one
-    # exists.
-    #
-    # The implementation here is an adapation of an algorithm described in
-    # "Introduction to Algorithms", Cormen et al, 2nd ed., pp 658-662.
-    dim = len(graph)
-    flow_function = [[0 for sh in range(dim)] for s in range(dim)]
-    residual_graph, residual_function = residual_network(graph, flow_function)
-    while augmenting_path_for(residual_graph):
-        path = augmenting_path_for(residual_graph)
-        # Delta is the largest amount that we can increase flow across
-        # all of the edges in path. Because of the way that the residual
-        # function is constructed, f[u][v] for a particular edge (u, v)
-        # is the amount of unused capacity on that edge. Taking the
-        # minimum of a list of those values for each edge in the
-        # augmenting path gives us our delta.
-        delta = min(residual_function[u][v] for (u, v) in path)
-        for (u, v) in path:
-            flow_function[u][v] += delta
-            flow_function[v][u] -= delta
-        residual_graph, residual_function = residual_network(graph,
-                                                             flow_function)
-    num_servers = len(servermap)
-    # The value of a flow is the total flow out of the source vertex
-    # (vertex 0, in our graph). We could just as well sum across all of
-    # f[0], but we know that vertex 0 only has edges to the servers in
-    # our graph, so we can stop after summing flow across those. The
-    # value of a flow computed in this way is the size of a maximum
-    # matching on the bipartite graph described above.
-    return sum([flow_function[0][v] for v in range(1, num_servers+1)])
-
-def _flow_network_for(servermap):
-    """
-    I take my argument, a dict of peerid -> set(shareid) mappings, and
-    turn it into a flow network suitable for use with Edmonds-Karp. I
-    then return the adjacency list representation of that network.
-
-    Specifically, I build G = (V, E), where:
-      V = { peerid in servermap } U { shareid in servermap } U {s, t}
-      E = {(s, peerid) for each peerid}
-          U {(peerid, shareid) if peerid is to store shareid }
-          U {(shareid, t) for each shareid}
-
-    s and t will be source and sink nodes when my caller starts treating
-    the graph I return like a flow network. Without s and t, the
-    returned graph is bipartite.
-    """
-    # Servers don't have integral identifiers, and we can't make any
-    # assumptions about the way shares are indexed -- it's possible that
-    # there are missing shares, for example. So before making a graph,
-    # we re-index so that all of our vertices have integral indices, and
-    # that there aren't any holes. We start indexing at 1, so that we
-    # can add a source node at index 0.
-    servermap, num_shares = _reindex(servermap, base_index=1)
-    num_servers = len(servermap)
-    graph = [] # index -> [index], an adjacency list
-    # Add an entry at the top (index 0) that has an edge to every server
-    # in servermap
-    graph.append(list(servermap.keys()))
-    # For each server, add an entry that has an edge to every share that it
-    # contains (or will contain).
-    for k in servermap:
-        graph.append(servermap[k])
-    # For each share, add an entry that has an edge to the sink.
-    sink_num = num_servers + num_shares + 1
-    for i in range(num_shares):
-        graph.append([sink_num])
-    # Add an empty entry for the sink, which has no outbound edges.
-    graph.append([])
-    return graph
-
-
-# XXX warning: this is different from happiness_upload's _reindex!
-def _reindex(servermap, base_index):
-    """
-    Given servermap, I map peerids and shareids to integers that don't
-    conflict with each other, so they're useful as indices in a graph. I
-    return a servermap that is reindexed appropriately, and also the
-    number of distinct shares in the resulting servermap as a convenience
-    for my caller. base_index tells me where to start indexing.
-    """
-    shares  = {} # shareid  -> vertex index
-    num = base_index
-    ret = {} # peerid -> [shareid], a reindexed servermap.
-    # Number the servers first
-    for k in servermap:
-        ret[num] = servermap[k]
-        num += 1
-    # Number the shares
-    for k in ret:
-        for shnum in ret[k]:
-            if shnum not in shares:
-                shares[shnum] = num
-                num += 1
-        ret[k] = [shares[x] for x in ret[k]]
-    return (ret, len(shares))
+    return ShareMatching.from_servermap(shares_by_server(sharemap)).size()
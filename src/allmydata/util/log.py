@@ -4,6 +4,8 @@ Logging utilities.
 Ported to Python 3.
 """
 
+from typing import Optional
+
 from six import ensure_str
 
 from pyutil import nummedobj
@@ -27,7 +29,92 @@ SCARY = log.SCARY # 35
 BAD = log.BAD # 40
 
 
+LEVELS = {
+    "NOISY": NOISY,
+    "OPERATIONAL": OPERATIONAL,
+    "UNUSUAL": UNUSUAL,
+    "INFREQUENT": INFREQUENT,
+    "CURIOUS": CURIOUS,
+    "WEIRD": WEIRD,
+    "SCARY": SCARY,
+    "BAD": BAD,
+}
+
+# Thresholds set with set_threshold(), by facility (None for the default).
+# A threshold applies to its facility and to every facility below it: one
+# for "tahoe.immutable" also covers "tahoe.immutable.download".
+_thresholds: dict[Optional[str], int] = {}
+# The effective threshold of each facility asked about so far.
+_effective_thresholds: dict[Optional[str], int] = {}
+
+
+def parse_level(level):
+    """
+    Convert a level name like ``NOISY`` (or a number) to a numeric level.
+
+    :raise ValueError: If the level is not recognized.
+    """
+    try:
+        return LEVELS[level.upper()]
+    except KeyError:
+        pass
+    try:
+        return int(level)
+    except ValueError:
+        raise ValueError("unknown log level %r" % (level,))
+
+
+def set_threshold(level, facility=None):
+    """
+    Do not generate log events below ``level`` for ``facility`` or any of the
+    facilities below it. A ``facility`` of ``None`` sets the default.
+    """
+    _thresholds[facility] = level
+    _effective_thresholds.clear()
+    log.set_generation_threshold(level, facility)
+
+
+def reset_thresholds():
+    """
+    Forget all thresholds set with ``set_threshold``.
+    """
+    for facility in _thresholds:
+        log.theLogger.thresholds.pop(facility, None)
+    _thresholds.clear()
+    _effective_thresholds.clear()
+
+
+def get_threshold(facility=None):
+    """
+    :return: The lowest level at which log events for ``facility`` are
+        generated.
+    """
+    if not _thresholds:
+        return log.get_generation_threshold(facility)
+    try:
+        return _effective_thresholds[facility]
+    except KeyError:
+        pass
+    f = facility
+    while f and f not in _thresholds:
+        f = f.rpartition(".")[0]
+    threshold = _thresholds.get(f or None, log.get_generation_threshold(None))
+    _effective_thresholds[facility] = threshold
+    return threshold
+
+
+def is_enabled(level, facility=None):
+    """
+    :return: True if a log event at ``level`` for ``facility`` would be
+        generated. Hot code paths can use this to avoid computing the
+        arguments of a message nobody will see.
+    """
+    return level >= get_threshold(facility)
+
+
 def msg(*args, **kwargs):
+    if kwargs.get("level", OPERATIONAL) < get_threshold(kwargs.get("facility")):
+        return None
     return log.msg(*args, **bytes_to_unicode(True, kwargs))
 
 # If log.err() happens during a unit test, the unit test should fail. We
@@ -56,6 +143,8 @@ class LogMixin:
             pmsgid = self._parentmsgid
             if pmsgid is None:
                 pmsgid = self._grandparentmsgid
+        if kwargs.get("level", OPERATIONAL) < get_threshold(facility):
+            return None
         kwargs = {ensure_str(k): v for (k, v) in kwargs.items()}
         msgid = log.msg(msg, facility=facility, parent=pmsgid, *args,
                         **bytes_to_unicode(True, kwargs))
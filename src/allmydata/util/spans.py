@@ -1,3 +1,4 @@
+import bisect
 
 
 class Spans:
@@ -14,6 +15,8 @@ class Spans:
 
     Rather than storing an actual (large) list or dictionary, I represent my
     internal state as a sorted list of spans, each with a start and a length.
+    I find the spans affected by an operation by bisecting this list, and I
+    keep track of the total length as I go, so that len() is cheap.
     My API is presented in terms of start+length pairs. I provide set
     arithmetic operators, to efficiently answer questions like 'I want bytes
     XYZ, I already requested bytes ABC, and I've already received bytes DEF:
@@ -25,8 +28,13 @@ class Spans:
 
     def __init__(self, _span_or_start=None, length=None):
         self._spans = list()
+        self._len = 0
         if length is not None:
             self._spans.append( (_span_or_start, length) )
+            self._len = length
+        elif isinstance(_span_or_start, Spans):
+            self._spans = list(_span_or_start._spans)
+            self._len = _span_or_start._len
         elif _span_or_start:
             for (start,length) in _span_or_start:
                 self.add(start, length)
@@ -40,104 +48,67 @@ class Spans:
                 if prev_end is not None:
                     assert start > prev_end
                 prev_end = start+length
+            assert self._len == sum([length for start,length in self._spans])
         except AssertionError:
             print("BAD:", self.dump())
             raise
 
+    def _find(self, start, end):
+        """Return (first, last) such that self._spans[first:last] are the
+        spans which overlap [start, end), or touch it if end > start."""
+        spans = self._spans
+        # the last span that starts before 'start' is the only one before
+        # position 'first' that can reach it
+        first = bisect.bisect_left(spans, (start,))
+        if first > 0 and spans[first-1][0] + spans[first-1][1] >= start:
+            first -= 1
+        last = first
+        while last < len(spans) and spans[last][0] <= end:
+            last += 1
+        return first, last
+
     def add(self, start, length):
         assert start >= 0
         assert length > 0
-        #print(" ADD [%d+%d -%d) to %s" % (start, length, start+length, self.dump()))
-        first_overlap = last_overlap = None
-        for i,(s_start,s_length) in enumerate(self._spans):
-            #print("  (%d+%d)-> overlap=%s adjacent=%s" % (s_start,s_length, overlap(s_start, s_length, start, length), adjacent(s_start, s_length, start, length)))
-            if (overlap(s_start, s_length, start, length)
-                or adjacent(s_start, s_length, start, length)):
-                last_overlap = i
-                if first_overlap is None:
-                    first_overlap = i
-                continue
-            # no overlap
-            if first_overlap is not None:
-                break
-        #print("  first_overlap", first_overlap, last_overlap)
-        if first_overlap is None:
-            # no overlap, so just insert the span and sort by starting
-            # position.
-            self._spans.insert(0, (start,length))
-            self._spans.sort()
+        end = start + length
+        first, last = self._find(start, end)
+        if first == last:
+            # no overlap, so just insert the span
+            self._spans.insert(first, (start, length))
+            self._len += length
         else:
-            # everything from [first_overlap] to [last_overlap] overlapped
-            first_start,first_length = self._spans[first_overlap]
-            last_start,last_length = self._spans[last_overlap]
+            # everything from [first] to [last-1] overlapped or was adjacent
+            first_start,first_length = self._spans[first]
+            last_start,last_length = self._spans[last-1]
             newspan_start = min(start, first_start)
-            newspan_end = max(start+length, last_start+last_length)
+            newspan_end = max(end, last_start+last_length)
             newspan_length = newspan_end - newspan_start
-            newspan = (newspan_start, newspan_length)
-            self._spans[first_overlap:last_overlap+1] = [newspan]
-        #print("  ADD done: %s" % self.dump())
-        self._check()
-
+            self._len += newspan_length - sum([l for (s,l) in self._spans[first:last]])
+            self._spans[first:last] = [(newspan_start, newspan_length)]
         return self
 
     def remove(self, start, length):
         assert start >= 0
         assert length > 0
-        #print(" REMOVE [%d+%d -%d) from %s" % (start, length, start+length, self.dump()))
-        first_complete_overlap = last_complete_overlap = None
-        for i,(s_start,s_length) in enumerate(self._spans):
-            s_end = s_start + s_length
-            o = overlap(s_start, s_length, start, length)
-            if o:
-                o_start, o_length = o
-                o_end = o_start+o_length
-                if o_start == s_start and o_end == s_end:
-                    # delete this span altogether
-                    if first_complete_overlap is None:
-                        first_complete_overlap = i
-                    last_complete_overlap = i
-                elif o_start == s_start:
-                    # we only overlap the left side, so trim the start
-                    #    1111
-                    #  rrrr
-                    #    oo
-                    # ->   11
-                    new_start = o_end
-                    new_end = s_end
-                    assert new_start > s_start
-                    new_length = new_end - new_start
-                    self._spans[i] = (new_start, new_length)
-                elif o_end == s_end:
-                    # we only overlap the right side
-                    #    1111
-                    #      rrrr
-                    #      oo
-                    # -> 11
-                    new_start = s_start
-                    new_end = o_start
-                    assert new_end < s_end
-                    new_length = new_end - new_start
-                    self._spans[i] = (new_start, new_length)
-                else:
-                    # we overlap the middle, so create a new span. No need to
-                    # examine any other spans.
-                    #    111111
-                    #      rr
-                    #    LL  RR
-                    left_start = s_start
-                    left_end = o_start
-                    left_length = left_end - left_start
-                    right_start = o_end
-                    right_end = s_end
-                    right_length = right_end - right_start
-                    self._spans[i] = (left_start, left_length)
-                    self._spans.append( (right_start, right_length) )
-                    self._spans.sort()
-                    break
-        if first_complete_overlap is not None:
-            del self._spans[first_complete_overlap:last_complete_overlap+1]
-        #print("  REMOVE done: %s" % self.dump())
-        self._check()
+        end = start + length
+        first, last = self._find(start, end)
+        # _find includes spans which merely touch the removed region, which
+        # the trimming below leaves unchanged
+        new = []
+        if first < last:
+            first_start,first_length = self._spans[first]
+            if first_start < start:
+                # keep the part to the left of the removed region
+                new.append( (first_start, min(first_length, start-first_start)) )
+            last_start,last_length = self._spans[last-1]
+            last_end = last_start + last_length
+            if last_end > end:
+                # keep the part to the right of the removed region
+                new_start = max(end, last_start)
+                new.append( (new_start, last_end-new_start) )
+            self._len -= (sum([l for (s,l) in self._spans[first:last]])
+                          - sum([l for (s,l) in new]))
+            self._spans[first:last] = new
         return self
 
     def dump(self):
@@ -162,7 +133,7 @@ class Spans:
     def len(self):
         # guess what! python doesn't allow __len__ to return a long, only an
         # int. So we stop using len(spans), use spans.len() instead.
-        return sum([length for start,length in self._spans])
+        return self._len
 
     def __add__(self, other):
         s = self.__class__(self)
@@ -187,22 +158,35 @@ class Spans:
         return self
 
     def __and__(self, other):
-        if not self._spans:
-            return self.__class__()
-        bounds = self.__class__(self._spans[0][0],
-                                self._spans[-1][0]+self._spans[-1][1])
-        not_other = bounds - other
-        return self - not_other
+        if not isinstance(other, Spans):
+            other = Spans(other)
+        # walk both sorted lists at once
+        a, b = self._spans, other._spans
+        i = j = 0
+        s = self.__class__()
+        while i < len(a) and j < len(b):
+            (a_start, a_length), (b_start, b_length) = a[i], b[j]
+            o = overlap(a_start, a_length, b_start, b_length)
+            if o:
+                s._spans.append(o)
+                s._len += o[1]
+            if a_start+a_length < b_start+b_length:
+                i += 1
+            else:
+                j += 1
+        return s
 
     def __contains__(self, start_and_length):
         (start, length) = start_and_length
-        for span_start,span_length in self._spans:
-            o = overlap(start, length, span_start, span_length)
-            if o:
-                o_start,o_length = o
-                if o_start == start and o_length == length:
-                    return True
-        return False
+        if length <= 0:
+            return False
+        # the only span that can hold it is the last one starting at or
+        # before 'start'
+        i = bisect.bisect_left(self._spans, (start+1,)) - 1
+        if i < 0:
+            return False
+        span_start,span_length = self._spans[i]
+        return start+length <= span_start+span_length
 
 def overlap(start0, length0, start1, length1):
     # return start2,length2 of the overlapping region, or None
@@ -231,8 +215,16 @@ class DataSpans:
     """
 
     def __init__(self, other=None):
-        self.spans = [] # (start, data) tuples, non-overlapping, merged
-        if other:
+        # (start, data) tuples, sorted and non-overlapping. Each data is a
+        # read-only memoryview, so that trimming a chunk does not copy it.
+        # Adjacent chunks are not merged until a get() needs to read across
+        # them.
+        self.spans = []
+        self._len = 0
+        if isinstance(other, DataSpans):
+            self.spans = list(other.spans)
+            self._len = other._len
+        elif other:
             for (start, data) in other.get_chunks():
                 self.add(start, data)
 
@@ -241,7 +233,7 @@ class DataSpans:
 
     def len(self):
         # return number of bytes we're holding
-        return sum([len(data) for (start,data) in self.spans])
+        return self._len
 
     def _dump(self):
         # return iterator of sorted list of offsets, one per byte
@@ -249,17 +241,29 @@ class DataSpans:
             for i in range(start, start+len(data)):
                 yield i
 
+    def _runs(self):
+        # return list of (start, [data..]) for each run of adjacent chunks
+        runs = []
+        for (start,data) in self.spans:
+            if runs and runs[-1][0] + runs[-1][1] == start:
+                runs[-1][1] += len(data)
+                runs[-1][2].append(data)
+            else:
+                runs.append([start, len(data), [data]])
+        return [(start, pieces) for (start, length, pieces) in runs]
+
     def dump(self):
         return "len=%d: %s" % (self.len(),
                                ",".join(["[%d-%d]" % (start,start+len(data)-1)
-                                         for (start,data) in self.spans]) )
+                                         for (start,data) in self.get_chunks()]) )
 
     def get_chunks(self):
-        return list(self.spans)
+        return [(start, b"".join(pieces)) for (start, pieces) in self._runs()]
 
     def get_spans(self):
         """Return a Spans object with a bit set for each byte I hold"""
-        return Spans([(start, len(data)) for (start,data) in self.spans])
+        return Spans([(start, sum([len(data) for data in pieces]))
+                      for (start, pieces) in self._runs()])
 
     def assert_invariants(self):
         if not self.spans:
@@ -267,173 +271,81 @@ class DataSpans:
         prev_start = self.spans[0][0]
         prev_end = prev_start + len(self.spans[0][1])
         for start, data in self.spans[1:]:
-            if not start > prev_end:
-                # adjacent or overlapping: bad
+            if not start >= prev_end or not data:
+                # overlapping or empty: bad
                 print("ASSERTION FAILED", self.spans)
                 raise AssertionError
+            prev_end = start + len(data)
+        assert self._len == sum([len(data) for (start,data) in self.spans])
 
     def get(self, start, length):
         # returns a string of LENGTH, or None
-        #print("get", start, length, self.spans)
-        end = start+length
-        for (s_start,s_data) in self.spans:
-            s_end = s_start+len(s_data)
-            #print(" ",s_start,s_end)
-            if s_start <= start < s_end:
-                # we want some data from this span. Because we maintain
-                # strictly merged and non-overlapping spans, everything we
-                # want must be in this span.
-                offset = start - s_start
-                if offset + length > len(s_data):
-                    #print(" None, span falls short")
-                    return None # span falls short
-                #print(" some", s_data[offset:offset+length])
-                return s_data[offset:offset+length]
-            if s_start >= end:
-                # we've gone too far: no further spans will overlap
-                #print(" None, gone too far")
-                return None
-        #print(" None, ran out of spans")
-        return None
+        spans = self.spans
+        # the last chunk starting at or before 'start' is the only one which
+        # can hold it
+        i = bisect.bisect_left(spans, (start+1,)) - 1
+        if i < 0:
+            return None
+        (s_start,s_data) = spans[i]
+        offset = start - s_start
+        if offset >= len(s_data):
+            return None # start is in a gap
+        if offset + length <= len(s_data):
+            return bytes(s_data[offset:offset+length])
+        # the range continues into the following chunks, which must be
+        # adjacent to this one
+        end = start + length
+        j = i + 1
+        pos = s_start + len(s_data)
+        while pos < end:
+            if j >= len(spans) or spans[j][0] != pos:
+                return None # span falls short
+            pos += len(spans[j][1])
+            j += 1
+        # merge the run we read, so reading it again needs no join
+        data = b"".join([d for (s,d) in spans[i:j]])
+        spans[i:j] = [(s_start, memoryview(data))]
+        return data[offset:offset+length]
 
     def add(self, start, data):
-        # first: walk through existing spans, find overlap, modify-in-place
-        #  create list of new spans
-        #  add new spans
-        #  sort
-        #  merge adjacent spans
-        #print("add", start, data, self.spans)
-        end = start + len(data)
-        i = 0
-        while len(data):
-            #print(" loop", start, data, i, len(self.spans), self.spans)
-            if i >= len(self.spans):
-                #print(" append and done")
-                # append a last span
-                self.spans.append( (start, data) )
-                break
-            (s_start,s_data) = self.spans[i]
-            # five basic cases:
-            #  a: OLD  b:OLDD  c1:OLD  c2:OLD   d1:OLDD  d2:OLD  e: OLLDD
-            #    NEW     NEW      NEW     NEWW      NEW      NEW     NEW
-            #
-            # we handle A by inserting a new segment (with "N") and looping,
-            # turning it into B or C. We handle B by replacing a prefix and
-            # terminating. We handle C (both c1 and c2) by replacing the
-            # segment (and, for c2, looping, turning it into A). We handle D
-            # by replacing a suffix (and, for d2, looping, turning it into
-            # A). We handle E by replacing the middle and terminating.
-            if start < s_start:
-                # case A: insert a new span, then loop with the remainder
-                #print(" insert new span")
-                s_len = s_start-start
-                self.spans.insert(i, (start, data[:s_len]))
-                i += 1
-                start = s_start
-                data = data[s_len:]
-                continue
-            s_len = len(s_data)
-            s_end = s_start+s_len
-            if s_start <= start < s_end:
-                #print(" modify this span", s_start, start, s_end)
-                # we want to modify some data in this span: a prefix, a
-                # suffix, or the whole thing
-                if s_start == start:
-                    if s_end <= end:
-                        #print(" replace whole segment")
-                        # case C: replace this segment
-                        self.spans[i] = (s_start, data[:s_len])
-                        i += 1
-                        start += s_len
-                        data = data[s_len:]
-                        # C2 is where len(data)>0
-                        continue
-                    # case B: modify the prefix, retain the suffix
-                    #print(" modify prefix")
-                    self.spans[i] = (s_start, data + s_data[len(data):])
-                    break
-                if start > s_start and end < s_end:
-                    # case E: modify the middle
-                    #print(" modify middle")
-                    prefix_len = start - s_start # we retain this much
-                    suffix_len = s_end - end # and retain this much
-                    newdata = s_data[:prefix_len] + data + s_data[-suffix_len:]
-                    self.spans[i] = (s_start, newdata)
-                    break
-                # case D: retain the prefix, modify the suffix
-                #print(" modify suffix")
-                prefix_len = start - s_start # we retain this much
-                suffix_len = s_len - prefix_len # we replace this much
-                #print("  ", s_data, prefix_len, suffix_len, s_len, data)
-                self.spans[i] = (s_start,
-                                 s_data[:prefix_len] + data[:suffix_len])
-                i += 1
-                start += suffix_len
-                data = data[suffix_len:]
-                #print("  now", start, data)
-                # D2 is where len(data)>0
-                continue
-            # else we're not there yet
-            #print(" still looking")
-            i += 1
-            continue
-        # now merge adjacent spans
-        #print(" merging", self.spans)
-        newspans = []
-        for (s_start,s_data) in self.spans:
-            if newspans and adjacent(newspans[-1][0], len(newspans[-1][1]),
-                                     s_start, len(s_data)):
-                newspans[-1] = (newspans[-1][0], newspans[-1][1] + s_data)
-            else:
-                newspans.append( (s_start, s_data) )
-        self.spans = newspans
-        self.assert_invariants()
-        #print(" done", self.spans)
+        if not (isinstance(data, memoryview) and data.readonly):
+            if not isinstance(data, bytes):
+                data = bytes(data)
+            data = memoryview(data)
+        if not data:
+            return
+        # new data replaces whatever we held in the same place
+        self.remove(start, len(data))
+        i = bisect.bisect_left(self.spans, (start,))
+        self.spans.insert(i, (start, data))
+        self._len += len(data)
 
     def remove(self, start, length):
-        i = 0
+        if length <= 0:
+            return
+        spans = self.spans
         end = start + length
-        #print("remove", start, length, self.spans)
-        while i < len(self.spans):
-            (s_start,s_data) = self.spans[i]
-            if s_start >= end:
-                # this segment is entirely right of the removed region, and
-                # all further segments are even further right. We're done.
-                break
-            s_len = len(s_data)
-            s_end = s_start + s_len
-            o = overlap(start, length, s_start, s_len)
-            if not o:
-                i += 1
-                continue
-            o_start, o_len = o
-            o_end = o_start + o_len
-            if o_len == s_len:
-                # remove the whole segment
-                del self.spans[i]
-                continue
-            if o_start == s_start:
-                # remove a prefix, leaving the suffix from o_end to s_end
-                prefix_len = o_end - o_start
-                self.spans[i] = (o_end, s_data[prefix_len:])
-                i += 1
-                continue
-            elif o_end == s_end:
-                # remove a suffix, leaving the prefix from s_start to o_start
-                prefix_len = o_start - s_start
-                self.spans[i] = (s_start, s_data[:prefix_len])
-                i += 1
-                continue
-            # remove the middle, creating a new segment
-            # left is s_start:o_start, right is o_end:s_end
-            left_len = o_start - s_start
-            left = s_data[:left_len]
-            right_len = s_end - o_end
-            right = s_data[-right_len:]
-            self.spans[i] = (s_start, left)
-            self.spans.insert(i+1, (o_end, right))
-            break
-        #print(" done", self.spans)
+        i = bisect.bisect_left(spans, (start+1,)) - 1
+        if i < 0 or spans[i][0] + len(spans[i][1]) <= start:
+            i += 1
+        j = i
+        while j < len(spans) and spans[j][0] < end:
+            j += 1
+        if i == j:
+            return
+        new = []
+        (f_start, f_data) = spans[i]
+        if f_start < start:
+            # keep the prefix, from f_start to start
+            new.append( (f_start, f_data[:start-f_start]) )
+        (l_start, l_data) = spans[j-1]
+        l_end = l_start + len(l_data)
+        if l_end > end:
+            # keep the suffix, from end to l_end
+            new.append( (end, l_data[end-l_start:]) )
+        self._len -= (sum([len(d) for (s,d) in spans[i:j]])
+                      - sum([len(d) for (s,d) in new]))
+        spans[i:j] = new
 
     def pop(self, start, length):
         data = self.get(start, length)
@@ -14,6 +14,12 @@ class ParseDurationUnitFormat(str, Enum):
     SECONDS0 = "s"
     SECONDS1 = "second"
     SECONDS2 = "seconds"
+    MINUTES0 = "min"
+    MINUTES1 = "minute"
+    MINUTES2 = "minutes"
+    HOURS0 = "h"
+    HOURS1 = "hour"
+    HOURS2 = "hours"
     DAYS0 = "day"
     DAYS1 = "days"
     MONTHS0 = "mo"
@@ -84,6 +90,8 @@ def parse_duration(s):
         ValueError: If the input string does not match the expected format or contains invalid units.
     """
     SECOND = 1
+    MINUTE = 60
+    HOUR = 60*60
     DAY = 24*60*60
     MONTH = 31*DAY
     YEAR = 365*DAY
@@ -91,6 +99,12 @@ def parse_duration(s):
         ParseDurationUnitFormat.SECONDS0: SECOND,
         ParseDurationUnitFormat.SECONDS1: SECOND,
         ParseDurationUnitFormat.SECONDS2: SECOND,
+        ParseDurationUnitFormat.MINUTES0: MINUTE,
+        ParseDurationUnitFormat.MINUTES1: MINUTE,
+        ParseDurationUnitFormat.MINUTES2: MINUTE,
+        ParseDurationUnitFormat.HOURS0: HOUR,
+        ParseDurationUnitFormat.HOURS1: HOUR,
+        ParseDurationUnitFormat.HOURS2: HOUR,
         ParseDurationUnitFormat.DAYS0: DAY,
         ParseDurationUnitFormat.DAYS1: DAY,
         ParseDurationUnitFormat.MONTHS0: MONTH,
@@ -57,7 +57,6 @@ from twisted.python.failure import (
 )
 from twisted.internet.defer import (
     CancelledError,
-    maybeDeferred,
 )
 from twisted.web.resource import (
     IResource,
@@ -90,6 +89,7 @@ from allmydata.util.encodingutil import (
 )
 from allmydata.util import abbreviate
 from allmydata.crypto.rsa import PrivateKey, PublicKey, create_signing_keypair_from_string
+from allmydata.web.tracing import traced_call
 
 
 class WebError(Exception):
@@ -476,7 +476,10 @@ def exception_to_child(getChild):
             handler=fullyQualifiedName(bound_getChild),
         )
         with action.context():
-            result = DeferredContext(maybeDeferred(bound_getChild, name, req))
+            result = DeferredContext(traced_call(
+                req, "traverse", _handler_name(bound_getChild),
+                bound_getChild, name, req,
+            ))
             result.addCallbacks(
                 _getChild_done,
                 _getChild_failed,
@@ -487,6 +490,13 @@ def exception_to_child(getChild):
     return g
 
 
+def _handler_name(method):
+    """
+    :return str: a short name for a resource method, for request traces.
+    """
+    return "%s.%s" % (type(method.__self__).__name__, method.__name__)
+
+
 def _getChild_done(child, parent):
     Message.log(
         message_type=u"allmydata:web:common-getChild:result",
@@ -524,7 +534,10 @@ def render_exception(render):
                 return bound_render(request)
 
         with action.context():
-            result = DeferredContext(maybeDeferred(bound_render, request))
+            result = DeferredContext(traced_call(
+                request, "render", _handler_name(bound_render),
+                bound_render, request,
+            ))
             # Apply `_finish` all of our result handling logic to whatever it
             # returned.
             result.addBoth(_finish, bound_render, request)
@@ -2,12 +2,14 @@
 Ported to Python 3.
 """
 
+import time
+from bisect import bisect_right
 from urllib.parse import quote as url_quote
 from datetime import timedelta
 
 from zope.interface import implementer
 from twisted.internet import defer
-from twisted.internet.interfaces import IPushProducer
+from twisted.internet.interfaces import IPullProducer, IPushProducer
 from twisted.python.failure import Failure
 from twisted.web import http
 from twisted.web.resource import ErrorPage
@@ -40,6 +42,7 @@ from allmydata.interfaces import IDirectoryNode, IFileNode, IFilesystemNode, \
 from allmydata.blacklist import ProhibitedNode
 from allmydata.monitor import Monitor, OperationCancelledError
 from allmydata import dirnode
+from allmydata.check_index import IncrementalCheck
 from allmydata.web.common import (
     text_plain,
     WebError,
@@ -122,15 +125,17 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
             if not segment:
                 raise EmptyPathnameComponentError()
 
-        d = self.node.get(name)
+        # get_child_at_path() answers from the path cache when this
+        # directory was listed recently
+        d = self.node.get_child_at_path([name])
         d.addBoth(self._got_child, req, name)
         return d
 
     def _got_child(self, node_or_failure, req, name):
         """
-        Callback when self.node.get has returned, meaning we have received
-        whatever child was requested -- that is `node.get` has
-        returned something (maybe an error). This method then performs
+        Callback when self.node.get_child_at_path has returned, meaning we
+        have received whatever child was requested -- that is
+        `get_child_at_path` has returned something (maybe an error). This method then performs
         the rest of the work of the Twisted API getChild(): returning
         a suitable child resource to Twisted Web.
         """
@@ -241,6 +246,8 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
 
         if t == "json":
             return _directory_json_metadata(req, self.node)
+        if t == "stream-json":
+            return _directory_json_stream(req, self.node)
         if t == "info":
             return MoreInfo(self.node)
         if t == "uri":
@@ -307,10 +314,14 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
             d = self._POST_start_deep_size(req)
         elif t == "start-deep-stats":
             d = self._POST_start_deep_stats(req)
+        elif t == "start-renew-leases":
+            d = self._POST_start_renew_leases(req)
         elif t == "stream-manifest":
             d = self._POST_stream_manifest(req)
         elif t == "set_children" or t == "set-children":
             d = self._POST_set_children(req)
+        elif t == "batch":
+            d = self._POST_batch(req)
         else:
             raise WebError("POST to a directory with bad t=%s" % t)
 
@@ -541,19 +552,29 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
         verify = boolean_of_arg(get_arg(req, "verify", "false"))
         repair = boolean_of_arg(get_arg(req, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(req, "add-lease", "false"))
+        check_index = self._get_check_index(req)
         if repair:
-            monitor = self.node.start_deep_check_and_repair(verify, add_lease)
+            monitor = self.node.start_deep_check_and_repair(verify, add_lease,
+                                                            check_index)
             renderer = DeepCheckAndRepairResultsRenderer(self.client, monitor)
         else:
-            monitor = self.node.start_deep_check(verify, add_lease)
+            monitor = self.node.start_deep_check(verify, add_lease,
+                                                 check_index)
             renderer = DeepCheckResultsRenderer(self.client, monitor)
         return self._start_operation(monitor, renderer, req)
 
+    def _get_check_index(self, req):
+        if boolean_of_arg(get_arg(req, "incremental", "false")):
+            return self.client.get_check_index()
+        return None
+
     def _POST_stream_deep_check(self, req):
         verify = boolean_of_arg(get_arg(req, "verify", "false"))
         repair = boolean_of_arg(get_arg(req, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(req, "add-lease", "false"))
-        walker = DeepCheckStreamer(req, self.node, verify, repair, add_lease)
+        check_index = self._get_check_index(req)
+        walker = DeepCheckStreamer(req, self.node, verify, repair, add_lease,
+                                   check_index)
         monitor = self.node.deep_traverse(walker)
         walker.setMonitor(monitor)
         # register to hear stopProducing. The walker ignores pauseProducing.
@@ -579,8 +600,10 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
     def _POST_start_manifest(self, req):
         if not get_arg(req, "ophandle"):
             raise NeedOperationHandleError("slow operation requires ophandle=")
-        monitor = self.node.build_manifest()
-        renderer = ManifestResults(self.client, monitor)
+        spool = self._operations.create_spool(
+            req, "manifest", self.node.get_storage_index())
+        monitor = self.node.deep_traverse(ManifestSpooler(self.node, spool))
+        renderer = ManifestResults(self.client, monitor, spool)
         return self._start_operation(monitor, renderer, req)
 
     def _POST_start_deep_size(self, req):
@@ -597,6 +620,13 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
         renderer = DeepStatsResults(self.client, monitor)
         return self._start_operation(monitor, renderer, req)
 
+    def _POST_start_renew_leases(self, req):
+        if not get_arg(req, "ophandle"):
+            raise NeedOperationHandleError("slow operation requires ophandle=")
+        monitor = self.node.start_deep_renew_leases()
+        renderer = DeepStatsResults(self.client, monitor)
+        return self._start_operation(monitor, renderer, req)
+
     def _POST_stream_manifest(self, req):
         walker = ManifestStreamer(req, self.node)
         monitor = self.node.deep_traverse(walker)
@@ -646,6 +676,70 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
         # TODO: results
         return d
 
+    def _POST_batch(self, req):
+        # Queue the changes with the directory's batcher, which makes them
+        # together with any others queued close by in a single publish.
+        replace = parse_replace_arg(get_arg(req, "replace", "true"))
+        wait = boolean_of_arg(get_arg(req, "wait", "true"))
+        req.content.seek(0)
+        body = req.content.read()
+        changes = {}
+        if body:
+            try:
+                changes = json.loads(body)
+            except ValueError:
+                raise WebError("t=batch requires a JSON body")
+        if not isinstance(changes, dict):
+            raise WebError("t=batch requires a JSON object")
+        if self.node.is_readonly():
+            raise WebError("cannot change the children of a read-only "
+                           "directory", http.FORBIDDEN)
+
+        queue = []
+        for (name, (file_or_dir, mddict)) in changes.get("set", {}).items():
+            child = self.client.nodemaker.create_from_cap(
+                to_bytes(mddict.get("rw_uri")), to_bytes(mddict.get("ro_uri")),
+                name=name)
+            # check all the caps before queueing anything
+            child.raise_error()
+            queue.append(("set_node", name,
+                          (child, mddict.get("metadata"), replace)))
+        for name in changes.get("unlink", []):
+            queue.append(("delete", name, (True,)))
+
+        batcher = self.client.directory_batchers.get(self.node)
+        req.setHeader("content-type", "application/json")
+        if not wait:
+            for (kind, name, args) in queue:
+                batcher.queue_unwaited(kind, name, *args)
+            return json.dumps({"queued": len(queue)})
+
+        failures = []
+        def _failed(f, kind, name):
+            failures.append((kind, name, f))
+        ds = []
+        for (kind, name, args) in queue:
+            d = getattr(batcher, kind)(name, *args)
+            d.addErrback(_failed, kind, name)
+            ds.append(d)
+        if ds:
+            d = defer.gatherResults(ds)
+            d.addCallback(lambda ign: batcher.take_unreported())
+        else:
+            # nothing new, so just make whatever was queued before
+            d = batcher.flush()
+        def _done(unreported):
+            ops = {"set_node": "set", "delete": "unlink"}
+            return json.dumps({"failures": [
+                {"op": ops[kind],
+                 "name": name,
+                 "error": humanize_failure(f)[0],
+                 }
+                for (kind, name, f) in unreported + failures
+            ]})
+        d.addCallback(_done)
+        return d
+
 def abbreviated_dirnode(dirnode):
     u = from_string_dirnode(dirnode.get_uri())
     return u.abbrev_si()
@@ -1009,58 +1103,182 @@ class DirectoryAsHTML(Element):
     def results(self, req, tag):
         return get_arg(req, "results", "")
 
+def _child_json(childnode, metadata):
+    assert IFilesystemNode.providedBy(childnode), childnode
+    rw_uri = childnode.get_write_uri()
+    ro_uri = childnode.get_readonly_uri()
+    if IFileNode.providedBy(childnode):
+        kiddata = ("filenode", get_filenode_metadata(childnode))
+    elif IDirectoryNode.providedBy(childnode):
+        kiddata = ("dirnode", {'mutable': childnode.is_mutable()})
+    else:
+        kiddata = ("unknown", {})
+
+    kiddata[1]["metadata"] = metadata
+    if rw_uri:
+        kiddata[1]["rw_uri"] = rw_uri
+    if ro_uri:
+        kiddata[1]["ro_uri"] = ro_uri
+    verifycap = childnode.get_verify_cap()
+    if verifycap:
+        kiddata[1]['verify_uri'] = verifycap.to_string()
+    return kiddata
+
+
+def _dirnode_json(dirnode):
+    contents = {}
+    drw_uri = dirnode.get_write_uri()
+    dro_uri = dirnode.get_readonly_uri()
+    if dro_uri:
+        contents['ro_uri'] = dro_uri
+    if drw_uri:
+        contents['rw_uri'] = drw_uri
+    verifycap = dirnode.get_verify_cap()
+    if verifycap:
+        contents['verify_uri'] = verifycap.to_string()
+    contents['mutable'] = dirnode.is_mutable()
+    return contents
+
+
+def _get_count_arg(req, name):
+    value = get_arg(req, name)
+    if value is None:
+        return None
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise WebError("%s= must be a non-negative integer" % (name,))
+    return count
+
+
+def _select_children(req, children):
+    """
+    Apply the after=, offset= and limit= arguments of a directory listing.
+    Children are listed in order of name, starting after the name given by
+    after=, then skipping offset= of them, and listing at most limit= of
+    them.
+
+    :return: (the names to list, the name to pass as after= to get the rest
+        of the listing or None if there is no more)
+    """
+    after = get_arg(req, "after")
+    offset = _get_count_arg(req, "offset")
+    limit = _get_count_arg(req, "limit")
+    names = sorted(children)
+    start = 0
+    if after is not None:
+        start = bisect_right(names, str(after, "utf-8"))
+    if offset is not None:
+        start += offset
+    if limit is None:
+        return (names[start:], None)
+    selected = names[start:start + limit]
+    if selected and start + limit < len(names):
+        return (selected, selected[-1])
+    return (selected, None)
+
+
+def _directory_json_error(f, req):
+    message, code = humanize_failure(f)
+    req.setResponseCode(code)
+    return json.dumps({
+        "error": message,
+    })
+
+
 def _directory_json_metadata(req, dirnode):
     d = dirnode.list()
     def _got(children):
+        (names, next_after) = _select_children(req, children)
         kids = {}
-        for name, (childnode, metadata) in list(children.items()):
-            assert IFilesystemNode.providedBy(childnode), childnode
-            rw_uri = childnode.get_write_uri()
-            ro_uri = childnode.get_readonly_uri()
-            if IFileNode.providedBy(childnode):
-                kiddata = ("filenode", get_filenode_metadata(childnode))
-            elif IDirectoryNode.providedBy(childnode):
-                kiddata = ("dirnode", {'mutable': childnode.is_mutable()})
-            else:
-                kiddata = ("unknown", {})
-
-            kiddata[1]["metadata"] = metadata
-            if rw_uri:
-                kiddata[1]["rw_uri"] = rw_uri
-            if ro_uri:
-                kiddata[1]["ro_uri"] = ro_uri
-            verifycap = childnode.get_verify_cap()
-            if verifycap:
-                kiddata[1]['verify_uri'] = verifycap.to_string()
-
-            kids[name] = kiddata
-
-        drw_uri = dirnode.get_write_uri()
-        dro_uri = dirnode.get_readonly_uri()
-        contents = { 'children': kids }
-        if dro_uri:
-            contents['ro_uri'] = dro_uri
-        if drw_uri:
-            contents['rw_uri'] = drw_uri
-        verifycap = dirnode.get_verify_cap()
-        if verifycap:
-            contents['verify_uri'] = verifycap.to_string()
-        contents['mutable'] = dirnode.is_mutable()
+        for name in names:
+            kids[name] = _child_json(*children[name])
+
+        contents = _dirnode_json(dirnode)
+        contents['children'] = kids
+        if next_after is not None:
+            contents['next-after'] = next_after
         data = ("dirnode", contents)
         return json.dumps(data, indent=1) + "\n"
     d.addCallback(_got)
     d.addCallback(text_plain, req)
+    d.addErrback(_directory_json_error, req)
+    return d
+
 
-    def error(f):
-        message, code = humanize_failure(f)
-        req.setResponseCode(code)
-        return json.dumps({
-            "error": message,
-        })
-    d.addErrback(error)
+def _directory_json_stream(req, dirnode):
+    d = dirnode.list()
+    def _got(children):
+        (names, next_after) = _select_children(req, children)
+        contents = _dirnode_json(dirnode)
+        if next_after is not None:
+            contents['next-after'] = next_after
+        req.setHeader("content-type", "text/plain")
+        req.write(_json_line(("dirnode", contents)))
+        producer = ChildrenJSONProducer(req, names, children)
+        return producer.start()
+    d.addCallbacks(_got, _directory_json_error, errbackArgs=(req,))
     return d
 
 
+def _json_line(data):
+    j = json.dumps(data, ensure_ascii=True)
+    assert "\n" not in j
+    return j.encode("utf-8") + b"\n"
+
+
+@implementer(IPullProducer)
+class ChildrenJSONProducer(object):
+    """
+    I write one line of JSON for each child of a directory, a batch at a
+    time whenever the transport wants more, so that a large directory is
+    neither serialized all at once nor buffered whole in memory.
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, req, names, children):
+        self._req = req
+        self._names = names
+        self._children = children
+        self._next = 0
+        self._done = defer.Deferred()
+
+    def start(self):
+        """
+        :return: a Deferred that fires with an empty body to finish the
+            response with once every child has been written.
+        """
+        self._req.registerProducer(self, False)
+        return self._done
+
+    def resumeProducing(self):
+        end = min(self._next + self.BATCH_SIZE, len(self._names))
+        lines = []
+        for name in self._names[self._next:end]:
+            lines.append(_json_line({
+                "name": name,
+                "node": _child_json(*self._children[name]),
+            }))
+        self._next = end
+        if lines:
+            self._req.write(b"".join(lines))
+        if self._next == len(self._names):
+            self._req.unregisterProducer()
+            self._done.callback(b"")
+
+    def stopProducing(self):
+        self._names = []
+        self._next = 0
+        # Once the request has lost its connection, its producer is gone too.
+        if self._req.channel is not None:
+            self._req.unregisterProducer()
+        if not self._done.called:
+            self._done.errback(defer.CancelledError())
+
+
 def _directory_uri(req, dirnode):
     return text_plain(dirnode.get_uri(), req)
 
@@ -1208,9 +1426,13 @@ class ManifestElement(ReloadableMonitorElement):
             "Manifest of SI={}".format(self._si_abbrev())
         )
 
+    def __init__(self, monitor, manifest):
+        super(ManifestElement, self).__init__(monitor)
+        self.manifest = manifest
+
     @renderer
     def items(self, req, tag):
-        manifest = self.monitor.get_status()["manifest"]
+        manifest = self.manifest
         root = get_root(req)
         rows = [
             {
@@ -1222,31 +1444,56 @@ class ManifestElement(ReloadableMonitorElement):
         return SlotsSequenceElement(tag, rows)
 
 
+def _manifest_page(req, spool):
+    """
+    Apply the offset= and limit= arguments of a manifest.
+
+    :return: (a list of (path, cap, verifycap, storage index) tuples, the
+        offset= of the rest of the manifest or None if there is no more)
+    """
+    offset = _get_count_arg(req, "offset") or 0
+    limit = _get_count_arg(req, "limit")
+    entries = [(tuple(path), cap.encode("utf-8"), verifycap, si)
+               for (path, cap, verifycap, si) in spool.items(offset, limit)]
+    if limit is not None and offset + limit < len(spool):
+        return (entries, offset + limit)
+    return (entries, None)
+
+
 class ManifestResults(MultiFormatResource, ReloadMixin):
 
     # Control MultiFormatResource
     formatArgument = "output"
     formatDefault = "html"
 
-    def __init__(self, client, monitor):
+    def __init__(self, client, monitor, spool):
         self.client = client
         self.monitor = monitor
+        self.spool = spool
 
+    @render_exception
     def render_HTML(self, req):
+        (entries, next_offset) = _manifest_page(req, self.spool)
         return renderElement(
             req,
-            ManifestElement(self.monitor)
+            ManifestElement(self.monitor,
+                            [(path, cap) for (path, cap, v, si) in entries])
         )
 
+    @render_exception
     def render_TEXT(self, req):
         req.setHeader("content-type", "text/plain")
         lines = []
         is_finished = self.monitor.is_finished()
         lines.append(b"finished: " + {True: b"yes", False: b"no"}[is_finished])
-        for path, cap in self.monitor.get_status()["manifest"]:
+        (entries, next_offset) = _manifest_page(req, self.spool)
+        if next_offset is not None:
+            lines.append(b"next-offset: %d" % (next_offset,))
+        for (path, cap, verifycap, si) in entries:
             lines.append(_slashify_path(path) + b" " + cap)
         return b"\n".join(lines) + b"\n"
 
+    @render_exception
     def render_JSON(self, req):
         req.setHeader("content-type", "text/plain")
         m = self.monitor
@@ -1263,22 +1510,41 @@ class ManifestResults(MultiFormatResource, ReloadMixin):
         if m.is_finished():
             # don't return manifest/verifycaps/SIs unless the operation is
             # done, to save on CPU/memory (both here and in the HTTP client
-            # who has to unpack the JSON). Tests show that the ManifestWalker
-            # needs about 1092 bytes per item, the JSON we generate here
-            # requires about 503 bytes per item, and some internal overhead
-            # (perhaps transport-layer buffers in twisted.web?) requires an
-            # additional 1047 bytes per item.
-            status.update({ "manifest": s["manifest"],
-                            "verifycaps": [i for i in s["verifycaps"]],
-                            "storage-index": [i for i in s["storage-index"]],
+            # who has to unpack the JSON). The entries are read back from the
+            # spool, so a client with a large manifest should ask for it a
+            # page at a time with offset= and limit=.
+            (entries, next_offset) = _manifest_page(req, self.spool)
+            # deep_traverse visits each verifycap only once, so these need
+            # no further de-duplication
+            status.update({ "manifest": [(path, cap) for (path, cap, v, si)
+                                         in entries],
+                            "verifycaps": [v for (path, cap, v, si) in entries
+                                           if v],
+                            "storage-index": [si for (path, cap, v, si)
+                                              in entries if si],
                             })
-            # simplejson doesn't know how to serialize a set. We use a
-            # generator that walks the set rather than list(setofthing) to
-            # save a small amount of memory (4B*len) and a moderate amount of
-            # CPU.
+            if next_offset is not None:
+                status["next-offset"] = next_offset
         return json.dumps(status, indent=1)
 
 
+def restore_operation(client, spool):
+    """
+    Make the monitor and renderer for the spooled results of an operation
+    which finished before the node was restarted.
+
+    :return: (monitor, renderer), or None if the operation is not one whose
+        results are spooled.
+    """
+    if spool.header["operation"] != "manifest":
+        return None
+    monitor = Monitor()
+    origin = spool.header["origin"]
+    monitor.origin_si = base32.a2b(origin.encode("ascii")) if origin else None
+    monitor.finish({"stats": spool.summary})
+    return (monitor, ManifestResults(client, monitor, spool))
+
+
 class DeepSizeResults(MultiFormatResource):
 
     # Control MultiFormatResource
@@ -1311,8 +1577,8 @@ class DeepSizeResults(MultiFormatResource):
 
 class DeepStatsResults(Resource, object):
     """
-    Renders the results of a 'deep-stats' operation on a directory
-    capability.
+    Renders the results of a 'deep-stats' or 'renew-leases' operation on a
+    directory capability.
     """
     def __init__(self, client, monitor):
         self.client = client
@@ -1326,6 +1592,35 @@ class DeepStatsResults(Resource, object):
         return json.dumps(s, indent=1).encode("utf-8")
 
 
+class ManifestSpooler(dirnode.DeepStats):
+    """
+    Collects the manifest of a 'start-manifest' operation into a
+    ``ResultSpool``, one (path, cap, verifycap, storage index) entry per
+    node, rather than holding it all in memory like ``ManifestWalker``.
+    """
+
+    def __init__(self, origin, spool):
+        dirnode.DeepStats.__init__(self, origin)
+        self.spool = spool
+
+    def add_node(self, node, path):
+        v = node.get_verify_cap()
+        si = node.get_storage_index()
+        self.spool.add([path,
+                        node.get_uri(),
+                        v.to_string() if v else None,
+                        base32.b2a(si) if si else None])
+        return dirnode.DeepStats.add_node(self, node, path)
+
+    def get_results(self):
+        return {"stats": dirnode.DeepStats.get_results(self)}
+
+    def finish(self):
+        results = self.get_results()
+        self.spool.finish(results["stats"])
+        return results
+
+
 @implementer(IPushProducer)
 class ManifestStreamer(dirnode.DeepStats):
 
@@ -1386,12 +1681,16 @@ class ManifestStreamer(dirnode.DeepStats):
 @implementer(IPushProducer)
 class DeepCheckStreamer(dirnode.DeepStats):
 
-    def __init__(self, req, origin, verify, repair, add_lease):
+    def __init__(self, req, origin, verify, repair, add_lease,
+                 check_index=None):
         dirnode.DeepStats.__init__(self, origin)
         self.req = req
         self.verify = verify
         self.repair = repair
         self.add_lease = add_lease
+        self.incremental = None
+        if check_index is not None:
+            self.incremental = IncrementalCheck(check_index, int(time.time()))
 
     def setMonitor(self, monitor):
         self.monitor = monitor
@@ -1429,15 +1728,36 @@ class DeepCheckStreamer(dirnode.DeepStats):
             si = base32.b2a(si)
         data["storage-index"] = si or ""
 
+        if self.incremental and not self.incremental.wants_check(node):
+            # checked recently enough: say so instead of checking again
+            self.incremental.skipped(node)
+            data["skipped"] = True
+            return self.write_line(data)
         if self.repair:
             d = node.check_and_repair(self.monitor, self.verify, self.add_lease)
+            d.addCallback(self.record_check, node)
             d.addCallback(self.add_check_and_repair, data)
         else:
             d = node.check(self.monitor, self.verify, self.add_lease)
+            d.addCallback(self.record_check, node)
             d.addCallback(self.add_check, data)
         d.addCallback(self.write_line)
         return d
 
+    def record_check(self, results, node):
+        if self.incremental:
+            self.incremental.checked(node, results)
+        return results
+
+    def should_enter(self, node):
+        if self.incremental:
+            return self.incremental.should_enter(node)
+        return True
+
+    def leave_directory(self, node):
+        if self.incremental:
+            self.incremental.leave_directory(node)
+
     def add_check_and_repair(self, crr, data):
         data["check-and-repair-results"] = json_check_and_repair_results(crr)
         return data
@@ -1452,6 +1772,8 @@ class DeepCheckStreamer(dirnode.DeepStats):
         self.req.write(j.encode("utf-8")+b"\n")
 
     def finish(self):
+        if self.incremental:
+            self.incremental.finish()
         stats = dirnode.DeepStats.get_results(self)
         d = {"type": "stats",
              "stats": stats,
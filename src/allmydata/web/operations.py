@@ -2,6 +2,8 @@
 Ported to Python 3.
 """
 
+import io
+import os
 import time
 from hyperlink import (
     DecodedURL,
@@ -20,6 +22,7 @@ from twisted.web.http import NOT_FOUND
 from twisted.web.html import escape
 from twisted.application import service
 
+from allmydata.util import base32, fileutil, jsonbytes as json, log
 from allmydata.web.common import (
     WebError,
     get_arg,
@@ -33,6 +36,142 @@ DAY = 24*HOUR
 
 (MONITOR, RENDERER, WHEN_ADDED) = range(3)
 
+
+class ResultSpool:
+    """
+    I hold the results of one long-running operation, as an append-only
+    sequence of JSON lines: a header describing the operation, one line per
+    item of its results, and a final line with its summary once it has
+    finished. The items are written out as they are produced, so only the
+    write buffer (at most BUFFER_SIZE bytes) of them is held in memory, and
+    they can be read back a page at a time while the operation is running.
+
+    Use ``ResultSpool.create`` or ``ResultSpool.load`` for a spool on disk,
+    which survives a restart of the node once the operation has finished,
+    or ``ResultSpool.in_memory`` when there is nowhere to put one.
+    """
+
+    BUFFER_SIZE = 64*1024
+    # remember the file position of every INDEX_INTERVAL'th item, so that
+    # reading a page from the middle of a large spool does not have to
+    # parse every line before it
+    INDEX_INTERVAL = 1000
+
+    def __init__(self, f, path=None):
+        self._f = f
+        self.path = path
+        self.header = None
+        self.summary = None
+        self.finished_at = None
+        self._count = 0
+        self._index = []
+
+    @classmethod
+    def create(cls, path, header):
+        spool = cls(open(path, "w+b", buffering=cls.BUFFER_SIZE), path)
+        spool._write(["header", header])
+        spool.header = header
+        return spool
+
+    @classmethod
+    def in_memory(cls, header):
+        spool = cls(io.BytesIO())
+        spool._write(["header", header])
+        spool.header = header
+        return spool
+
+    @classmethod
+    def load(cls, path):
+        """
+        Re-open a spool written by an earlier run of the node. Its items are
+        indexed but not kept in memory.
+
+        :raise ValueError: if the file does not start with a header.
+        """
+        spool = cls(open(path, "r+b", buffering=cls.BUFFER_SIZE), path)
+        while True:
+            where = spool._f.tell()
+            line = spool._f.readline()
+            if not line.endswith(b"\n"):
+                # either the end of the file, or the last line was cut short
+                # when the node stopped
+                break
+            (kind, value) = json.loads(line)
+            if kind == "header":
+                spool.header = value
+            elif kind == "item":
+                if spool._count % cls.INDEX_INTERVAL == 0:
+                    spool._index.append(where)
+                spool._count += 1
+            elif kind == "done":
+                spool.summary = value["summary"]
+                spool.finished_at = value["when"]
+        if spool.header is None:
+            spool.close()
+            raise ValueError("%r is not a result spool" % (path,))
+        return spool
+
+    def _write(self, record):
+        self._f.write(json.dumps_bytes(record) + b"\n")
+
+    def __len__(self):
+        return self._count
+
+    def is_finished(self):
+        return self.finished_at is not None
+
+    def add(self, item):
+        if self._f is None:
+            # the operation was cancelled and its results thrown away
+            return
+        if self._count % self.INDEX_INTERVAL == 0:
+            self._index.append(self._f.tell())
+        self._write(["item", item])
+        self._count += 1
+
+    def finish(self, summary):
+        if self._f is None:
+            return
+        self.summary = summary
+        self.finished_at = time.time()
+        self._write(["done", {"when": self.finished_at, "summary": summary}])
+        self._f.flush()
+
+    def items(self, offset=0, limit=None):
+        """
+        :return: a list of at most ``limit`` items, starting at ``offset``.
+        """
+        end = self._count
+        if limit is not None:
+            end = min(end, offset + limit)
+        if offset >= end:
+            return []
+        append_at = self._f.tell()
+        self._f.flush()
+        (block, skip) = divmod(offset, self.INDEX_INTERVAL)
+        self._f.seek(self._index[block])
+        items = []
+        try:
+            for i in range(skip):
+                self._f.readline()
+            for i in range(end - offset):
+                (kind, item) = json.loads(self._f.readline())
+                items.append(item)
+        finally:
+            self._f.seek(append_at)
+        return items
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def remove(self):
+        self.close()
+        if self.path is not None:
+            fileutil.remove_if_possible(self.path)
+
+
 class OphandleTable(resource.Resource, service.Service):
     """Renders /operations/%d."""
     # The type in Twisted for services is wrong in 22.10...
@@ -42,25 +181,106 @@ class OphandleTable(resource.Resource, service.Service):
     UNCOLLECTED_HANDLE_LIFETIME = 4*DAY
     COLLECTED_HANDLE_LIFETIME = 1*DAY
 
-    def __init__(self, clock=None):
+    def __init__(self, clock=None, spooldir=None):
         super(OphandleTable, self).__init__()
-        # both of these are indexed by ophandle
+        # all of these are indexed by ophandle
         self.handles = {} # tuple of (monitor, renderer, when_added)
         self.timers = {}
+        self.spools = {}
         # The tests will provide a deterministic clock
         # (twisted.internet.task.Clock) that they can control so that
         # they can test ophandle expiration. If this is provided, I'll
         # use it schedule the expiration of ophandles.
         self.clock = clock
+        # If provided, the results of operations which can be large are
+        # spooled to files in this directory, and the finished ones are
+        # served again after a restart.
+        self.spooldir = spooldir
+        if spooldir is not None:
+            fileutil.make_dirs(spooldir)
 
     def stopService(self):
         for t in self.timers.values():
             if t.active():
                 t.cancel()
+        # keep the spooled results for the next run
+        for spool in self.spools.values():
+            spool.close()
         del self.handles # this is not restartable
         del self.timers
+        del self.spools
         return service.Service.stopService(self)
 
+    def create_spool(self, req, operation, origin_si):
+        """
+        Make somewhere to put the results of a new operation, for the
+        ``ophandle=`` of the request which starts it.
+
+        :param bytes operation: what kind of operation this is, so that its
+            results can be rendered again after a restart.
+        :param bytes origin_si: the storage index the operation started from,
+            or None.
+        :return ResultSpool:
+        """
+        ophandle = get_arg(req, "ophandle")
+        assert ophandle
+        if ophandle in self.spools:
+            # the handle is being re-used, so the old results are gone
+            self.spools.pop(ophandle).remove()
+        header = {"operation": operation,
+                  "ophandle": ophandle,
+                  "origin": base32.b2a(origin_si) if origin_si else None,
+                  "added": time.time(),
+                  }
+        if self.spooldir is None:
+            spool = ResultSpool.in_memory(header)
+        else:
+            spool = ResultSpool.create(self._spool_path(ophandle), header)
+        self.spools[ophandle] = spool
+        return spool
+
+    def _spool_path(self, ophandle):
+        return os.path.join(self.spooldir,
+                            str(base32.b2a(ophandle), "ascii") + ".jsonl")
+
+    def restore(self, make_handle):
+        """
+        Serve again the results of operations which finished before the node
+        was last stopped. Those which had not finished, or which have been
+        kept for longer than an uncollected handle would be, are deleted.
+
+        :param make_handle: called with each ``ResultSpool`` to get back a
+            (monitor, renderer) tuple for it, or None if its kind of
+            operation is not known.
+        """
+        if self.spooldir is None:
+            return
+        now = time.time()
+        for name in sorted(os.listdir(self.spooldir)):
+            path = os.path.join(self.spooldir, name)
+            try:
+                spool = ResultSpool.load(path)
+            except (OSError, ValueError):
+                log.msg(format="discarding unreadable operation results %(path)s",
+                        path=path, level=log.UNUSUAL, umid="Jq3wVb")
+                fileutil.remove_if_possible(path)
+                continue
+            remaining = None
+            if spool.is_finished():
+                remaining = (spool.finished_at + self.UNCOLLECTED_HANDLE_LIFETIME
+                             - now)
+            handle = None
+            if remaining is not None and remaining > 0:
+                handle = make_handle(spool)
+            if handle is None:
+                spool.remove()
+                continue
+            ophandle = spool.header["ophandle"].encode("utf-8")
+            (monitor, renderer) = handle
+            self.handles[ophandle] = (monitor, renderer, spool.header["added"])
+            self.spools[ophandle] = spool
+            self._set_timer(ophandle, remaining)
+
     def add_monitor(self, req, monitor, renderer):
         """
         :param allmydata.webish.MyRequest req:
@@ -113,7 +333,7 @@ class OphandleTable(resource.Resource, service.Service):
         if t == b"cancel" and req.method == b"POST":
             monitor.cancel()
             # return the status anyways, but release the handle
-            self._release_ophandle(ophandle)
+            self._release_ophandle(ophandle, req.notifyFinish())
 
         else:
             retain_for = get_arg(req, "retain-for", None)
@@ -122,7 +342,7 @@ class OphandleTable(resource.Resource, service.Service):
 
             if monitor.is_finished():
                 if boolean_of_arg(get_arg(req, "release-after-complete", "false")):
-                    self._release_ophandle(ophandle)
+                    self._release_ophandle(ophandle, req.notifyFinish())
                 if retain_for is None:
                     # this GET is collecting the ophandle, so change its timer
                     self._set_timer(ophandle, self.COLLECTED_HANDLE_LIFETIME)
@@ -142,11 +362,22 @@ class OphandleTable(resource.Resource, service.Service):
             t = reactor.callLater(when, self._release_ophandle, ophandle)
         self.timers[ophandle] = t
 
-    def _release_ophandle(self, ophandle):
+    def _release_ophandle(self, ophandle, rendered=None):
+        """
+        :param rendered: if given, a Deferred which fires once the results
+            have been rendered one last time, and only then are they
+            thrown away.
+        """
         if ophandle in self.timers and self.timers[ophandle].active():
             self.timers[ophandle].cancel()
         self.timers.pop(ophandle, None)
         self.handles.pop(ophandle, None)
+        spool = self.spools.pop(ophandle, None)
+        if spool is not None:
+            if rendered is None:
+                spool.remove()
+            else:
+                rendered.addBoth(lambda ignored: spool.remove())
 
 
 class ReloadMixin:
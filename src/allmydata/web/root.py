@@ -215,13 +215,15 @@ class Root(MultiFormatResource):
 
     addSlash = True
 
-    def __init__(self, client, clock=None, now_fn=None):
+    def __init__(self, client, clock=None, now_fn=None, slow_requests=None):
         """
         Render root page ("/") of the URI.
 
         :client allmydata.client._Client: a stats provider.
         :clock: unused here.
         :now_fn: a function that returns current time.
+        :slow_requests allmydata.web.tracing.SlowRequests: the slowest
+            recent requests, if they are being kept.
 
         """
         super(Root, self).__init__()
@@ -238,7 +240,7 @@ class Root(MultiFormatResource):
 
         self.putChild(b"file", FileHandler(client))
         self.putChild(b"named", FileHandler(client))
-        self.putChild(b"status", status.Status(client.get_history()))
+        self.putChild(b"status", status.Status(client.get_history(), slow_requests))
         self.putChild(b"statistics", status.Statistics(client.stats_provider))
         self.putChild(b"report_incident", IncidentReporter())
 
@@ -253,6 +255,8 @@ class Root(MultiFormatResource):
             # the Helper isn't attached until after the Tub starts, so this child
             # needs to created on each request
             return status.HelperStatus(self._client.helper)
+        if path == b"repair_status":
+            return status.RepairStatus(self._client.repair_scheduler)
         if path == b"storage":
             # Storage isn't initialized until after the web hierarchy is
             # constructed so this child needs to be created later than
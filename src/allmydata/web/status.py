@@ -1256,12 +1256,15 @@ def marshal_json(s):
 class Status(MultiFormatResource):
     """Renders /status page."""
 
-    def __init__(self, history):
+    def __init__(self, history, slow_requests=None):
         """
         :param allmydata.history.History history: provides operation statuses.
+        :param allmydata.web.tracing.SlowRequests slow_requests: the slowest
+            recent web requests, if they are being kept.
         """
         super(Status, self).__init__()
         self.history = history
+        self.slow_requests = slow_requests
 
     @render_exception
     def render_HTML(self, req):
@@ -1298,6 +1301,9 @@ class Status(MultiFormatResource):
         if not path and request.postpath != [b'']:
             return self
 
+        if path == b"slow-requests" and self.slow_requests is not None:
+            return SlowRequestsPage(self.slow_requests)
+
         h = self.history
         try:
             stype, count_s = path.split(b"-")
@@ -1520,6 +1526,173 @@ class HelperStatusElement(Element):
         return tag(str(self._data["chk_upload_helper.encoded_bytes"]))
 
 
+class RepairStatus(MultiFormatResource):
+    """Renders /repair_status page."""
+
+    def __init__(self, repair_scheduler):
+        """
+        :param allmydata.repair_scheduler.RepairScheduler repair_scheduler:
+            the client's repair service, or ``None`` if it is not enabled.
+        """
+        super(RepairStatus, self).__init__()
+        self._scheduler = repair_scheduler
+
+    @render_exception
+    def render_HTML(self, req):
+        return renderElement(req, RepairStatusElement(self._scheduler))
+
+    @render_exception
+    def render_JSON(self, req):
+        req.setHeader("content-type", "application/json")
+        if self._scheduler:
+            return json.dumps(self._scheduler.get_status(), indent=1) + "\n"
+        return json.dumps({}) + "\n"
+
+class RepairStatusElement(Element):
+
+    loader = XMLFile(FilePath(__file__).sibling("repair-status.xhtml"))
+
+    def __init__(self, repair_scheduler):
+        super(RepairStatusElement, self).__init__()
+        self._scheduler = repair_scheduler
+
+    @renderer
+    def repair_running(self, req, tag):
+        if self._scheduler:
+            self._data = self._scheduler.get_status()
+            return tag
+        return tags.h1("No repair service is running")
+
+    @renderer
+    def roots(self, req, tag):
+        return tag(str(self._data["roots"]))
+
+    @renderer
+    def limits(self, req, tag):
+        bandwidth = self._data["bandwidth"]
+        return tag("%d at once, %s" % (
+            self._data["concurrency"],
+            abbreviate_rate(bandwidth) if bandwidth else "no bandwidth limit"))
+
+    @renderer
+    def walk(self, req, tag):
+        if self._data["walking"]:
+            return tag("in progress, started %s"
+                       % render_time(self._data["last-cycle-started"]))
+        if self._data["last-cycle-finished"] is not None:
+            return tag("last finished %s"
+                       % render_time(self._data["last-cycle-finished"]))
+        return tag("not yet started")
+
+    @renderer
+    def objects_checked(self, req, tag):
+        return tag("%d (%d unhealthy, %d unrecoverable)" % (
+            self._data["objects-checked"], self._data["objects-unhealthy"],
+            self._data["objects-unrecoverable"]))
+
+    @renderer
+    def repairs(self, req, tag):
+        return tag("%d attempted, %d succeeded, %d failed, %d running" % (
+            self._data["repairs-attempted"], self._data["repairs-succeeded"],
+            self._data["repairs-failed"], self._data["active"]))
+
+    @renderer
+    def throughput(self, req, tag):
+        return tag("%s (%s in total)" % (
+            abbreviate_rate(self._data["throughput"]),
+            abbreviate_size(self._data["bytes-repaired"])))
+
+    @renderer
+    def queue(self, req, tag):
+        entries = []
+        for entry in self._data["queue"]:
+            entries.append({
+                "si": entry["storage_index"],
+                "shares": "%d (need %d of %d)" % (entry["shares_good"],
+                                                  entry["shares_needed"],
+                                                  entry["shares_expected"]),
+                "size": abbreviate_size(entry["size"]),
+                "attempts": str(entry["attempts"]),
+                "last_error": entry["last_error"] or "",
+            })
+        return SlotsSequenceElement(tag, entries)
+
+
+class SlowRequestsPage(MultiFormatResource):
+    """Renders /status/slow-requests page."""
+
+    def __init__(self, slow_requests):
+        """
+        :param allmydata.web.tracing.SlowRequests slow_requests: the
+            slowest recent web requests.
+        """
+        super(SlowRequestsPage, self).__init__()
+        self._slow_requests = slow_requests
+
+    @render_exception
+    def render_HTML(self, req):
+        return renderElement(req, SlowRequestsElement(self._slow_requests))
+
+    @render_exception
+    def render_JSON(self, req):
+        req.setHeader("content-type", "application/json")
+        data = [trace.to_json() for trace in self._slow_requests.get_slowest()]
+        return json.dumps(data, indent=1) + "\n"
+
+    @render_exception
+    def render_TRACE(self, req):
+        """
+        Render the requests in the Chrome trace event format, which
+        chrome://tracing and Perfetto can load.
+        """
+        req.setHeader("content-type", "application/json")
+        req.setHeader("content-disposition",
+                      'attachment; filename="slow-requests.json"')
+        return json.dumps(self._slow_requests.to_chrome_trace()) + "\n"
+
+
+class SlowRequestsElement(Element):
+
+    loader = XMLFile(FilePath(__file__).sibling("slow-requests.xhtml"))
+
+    def __init__(self, slow_requests):
+        super(SlowRequestsElement, self).__init__()
+        self._slow_requests = slow_requests
+
+    @renderer
+    def window(self, req, tag):
+        return tag(abbreviate_time(self._slow_requests.window))
+
+    @renderer
+    def requests(self, req, tag):
+        def phase(phases, name):
+            if name in phases:
+                return abbreviate_time(phases[name])
+            return ""
+        rows = []
+        for trace in self._slow_requests.get_slowest():
+            phases = trace.get_phase_times()
+            spans = [
+                "%s %s" % (name, abbreviate_time(end - start))
+                for (kind, name, start, end) in trace.spans
+                if end is not None
+            ]
+            rows.append({
+                "started": render_time(trace.started),
+                "request": "%s %s" % (str(trace.method, "utf-8"),
+                                      str(trace.uri, "utf-8")),
+                "code": str(trace.code) if trace.code is not None else "lost",
+                "total": abbreviate_time(trace.get_duration()),
+                "traverse": phase(phases, "traverse"),
+                "render": phase(phases, "render"),
+                "first_byte": phase(phases, "first-byte"),
+                "write": phase(phases, "write"),
+                "sent": abbreviate_size(trace.bytes_written),
+                "spans": ", ".join(spans),
+            })
+        return SlotsSequenceElement(tag, rows)
+
+
 # Render "/statistics" page.
 class Statistics(MultiFormatResource):
     """Class that renders "/statistics" page.
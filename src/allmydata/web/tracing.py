@@ -0,0 +1,214 @@
+"""
+Timings of web-API requests, for finding out where slow ones spend their
+time.
+
+Each request gets a ``RequestTrace`` when its processing starts. The
+``getChild`` and ``render`` wrappers in ``allmydata.web.common`` add a span
+to it for each step of traversing the resource tree (which is where
+directories are looked up) and for rendering the response, and the request
+itself keeps track of writing the response to the socket. Once the request
+is finished its trace is offered to a ``SlowRequests``, which keeps the
+slowest few of the recent ones for ``/status/slow-requests``.
+"""
+
+import time
+
+from twisted.internet.defer import maybeDeferred
+
+MINUTE = 60
+HOUR = 60*MINUTE
+
+
+class RequestTrace:
+    """
+    The timings of one request.
+
+    :ivar bytes method: the HTTP method.
+    :ivar bytes uri: the request URI, with any capabilities censored.
+    :ivar float started: when processing started.
+    :ivar float finished: when the response was finished, or the connection
+        was lost, or None if neither has happened yet.
+    :ivar int code: the response code, or None if the connection was lost.
+    :ivar spans: a list of [phase, name, start, end] lists, in the order
+        they started. ``end`` is None until the span has ended.
+    """
+
+    def __init__(self, method, uri, started):
+        self.method = method
+        self.uri = uri
+        self.started = started
+        self.finished = None
+        self.code = None
+        self.spans = []
+        # writes are far too many to keep a span for each one
+        self.first_write = None
+        self.last_write = None
+        self.write_time = 0.0
+        self.bytes_written = 0
+
+    def start_span(self, phase, name):
+        span = [phase, name, time.time(), None]
+        self.spans.append(span)
+        return span
+
+    def end_span(self, span):
+        span[3] = time.time()
+
+    def wrote(self, start, end, length):
+        if self.first_write is None:
+            self.first_write = start
+        self.last_write = end
+        self.write_time += end - start
+        self.bytes_written += length
+
+    def finish(self, code):
+        self.finished = time.time()
+        self.code = code
+
+    def get_duration(self):
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def get_phase_times(self):
+        """
+        :return: a dict mapping each phase to the total time spent in it.
+            "first-byte" is the time until the response started to be
+            written, and "write" the time spent writing it.
+        """
+        phases = {}
+        for (phase, name, start, end) in self.spans:
+            if end is not None:
+                phases[phase] = phases.get(phase, 0.0) + (end - start)
+        if self.first_write is not None:
+            phases["first-byte"] = self.first_write - self.started
+            phases["write"] = self.write_time
+        return phases
+
+    def to_json(self):
+        return {
+            "method": str(self.method, "utf-8"),
+            "uri": str(self.uri, "utf-8"),
+            "code": self.code,
+            "started": self.started,
+            "duration": self.get_duration(),
+            "bytes-written": self.bytes_written,
+            "phases": self.get_phase_times(),
+            "spans": [
+                {"phase": phase,
+                 "name": name,
+                 "start": start - self.started,
+                 "duration": None if end is None else end - start,
+                 }
+                for (phase, name, start, end) in self.spans
+            ],
+        }
+
+    def to_chrome_trace(self, tid):
+        """
+        :param int tid: the "thread" to show this request as.
+
+        :return: a list of events in the Chrome trace event format, with
+            this request as a single thread.
+        """
+        def microseconds(seconds):
+            return int(seconds * 1000000)
+
+        def complete(name, category, start, end, args=None):
+            event = {"name": name,
+                     "cat": category,
+                     "ph": "X",
+                     "pid": 1,
+                     "tid": tid,
+                     "ts": microseconds(start),
+                     "dur": microseconds(end - start),
+                     }
+            if args:
+                event["args"] = args
+            return event
+
+        label = "%s %s" % (str(self.method, "utf-8"), str(self.uri, "utf-8"))
+        events = [{"name": "thread_name",
+                   "ph": "M",
+                   "pid": 1,
+                   "tid": tid,
+                   "args": {"name": label},
+                   }]
+        finished = self.finished if self.finished is not None else time.time()
+        events.append(complete(label, "request", self.started, finished,
+                               {"code": self.code}))
+        for (phase, name, start, end) in self.spans:
+            if end is not None:
+                events.append(complete(name, phase, start, end))
+        if self.first_write is not None:
+            events.append(complete("write", "write", self.first_write,
+                                   self.last_write,
+                                   {"bytes": self.bytes_written,
+                                    "seconds-in-write": self.write_time}))
+        return events
+
+
+class SlowRequests:
+    """
+    I keep the traces of the slowest requests which finished recently.
+
+    :param int size: how many traces to keep.
+    :param float window: how many seconds a trace is kept for.
+    """
+
+    def __init__(self, size=20, window=1*HOUR):
+        self.size = size
+        self.window = window
+        self._traces = []
+
+    def add(self, trace):
+        cutoff = trace.finished - self.window
+        self._traces = [t for t in self._traces if t.finished >= cutoff]
+        if len(self._traces) < self.size:
+            self._traces.append(trace)
+            return
+        fastest = min(self._traces, key=RequestTrace.get_duration)
+        if trace.get_duration() > fastest.get_duration():
+            self._traces.remove(fastest)
+            self._traces.append(trace)
+
+    def get_slowest(self, now=None):
+        """
+        :return: the recent traces, slowest first.
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - self.window
+        recent = [t for t in self._traces if t.finished >= cutoff]
+        recent.sort(key=RequestTrace.get_duration, reverse=True)
+        return recent
+
+    def to_chrome_trace(self):
+        """
+        :return: the recent traces as a Chrome trace, one request per thread.
+        """
+        events = []
+        for (tid, trace) in enumerate(self.get_slowest()):
+            events.extend(trace.to_chrome_trace(tid))
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def traced_call(req, phase, name, f, *args):
+    """
+    Call a function which may return a Deferred, adding a span to the trace
+    of a request which lasts until it has returned and the Deferred fired.
+
+    :param req: the request, which may not have a trace.
+    :param str phase: what kind of work this is.
+    :param str name: what is doing the work.
+
+    :return Deferred: the result of the call.
+    """
+    trace = getattr(req, "trace", None)
+    if trace is None:
+        return maybeDeferred(f, *args)
+    span = trace.start_span(phase, name)
+    def _done(result):
+        trace.end_span(span)
+        return result
+    return maybeDeferred(f, *args).addBoth(_done)
@@ -16,6 +16,7 @@ from twisted.web.template import (
     tags,
 )
 from allmydata.immutable.upload import FileHandle
+from allmydata.interfaces import IUploadable
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.web.common import (
     get_keypair,
@@ -32,7 +33,13 @@ from allmydata.web import status
 
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
-    uploadable = FileHandle(req.content, client.convergence)
+    if IUploadable.providedBy(req.content):
+        # a large random-key upload, streamed as it arrives
+        uploadable = req.content
+    elif boolean_of_arg(get_arg(req, "random-key", "false")):
+        uploadable = FileHandle(req.content, None)
+    else:
+        uploadable = FileHandle(req.content, client.convergence)
     d = client.upload(uploadable)
     d.addCallback(lambda results: results.get_uri())
     # that fires with the URI of the new file
@@ -5,7 +5,9 @@ from __future__ import annotations
 
 from six import ensure_str
 from typing import IO, Callable, Optional
-import re, time, tempfile
+import re, os, time, tempfile
+from collections import deque
+from functools import partial
 from urllib.parse import parse_qsl, urlencode
 
 from cgi import (
@@ -25,14 +27,24 @@ from twisted.web.server import (
     Site,
 )
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from twisted.internet.address import (
     IPv4Address,
     IPv6Address,
 )
+from zope.interface import implementer
+from eliot import start_action
+
+from allmydata.immutable.upload import BaseUploadable, ConvergentHashingFile
+from allmydata.interfaces import IUploadable
 from allmydata.util import log, fileutil
+from allmydata.util.observer import OneShotObserverList
 
 from allmydata.web import introweb, root
+from allmydata.web.common import WebError, boolean_of_arg, get_arg, get_format
+from allmydata.web.directory import restore_operation
 from allmydata.web.operations import OphandleTable
+from allmydata.web.tracing import RequestTrace, SlowRequests
 
 from .web.storage_plugins import (
     StoragePlugins,
@@ -72,6 +84,133 @@ class FileUploadFieldStorage(FieldStorage):
         self._mime_filename = value
 
 
+# Request bodies at least this big are spooled to a temporary file rather
+# than kept in memory, or streamed if they are uploads which can be.
+LARGE_BODY_SIZE = 1024 * 1024
+
+
+@implementer(IUploadable)
+class StreamingRequestBody(BaseUploadable):
+    """
+    The body of a ``PUT /uri?random-key=true`` request, which is uploaded as
+    an immutable file while it is still arriving.
+
+    The HTTP channel writes the body to me as it is received and the
+    uploader reads it from me as it encodes, so no part of it needs to touch
+    the disk.  When more than ``HIGH_WATER`` bytes are waiting for the
+    uploader, I pause the connection the body is arriving on, and resume it
+    once the uploader has caught up.
+
+    :param size: the length of the body, from its Content-Length.
+    :param producer: the ``IPushProducer`` the body arrives from.
+    """
+    HIGH_WATER = 4 * 1024 * 1024
+    # the key is random, as for a ``FileHandle`` without a convergence secret
+    convergence = None
+
+    def __init__(self, size, producer):
+        self._size = size
+        self._producer = producer
+        self._key = None
+        self._chunks = deque()
+        self._buffered = 0
+        self._consumed = 0
+        self._reads = deque() # (length, Deferred)
+        self._paused = False
+        self._discarding = False
+        self._failure = None
+        self._received = OneShotObserverList()
+
+    def write(self, data):
+        """
+        Called as each piece of the body arrives.
+        """
+        if self._discarding:
+            return
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self._satisfy_reads()
+        if self._buffered >= self.HIGH_WATER and not self._paused:
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def body_received(self):
+        """
+        Called once the whole body has arrived.
+        """
+        self._received.fire(None)
+
+    def is_received(self):
+        return self._received._fired
+
+    def when_received(self):
+        return self._received.when_fired()
+
+    def discard(self):
+        """
+        Throw away the rest of the body, because nothing is going to read
+        it.
+        """
+        self._discarding = True
+        self._chunks.clear()
+        self._buffered = 0
+        self._resume()
+
+    def abort(self, reason):
+        """
+        The body will never arrive in full: fail any reads waiting for it.
+        """
+        self._failure = reason
+        self._satisfy_reads()
+
+    def _resume(self):
+        if self._paused:
+            self._paused = False
+            self._producer.resumeProducing()
+
+    def _satisfy_reads(self):
+        while self._reads:
+            (length, d) = self._reads[0]
+            if self._failure is not None:
+                self._reads.popleft()
+                d.errback(self._failure)
+                continue
+            wanted = min(length, self._size - self._consumed)
+            if self._buffered < wanted:
+                break
+            self._reads.popleft()
+            data = []
+            self._consumed += wanted
+            self._buffered -= wanted
+            while wanted:
+                chunk = self._chunks.popleft()
+                if len(chunk) > wanted:
+                    self._chunks.appendleft(chunk[wanted:])
+                    chunk = chunk[:wanted]
+                data.append(chunk)
+                wanted -= len(chunk)
+            d.callback(data)
+        if self._buffered < self.HIGH_WATER // 2:
+            self._resume()
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def get_encryption_key(self):
+        if self._key is None:
+            self._key = os.urandom(16)
+        return defer.succeed(self._key)
+
+    def read(self, length):
+        d = defer.Deferred()
+        self._reads.append((length, d))
+        self._satisfy_reads()
+        return d
+
+    def close(self):
+        pass
+
+
 class TahoeLAFSRequest(Request, object):
     """
     ``TahoeLAFSRequest`` adds several features to a Twisted Web ``Request``
@@ -82,6 +221,51 @@ class TahoeLAFSRequest(Request, object):
         else, ``None``.
     """
     fields = None
+    # the timings of this request, once processing has started
+    trace = None
+
+    def gotLength(self, length):
+        """
+        Called by channel once the headers have been received.
+
+        Large random-key uploads to ``PUT /uri`` are processed from here on,
+        with the body streamed into the uploader as it arrives.  Everything
+        else is processed once the whole body has been received.
+        """
+        command = getattr(self.channel, "_command", None)
+        path = getattr(self.channel, "_path", None)
+        if command == b"PUT" and length is not None and length >= LARGE_BODY_SIZE:
+            self._parseRequestLine(command, path, self.channel._version)
+            upload = self._immutableUpload()
+            if upload == "random-key" and self.path in (b"/uri", b"/uri/"):
+                self.content = StreamingRequestBody(length, self.channel.transport)
+                self._startProcessing()
+                return
+            if upload == "convergent":
+                # spool it, computing the encryption key on the way
+                self.content = self.channel.site.getConvergentContentFile(length)
+                return
+        Request.gotLength(self, length)
+
+    def _immutableUpload(self):
+        """
+        :return: ``"random-key"`` or ``"convergent"`` if this request uploads
+            an immutable file with that kind of encryption key, else
+            ``None``.
+        """
+        if not (self.path == b"/uri" or self.path.startswith(b"/uri/")):
+            return None
+        try:
+            if get_arg(self, "t", "").strip() != b"":
+                return None
+            if get_format(self, "CHK") != "CHK":
+                return None
+            if boolean_of_arg(get_arg(self, "random-key", "false")):
+                return "random-key"
+        except WebError:
+            # let the usual processing complain about it
+            return None
+        return "convergent"
 
     def requestReceived(self, command, path, version):
         """
@@ -91,19 +275,13 @@ class TahoeLAFSRequest(Request, object):
         and to provide less memory-intensive multipart/form-post handling for
         large file uploads.
         """
-        self.content.seek(0)
-        self.args = {}
-        self.stack = []
-
-        self.method, self.uri = command, path
-        self.clientproto = version
-        x = self.uri.split(b'?', 1)
+        if isinstance(self.content, StreamingRequestBody):
+            # processing began when the headers arrived
+            self.content.body_received()
+            return
 
-        if len(x) == 1:
-            self.path = self.uri
-        else:
-            self.path, argstring = x
-            self.args = parse_qs(argstring, 1)
+        self.content.seek(0)
+        self._parseRequestLine(command, path, version)
 
         content_type = (self.requestHeaders.getRawHeaders("content-type") or [""])[0]
         if self.method == b'POST' and content_type.split(";")[0] in ("multipart/form-data", "application/x-www-form-urlencoded"):
@@ -127,10 +305,76 @@ class TahoeLAFSRequest(Request, object):
                 self.content, headers, environ={'REQUEST_METHOD': 'POST'})
             self.content.seek(0)
 
+        self._startProcessing()
+
+    def _parseRequestLine(self, command, path, version):
+        self.args = {}
+        self.stack = []
+
+        self.method, self.uri = command, path
+        self.clientproto = version
+        x = self.uri.split(b'?', 1)
+
+        if len(x) == 1:
+            self.path = self.uri
+        else:
+            self.path, argstring = x
+            self.args = parse_qs(argstring, 1)
+
+    def _startProcessing(self):
         self._tahoeLAFSSecurityPolicy()
 
         self.processing_started_timestamp = time.time()
-        self.process()
+        self.trace = RequestTrace(self.method, _censored_uri(self.uri),
+                                  self.processing_started_timestamp)
+        # everything logged while handling this request is part of this
+        # action
+        self._action = start_action(
+            action_type=u"allmydata:web:request",
+            method=self.method,
+            uri=self.trace.uri,
+        )
+        self.notifyFinish().addBoth(self._finishTrace)
+        with self._action.context():
+            self.process()
+
+    def _finishTrace(self, result):
+        if isinstance(result, Failure):
+            # the connection was lost before the response was finished
+            self.trace.finish(None)
+            self._action.finish(result.value)
+        else:
+            self.trace.finish(self.code)
+            self._action.add_success_fields(code=self.code)
+            self._action.finish()
+        slow_requests = getattr(self.site, "slow_requests", None)
+        if slow_requests is not None:
+            slow_requests.add(self.trace)
+
+    def write(self, data):
+        if self.trace is None:
+            return Request.write(self, data)
+        start = time.time()
+        Request.write(self, data)
+        self.trace.wrote(start, time.time(), len(data))
+
+    def finish(self):
+        if (isinstance(self.content, StreamingRequestBody)
+            and not self.content.is_received()):
+            # The upload finished (or, more likely, failed) before the whole
+            # body arrived.  The channel cannot take the response until it
+            # has read the rest of the request, so throw that away as it
+            # comes, and only then finish.
+            self.content.discard()
+            self.content.when_received().addCallback(
+                lambda ignored: Request.finish(self))
+            return
+        Request.finish(self)
+
+    def connectionLost(self, reason):
+        if isinstance(self.content, StreamingRequestBody):
+            self.content.abort(reason)
+        Request.connectionLost(self, reason)
 
     def _tahoeLAFSSecurityPolicy(self):
         """
@@ -157,17 +401,17 @@ def _get_client_ip(request):
         return None
 
 
-def _logFormatter(logDateTime, request):
-    # we build up a log string that hides most of the cap, to preserve
-    # user privacy. We retain the query args so we can identify things
-    # like t=json. Then we send it to the flog. We make no attempt to
-    # match apache formatting. TODO: when we move to DSA dirnodes and
-    # shorter caps, consider exposing a few characters of the cap, or
-    # maybe a few characters of its hash.
-    x = request.uri.split(b"?", 1)
+def _censored_uri(uri: bytes) -> bytes:
+    """
+    Hide most of any cap in a request URI, to preserve user privacy. We
+    retain the query args so we can identify things like t=json. TODO:
+    when we move to DSA dirnodes and shorter caps, consider exposing a few
+    characters of the cap, or maybe a few characters of its hash.
+    """
+    x = uri.split(b"?", 1)
     if len(x) == 1:
         # no query args
-        path = request.uri
+        path = uri
         queryargs = b""
     else:
         path, queryargs = x
@@ -178,8 +422,13 @@ def _logFormatter(logDateTime, request):
         path = b"/file/[CENSORED]"
     elif path.startswith(b"/named/"):
         path = b"/named/[CENSORED]"
+    return path + queryargs
 
-    uri = path + queryargs
+
+def _logFormatter(logDateTime, request):
+    # we build up a log string with the caps censored, and send it to the
+    # flog. We make no attempt to match apache formatting.
+    uri = _censored_uri(request.uri)
 
     template = "web: %(clientip)s %(method)s %(uri)s %(code)s %(length)s"
     return template % dict(
@@ -243,25 +492,43 @@ class TahoeLAFSSite(Site, object):
     """
     requestFactory = TahoeLAFSRequest
 
-    def __init__(self, make_tempfile: Callable[[], IO[bytes]], *args, **kwargs):
+    def __init__(self, make_tempfile: Callable[[], IO[bytes]], *args, client=None,
+                 slow_requests: Optional[SlowRequests]=None, **kwargs):
         Site.__init__(self, *args, logFormatter=_logFormatter, **kwargs)
         assert callable(make_tempfile)
         with make_tempfile():
             pass
         self._make_tempfile = make_tempfile
+        self._client = client
+        # if given, the trace of each finished request is offered to this
+        self.slow_requests = slow_requests
 
     def getContentFile(self, length: Optional[int]) -> IO[bytes]:
-        if length is None or length >= 1024 * 1024:
+        if length is None or length >= LARGE_BODY_SIZE:
             return self._make_tempfile()
         return BytesIO()
 
+    def getConvergentContentFile(self, length: int) -> IO[bytes]:
+        """
+        Get a file for a request body which will be uploaded as a convergent
+        immutable file.  If there is a client to supply the convergence
+        secret and encoding parameters, the file computes the encryption key
+        as the body is written to it.
+        """
+        f = self.getContentFile(length)
+        if self._client is None:
+            return f
+        return ConvergentHashingFile(  # type: ignore[return-value]
+            f, length, self._client.convergence,
+            self._client.get_encoding_parameters())
+
 class WebishServer(service.MultiService):
     # The type in Twisted for services is wrong in 22.10...
     # https://github.com/twisted/twisted/issues/10135
     name = "webish"  # type: ignore[assignment]
 
     def __init__(self, client, webport, make_tempfile, nodeurl_path=None, staticdir=None,
-                 clock=None, now_fn=time.time):
+                 clock=None, now_fn=time.time, operations_dir=None):
         service.MultiService.__init__(self)
         # the 'data' argument to all render() methods default to the Client
         # the 'clock' argument to root.Root is, if set, a
@@ -269,20 +536,27 @@ class WebishServer(service.MultiService):
         # so that they can test features that involve the passage of
         # time in a deterministic manner.
 
-        self.root = root.Root(client, clock, now_fn)
-        self.buildServer(webport, make_tempfile, nodeurl_path, staticdir)
+        self.slow_requests = SlowRequests()
+        self.root = root.Root(client, clock, now_fn, self.slow_requests)
+        self.buildServer(webport, make_tempfile, nodeurl_path, staticdir, client,
+                         self.slow_requests)
 
         # If set, clock is a twisted.internet.task.Clock that the tests
         # use to test ophandle expiration.
-        self._operations = OphandleTable(clock)
+        # If set, operations_dir is where the results of long-running
+        # operations are spooled, and kept across restarts.
+        self._operations = OphandleTable(clock, operations_dir)
+        self._operations.restore(partial(restore_operation, client))
         self._operations.setServiceParent(self)
         self.root.putChild(b"operations", self._operations)
 
         self.root.putChild(b"storage-plugins", StoragePlugins(client))
 
-    def buildServer(self, webport, make_tempfile, nodeurl_path, staticdir):
+    def buildServer(self, webport, make_tempfile, nodeurl_path, staticdir, client=None,
+                    slow_requests=None):
         self.webport = webport
-        self.site = TahoeLAFSSite(make_tempfile, self.root)
+        self.site = TahoeLAFSSite(make_tempfile, self.root, client=client,
+                                  slow_requests=slow_requests)
         self.staticdir = staticdir # so tests can check
         if staticdir:
             self.root.putChild(b"static", static.File(staticdir))